@@ -17,6 +17,16 @@ class Settings(BaseSettings):
     smtp_username: Optional[str] = None
     smtp_password: Optional[str] = None
     smtp_use_tls: bool = True
+    smtp_pool_size: int = 2  # Số kết nối SMTP giữ sẵn
+    smtp_timeout_seconds: float = 10
+    
+    # Outbound Mail Queue
+    mail_queue_workers: int = 2
+    mail_max_attempts: int = 5
+    mail_retry_base_seconds: int = 30  # Backoff: 30s, 60s, 120s...
+    mail_queue_poll_seconds: float = 5
+    mail_queue_retention_days: int = 7
+    mail_send_lease_seconds: int = 300  # Job 'sending' quá thời gian này (worker chết giữa chừng) được nhận lại
     
     # CORS Origins
     cors_origins: str = "http://localhost:3000,http://localhost:3001"
@@ -27,25 +37,109 @@ class Settings(BaseSettings):
     
     # File Upload
     max_file_size: int = 10 * 1024 * 1024  # 10MB
+    face_thumbnail_size: int = 160  # Cạnh dài thumbnail ảnh khuôn mặt (px)
+    migrate_face_images_on_startup: bool = True  # Chuyển ảnh base64 inline cũ sang GridFS (chạy nền)
+    embedding_storage_dtype: str = "float16"  # float16 | float32 (BinData trong face_embeddings)
+    migrate_embeddings_on_startup: bool = True  # Chuyển embedding mảng double / base64 cũ sang BinData (chạy nền)
     allowed_image_extensions: List[str] = [".jpg", ".jpeg", ".png", ".webp"]
     
     # Performance
+    preload_models_on_startup: bool = True  # Nạp model InsightFace nền khi khởi động (/ready)
     max_detection_threads: int = 4
     stream_frame_rate: int = 30
     detection_interval: int = 5  # Process every Nth frame
+
+    # ONNX Runtime (áp dụng cho mọi session của FaceAnalysis)
+    onnx_session_profile: bool = True  # False = giữ SessionOptions mặc định của onnxruntime
+    onnx_intra_op_threads: int = 0  # 0 = số core / số worker executor
+    onnx_inter_op_threads: int = 1
+    onnx_graph_optimization: str = "all"  # disable | basic | extended | all
+    onnx_execution_mode: str = "sequential"  # sequential | parallel
+    onnx_enable_mem_arena: bool = True
+    onnx_enable_mem_pattern: bool = True
+    model_warmup_iterations: int = 3  # Số lần chạy ảnh giả mỗi model trước khi báo ready (0 = tắt)
+    model_precision: str = "auto"  # fp32 | int8_dynamic | int8_static | auto (INT8 nếu chỉ có CPU và đã sinh biến thể)
+    quantized_model_dir: str = "data/models"  # Biến thể INT8 (python -m app.utils.model_quantization quantize)
+
+    # Cascade detection (detector nhẹ trước, detector đầy đủ khi cần)
+    cascade_detection: bool = False
+    cascade_det_size: int = 320  # Input tầng nhẹ
+    cascade_detector_model: str = ""  # File ONNX detector nhỏ (vd det_500m.onnx); rỗng = detector chính ở cascade_det_size
+    cascade_threshold: float = 0.3  # det_thresh của detector nhỏ (thấp để không bỏ sót)
+    cascade_full_interval: int = 10  # Cứ N frame AI detect đầy đủ cả frame (0 = không)
+    cascade_roi_margin: float = 0.5  # Nới vùng quanh mặt, theo kích thước mặt
+    cascade_max_roi_ratio: float = 0.5  # Vùng lớn hơn tỉ lệ này của frame → detect cả frame
+
+    # Recognition index
+    recognition_prototype_min_embeddings: int = 2000  # Gallery từ cỡ này trở lên chỉ search prototype
+    recognition_prototype_medoids: int = 1  # Prototype mỗi person = mean + N medoid
+    recognition_rerank_margin: float = 0.1  # Re-rank khi điểm prototype trong ±margin quanh ngưỡng
+    recognition_index_backend: str = "auto"  # auto | flat | hnsw | ivf_flat | ivf_pq
+    recognition_hnsw_min_vectors: int = 20000  # auto: từ cỡ này dùng HNSW
+    recognition_ivf_min_vectors: int = 500000  # auto: từ cỡ này dùng IVF-PQ
+    recognition_hnsw_m: int = 32
+    recognition_hnsw_ef_search: int = 64
+    recognition_ivf_nprobe: int = 16
+    recognition_index_dir: str = "data/recognition_index"  # Lưu index ANN + gallery đã dựng ("" để tắt)
+    recognition_persist_galleries: bool = True  # Gallery theo user (mmap) để khởi động nhanh
+    
+    # Bulk import
+    bulk_import_batch_size: int = 32  # Person mỗi batch (decode + embedding + insert_many)
+    
+    # Enrollment (trích embedding nền khi thêm ảnh)
+    enrollment_workers: int = 1
+    enrollment_max_attempts: int = 3
+    enrollment_poll_seconds: float = 5
+    enrollment_min_face_size: int = 80  # Cạnh ngắn bbox khuôn mặt (px)
+    enrollment_min_sharpness: float = 30  # Phương sai Laplacian vùng mặt
+    enrollment_min_det_score: float = 0.6
+    enrollment_max_yaw: float = 0.45  # Lệch mũi / khoảng cách hai mắt
+    enrollment_max_roll: float = 30  # Độ
+    enrollment_duplicate_similarity: float = 0.95  # Cosine ≥ ngưỡng → ảnh trùng
+    enrollment_max_embeddings: int = 20  # Tối đa embedding mỗi person trong gallery
     
     # Notifications
     alert_cooldown_minutes: int = 5
-    max_alerts_per_hour: int = 20
+    max_alerts_per_hour: int = 20  # Budget email cảnh báo mỗi user
+    alert_digest_window_seconds: int = 30  # Cửa sổ gom cảnh báo người lạ
+    alert_digest_max_events: int = 50
+    alert_digest_max_faces: int = 12
+    alert_digest_tile_size: int = 112
+    notification_cache_ttl_seconds: int = 300  # Cache settings/email/camera khi dựng cảnh báo
+    
+    # WebSocket hub
+    websocket_queue_size: int = 100  # Message chờ gửi tối đa mỗi connection, đầy → ngắt client chậm
+    websocket_send_timeout_seconds: float = 5
+    
+    # Multi-worker: event bus + state dùng chung ("memory" = một worker, "mongo" = nhiều worker)
+    event_bus_backend: str = "memory"
+    event_bus_capped_size_mb: int = 16
+    state_backend: str = "memory"
+    
+    # Webhooks
+    webhook_signing_secret: Optional[str] = None  # Mặc định khi user không đặt webhook_secret
+    webhook_max_concurrency: int = 4  # Request đồng thời tối đa mỗi endpoint
+    webhook_queue_size: int = 1000  # Sự kiện chờ tối đa mỗi endpoint, vượt → dead-letter
+    webhook_timeout_seconds: float = 10
+    webhook_max_attempts: int = 5
+    webhook_retry_base_seconds: float = 2
+    webhook_batch_size: int = 1  # > 1: gom nhiều sự kiện vào một request
+    webhook_batch_window_seconds: float = 2
     
     # Development settings
     development_mode: bool = False
     bypass_email_cooldown: bool = False
     
     # Data Retention
+    detection_logs_retention_enabled: bool = False  # Opt-in: job xóa log cũ kèm file ảnh, trừ bộ đếm
     detection_logs_retention_days: int = 30
+    detection_logs_retention_interval_minutes: int = 60
     auto_cleanup_enabled: bool = True
     
+    # Database Indexes
+    ensure_indexes_on_startup: bool = True
+    explain_queries_on_startup: bool = False
+    
     # Security
     max_login_attempts: int = 5
     login_lockout_minutes: int = 15
@@ -1,12 +1,19 @@
+import time
+_import_started = time.perf_counter()
+
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import JSONResponse
 from .routers import auth, camera, person, admin, detection, stream, websocket, settings, alerts, detection_optimizer, user, test_email, notifications
 from .database import startup_db_client, shutdown_db_client
+from .config import get_settings
+import asyncio
 import logging
 import os
-import time
+
+# Thời gian import app + routers (không gồm nạp model, xem face_processor.warm_up)
+import_seconds = round(time.perf_counter() - _import_started, 3)
 
 # ✅ Setup enhanced logging
 logging.basicConfig(
@@ -92,10 +99,154 @@ async def startup_event():
     except Exception as e:
         logger.error(f"❌ Database connection failed: {e}")
         raise
+    
+    logger.info(f"⏱️ App modules imported in {import_seconds}s")
+    
+    # Nạp model nhận dạng nền, /ready báo khi xong
+    try:
+        from .services.face_processor import face_processor
+        if get_settings().preload_models_on_startup:
+            face_processor.ensure_loading()
+    except Exception as e:
+        logger.warning(f"⚠️ Model warm-up failed: {e}")
+    
+    # Index MongoDB cho các truy vấn chính
+    try:
+        from .services.index_service import index_service
+        app_settings = get_settings()
+        if app_settings.ensure_indexes_on_startup:
+            await index_service.ensure_indexes()
+        report = await index_service.report_indexes()
+        missing = {name: info["missing"] for name, info in report.items() if info["missing"]}
+        if missing:
+            logger.warning(f"⚠️ Missing indexes: {missing}")
+        else:
+            logger.info("✅ Database indexes ready")
+        if app_settings.explain_queries_on_startup:
+            for plan in await index_service.explain_queries():
+                if plan.get("uses_collection_scan"):
+                    logger.warning(f"⚠️ Query '{plan['query']}' uses COLLSCAN on {plan['collection']}")
+    except Exception as e:
+        logger.warning(f"⚠️ Database index setup failed: {e}")
+    
+    # Detection counters (rollup) cho dashboard stats
+    try:
+        from .services.detection_counter_service import detection_counter_service
+        asyncio.create_task(detection_counter_service.rebuild_if_empty())
+        logger.info("✅ Detection counters ready")
+    except Exception as e:
+        logger.warning(f"⚠️ Detection counters setup failed: {e}")
+    
+    # Retention detection_logs (opt-in, xóa kèm file ảnh và trừ bộ đếm)
+    try:
+        from .services.detection_service import detection_service
+        detection_service.start_retention_task()
+    except Exception as e:
+        logger.warning(f"⚠️ Detection retention startup failed: {e}")
+    
+    # Event bus giữa các worker
+    try:
+        from .services.event_bus import event_bus
+        await event_bus.start()
+    except Exception as e:
+        logger.warning(f"⚠️ Event bus startup failed: {e}")
+    
+    # Email templates (compile một lần)
+    try:
+        from .services.email_template_service import email_template_service
+        email_template_service.compile_all()
+    except Exception as e:
+        logger.warning(f"⚠️ Email template compilation failed: {e}")
+    
+    # Mail queue workers
+    try:
+        from .services.mail_queue_service import mail_queue_service
+        await mail_queue_service.start()
+    except Exception as e:
+        logger.warning(f"⚠️ Mail queue startup failed: {e}")
+    
+    # Chuyển ảnh khuôn mặt inline cũ sang GridFS
+    try:
+        from .services.face_image_store import face_image_store
+        if get_settings().migrate_face_images_on_startup:
+            asyncio.create_task(face_image_store.migrate_inline_images())
+    except Exception as e:
+        logger.warning(f"⚠️ Face image migration failed: {e}")
+    
+    # Chuyển embedding cũ sang định dạng BinData
+    try:
+        from .services.person_service import person_service
+        if get_settings().migrate_embeddings_on_startup:
+            asyncio.create_task(person_service.migrate_embedding_storage())
+    except Exception as e:
+        logger.warning(f"⚠️ Embedding migration failed: {e}")
+    
+    # Bulk import job bị gián đoạn
+    try:
+        from .services.bulk_import_service import bulk_import_service
+        await bulk_import_service.recover_jobs()
+    except Exception as e:
+        logger.warning(f"⚠️ Bulk import recovery failed: {e}")
+    
+    # Gallery nhận dạng đã lưu trên đĩa (mmap, kiểm tra version với Mongo)
+    try:
+        from .services.recognition_index import recognition_index
+        await recognition_index.warm_start()
+    except Exception as e:
+        logger.warning(f"⚠️ Recognition index warm start failed: {e}")
+    
+    # Enrollment workers (trích embedding ảnh mới thêm)
+    try:
+        from .services.enrollment_service import enrollment_service
+        await enrollment_service.start()
+    except Exception as e:
+        logger.warning(f"⚠️ Enrollment startup failed: {e}")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Đóng kết nối database khi shutdown app"""
+    try:
+        from .services.alert_digest_service import alert_digest_service
+        await alert_digest_service.flush_all()
+    except Exception as e:
+        logger.warning(f"⚠️ Alert digest flush failed: {e}")
+    
+    try:
+        from .services.detection_service import detection_service
+        await detection_service.stop_retention_task()
+    except Exception as e:
+        logger.warning(f"⚠️ Detection retention shutdown failed: {e}")
+    
+    try:
+        from .services.webhook_service import webhook_dispatcher
+        await webhook_dispatcher.close()
+    except Exception as e:
+        logger.warning(f"⚠️ Webhook dispatcher shutdown failed: {e}")
+    
+    try:
+        from .services.bulk_import_service import bulk_import_service
+        await bulk_import_service.stop()
+    except Exception as e:
+        logger.warning(f"⚠️ Bulk import shutdown failed: {e}")
+    
+    try:
+        from .services.enrollment_service import enrollment_service
+        await enrollment_service.stop()
+    except Exception as e:
+        logger.warning(f"⚠️ Enrollment shutdown failed: {e}")
+    
+    try:
+        from .services.mail_queue_service import mail_queue_service
+        await mail_queue_service.stop()
+    except Exception as e:
+        logger.warning(f"⚠️ Mail queue shutdown failed: {e}")
+    
+    try:
+        from .services.event_bus import event_bus
+        await event_bus.stop()
+    except Exception as e:
+        logger.warning(f"⚠️ Event bus shutdown failed: {e}")
+    
     try:
         await shutdown_db_client()
         logger.info("✅ Database disconnected successfully")
@@ -171,7 +322,8 @@ async def root():
         "version": "1.0.0",
         "status": "running",
         "docs": "/docs",
-        "health": "/health"
+        "health": "/health",
+        "ready": "/ready"
     }
 
 # Health check endpoint
@@ -183,6 +335,19 @@ async def health_check():
         "uptime": f"{time.time() - start_time:.2f} seconds" if 'start_time' in globals() else "unknown"
     }
 
+# Readiness endpoint: 503 cho tới khi model nhận dạng nạp xong
+@app.get("/ready")
+async def readiness_check():
+    from .services.face_processor import face_processor
+    
+    body = {
+        "ready": face_processor.is_ready,
+        "models": face_processor.get_status(),
+        "import_seconds": import_seconds,
+        "timestamp": time.time()
+    }
+    return JSONResponse(status_code=200 if face_processor.is_ready else 503, content=body)
+
 # Debug endpoint
 @app.get("/debug/headers")
 async def debug_headers(request: Request):
@@ -51,6 +51,8 @@ class DetectionFilter(BaseModel):
     end_date: Optional[datetime] = None
     limit: int = Field(50, ge=1, le=1000)  # Tăng limit lên 1000
     offset: int = Field(0, ge=0)
+    page: int = Field(1, ge=1)
+    cursor: Optional[str] = None  # Keyset pagination token (ưu tiên hơn offset/page)
 
 class DetectionLog(BaseModel):
     id: str
@@ -9,7 +9,9 @@ class FaceImage(BaseModel):
     embedding: Optional[List[float]] = None
 
 class FaceImageResponse(BaseModel):
-    image_url: str
+    image_id: Optional[str] = None
+    image_url: str  # Thumbnail (data URL)
+    full_image_url: Optional[str] = None  # Ảnh gốc: GET /api/persons/{id}/images/{image_id}
     uploaded_at: datetime
 
 class KnownPersonCreate(BaseModel):
@@ -87,8 +89,9 @@ class KnownPerson(BaseModel):
     employee_id: Optional[str] = None
     position: Optional[str] = None
     access_level: Optional[str] = None
-    face_images: List[str] = []  # Base64 encoded images
-    face_embeddings: List[List[float]] = []  # Face embeddings
+    face_image_refs: List[Dict[str, Any]] = []  # Ảnh trên GridFS (xem face_image_store)
+    face_embeddings: List[Any] = []  # BinData float16/float32 theo vị trí ảnh (xem utils/embedding_codec)
+    embedding_format: int = 1
     is_active: bool = True
     created_at: datetime
     updated_at: datetime
@@ -1,11 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from typing import List, Dict, Any
+from bson import ObjectId
 from ..models.user import User
 from ..services.admin_service import admin_service
 from ..services.auth_service import get_admin_user
 from pydantic import BaseModel
 import time
-import time
+import asyncio
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
@@ -166,7 +167,7 @@ async def get_detection_tracking_overview(
             camera_id = str(camera["_id"])
             camera_name = camera.get("name", "Unknown")
             
-            presence_info = detection_tracker.get_presence_info(camera_id)
+            presence_info = await detection_tracker.get_shared_presence_info(camera_id)
             
             if presence_info:
                 cameras_with_activity += 1
@@ -200,8 +201,8 @@ async def reset_detection_tracking(
     try:
         from ..services.detection_tracker import detection_tracker
         
-        # Reset all presences
-        detection_tracker.presences.clear()
+        # Reset all presences (mọi worker)
+        await detection_tracker.reset()
         
         return {
             "message": "Detection tracking reset successfully",
@@ -213,4 +214,261 @@ async def reset_detection_tracking(
         raise HTTPException(
             status_code=500,
             detail=f"Failed to reset detection tracking: {str(e)}"
-        )
\ No newline at end of file
+        )
+@router.post("/detection-counters/rebuild")
+async def rebuild_detection_counters(
+    current_admin: User = Depends(get_admin_user)
+):
+    """Tính lại bộ đếm detection (rollup) từ detection_logs"""
+    try:
+        from ..services.detection_counter_service import detection_counter_service
+        
+        rebuilt = await detection_counter_service.rebuild_counters()
+        
+        return {
+            "message": "Detection counters rebuilt successfully",
+            "buckets": rebuilt,
+            "timestamp": time.time()
+        }
+        
+    except Exception as e:
+        print(f"❌ Error rebuilding detection counters: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to rebuild detection counters: {str(e)}"
+        )
+
+@router.get("/indexes")
+async def get_index_report(
+    current_admin: User = Depends(get_admin_user)
+):
+    """Báo cáo index thiếu / không được sử dụng"""
+    try:
+        from ..services.index_service import index_service
+        
+        return {
+            "collections": await index_service.report_indexes(),
+            "timestamp": time.time()
+        }
+        
+    except Exception as e:
+        print(f"❌ Error getting index report: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to get index report: {str(e)}"
+        )
+
+@router.post("/indexes/ensure")
+async def ensure_indexes(
+    current_admin: User = Depends(get_admin_user)
+):
+    """Tạo lại các index đã khai báo"""
+    try:
+        from ..services.index_service import index_service
+        
+        created = await index_service.ensure_indexes()
+        
+        return {
+            "message": "Indexes ensured successfully",
+            "indexes": created,
+            "timestamp": time.time()
+        }
+        
+    except Exception as e:
+        print(f"❌ Error ensuring indexes: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to ensure indexes: {str(e)}"
+        )
+
+@router.get("/indexes/explain")
+async def explain_queries(
+    user_id: str = None,
+    current_admin: User = Depends(get_admin_user)
+):
+    """Kiểm tra query plan của các truy vấn chính"""
+    try:
+        from ..services.index_service import index_service
+        
+        plans = await index_service.explain_queries(user_id)
+        
+        return {
+            "plans": plans,
+            "collection_scans": [plan["query"] for plan in plans if plan.get("uses_collection_scan")],
+            "timestamp": time.time()
+        }
+        
+    except Exception as e:
+        print(f"❌ Error explaining queries: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to explain queries: {str(e)}"
+        )
+
+@router.get("/mail-queue")
+async def get_mail_queue_stats(
+    current_admin: User = Depends(get_admin_user)
+):
+    """Trạng thái hàng đợi email gửi đi"""
+    try:
+        from ..services.mail_queue_service import mail_queue_service
+        
+        return {
+            "queue": await mail_queue_service.get_queue_stats(),
+            "timestamp": time.time()
+        }
+        
+    except Exception as e:
+        print(f"❌ Error getting mail queue stats: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to get mail queue stats: {str(e)}"
+        )
+
+@router.get("/email-templates/benchmark")
+async def benchmark_email_templates(
+    iterations: int = Query(200, ge=1, le=5000),
+    image_bytes: int = Query(150_000, ge=0, le=5_000_000),
+    current_admin: User = Depends(get_admin_user)
+):
+    """Đo thời gian render template + dựng MIME cho mỗi email cảnh báo"""
+    try:
+        from ..services.email_template_service import email_template_service
+        
+        result = await asyncio.to_thread(email_template_service.benchmark, iterations, image_bytes)
+        
+        return {
+            "benchmark": result,
+            "timestamp": time.time()
+        }
+        
+    except Exception as e:
+        print(f"❌ Error benchmarking email templates: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to benchmark email templates: {str(e)}"
+        )
+
+@router.post("/webhooks/redeliver")
+async def redeliver_webhooks(
+    limit: int = 50,
+    current_admin: User = Depends(get_admin_user)
+):
+    """Đưa các webhook trong dead-letter collection vào hàng gửi lại (chạy nền)"""
+    try:
+        from ..services.webhook_service import webhook_dispatcher
+        
+        result = await webhook_dispatcher.redeliver_dead_letters(limit)
+        
+        return {
+            "message": "Dead-letter webhooks queued for redelivery",
+            **result,
+            "timestamp": time.time()
+        }
+        
+    except Exception as e:
+        print(f"❌ Error redelivering webhooks: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to redeliver webhooks: {str(e)}"
+        )
+
+@router.post("/face-images/migrate")
+async def migrate_face_images(
+    current_admin: User = Depends(get_admin_user)
+):
+    """Chuyển ảnh khuôn mặt base64 inline trong known_persons sang GridFS"""
+    try:
+        from ..services.face_image_store import face_image_store
+        
+        result = await face_image_store.migrate_inline_images()
+        
+        return {
+            "message": "Face images migrated successfully",
+            **result,
+            "timestamp": time.time()
+        }
+        
+    except Exception as e:
+        print(f"❌ Error migrating face images: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to migrate face images: {str(e)}"
+        )
+
+@router.get("/recognition-index")
+async def get_recognition_index_stats(
+    current_admin: User = Depends(get_admin_user)
+):
+    """Gallery nhận dạng đang nạp trong bộ nhớ và hàng đợi enrollment"""
+    try:
+        from ..services.recognition_index import recognition_index
+        from ..services.enrollment_service import enrollment_service
+        
+        counts = {"pending": 0, "processing": 0, "done": 0, "failed": 0}
+        async for row in enrollment_service.collection.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+            counts[row["_id"]] = row["count"]
+        
+        return {
+            "index": recognition_index.get_stats(),
+            "enrollment_jobs": counts,
+            "timestamp": time.time()
+        }
+        
+    except Exception as e:
+        print(f"❌ Error getting recognition index stats: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to get recognition index stats: {str(e)}"
+        )
+
+@router.get("/recognition-index/benchmark")
+async def benchmark_recognition_index(
+    user_id: str,
+    queries: int = Query(200, ge=1, le=10000),
+    noise: float = Query(0.02, ge=0, le=1),
+    current_admin: User = Depends(get_admin_user)
+):
+    """Recall@1 và latency của index nhận dạng (ANN) so với tìm kiếm exact (FlatIP)"""
+    try:
+        from ..services.recognition_index import recognition_index
+        
+        if not ObjectId.is_valid(user_id):
+            raise HTTPException(status_code=400, detail="Invalid user id")
+        
+        return {
+            "report": await recognition_index.benchmark(user_id, queries, noise),
+            "timestamp": time.time()
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Error benchmarking recognition index: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to benchmark recognition index: {str(e)}"
+        )
+
+@router.post("/face-embeddings/migrate")
+async def migrate_face_embeddings(
+    current_admin: User = Depends(get_admin_user)
+):
+    """Chuyển face_embeddings cũ (mảng double / base64) sang BinData float16/float32"""
+    try:
+        from ..services.person_service import person_service
+        
+        result = await person_service.migrate_embedding_storage()
+        
+        return {
+            "message": "Face embeddings migrated successfully",
+            **result,
+            "timestamp": time.time()
+        }
+        
+    except Exception as e:
+        print(f"❌ Error migrating face embeddings: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to migrate face embeddings: {str(e)}"
+        )
@@ -7,6 +7,7 @@ from app.database import get_db
 from app.models.detection_log import DetectionLog
 from app.models.user import User
 from app.services.auth_service import get_current_user
+from app.utils.pagination import apply_cursor, keyset_sort, split_page
 
 router = APIRouter()
 
@@ -60,11 +61,14 @@ async def get_alerts(
     skip: int = Query(0, ge=0),
     limit: int = Query(50, ge=1, le=100),
     alert_type: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None, description="Continuation token (next_cursor của trang trước)"),
     db = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
     """
     Get alerts (detection events that need attention)
+    
+    Dùng `cursor` để phân trang keyset trên (timestamp, _id); `skip` giữ lại cho tương thích.
     """
     try:
         # Build MongoDB query
@@ -79,22 +83,26 @@ async def get_alerts(
         total = await db["detection_logs"].count_documents(query)
         
         # Get alerts with pagination
-        cursor = db["detection_logs"].find(query).sort("timestamp", -1).skip(skip).limit(limit)
+        page_query = apply_cursor(dict(query), cursor)
+        find_cursor = db["detection_logs"].find(page_query).sort(keyset_sort())
+        if not cursor:
+            find_cursor = find_cursor.skip(skip)
+        alerts, next_cursor = split_page(await find_cursor.limit(limit + 1).to_list(length=limit + 1), limit)
+        
+        # Lấy tên camera một lần cho cả trang
+        camera_ids = list({alert["camera_id"] for alert in alerts if alert.get("camera_id")})
+        camera_names = {}
+        if camera_ids:
+            async for camera in db["cameras"].find({"_id": {"$in": camera_ids}}, {"name": 1}):
+                camera_names[camera["_id"]] = camera.get("name", "Unknown")
         
         # Convert to response format
         alert_list = []
-        async for alert in cursor:
-            # Get camera name
-            camera_name = "Unknown"
-            if "camera_id" in alert:
-                camera = await db["cameras"].find_one({"id": alert["camera_id"]})
-                if camera and "name" in camera:
-                    camera_name = camera["name"]
-                    
+        for alert in alerts:
             alert_data = {
-                "id": str(alert["id"]),
+                "id": str(alert["_id"]),
                 "camera_id": str(alert.get("camera_id", "")),
-                "camera_name": camera_name,
+                "camera_name": camera_names.get(alert.get("camera_id"), "Unknown"),
                 "detection_type": alert.get("detection_type", "unknown"),
                 "person_name": alert.get("person_name"),
                 "confidence": alert.get("confidence", 0.0),
@@ -112,10 +120,13 @@ async def get_alerts(
             "total": total,
             "skip": skip,
             "limit": limit,
-            "has_next": skip + limit < total,
-            "has_prev": skip > 0
+            "has_next": next_cursor is not None,
+            "has_prev": skip > 0 or cursor is not None,
+            "next_cursor": next_cursor
         }
         
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
-from fastapi import Request
+from fastapi import Request, Response
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
+from bson.errors import InvalidId
 from ..models.detection_log import DetectionLogCreate, DetectionLogResponse, DetectionStats, DetectionFilter
 from ..models.user import User
 from ..services.detection_service import detection_service
@@ -31,15 +32,17 @@ async def create_detection(
 # ✅ MAIN ROUTE - với trailing slash
 @router.get("/", response_model=List[DetectionLogResponse])
 async def get_detections(
+    response: Response,
     camera_id: Optional[str] = Query(None),
     detection_type: Optional[str] = Query(None),
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     limit: int = Query(50, ge=1, le=1000),  # Tăng limit lên 1000
     offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None, description="Continuation token từ header X-Next-Cursor"),
     current_user: User = Depends(get_current_active_user)
 ):
-    """Lấy danh sách detection logs"""
+    """Lấy danh sách detection logs (cursor pagination, offset giữ lại cho tương thích)"""
     try:
         print(f"🔵 Getting detections for user: {current_user.id}")
         print(f"🔵 Filters: camera_id={camera_id}, type={detection_type}, limit={limit}")
@@ -77,10 +80,14 @@ async def get_detections(
             start_date=start_datetime,
             end_date=end_datetime,
             limit=limit,
-            offset=offset
+            offset=offset,
+            cursor=cursor
         )
 
-        detections = await detection_service.get_user_detections(str(current_user.id), filter_data)
+        page = await detection_service.get_user_detections_page(str(current_user.id), filter_data)
+        detections = page["detections"]
+        if page["next_cursor"]:
+            response.headers["X-Next-Cursor"] = page["next_cursor"]
         print(f"✅ Found {len(detections)} detections")
 
         # Debug: Log first detection details if any
@@ -111,6 +118,8 @@ async def get_detections(
                       f"image_path='{det.get('image_path')}'")
 
         return detections
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(f"❌ Error getting detections: {e}")
         import traceback
@@ -250,47 +259,68 @@ async def get_detection_chart_data(
         print(f"❌ Error getting chart data: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _gzip_stream(chunks):
+    """Nén gzip từng chunk của stream export"""
+    import zlib
+    
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> định dạng gzip
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
 @router.get("/stats/export")
 async def export_detection_stats(
     time_range: str = Query("7d", regex="^(24h|7d|30d|90d)$"),
-    format: str = Query("csv", regex="^(csv|json)$"),
+    format: str = Query("csv", regex="^(csv|json|ndjson)$"),
     camera_id: Optional[str] = Query(None),
     detection_type: Optional[str] = Query(None),
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
+    compress: bool = Query(False, description="Nén file export bằng gzip"),
+    batch_size: int = Query(1000, ge=100, le=10000),
     current_user: User = Depends(get_current_active_user)
 ):
-    """Export thống kê detection"""
+    """Export thống kê detection (streaming)"""
     try:
-        from fastapi.responses import Response
+        from fastapi.responses import StreamingResponse
+        start_datetime = datetime.fromisoformat(start_date) if start_date else None
+        end_datetime = datetime.fromisoformat(end_date) if end_date else None
         
-        data = await detection_service.export_stats(
-            str(current_user.id), 
-            time_range, 
-            format,
+        query = detection_service.build_export_query(
+            str(current_user.id),
+            time_range,
             camera_id,
             detection_type,
-            start_date,
-            end_date
+            start_datetime,
+            end_datetime
         )
+        chunks = detection_service.stream_export(str(current_user.id), query, format, batch_size)
         
-        if format == "csv":
-            return Response(
-                content=data,
-                media_type="text/csv",
-                headers={
-                    "Content-Disposition": f"attachment; filename=detections_{time_range}.csv"
-                }
-            )
-        else:
-            return Response(
-                content=data,
-                media_type="application/json",
-                headers={
-                    "Content-Disposition": f"attachment; filename=detections_{time_range}.json"
-                }
-            )
-            
+        media_types = {
+            "csv": "text/csv",
+            "json": "application/json",
+            "ndjson": "application/x-ndjson"
+        }
+        filename = f"detections_{time_range}.{format}"
+        media_type = media_types[format]
+        
+        if compress:
+            chunks = _gzip_stream(chunks)
+            filename += ".gz"
+            media_type = "application/gzip"
+        
+        return StreamingResponse(
+            chunks,
+            media_type=media_type,
+            headers={
+                "Content-Disposition": f"attachment; filename={filename}"
+            }
+        )
+        
+    except (ValueError, InvalidId) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid export parameters: {str(e)}")
     except Exception as e:
         print(f"❌ Error exporting stats: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -304,7 +334,7 @@ async def get_detection_tracking_status(
     try:
         from ..services.detection_tracker import detection_tracker
         
-        presence_info = detection_tracker.get_presence_info(camera_id)
+        presence_info = await detection_tracker.get_shared_presence_info(camera_id)
         
         return {
             "camera_id": camera_id,
@@ -329,6 +359,7 @@ async def get_detection_history(
     date_to: Optional[datetime] = Query(None),
     page: int = Query(1, ge=1),
     limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="Continuation token (next_cursor của trang trước)"),
     current_user: User = Depends(get_current_active_user)
 ):
     """Lấy lịch sử detection"""
@@ -336,10 +367,11 @@ async def get_detection_history(
         filters = DetectionFilter(
             detection_type=detection_type,
             camera_id=camera_id,
-            date_from=date_from,
-            date_to=date_to,
+            start_date=date_from,
+            end_date=date_to,
             page=page,
-            limit=limit
+            limit=limit,
+            cursor=cursor
         )
         
         # Sử dụng detection_optimizer nếu có thể, nếu không, fallback về detection_service
@@ -362,12 +394,14 @@ async def get_detection_history(
                 
             skip = (page - 1) * limit
             
-            sessions = await detection_optimizer.get_sessions(
+            sessions_page = await detection_optimizer.get_sessions_page(
                 user_id=current_user.id,
                 filters=optimizer_filters,
                 limit=limit,
-                skip=skip
+                skip=skip,
+                cursor=cursor
             )
+            sessions = sessions_page["sessions"]
             
             stats = await detection_optimizer.get_session_stats(user_id=current_user.id)
             
@@ -393,14 +427,19 @@ async def get_detection_history(
                 "known_persons": stats.get("known_person_sessions", 0),
                 "strangers": stats.get("stranger_sessions", 0),
                 "page": page,
-                "limit": limit
+                "limit": limit,
+                "next_cursor": sessions_page["next_cursor"]
             }
             
+        except ValueError:
+            raise
         except Exception as optimizer_error:
             print(f"Warning: Detection optimizer failed, falling back to standard service: {optimizer_error}")
             # Fallback to regular detection service
             return await detection_service.get_detections(str(current_user.id), filters)
             
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500,
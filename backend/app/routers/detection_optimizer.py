@@ -56,6 +56,7 @@ async def get_optimized_detection_history(
     date_to: Optional[datetime] = Query(None),
     page: int = Query(1, ge=1),
     limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
     current_user: User = Depends(get_current_active_user)
 ):
     if detection_optimizer is None:
@@ -75,12 +76,14 @@ async def get_optimized_detection_history(
         # Calculate skip for pagination
         skip = (page - 1) * limit
         
-        sessions = await detection_optimizer.get_sessions(
+        sessions_page = await detection_optimizer.get_sessions_page(
             user_id=current_user.id,
             filters=filters,
             limit=limit,
-            skip=skip
+            skip=skip,
+            cursor=cursor
         )
+        sessions = sessions_page["sessions"]
         
         stats = await detection_optimizer.get_session_stats(
             user_id=current_user.id
@@ -91,9 +94,12 @@ async def get_optimized_detection_history(
             "stats": stats,
             "total_count": len(sessions),
             "page": page,
-            "limit": limit
+            "limit": limit,
+            "next_cursor": sessions_page["next_cursor"]
         }
         
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500,
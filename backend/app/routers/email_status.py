@@ -20,7 +20,7 @@ async def get_email_status(
     current_time = datetime.utcnow()
     
     # Kiểm tra cooldown
-    last_alert_time = notification_service.alert_cooldown.get(cooldown_key)
+    last_alert_time = (await notification_service.get_alert_cooldowns(user_id)).get(cooldown_key)
     cooldown_remaining = 0
     
     if last_alert_time:
@@ -52,11 +52,9 @@ async def reset_email_cooldown(
     """Reset email cooldown cho camera (chỉ dành cho admin hoặc dev mode)"""
     
     user_id = str(current_user.id)
-    cooldown_key = f"{user_id}_{camera_id}_stranger_email"
     
     # Reset cooldown
-    if cooldown_key in notification_service.alert_cooldown:
-        del notification_service.alert_cooldown[cooldown_key]
+    await notification_service.clear_alert_cooldowns(user_id, camera_id)
     
     return {
         "status": "success",
@@ -75,7 +73,7 @@ async def get_email_statistics(
     # Đếm số camera có cooldown active
     active_cooldowns = []
     
-    for key, last_time in notification_service.alert_cooldown.items():
+    for key, last_time in (await notification_service.get_alert_cooldowns(user_id)).items():
         if key.startswith(f"{user_id}_") and key.endswith("_stranger_email"):
             camera_id = key.split(f"{user_id}_")[1].split("_stranger_email")[0]
             remaining_seconds = max(0, 60 - (current_time - last_time).total_seconds())
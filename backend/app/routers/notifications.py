@@ -2,6 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException
 from typing import Dict, Any
 from ..services.auth_service import get_current_user
 from ..services.notification_service import notification_service
+from ..services.alert_digest_service import alert_digest_service
 from ..models.user import User
 
 router = APIRouter(prefix="/api/notifications", tags=["notifications"])
@@ -97,6 +98,16 @@ async def get_notification_settings(current_user: User = Depends(get_current_use
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/digest-status")
+async def get_digest_status(current_user: User = Depends(get_current_user)) -> Dict[str, Any]:
+    """
+    Get pending alert digest and remaining email budget
+    """
+    try:
+        return {"success": True, "digest": await alert_digest_service.get_status(str(current_user.id))}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.post("/reset-cooldown")
 async def reset_email_cooldown(current_user: User = Depends(get_current_user)) -> Dict[str, Any]:
     """
@@ -105,15 +116,13 @@ async def reset_email_cooldown(current_user: User = Depends(get_current_user)) -
     try:
         # Clear cooldown for this user
         user_id = str(current_user.id)
-        keys_to_remove = [key for key in notification_service.alert_cooldown.keys() if user_id in key]
-        
-        for key in keys_to_remove:
-            del notification_service.alert_cooldown[key]
+        cleared_keys = await notification_service.clear_alert_cooldowns(user_id)
+        await alert_digest_service.reset_budget(user_id)
         
         return {
             "success": True, 
             "message": f"Email cooldown reset for user {current_user.email}",
-            "cleared_keys": len(keys_to_remove)
+            "cleared_keys": cleared_keys
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -124,10 +133,7 @@ async def force_test_stranger_email(current_user: User = Depends(get_current_use
     Force send test stranger email (bypass cooldown)
     """
     try:
-        # Temporarily clear cooldown
         user_id = str(current_user.id)
-        old_cooldowns = notification_service.alert_cooldown.copy()
-        notification_service.alert_cooldown.clear()
         
         # Sample detection data
         sample_detections = [
@@ -184,17 +190,10 @@ async def force_test_stranger_email(current_user: User = Depends(get_current_use
         #     image_data=None
         # )
         
-        # Restore original cooldowns (but not the test one)
-        for key, value in old_cooldowns.items():
-            if "force_test" not in key:
-                notification_service.alert_cooldown[key] = value
-        
         if email_sent:
             return {"success": True, "message": "Force test email sent successfully (bypassed cooldown)"}
         else:
             return {"success": False, "message": "Failed to send force test email"}
             
     except Exception as e:
-        # Restore cooldowns on error
-        notification_service.alert_cooldown = old_cooldowns
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,10 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Query
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Query, Response
 from typing import List, Optional, Dict, Any
 from bson import ObjectId
 from datetime import datetime
 from ..models.known_person import KnownPersonCreate, KnownPersonUpdate, KnownPersonResponse, AddFaceImageRequest
 from ..models.user import User
 from ..services.person_service import person_service
+from ..services.bulk_import_service import bulk_import_service
+from ..services.enrollment_service import enrollment_service
 from ..services.auth_service import get_current_active_user
 
 router = APIRouter(prefix="/persons", tags=["persons"])
@@ -191,6 +193,23 @@ async def upload_face_image(
         print(f"❌ Error uploading face image: {e}")
         raise HTTPException(status_code=500, detail="Failed to upload face image")
 
+@router.get("/{person_id}/images/{image_id}")
+async def get_face_image(
+    person_id: str,
+    image_id: str,
+    thumbnail: bool = False,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Tải ảnh khuôn mặt gốc (hoặc thumbnail) từ kho ảnh"""
+    image_data = await person_service.get_face_image(person_id, image_id, str(current_user.id), thumbnail)
+    if image_data is None:
+        raise HTTPException(status_code=404, detail="Face image not found")
+    return Response(
+        content=image_data,
+        media_type="image/jpeg",
+        headers={"Cache-Control": "private, max-age=86400"}
+    )
+
 @router.post("/{person_id}/regenerate-embeddings")
 async def regenerate_face_embeddings(
     person_id: str,
@@ -296,6 +315,69 @@ async def bulk_import_persons(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Bulk import failed: {str(e)}")
     
+@router.post("/bulk-import/jobs")
+async def start_bulk_import_job(
+    request: Dict[str, List[Dict[str, Any]]],
+    current_user: User = Depends(get_current_active_user)
+):
+    """Tạo job bulk import chạy nền (theo dõi qua polling hoặc WebSocket bulk_import_progress)"""
+    try:
+        persons_data = request.get("persons", [])
+        if not persons_data:
+            raise HTTPException(status_code=400, detail="No persons data provided")
+        
+        return await bulk_import_service.start_job(persons_data, str(current_user.id))
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Error starting bulk import job: {e}")
+        raise HTTPException(status_code=500, detail=f"Bulk import failed: {str(e)}")
+
+@router.get("/bulk-import/jobs")
+async def list_bulk_import_jobs(
+    limit: int = Query(20, ge=1, le=100),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Danh sách job bulk import gần nhất"""
+    return await bulk_import_service.list_jobs(str(current_user.id), limit)
+
+@router.get("/bulk-import/jobs/{job_id}")
+async def get_bulk_import_job(
+    job_id: str,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Tiến độ job bulk import"""
+    job = await bulk_import_service.get_job(job_id, str(current_user.id))
+    if not job:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return job
+
+@router.get("/enrollment-jobs/{job_id}")
+async def get_enrollment_job(
+    job_id: str,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Trạng thái trích embedding của ảnh vừa thêm (enrollment_job_id)"""
+    if not ObjectId.is_valid(job_id):
+        raise HTTPException(status_code=404, detail="Enrollment job not found")
+    job = await enrollment_service.get_job(job_id, str(current_user.id))
+    if not job:
+        raise HTTPException(status_code=404, detail="Enrollment job not found")
+    return job
+
+@router.post("/bulk-import/jobs/{job_id}/resume")
+async def resume_bulk_import_job(
+    job_id: str,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Chạy tiếp job bulk import bị lỗi / gián đoạn"""
+    if not ObjectId.is_valid(job_id):
+        raise HTTPException(status_code=404, detail="Import job not found")
+    job = await bulk_import_service.resume_job(job_id, str(current_user.id))
+    if not job:
+        raise HTTPException(status_code=409, detail="Import job not found or not resumable")
+    return job
+    
 # ✅ Add test endpoint for verification
 @router.get("/bulk-import/test")
 async def test_bulk_import(
@@ -1,5 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from ..models.user import User
 from ..services.auth_service import get_current_active_user
 from ..services.settings_service import settings_service
@@ -42,6 +42,44 @@ async def update_user_settings(
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+class WebhookSettings(BaseModel):
+    webhook_enabled: bool = False
+    webhook_url: Optional[str] = None
+    # None = giữ secret hiện tại, "" = xóa (dùng webhook_signing_secret của server)
+    webhook_secret: Optional[str] = None
+
+@router.get("/webhook")
+async def get_webhook_settings(
+    current_user: User = Depends(get_current_active_user)
+) -> Dict[str, Any]:
+    """Cấu hình webhook của user (không trả về secret)"""
+    settings = await settings_service.get_user_settings(str(current_user.id))
+    return {
+        "webhook_enabled": settings.get("webhook_enabled", False),
+        "webhook_url": settings.get("webhook_url"),
+        "secret_configured": bool(settings.get("webhook_secret"))
+    }
+
+@router.put("/webhook")
+async def update_webhook_settings(
+    settings_data: WebhookSettings,
+    current_user: User = Depends(get_current_active_user)
+) -> Dict[str, Any]:
+    """Cập nhật URL và secret ký HMAC của webhook"""
+    if settings_data.webhook_url and not settings_data.webhook_url.startswith(("http://", "https://")):
+        raise HTTPException(status_code=400, detail="Webhook URL must start with http:// or https://")
+    try:
+        update = {
+            "webhook_enabled": settings_data.webhook_enabled,
+            "webhook_url": settings_data.webhook_url or None
+        }
+        if settings_data.webhook_secret is not None:
+            update["webhook_secret"] = settings_data.webhook_secret or None
+        await settings_service.update_user_settings(str(current_user.id), update)
+        return await get_webhook_settings(current_user)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.get("/default")
 async def get_default_settings() -> UserSettings:
     """Lấy cài đặt mặc định"""
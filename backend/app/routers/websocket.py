@@ -1,8 +1,10 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, status
 from fastapi.security import HTTPBearer
-from typing import Dict, Any
-from ..services.websocket_manager import websocket_manager
-from ..services.auth_service import get_current_active_user
+from typing import Dict, Any, Optional
+from bson import ObjectId
+from ..database import get_database
+from ..services.websocket_manager import websocket_manager, camera_topic, ENCODINGS
+from ..services.auth_service import auth_service, get_current_active_user, get_admin_user
 from ..models.user import User
 import json
 import asyncio
@@ -11,39 +13,105 @@ from datetime import datetime
 router = APIRouter(prefix="/ws", tags=["websocket"])
 security = HTTPBearer()
 
+async def _owns_camera(user_id: str, camera_id: str) -> bool:
+    """Kiểm tra camera thuộc về user trước khi cho subscribe topic camera"""
+    try:
+        if not ObjectId.is_valid(camera_id) or not ObjectId.is_valid(user_id):
+            return False
+        db = get_database()
+        camera = await db.cameras.find_one(
+            {"_id": ObjectId(camera_id), "user_id": ObjectId(user_id)},
+            {"_id": 1}
+        )
+        return camera is not None
+    except Exception:
+        return False
+
 @router.websocket("/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    """WebSocket endpoint cho real-time notifications"""
+async def websocket_endpoint(
+    websocket: WebSocket,
+    user_id: str,
+    token: Optional[str] = None,
+    encoding: str = "json",
+    delta: bool = False
+):
+    """
+    WebSocket endpoint cho real-time notifications
+
+    `encoding=msgpack` để nhận binary frame (msgpack), không có thư viện thì dùng JSON.
+    `delta=true` để nhận track của camera dạng `camera_delta` thay vì `camera_state`.
+    """
+    # Bắt buộc token; user của kết nối lấy từ token, user_id trên path phải khớp
+    if not token:
+        await websocket.close(code=1008)
+        return
+    try:
+        token_user = await auth_service.verify_token_from_query(token)
+    except Exception:
+        await websocket.close(code=1008)
+        return
+    if not token_user.is_active or str(token_user.id) != user_id:
+        await websocket.close(code=1008)
+        return
+    user_id = str(token_user.id)
+    
     # Accept connection first
     await websocket.accept()
     
+    connection = None
     try:
-        # Connect to manager
-        await websocket_manager.connect(websocket, user_id)
+        # Connect to manager (tự subscribe topic user:<id>)
+        connection = await websocket_manager.connect(
+            websocket,
+            user_id,
+            encoding=encoding.lower() if encoding.lower() in ENCODINGS else "json",
+            delta=delta
+        )
         
-        # Send welcome message
+        # Send welcome message (qua hàng đợi của connection)
         welcome_message = {
             "type": "connection",
             "message": f"Connected to SafeFace WebSocket",
             "user_id": user_id,
+            "encoding": connection.encoding,
+            "delta": connection.delta,
+            "available_encodings": ENCODINGS,
             "timestamp": datetime.utcnow().isoformat()
         }
-        await websocket.send_text(json.dumps(welcome_message))
+        connection.enqueue(welcome_message)
         
         # Listen for messages
         while True:
             try:
-                # Wait for any message from client (keep-alive, etc.)
+                # Wait for any message from client (keep-alive, subscribe, etc.)
                 data = await websocket.receive_text()
                 message_data = json.loads(data)
+                message_type = message_data.get("type")
                 
                 # Handle different message types
-                if message_data.get("type") == "ping":
+                if message_type == "ping":
                     pong_response = {
                         "type": "pong", 
                         "timestamp": datetime.utcnow().isoformat()
                     }
-                    await websocket.send_text(json.dumps(pong_response))
+                    connection.enqueue(pong_response)
+                
+                elif message_type in ("subscribe", "unsubscribe"):
+                    camera_id = str(message_data.get("camera_id", ""))
+                    topic = camera_topic(camera_id)
+                    if message_type == "unsubscribe":
+                        websocket_manager.unsubscribe(connection, topic)
+                        ok = True
+                    else:
+                        ok = await _owns_camera(user_id, camera_id)
+                        if ok:
+                            websocket_manager.subscribe(connection, topic)
+                    connection.enqueue({
+                        "type": f"{message_type}d" if ok else "error",
+                        "topic": topic,
+                        "message": None if ok else "Camera not found",
+                        "timestamp": datetime.utcnow().isoformat()
+                    })
                     
             except WebSocketDisconnect:
                 break
@@ -81,10 +149,7 @@ async def test_websocket_connection(
             "timestamp": datetime.utcnow().isoformat()
         }
         
-        await websocket_manager.send_personal_message(
-            json.dumps(test_message), 
-            user_id
-        )
+        await websocket_manager.send_personal_message(test_message, user_id)
         
         return {
             "message": "Test message sent successfully",
@@ -120,4 +185,11 @@ async def get_websocket_status(
             "status": "connected" if connection_count > 0 else "disconnected"
         }
     except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/hub/stats")
+async def get_websocket_hub_stats(
+    current_admin: User = Depends(get_admin_user)
+):
+    """Thống kê hub WebSocket (connection, topic, hàng đợi, client bị ngắt)"""
+    return websocket_manager.get_stats()
@@ -7,6 +7,18 @@ from .admin_service import admin_service
 from .notification_service import notification_service
 from .detection_service import detection_service
 from .person_service import person_service
+from .detection_counter_service import detection_counter_service
+from .index_service import index_service
+from .mail_queue_service import mail_queue_service
+from .alert_digest_service import alert_digest_service
+from .webhook_service import webhook_dispatcher
+from .notification_context_service import notification_context_service
+from .event_bus import event_bus
+from .state_store import state_store
+from .bulk_import_service import bulk_import_service
+from .face_image_store import face_image_store
+from .recognition_index import recognition_index
+from .enrollment_service import enrollment_service
 
 __all__ = [
     "auth_service",
@@ -20,5 +32,17 @@ __all__ = [
     "admin_service",
     "notification_service",
     "detection_service",
-    "person_service"
+    "person_service",
+    "detection_counter_service",
+    "index_service",
+    "mail_queue_service",
+    "alert_digest_service",
+    "webhook_dispatcher",
+    "notification_context_service",
+    "event_bus",
+    "state_store",
+    "bulk_import_service",
+    "face_image_store",
+    "recognition_index",
+    "enrollment_service"
 ]
\ No newline at end of file
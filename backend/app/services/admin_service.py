@@ -1,7 +1,10 @@
 from typing import List, Dict, Any, Optional
 from bson import ObjectId
 from ..database import get_database
+from .detection_counter_service import detection_counter_service
+from .person_service import PersonService
 from datetime import datetime, timedelta
+from ..utils.timezone_utils import vietnam_now
 import psutil
 import os
 
@@ -26,17 +29,13 @@ class AdminService:
         # Count total persons
         total_persons = await db.known_persons.count_documents({"is_active": True})
         
-        # Count detections today
-        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        today_detections = await db.detection_logs.count_documents({
-            "timestamp": {"$gte": today}
-        })
-        
-        # Count detections this week
-        week_ago = datetime.utcnow() - timedelta(days=7)
-        week_detections = await db.detection_logs.count_documents({
-            "timestamp": {"$gte": week_ago}
-        })
+        # Detection counts đọc từ bộ đếm rollup (bucket theo giờ Việt Nam như detection_logs)
+        now = vietnam_now()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        week_ago = now - timedelta(days=7)
+        detection_totals = await detection_counter_service.get_counts()
+        today_detections = (await detection_counter_service.get_counts(since=today, now=now, until=now))["total"]
+        week_detections = (await detection_counter_service.get_counts(since=week_ago, now=now, until=now))["total"]
         
         return {
             # ✅ Flat structure for frontend compatibility
@@ -48,9 +47,9 @@ class AdminService:
             "streaming_cameras": 0,  # Will be calculated later
             "total_persons": total_persons,
             "active_persons": total_persons,  # Same as total for now
-            "total_detections": await db.detection_logs.count_documents({}),
-            "stranger_detections": await db.detection_logs.count_documents({"person_type": "stranger"}),
-            "known_person_detections": await db.detection_logs.count_documents({"person_type": "known"}),
+            "total_detections": detection_totals["total"],
+            "stranger_detections": detection_totals["stranger"],
+            "known_person_detections": detection_totals["known_person"],
             "today_detections": today_detections,
             "this_week_detections": week_detections,
             "recent_activity": [],  # Will add later
@@ -280,18 +279,21 @@ class AdminService:
             
             # Get user's persons
             persons = []
-            async for person in db.known_persons.find({"user_id": ObjectId(user_id), "is_active": True}):
+            async for person in db.known_persons.find(
+                {"user_id": ObjectId(user_id), "is_active": True},
+                {"name": 1, "created_at": 1, "face_images_count": PersonService.SUMMARY_PROJECTION["face_images_count"]}
+            ):
                 persons.append({
                     "id": str(person["_id"]),
                     "name": person["name"],
-                    "face_images_count": len(person.get("face_images", [])),
+                    "face_images_count": person.get("face_images_count", 0),
                     "created_at": person["created_at"]
                 })
             
             # Get recent detections
             recent_detections = await db.detection_logs.count_documents({
                 "user_id": ObjectId(user_id),
-                "timestamp": {"$gte": datetime.utcnow() - timedelta(days=7)}
+                "timestamp": {"$gte": vietnam_now() - timedelta(days=7)}
             })
             
             return {
@@ -0,0 +1,247 @@
+from typing import Dict, Any, List, Optional, Callable, Awaitable, Set
+from datetime import datetime
+import asyncio
+import cv2
+import numpy as np
+from ..config import get_settings
+from .state_store import state_store
+
+
+class AlertDigest:
+    """Các sự kiện người lạ đang chờ gom thành một thông báo"""
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.opened_at = datetime.utcnow()
+        self.events: List[Dict[str, Any]] = []
+        self.crops: List[np.ndarray] = []
+        self.latest_image: Optional[bytes] = None  # Khung hình gốc, dùng khi digest chỉ có 1 sự kiện
+        self.full_event = asyncio.Event()
+        # Sự kiện vượt alert_digest_max_events chỉ được đếm, không giữ lại
+        self.camera_names: List[str] = []
+        self.stranger_count = 0
+        self.overflow_events = 0
+        self.last_timestamp: Optional[datetime] = None
+
+    @property
+    def total_events(self) -> int:
+        return len(self.events) + self.overflow_events
+
+    def add(self, alert_data: Dict[str, Any], max_events: int) -> bool:
+        """Ghi nhận một sự kiện, trả về False nếu digest đã đủ max_events (chỉ cộng dồn)"""
+        name = alert_data.get("camera_info", {}).get("name", "Camera")
+        if name not in self.camera_names:
+            self.camera_names.append(name)
+        self.stranger_count += alert_data.get("stranger_count", 0)
+        self.last_timestamp = alert_data.get("timestamp") or self.last_timestamp
+        if len(self.events) >= max_events:
+            self.overflow_events += 1
+            return False
+        self.events.append(alert_data)
+        return True
+
+
+class AlertDigestService:
+    """
+    Gom các cảnh báo người lạ liên tiếp (nhiều camera) thành một digest
+
+    Sự kiện đầu tiên mở một cửa sổ `alert_digest_window_seconds`; mọi sự kiện
+    trong cửa sổ được gom lại, ảnh khuôn mặt được cắt sẵn để ghép contact sheet.
+    Khi hết cửa sổ, digest chỉ được gửi nếu user còn budget (token bucket theo
+    `max_alerts_per_hour`, lưu trong state store dùng chung giữa các worker),
+    nếu không thì tiếp tục gom cho tới khi có budget. Quá `alert_digest_max_events`
+    sự kiện thì chỉ cộng dồn số lượt / camera, bộ nhớ mỗi digest luôn có giới hạn.
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.pending: Dict[str, AlertDigest] = {}
+        self.flush_tasks: Set[asyncio.Task] = set()
+        self.flush_handler: Optional[Callable[[AlertDigest, Optional[bytes]], Awaitable[Any]]] = None
+        self._closing: Optional[asyncio.Event] = None
+
+    def _closing_event(self) -> asyncio.Event:
+        if self._closing is None:
+            self._closing = asyncio.Event()
+        return self._closing
+
+    def set_flush_handler(self, handler: Callable[[AlertDigest, Optional[bytes]], Awaitable[Any]]):
+        """Đăng ký hàm gửi digest (notification_service)"""
+        self.flush_handler = handler
+
+    @property
+    def _budget_capacity(self) -> int:
+        return max(1, self.settings.max_alerts_per_hour)
+
+    @property
+    def _budget_rate(self) -> float:
+        return self._budget_capacity / 3600.0
+
+    async def _try_consume_budget(self, user_id: str) -> float:
+        """Lấy một lượt gửi từ budget, trả về số giây cần chờ (0 nếu được gửi ngay)"""
+        allowed, tokens = await state_store.take_token(
+            f"alert_budget:{user_id}", self._budget_capacity, self._budget_rate
+        )
+        return 0.0 if allowed else (1 - tokens) / self._budget_rate
+
+    async def reset_budget(self, user_id: str):
+        """Khôi phục budget của user (dùng cho test / reset cooldown)"""
+        await state_store.delete(f"alert_budget:{user_id}")
+
+    def _extract_crops(self, image_data: bytes, detections: List[Dict[str, Any]]) -> List[np.ndarray]:
+        """Cắt ảnh khuôn mặt từ khung hình (chạy trong thread)"""
+        tile = self.settings.alert_digest_tile_size
+        frame = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            return []
+
+        height, width = frame.shape[:2]
+        crops = []
+        for detection in detections:
+            bbox = detection.get("bbox") or [0, 0, 0, 0]
+            if isinstance(bbox, dict):
+                bbox = [bbox.get("x", 0), bbox.get("y", 0), bbox.get("width", 0), bbox.get("height", 0)]
+            if len(bbox) < 4:
+                continue
+            x, y, w, h = [int(v) for v in bbox[:4]]
+            if w <= 0 or h <= 0:
+                continue
+
+            # Mở rộng 20% quanh khuôn mặt
+            pad_x, pad_y = int(w * 0.2), int(h * 0.2)
+            x1, y1 = max(0, x - pad_x), max(0, y - pad_y)
+            x2, y2 = min(width, x + w + pad_x), min(height, y + h + pad_y)
+            if x2 <= x1 or y2 <= y1:
+                continue
+            crops.append(cv2.resize(frame[y1:y2, x1:x2], (tile, tile), interpolation=cv2.INTER_AREA))
+        return crops
+
+    def _build_contact_sheet(self, crops: List[np.ndarray]) -> Optional[bytes]:
+        """Ghép các khuôn mặt thành một ảnh lưới JPEG (chạy trong thread)"""
+        if not crops:
+            return None
+
+        tile = self.settings.alert_digest_tile_size
+        cols = min(4, len(crops))
+        rows = (len(crops) + cols - 1) // cols
+        sheet = np.full((rows * tile, cols * tile, 3), 255, dtype=np.uint8)
+
+        for index, crop in enumerate(crops):
+            row, col = divmod(index, cols)
+            sheet[row * tile:(row + 1) * tile, col * tile:(col + 1) * tile] = crop
+            cv2.putText(sheet, f"#{index + 1}", (col * tile + 4, row * tile + 16),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 255), 1, cv2.LINE_AA)
+
+        success, buffer = cv2.imencode(".jpg", sheet, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        return buffer.tobytes() if success else None
+
+    async def add_event(self, user_id: str, alert_data: Dict[str, Any],
+                        detections: List[Dict[str, Any]], image_data: Optional[bytes] = None,
+                        immediate: bool = False):
+        """Thêm một sự kiện người lạ vào digest đang mở của user"""
+        digest = self.pending.get(user_id)
+        if digest is None:
+            # Mỗi digest có một task gửi riêng
+            digest = AlertDigest(user_id)
+            self.pending[user_id] = digest
+            task = asyncio.create_task(self._flush_later(digest, ignore_budget=immediate))
+            self.flush_tasks.add(task)
+            task.add_done_callback(self.flush_tasks.discard)
+
+        kept = digest.add(alert_data, max(1, self.settings.alert_digest_max_events))
+        if image_data and kept:
+            digest.latest_image = image_data
+
+        max_faces = self.settings.alert_digest_max_faces
+        if image_data and kept and len(digest.crops) < max_faces:
+            try:
+                crops = await asyncio.to_thread(self._extract_crops, image_data, detections)
+                digest.crops.extend(crops[:max_faces - len(digest.crops)])
+            except Exception as e:
+                print(f"⚠️ [DIGEST] Could not extract face crops: {e}")
+
+        if immediate or len(digest.events) >= self.settings.alert_digest_max_events:
+            digest.full_event.set()
+
+        print(f"🧺 [DIGEST] User {user_id}: {digest.total_events} events, "
+              f"{len(digest.crops)} faces, cameras={digest.camera_names}")
+
+    async def _flush_later(self, digest: AlertDigest, ignore_budget: bool = False):
+        """Chờ hết cửa sổ gom (hoặc digest đầy) rồi gửi khi còn budget"""
+        user_id = digest.user_id
+        try:
+            try:
+                await asyncio.wait_for(digest.full_event.wait(),
+                                       timeout=self.settings.alert_digest_window_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+            # Khi shutdown (flush_all) thì gửi ngay, không chờ budget
+            closing = self._closing_event()
+            while not ignore_budget and not closing.is_set():
+                wait_seconds = await self._try_consume_budget(user_id)
+                if wait_seconds <= 0:
+                    break
+                print(f"⏳ [DIGEST] User {user_id} out of alert budget, holding digest {wait_seconds:.0f}s")
+                try:
+                    await asyncio.wait_for(closing.wait(), timeout=wait_seconds)
+                except asyncio.TimeoutError:
+                    pass
+
+            await self.flush(digest)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"❌ [DIGEST] Error flushing digest for user {user_id}: {e}")
+
+    async def flush(self, digest: AlertDigest):
+        """Đóng digest (sự kiện mới sẽ mở digest khác) và gửi đi"""
+        user_id = digest.user_id
+        if self.pending.get(user_id) is digest:
+            del self.pending[user_id]
+        if not digest.events:
+            return
+
+        contact_sheet = None
+        try:
+            contact_sheet = await asyncio.to_thread(self._build_contact_sheet, digest.crops)
+        except Exception as e:
+            print(f"⚠️ [DIGEST] Could not build contact sheet: {e}")
+
+        if self.flush_handler is None:
+            print(f"⚠️ [DIGEST] No flush handler registered, dropping digest for user {user_id}")
+            return
+
+        print(f"📬 [DIGEST] Flushing digest for user {user_id}: {digest.total_events} events, "
+              f"{digest.stranger_count} strangers, {len(digest.camera_names)} cameras")
+        await self.flush_handler(digest, contact_sheet)
+
+    async def flush_all(self):
+        """Gửi mọi digest đang chờ và đợi các lần gửi đang chạy (khi shutdown)"""
+        self._closing_event().set()
+        for digest in list(self.pending.values()):
+            digest.full_event.set()
+        if self.flush_tasks:
+            await asyncio.gather(*list(self.flush_tasks), return_exceptions=True)
+        for user_id, digest in list(self.pending.items()):
+            try:
+                await self.flush(digest)
+            except Exception as e:
+                print(f"❌ [DIGEST] Error flushing digest for user {user_id}: {e}")
+
+    async def get_status(self, user_id: str) -> Dict[str, Any]:
+        """Trạng thái digest và budget hiện tại của user"""
+        digest = self.pending.get(user_id)
+        tokens = await state_store.peek_tokens(f"alert_budget:{user_id}", self._budget_capacity, self._budget_rate)
+        return {
+            "pending_events": digest.total_events if digest else 0,
+            "pending_faces": len(digest.crops) if digest else 0,
+            "pending_cameras": digest.camera_names if digest else [],
+            "window_seconds": self.settings.alert_digest_window_seconds,
+            "budget_per_hour": self._budget_capacity,
+            "budget_remaining": int(tokens)
+        }
+
+
+# Global instance
+alert_digest_service = AlertDigestService()
@@ -8,6 +8,7 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from ..database import get_database
 from ..config import get_settings
 from ..models.user import User, UserCreate, UserUpdate, UserResponse
+from .notification_context_service import notification_context_service
 import logging
 
 logger = logging.getLogger(__name__)
@@ -321,6 +322,7 @@ class AuthService:
                     {"_id": ObjectId(user_id)},
                     {"$set": update_data}
                 )
+                notification_context_service.invalidate_user(user_id)
                 
                 if result.modified_count == 0:
                     raise HTTPException(status_code=404, detail="User not found")
@@ -0,0 +1,448 @@
+from typing import Dict, Any, List, Optional, Tuple
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+import asyncio
+from ..config import get_settings
+from ..database import get_database
+from ..models.known_person import KnownPersonCreate
+from ..utils.timezone_utils import vietnam_now
+from ..utils.embedding_codec import EMBEDDING_FORMAT, encode_embedding
+from .face_processor import face_processor
+from .face_image_store import face_image_store
+from .recognition_index import recognition_index
+from .notification_context_service import notification_context_service
+from .websocket_manager import websocket_manager
+from .event_bus import event_bus
+
+MAX_JOB_ERRORS = 100
+STALE_JOB_SECONDS = 120
+HEARTBEAT_SECONDS = 30
+
+
+class BulkImportService:
+    """
+    Job import nhiều known person (collection `import_jobs` + `import_job_items`)
+
+    - Mỗi person là một item lưu sẵn trong DB với `person_id` cấp trước, job xử lý
+      theo batch `bulk_import_batch_size`: decode ảnh song song, trích embedding
+      theo batch qua face_processor, lưu ảnh lên GridFS, ghi person bằng insert_many
+    - Item chỉ được đánh dấu done sau khi ghi xong; chạy lại (resume) sau lỗi hay
+      restart chỉ xử lý item còn pending, person đã ghi bị bỏ qua nhờ `_id` cố định
+    - Tiến độ đọc qua polling (`get_job`) hoặc WebSocket `bulk_import_progress`
+    - Worker chạy job gửi heartbeat riêng mỗi HEARTBEAT_SECONDS (batch dài không làm
+      job bị coi là stale); mọi ghi lên job đều kèm `node_id`, job đã bị worker khác
+      nhận lại thì worker cũ dừng
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    @property
+    def db(self):
+        return get_database()
+
+    @property
+    def jobs(self):
+        return self.db.import_jobs
+
+    @property
+    def items(self):
+        return self.db.import_job_items
+
+    # ===== Job lifecycle =====
+
+    async def start_job(self, persons_data: List[Dict[str, Any]], user_id: str) -> Dict[str, Any]:
+        """Tạo job import và chạy nền, trả về trạng thái ban đầu"""
+        now = datetime.utcnow()
+        job = {
+            "user_id": ObjectId(user_id),
+            "status": "running",
+            "total": len(persons_data),
+            "processed": 0,
+            "imported": 0,
+            "failed": 0,
+            "images_total": 0,
+            "embeddings_extracted": 0,
+            "errors": [],
+            "node_id": event_bus.node_id,
+            "created_at": now,
+            "updated_at": now,
+            "heartbeat_at": now,
+            "finished_at": None
+        }
+        result = await self.jobs.insert_one(job)
+        job_id = result.inserted_id
+
+        item_docs = [
+            {
+                "job_id": job_id,
+                "index": index,
+                "status": "pending",
+                "person_id": ObjectId(),
+                "data": {
+                    "name": person_data.get("name"),
+                    "description": person_data.get("description", ""),
+                    "metadata": person_data.get("metadata") or {},
+                    "face_images": list(person_data.get("face_images") or [])
+                }
+            }
+            for index, person_data in enumerate(persons_data)
+        ]
+        batch_size = max(1, self.settings.bulk_import_batch_size)
+        for start in range(0, len(item_docs), batch_size):
+            await self.items.insert_many(item_docs[start:start + batch_size], ordered=False)
+
+        self._launch(str(job_id))
+        print(f"📥 [BULK IMPORT] Job {job_id} started with {len(persons_data)} persons")
+        return self._serialize(await self.jobs.find_one({"_id": job_id}))
+
+    def _launch(self, job_id: str):
+        task = self.tasks.get(job_id)
+        if task is not None and not task.done():
+            return
+        task = asyncio.create_task(self._run(job_id))
+        self.tasks[job_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job_id, None))
+
+    async def wait_for_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Chờ job chạy trên worker này xong, trả về trạng thái cuối"""
+        task = self.tasks.get(job_id)
+        if task is not None:
+            await asyncio.shield(task)
+        job = await self.jobs.find_one({"_id": ObjectId(job_id)})
+        return self._serialize(job) if job else None
+
+    async def resume_job(self, job_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        """Chạy tiếp job bị lỗi / gián đoạn từ các item còn pending"""
+        job = await self.jobs.find_one_and_update(
+            {
+                "_id": ObjectId(job_id),
+                "user_id": ObjectId(user_id),
+                "$or": [
+                    {"status": {"$in": ["failed", "interrupted"]}},
+                    {"status": "running", "heartbeat_at": {"$lt": datetime.utcnow() - timedelta(seconds=STALE_JOB_SECONDS)}}
+                ]
+            },
+            {"$set": {
+                "status": "running",
+                "node_id": event_bus.node_id,
+                "heartbeat_at": datetime.utcnow(),
+                "updated_at": datetime.utcnow(),
+                "finished_at": None
+            }},
+            return_document=ReturnDocument.AFTER
+        )
+        if not job:
+            return None
+        self._launch(job_id)
+        print(f"🔄 [BULK IMPORT] Job {job_id} resumed")
+        return self._serialize(job)
+
+    async def recover_jobs(self) -> int:
+        """Chạy tiếp job bị dừng khi shutdown hoặc không còn heartbeat (worker đã chết giữa chừng)"""
+        stale_before = datetime.utcnow() - timedelta(seconds=STALE_JOB_SECONDS)
+        recovered = 0
+        while True:
+            job = await self.jobs.find_one_and_update(
+                {"$or": [
+                    {"status": "interrupted"},
+                    {"status": "running", "heartbeat_at": {"$lt": stale_before}}
+                ]},
+                {"$set": {"status": "running", "node_id": event_bus.node_id, "heartbeat_at": datetime.utcnow()}}
+            )
+            if not job:
+                break
+            self._launch(str(job["_id"]))
+            recovered += 1
+        if recovered:
+            print(f"🔄 [BULK IMPORT] Recovered {recovered} interrupted jobs")
+        return recovered
+
+    async def stop(self):
+        """Dừng các job đang chạy (đánh dấu interrupted, có thể resume)"""
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    # ===== Processing =====
+
+    def _owned(self, object_id: ObjectId) -> Dict[str, Any]:
+        """Filter job đang chạy trên worker này"""
+        return {"_id": object_id, "status": "running", "node_id": event_bus.node_id}
+
+    async def _heartbeat(self, object_id: ObjectId, run_task: asyncio.Task):
+        """Gia hạn heartbeat_at trong lúc job chạy, hủy job nếu worker khác đã nhận lại"""
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            try:
+                result = await self.jobs.update_one(
+                    self._owned(object_id), {"$set": {"heartbeat_at": datetime.utcnow()}}
+                )
+            except Exception as e:
+                print(f"⚠️ [BULK IMPORT] Heartbeat failed for job {object_id}: {e}")
+                continue
+            if not result.matched_count:
+                print(f"⚠️ [BULK IMPORT] Job {object_id} is no longer owned by this worker, stopping")
+                run_task.cancel()
+                return
+
+    async def _run(self, job_id: str):
+        object_id = ObjectId(job_id)
+        heartbeat = asyncio.create_task(self._heartbeat(object_id, asyncio.current_task()))
+        try:
+            job = await self.jobs.find_one(self._owned(object_id))
+            if not job:
+                return
+            user_id = str(job["user_id"])
+            batch_size = max(1, self.settings.bulk_import_batch_size)
+
+            while True:
+                items = await self.items.find(
+                    {"job_id": object_id, "status": "pending"}
+                ).sort("index", 1).limit(batch_size).to_list(length=batch_size)
+                if not items:
+                    break
+                if not await self._process_batch(object_id, user_id, items):
+                    print(f"⚠️ [BULK IMPORT] Job {job_id} was taken over by another worker, stopping")
+                    return
+
+            job = await self.jobs.find_one_and_update(
+                self._owned(object_id),
+                {"$set": {"status": "completed", "finished_at": datetime.utcnow(), "updated_at": datetime.utcnow()}},
+                return_document=ReturnDocument.AFTER
+            )
+            if not job:
+                return
+            # Item thành công không cần giữ lại, item lỗi giữ để xem chi tiết
+            await self.items.delete_many({"job_id": object_id, "status": "done"})
+            print(f"✅ [BULK IMPORT] Job {job_id} completed: {job['imported']} imported, {job['failed']} failed")
+            await self._publish_progress(job)
+        except asyncio.CancelledError:
+            await self.jobs.update_one(
+                self._owned(object_id),
+                {"$set": {"status": "interrupted", "updated_at": datetime.utcnow()}}
+            )
+            raise
+        except Exception as e:
+            print(f"❌ [BULK IMPORT] Job {job_id} failed: {e}")
+            job = await self.jobs.find_one_and_update(
+                self._owned(object_id),
+                {"$set": {"status": "failed", "last_error": str(e), "updated_at": datetime.utcnow()}},
+                return_document=ReturnDocument.AFTER
+            )
+            if job:
+                await self._publish_progress(job)
+        finally:
+            heartbeat.cancel()
+
+    @staticmethod
+    def _decode_images(items: List[Dict[str, Any]]) -> List[List[Tuple[Optional[bytes], Optional[str]]]]:
+        """Decode base64 của cả batch (chạy trong thread): [(bytes, lỗi)] theo item"""
+        decoded = []
+        for item in items:
+            images = []
+            for image_base64 in item["data"].get("face_images", []):
+                try:
+                    images.append((face_image_store.decode_base64(str(image_base64)), None))
+                except Exception as e:
+                    images.append((None, f"Failed to decode base64 image: {e}"))
+            decoded.append(images)
+        return decoded
+
+    async def _save_images(self, flat: List[Tuple[Dict[str, Any], bytes]], user_id: str) -> List[Any]:
+        """Lưu ảnh + thumbnail lên GridFS song song (giới hạn số upload đồng thời)"""
+        semaphore = asyncio.Semaphore(8)
+
+        async def save(item: Dict[str, Any], image_data: bytes):
+            async with semaphore:
+                try:
+                    return await face_image_store.save(image_data, user_id, str(item["person_id"]))
+                except Exception as e:
+                    return e
+
+        return await asyncio.gather(*[save(item, image_data) for item, image_data in flat])
+
+    def _build_person(self, item: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+        """Document person giống create_person"""
+        data = item["data"]
+        metadata = data.get("metadata") or {}
+        person_create = KnownPersonCreate(
+            name=data["name"],
+            description=data.get("description", ""),
+            department=metadata.get("department"),
+            employee_id=metadata.get("employee_id"),
+            position=metadata.get("position"),
+            access_level=metadata.get("access_level"),
+            metadata=metadata
+        )
+        name = str(person_create.name).strip()
+        if not name:
+            raise ValueError("Person name is required")
+        now = vietnam_now()
+        return {
+            "_id": item["person_id"],
+            "user_id": ObjectId(user_id),
+            "name": name,
+            "description": person_create.description,
+            "department": person_create.department,
+            "employee_id": person_create.employee_id,
+            "position": person_create.position,
+            "access_level": person_create.access_level,
+            "metadata": person_create.metadata or {},
+            "face_image_refs": [],
+            "face_embeddings": [],
+            "embedding_format": EMBEDDING_FORMAT,
+            "is_active": True,
+            "created_at": now,
+            "updated_at": now
+        }
+
+    async def _process_batch(self, job_id: ObjectId, user_id: str, items: List[Dict[str, Any]]) -> bool:
+        """Xử lý một batch item, trả về False nếu job không còn thuộc worker này"""
+        errors: List[str] = []
+        failed_items: Dict[ObjectId, str] = {}
+        persons: Dict[ObjectId, Dict[str, Any]] = {}
+
+        # Resume: person đã ghi ở lần chạy trước thì chỉ cần đánh dấu done,
+        # ảnh còn sót của lần chạy dang dở (chưa kịp ghi person) bị xóa trước khi upload lại
+        existing = {
+            doc["_id"] async for doc in self.db.known_persons.find(
+                {"_id": {"$in": [item["person_id"] for item in items]}}, {"_id": 1}
+            )
+        }
+        for item in items:
+            if item["person_id"] in existing:
+                continue
+            await face_image_store.delete_person(item["person_id"])
+            try:
+                persons[item["_id"]] = self._build_person(item, user_id)
+            except Exception as e:
+                failed_items[item["_id"]] = f"Failed to import {item['data'].get('name') or 'Unknown'}: {e}"
+
+        # Decode base64 trong thread, embedding theo batch cho cả batch person
+        valid_items = [item for item in items if item["_id"] in persons]
+        decoded = await asyncio.to_thread(self._decode_images, valid_items)
+        flat = [(item, image_data) for item, images in zip(valid_items, decoded)
+                for image_data, error in images if image_data is not None]
+        embeddings, refs = await asyncio.gather(
+            face_processor.extract_face_embeddings_batch([image_data for _, image_data in flat]),
+            self._save_images(flat, user_id)
+        )
+
+        images_total = embeddings_extracted = 0
+        for item, images in zip(valid_items, decoded):
+            for _, error in images:
+                if error:
+                    errors.append(f"Failed to add face image for {item['data'].get('name')}: {error}")
+        for (item, _), ref, embedding in zip(flat, refs, embeddings):
+            if isinstance(ref, Exception):
+                errors.append(f"Failed to add face image for {item['data'].get('name')}: {ref}")
+                continue
+            person = persons[item["_id"]]
+            person["face_image_refs"].append({**ref, "embedding_status": "done" if embedding is not None else "failed"})
+            images_total += 1
+            # [] khi không trích được embedding (giữ đúng thứ tự với face_image_refs)
+            person["face_embeddings"].append(
+                encode_embedding(embedding, self.settings.embedding_storage_dtype) if embedding is not None else []
+            )
+            if embedding is not None:
+                embeddings_extracted += 1
+
+        if persons:
+            try:
+                await self.db.known_persons.insert_many(list(persons.values()), ordered=False)
+            except BulkWriteError as e:
+                # 11000: person đã được ghi ở lần chạy trước (resume) → coi như thành công
+                person_ids = list(persons.keys())
+                for write_error in e.details.get("writeErrors", []):
+                    if write_error.get("code") != 11000:
+                        item_id = person_ids[write_error["index"]]
+                        failed_items[item_id] = f"Failed to import {persons[item_id]['name']}: {write_error.get('errmsg')}"
+                        await face_image_store.delete_refs(persons[item_id]["face_image_refs"])
+
+        done_ids = [item["_id"] for item in items if item["_id"] not in failed_items]
+        if done_ids:
+            await self.items.update_many({"_id": {"$in": done_ids}}, {"$set": {"status": "done"}, "$unset": {"data": ""}})
+        if failed_items:
+            await self.items.bulk_write([
+                UpdateOne({"_id": item_id}, {"$set": {"status": "failed", "error": error}})
+                for item_id, error in failed_items.items()
+            ], ordered=False)
+
+        errors = list(failed_items.values()) + errors
+        job = await self.jobs.find_one_and_update(
+            self._owned(job_id),
+            {
+                "$inc": {
+                    "processed": len(items),
+                    "imported": len(done_ids),
+                    "failed": len(failed_items),
+                    "images_total": images_total,
+                    "embeddings_extracted": embeddings_extracted
+                },
+                "$push": {"errors": {"$each": errors, "$slice": -MAX_JOB_ERRORS}},
+                "$set": {"heartbeat_at": datetime.utcnow(), "updated_at": datetime.utcnow()}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        if done_ids:
+            notification_context_service.invalidate_counts(user_id)
+            await recognition_index.refresh_persons(
+                user_id, [persons[item_id]["_id"] for item_id in done_ids if item_id in persons]
+            )
+        if not job:
+            return False
+        print(f"🔵 [BULK IMPORT] Job {job_id}: {job['processed']}/{job['total']} processed")
+        await self._publish_progress(job)
+        return True
+
+    async def _publish_progress(self, job: Dict[str, Any]):
+        await websocket_manager.send_personal_message(
+            {"type": "bulk_import_progress", "job": self._serialize(job, include_errors=False)},
+            str(job["user_id"])
+        )
+
+    # ===== Queries =====
+
+    @staticmethod
+    def _serialize(job: Dict[str, Any], include_errors: bool = True) -> Dict[str, Any]:
+        total = job.get("total", 0)
+        result = {
+            "id": str(job["_id"]),
+            "status": job.get("status"),
+            "total": total,
+            "processed": job.get("processed", 0),
+            "imported": job.get("imported", 0),
+            "failed": job.get("failed", 0),
+            "images_total": job.get("images_total", 0),
+            "embeddings_extracted": job.get("embeddings_extracted", 0),
+            "progress": round(job.get("processed", 0) / total * 100, 1) if total else 100.0,
+            "last_error": job.get("last_error"),
+            "created_at": job.get("created_at").isoformat() if job.get("created_at") else None,
+            "updated_at": job.get("updated_at").isoformat() if job.get("updated_at") else None,
+            "finished_at": job.get("finished_at").isoformat() if job.get("finished_at") else None
+        }
+        if include_errors:
+            result["errors"] = job.get("errors", [])
+        return result
+
+    async def get_job(self, job_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        """Trạng thái job (polling)"""
+        if not ObjectId.is_valid(job_id):
+            return None
+        job = await self.jobs.find_one({"_id": ObjectId(job_id), "user_id": ObjectId(user_id)})
+        return self._serialize(job) if job else None
+
+    async def list_jobs(self, user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """Các job import gần nhất của user"""
+        cursor = self.jobs.find({"user_id": ObjectId(user_id)}).sort("created_at", -1).limit(limit)
+        return [self._serialize(job, include_errors=False) async for job in cursor]
+
+
+# Global instance
+bulk_import_service = BulkImportService()
@@ -6,6 +6,7 @@ import cv2
 import asyncio
 from datetime import datetime
 from ..utils.timezone_utils import vietnam_now
+from .notification_context_service import notification_context_service
 import socket
 import urllib.parse
 import re
@@ -78,6 +79,7 @@ class CameraService:
             }
             
             result = await self.collection.insert_one(camera_dict)
+            notification_context_service.invalidate_counts(user_id)
             
             return CameraResponse(
                 id=str(result.inserted_id),
@@ -298,6 +300,7 @@ class CameraService:
                 {"$set": update_dict},
                 return_document=True
             )
+            notification_context_service.invalidate_camera(camera_id)
             
             if result:
                 return CameraResponse(
@@ -328,6 +331,7 @@ class CameraService:
                 "_id": ObjectId(camera_id),
                 "user_id": ObjectId(user_id)
             })
+            notification_context_service.invalidate_camera(camera_id, user_id)
             return result.deleted_count > 0
         except Exception:
             return False
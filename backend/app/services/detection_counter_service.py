@@ -0,0 +1,444 @@
+from typing import Dict, Any, List, Optional, Callable
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ReplaceOne, UpdateOne
+import asyncio
+import uuid
+from ..database import get_database
+from ..utils.timezone_utils import vietnam_now
+
+# Bucket cho bộ đếm toàn thời gian (không phụ thuộc thời gian)
+TOTAL_BUCKET = datetime(1970, 1, 1)
+
+DETECTION_TYPES = ["known_person", "stranger", "unknown"]
+
+# detection_type của detection_logs → loại trong bộ đếm (giống _normalize_type)
+DETECTION_TYPE_EXPR = {
+    "$switch": {
+        "branches": [
+            {"case": {"$eq": ["$detection_type", "stranger_only_alert"]}, "then": "stranger"},
+            {"case": {"$in": ["$detection_type", DETECTION_TYPES]}, "then": "$detection_type"},
+        ],
+        "default": "unknown",
+    }
+}
+
+BUCKET_STEP = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+
+
+class DetectionCounterService:
+    """
+    Bộ đếm detection được tổng hợp trước (rollup) theo user/camera/loại detection
+
+    Mỗi document trong collection `detection_counters` là một bucket:
+    {user_id, camera_id, detection_type, granularity, bucket, count, alerts}
+    với granularity là minute/hour/day/total. Bộ đếm được cập nhật bằng
+    `$inc` upsert ngay khi ghi detection_logs, nên các thống kê dashboard
+    chỉ cần vài truy vấn theo index thay vì count_documents trên toàn bộ lịch sử.
+    """
+
+    # Thời gian giữ lại bucket chi tiết (bucket day/total giữ vĩnh viễn)
+    RETENTION = {
+        "minute": timedelta(days=2),
+        "hour": timedelta(days=45),
+    }
+
+    def __init__(self):
+        self.listeners: List[Callable[[Dict[str, Any]], Any]] = []
+        self._rebuild_lock: Optional[asyncio.Lock] = None
+
+    def add_listener(self, listener: Callable[[Dict[str, Any]], Any]):
+        """Đăng ký hàm được gọi (đồng bộ) mỗi khi có detection log mới"""
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    @property
+    def db(self):
+        return get_database()
+
+    @property
+    def collection(self):
+        return self.db.detection_counters
+
+    @staticmethod
+    def _truncate(timestamp: datetime, granularity: str) -> datetime:
+        """Làm tròn timestamp xuống đầu bucket"""
+        if granularity == "minute":
+            return timestamp.replace(second=0, microsecond=0)
+        if granularity == "hour":
+            return timestamp.replace(minute=0, second=0, microsecond=0)
+        if granularity == "day":
+            return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+        return TOTAL_BUCKET
+
+    @staticmethod
+    def _normalize_type(detection_type: Optional[str]) -> str:
+        """Chuẩn hóa detection_type giống cách các router đang hiển thị"""
+        if detection_type == "stranger_only_alert":
+            return "stranger"
+        if detection_type in DETECTION_TYPES:
+            return detection_type
+        return "unknown"
+
+    def _build_updates(self, user_id, camera_id, detection_type: str,
+                       timestamp: datetime, count: int, alerts: int) -> List[UpdateOne]:
+        updates = []
+        for granularity in ("minute", "hour", "day", "total"):
+            bucket = self._truncate(timestamp, granularity)
+            on_insert = {}
+            if granularity in self.RETENTION:
+                on_insert["expires_at"] = bucket + self.RETENTION[granularity]
+            update = {"$inc": {"count": count, "alerts": alerts}}
+            if on_insert:
+                update["$setOnInsert"] = on_insert
+            updates.append(UpdateOne(
+                {
+                    "user_id": user_id,
+                    "granularity": granularity,
+                    "bucket": bucket,
+                    "camera_id": camera_id,
+                    "detection_type": detection_type,
+                },
+                update,
+                upsert=True,
+            ))
+        return updates
+
+    async def record_detection(self, user_id, camera_id, detection_type: str,
+                               timestamp: Optional[datetime] = None, alert_sent: bool = False,
+                               delta: int = 1):
+        """Cập nhật bộ đếm khi một detection log được ghi (hoặc xóa với delta=-1)"""
+        try:
+            user_oid = user_id if isinstance(user_id, ObjectId) else ObjectId(user_id)
+            camera_oid = camera_id if isinstance(camera_id, ObjectId) or camera_id is None else ObjectId(camera_id)
+            updates = self._build_updates(
+                user_oid,
+                camera_oid,
+                self._normalize_type(detection_type),
+                timestamp or vietnam_now(),
+                delta,
+                delta if alert_sent else 0,
+            )
+            await self.collection.bulk_write(updates, ordered=False)
+        except Exception as e:
+            print(f"Error updating detection counters: {e}")
+
+    async def record_deletions(self, detection_docs: List[Dict[str, Any]]):
+        """
+        Trừ bộ đếm cho các detection log đã bị xóa
+
+        Gộp theo bucket rồi `$inc` âm không upsert; bucket minute/hour đã hết
+        RETENTION (TTL đã xóa) được bỏ qua để không sinh bucket âm.
+        """
+        now = vietnam_now()
+        deltas: Dict[tuple, List[int]] = {}
+        for doc in detection_docs:
+            if not doc.get("user_id"):
+                continue
+            camera_id = doc.get("camera_id")
+            user_oid = doc["user_id"] if isinstance(doc["user_id"], ObjectId) else ObjectId(doc["user_id"])
+            camera_oid = camera_id if isinstance(camera_id, ObjectId) or camera_id is None else ObjectId(camera_id)
+            detection_type = self._normalize_type(doc.get("detection_type"))
+            for granularity in ("minute", "hour", "day", "total"):
+                bucket = self._truncate(doc.get("timestamp") or now, granularity)
+                if granularity in self.RETENTION and bucket + self.RETENTION[granularity] <= now:
+                    continue
+                entry = deltas.setdefault((user_oid, camera_oid, detection_type, granularity, bucket), [0, 0])
+                entry[0] -= 1
+                if doc.get("is_alert_sent"):
+                    entry[1] -= 1
+
+        updates = [
+            UpdateOne(
+                {
+                    "user_id": user_oid,
+                    "granularity": granularity,
+                    "bucket": bucket,
+                    "camera_id": camera_oid,
+                    "detection_type": detection_type,
+                },
+                {"$inc": {"count": count, "alerts": alerts}},
+            )
+            for (user_oid, camera_oid, detection_type, granularity, bucket), (count, alerts) in deltas.items()
+        ]
+        try:
+            if updates:
+                await self.collection.bulk_write(updates, ordered=False)
+        except Exception as e:
+            print(f"Error updating detection counters: {e}")
+
+    async def record_detection_log(self, detection_doc: Dict[str, Any], delta: int = 1):
+        """Cập nhật bộ đếm từ một document detection_logs"""
+        if not detection_doc.get("user_id"):
+            return
+        if delta > 0:
+            for listener in self.listeners:
+                try:
+                    listener(detection_doc)
+                except Exception as e:
+                    print(f"Error in detection counter listener: {e}")
+        await self.record_detection(
+            detection_doc["user_id"],
+            detection_doc.get("camera_id"),
+            detection_doc.get("detection_type"),
+            detection_doc.get("timestamp"),
+            bool(detection_doc.get("is_alert_sent")),
+            delta,
+        )
+
+    @staticmethod
+    def _pick_granularity(since: datetime, now: datetime) -> str:
+        """Chọn độ chi tiết bucket phù hợp với cửa sổ thời gian"""
+        if since == since.replace(hour=0, minute=0, second=0, microsecond=0):
+            return "day"
+        window = now - since
+        if window <= timedelta(hours=6):
+            return "minute"
+        if window <= timedelta(days=45):
+            return "hour"
+        return "day"
+
+    def _build_match(self, user_id=None, camera_id=None, granularity: str = "total",
+                     since: Optional[datetime] = None, until: Optional[datetime] = None) -> Dict[str, Any]:
+        match: Dict[str, Any] = {"granularity": granularity}
+        if user_id is not None:
+            match["user_id"] = user_id if isinstance(user_id, ObjectId) else ObjectId(user_id)
+        if camera_id is not None:
+            match["camera_id"] = camera_id if isinstance(camera_id, ObjectId) else ObjectId(camera_id)
+        if granularity != "total" and (since or until):
+            match["bucket"] = {}
+            if since:
+                match["bucket"]["$gte"] = self._truncate(since, granularity)
+            if until:
+                match["bucket"]["$lt"] = until
+        return match
+
+    async def get_counts(self, user_id=None, since: Optional[datetime] = None,
+                         camera_id=None, now: Optional[datetime] = None,
+                         until: Optional[datetime] = None) -> Dict[str, int]:
+        """
+        Đếm detection theo loại trong cửa sổ [since, until)
+
+        Không truyền since → đếm toàn thời gian. Bucket được chọn theo độ dài cửa
+        sổ (phút cho cửa sổ ngắn, giờ/ngày cho cửa sổ dài); chỉ bucket nằm trọn trong
+        cửa sổ được cộng, phần lẻ ở hai đầu đếm thẳng từ detection_logs. Bucket hiện
+        tại (chứa `now`) được coi là trọn vì chưa có dữ liệu sau `now`.
+        """
+        current = now or vietnam_now()
+        granularity = "total"
+        aligned = since
+        aligned_until = None
+        if since is not None or until is not None:
+            granularity = self._pick_granularity(since, until or current) if since is not None else "day"
+        if since is not None:
+            aligned = self._truncate(since, granularity)
+            if aligned < since:
+                aligned += BUCKET_STEP[granularity]
+        if until is not None:
+            aligned_until = until if until >= current else self._truncate(until, granularity)
+
+        counts = {"total": 0, "alerts": 0, **{t: 0 for t in DETECTION_TYPES}}
+        if since is not None and aligned_until is not None and aligned >= aligned_until:
+            # Cửa sổ không chứa trọn bucket nào → đếm thẳng từ detection_logs
+            rows = await self._count_logs(user_id, camera_id, since, until)
+        else:
+            pipeline = [
+                {"$match": self._build_match(user_id, camera_id, granularity, aligned, aligned_until)},
+                {"$group": {
+                    "_id": "$detection_type",
+                    "count": {"$sum": "$count"},
+                    "alerts": {"$sum": "$alerts"},
+                }},
+            ]
+            rows = await self.collection.aggregate(pipeline).to_list(length=None)
+            if since is not None and aligned > since:
+                rows += await self._count_logs(user_id, camera_id, since, aligned)
+            if aligned_until is not None and aligned_until < until:
+                rows += await self._count_logs(user_id, camera_id, aligned_until, until)
+        for row in rows:
+            detection_type = row["_id"] or "unknown"
+            counts[detection_type] = counts.get(detection_type, 0) + row["count"]
+            counts["total"] += row["count"]
+            counts["alerts"] += row["alerts"]
+        return counts
+
+    async def _count_logs(self, user_id, camera_id, since: datetime, until: datetime) -> List[Dict[str, Any]]:
+        """Đếm trực tiếp detection_logs trong [since, until) theo loại (phần bucket lẻ)"""
+        match: Dict[str, Any] = {
+            "user_id": {"$exists": True, "$ne": None},
+            "timestamp": {"$gte": since, "$lt": until},
+        }
+        if user_id is not None:
+            match["user_id"] = user_id if isinstance(user_id, ObjectId) else ObjectId(user_id)
+        if camera_id is not None:
+            match["camera_id"] = camera_id if isinstance(camera_id, ObjectId) else ObjectId(camera_id)
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": DETECTION_TYPE_EXPR,
+                "count": {"$sum": 1},
+                "alerts": {"$sum": {"$cond": [{"$eq": ["$is_alert_sent", True]}, 1, 0]}},
+            }},
+        ]
+        return await self.db.detection_logs.aggregate(pipeline).to_list(length=None)
+
+    async def get_series(self, user_id, granularity: str, since: datetime,
+                         until: Optional[datetime] = None, camera_id=None) -> Dict[datetime, Dict[str, int]]:
+        """Lấy chuỗi bucket {bucket: {loại: count}} trong khoảng thời gian"""
+        pipeline = [
+            {"$match": self._build_match(user_id, camera_id, granularity, since, until)},
+            {"$group": {
+                "_id": {"bucket": "$bucket", "detection_type": "$detection_type"},
+                "count": {"$sum": "$count"},
+            }},
+        ]
+
+        series: Dict[datetime, Dict[str, int]] = {}
+        async for row in self.collection.aggregate(pipeline):
+            bucket = row["_id"]["bucket"]
+            entry = series.setdefault(bucket, {"total": 0, **{t: 0 for t in DETECTION_TYPES}})
+            detection_type = row["_id"]["detection_type"] or "unknown"
+            entry[detection_type] = entry.get(detection_type, 0) + row["count"]
+            entry["total"] += row["count"]
+        return series
+
+    async def get_camera_totals(self, user_id, limit: int = 5) -> List[Dict[str, Any]]:
+        """Top camera theo tổng số detection (toàn thời gian)"""
+        pipeline = [
+            {"$match": self._build_match(user_id, granularity="total")},
+            {"$group": {
+                "_id": "$camera_id",
+                "detection_count": {"$sum": "$count"},
+                "stranger_count": {
+                    "$sum": {"$cond": [{"$eq": ["$detection_type", "stranger"]}, "$count", 0]}
+                },
+            }},
+            {"$sort": {"detection_count": -1}},
+            {"$limit": limit},
+        ]
+        return await self.collection.aggregate(pipeline).to_list(length=limit)
+
+    async def rebuild_counters(self, user_id: Optional[str] = None) -> Dict[str, int]:
+        """
+        Catch-up job: tính lại bộ đếm từ detection_logs
+
+        Dùng khi bộ đếm bị lệch (dữ liệu cũ trước khi có rollup, xóa hàng loạt...).
+        Bucket minute/hour chỉ được tính lại trong thời gian RETENTION của chúng.
+        Bộ đếm mới được dựng trong collection tạm rồi mới thay cho bộ đếm cũ, nên
+        dashboard không thấy bộ đếm rỗng / dở dang trong lúc rebuild.
+        """
+        if self._rebuild_lock is None:
+            self._rebuild_lock = asyncio.Lock()
+        async with self._rebuild_lock:
+            from .index_service import index_service
+
+            temp = self.db[f"detection_counters_rebuild_{uuid.uuid4().hex}"]
+            try:
+                # $merge cần unique index của bộ đếm trên collection đích
+                await temp.create_indexes(index_service.declared_indexes()["detection_counters"])
+                await self._aggregate_counters(temp.name, user_id)
+
+                if user_id:
+                    await self._replace_user_counters(temp, ObjectId(user_id))
+                else:
+                    await temp.rename(self.collection.name, dropTarget=True)
+            finally:
+                await temp.drop()
+
+            counter_filter: Dict[str, Any] = {"user_id": ObjectId(user_id)} if user_id else {}
+            rebuilt = {
+                granularity: await self.collection.count_documents({**counter_filter, "granularity": granularity})
+                for granularity in ("minute", "hour", "day", "total")
+            }
+        print(f"✅ Detection counters rebuilt: {rebuilt}")
+        return rebuilt
+
+    async def _aggregate_counters(self, target: str, user_id: Optional[str] = None):
+        """Tổng hợp detection_logs thành các bucket trong collection `target`"""
+        match: Dict[str, Any] = {"user_id": {"$exists": True, "$ne": None}}
+        if user_id:
+            match["user_id"] = ObjectId(user_id)
+
+        now = vietnam_now()
+        for granularity in ("minute", "hour", "day", "total"):
+            stage_match = dict(match)
+            if granularity in self.RETENTION:
+                stage_match["timestamp"] = {"$gte": self._truncate(now - self.RETENTION[granularity], granularity)}
+
+            if granularity == "total":
+                bucket_expr: Any = {"$literal": TOTAL_BUCKET}
+            else:
+                bucket_expr = {"$dateTrunc": {"date": "$timestamp", "unit": granularity}}
+
+            project = {
+                "_id": 0,
+                "user_id": "$_id.user_id",
+                "camera_id": "$_id.camera_id",
+                "detection_type": "$_id.detection_type",
+                "granularity": {"$literal": granularity},
+                "bucket": "$_id.bucket",
+                "count": 1,
+                "alerts": 1,
+            }
+            if granularity in self.RETENTION:
+                retention_ms = int(self.RETENTION[granularity].total_seconds() * 1000)
+                project["expires_at"] = {"$add": ["$_id.bucket", retention_ms]}
+
+            pipeline = [
+                {"$match": stage_match},
+                {"$group": {
+                    "_id": {
+                        "user_id": "$user_id",
+                        "camera_id": {"$ifNull": ["$camera_id", None]},
+                        "detection_type": DETECTION_TYPE_EXPR,
+                        "bucket": bucket_expr,
+                    },
+                    "count": {"$sum": 1},
+                    "alerts": {"$sum": {"$cond": [{"$eq": ["$is_alert_sent", True]}, 1, 0]}},
+                }},
+                {"$project": project},
+                {"$merge": {
+                    "into": target,
+                    "on": ["user_id", "granularity", "bucket", "camera_id", "detection_type"],
+                    "whenMatched": "replace",
+                    "whenNotMatched": "insert",
+                }},
+            ]
+            await self.db.detection_logs.aggregate(pipeline).to_list(length=None)
+
+    async def _replace_user_counters(self, temp, user_oid: ObjectId, batch_size: int = 1000):
+        """Thay bộ đếm của một user bằng bộ đếm đã dựng (upsert từng bucket, rồi xóa bucket thừa)"""
+        rebuild_id = uuid.uuid4().hex
+        batch: List[ReplaceOne] = []
+        async for doc in temp.find({"user_id": user_oid}, {"_id": 0}):
+            doc["rebuild_id"] = rebuild_id
+            batch.append(ReplaceOne(
+                {key: doc[key] for key in ("user_id", "granularity", "bucket", "camera_id", "detection_type")},
+                doc,
+                upsert=True,
+            ))
+            if len(batch) >= batch_size:
+                await self.collection.bulk_write(batch, ordered=False)
+                batch = []
+        if batch:
+            await self.collection.bulk_write(batch, ordered=False)
+        await self.collection.delete_many({"user_id": user_oid, "rebuild_id": {"$ne": rebuild_id}})
+
+    async def rebuild_if_empty(self):
+        """Tính lại bộ đếm lần đầu nếu collection rỗng nhưng đã có detection_logs"""
+        try:
+            if await self.collection.estimated_document_count() > 0:
+                return
+            if await self.db.detection_logs.estimated_document_count() == 0:
+                return
+            await self.rebuild_counters()
+        except Exception as e:
+            print(f"Error rebuilding detection counters: {e}")
+
+
+# Global instance
+detection_counter_service = DetectionCounterService()
@@ -4,6 +4,8 @@ import asyncio
 import uuid
 from bson import ObjectId
 from ..database import get_database
+from .detection_counter_service import detection_counter_service
+from ..utils.pagination import apply_cursor, keyset_sort, split_page
 
 class DetectionOptimizerService:
     """
@@ -215,6 +217,7 @@ class DetectionOptimizerService:
             # Insert into detection_logs collection
             result = await self.collection_detections.insert_one(detection_doc)
             detection_id = str(result.inserted_id)
+            await detection_counter_service.record_detection_log(detection_doc)
             
             print(f"✅ Detection saved to database: {detection_data.get('person_name')} - ID: {detection_id}")
             return detection_id
@@ -305,8 +308,15 @@ class DetectionOptimizerService:
             print(f"Error getting user_id from camera: {e}")
             return None
     
-    async def get_sessions(self, user_id: str, filters: dict = None, limit: int = 50, skip: int = 0) -> List[dict]:
-        """Lấy danh sách detection sessions với filters"""
+    async def get_sessions(self, user_id: str, filters: dict = None, limit: int = 50, skip: int = 0,
+                           cursor: Optional[str] = None) -> List[dict]:
+        """Lấy danh sách detection sessions với filters (cursor ưu tiên hơn skip)"""
+        page = await self.get_sessions_page(user_id, filters, limit, skip, cursor)
+        return page["sessions"]
+    
+    async def get_sessions_page(self, user_id: str, filters: dict = None, limit: int = 50, skip: int = 0,
+                                cursor: Optional[str] = None) -> dict:
+        """Lấy một trang detection sessions kèm cursor cho trang tiếp theo"""
         try:
             query = {"user_id": ObjectId(user_id)}
             
@@ -320,13 +330,26 @@ class DetectionOptimizerService:
                 if filters.get("date_to"):
                     query.setdefault("session_start", {})["$lte"] = filters["date_to"]
             
-            sessions = []
-            cursor = self.collection_sessions.find(query).sort("session_start", -1).skip(skip).limit(limit)
+            # Keyset pagination trên (session_start, _id), skip giữ lại cho tương thích
+            find_cursor = self.collection_sessions.find(
+                apply_cursor(query, cursor, field="session_start")
+            ).sort(keyset_sort("session_start"))
+            if not cursor:
+                find_cursor = find_cursor.skip(skip)
+            documents, next_cursor = split_page(
+                await find_cursor.limit(limit + 1).to_list(length=limit + 1), limit, field="session_start"
+            )
             
-            async for session in cursor:
-                # Populate camera info
-                camera = await self.db.cameras.find_one({"_id": session["camera_id"]})
-                camera_name = camera.get("name", "Unknown") if camera else "Unknown"
+            # Lấy tên camera một lần cho cả trang
+            camera_ids = list({session["camera_id"] for session in documents if session.get("camera_id")})
+            camera_names = {}
+            if camera_ids:
+                async for camera in self.db.cameras.find({"_id": {"$in": camera_ids}}, {"name": 1}):
+                    camera_names[camera["_id"]] = camera.get("name", "Unknown")
+            
+            sessions = []
+            for session in documents:
+                camera_name = camera_names.get(session.get("camera_id"), "Unknown")
                 
                 # Calculate duration in minutes
                 start = session.get("session_start")
@@ -351,11 +374,13 @@ class DetectionOptimizerService:
                     "is_active": session.get("is_active", False)
                 })
             
-            return sessions
+            return {"sessions": sessions, "next_cursor": next_cursor}
             
+        except ValueError:
+            raise
         except Exception as e:
             print(f"Error getting detection sessions: {e}")
-            return []
+            return {"sessions": [], "next_cursor": None}
     
     async def get_session_stats(self, user_id: str) -> dict:
         """Lấy thống kê sessions"""
@@ -421,6 +446,8 @@ class DetectionOptimizerService:
                 "user_id": ObjectId(user_id),
                 "timestamp": {"$lt": cutoff_date}
             })
+            if detection_result.deleted_count > 0:
+                await detection_counter_service.rebuild_counters(str(user_id))
             
             return {
                 "sessions_deleted": session_result.deleted_count,
@@ -1,6 +1,7 @@
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, AsyncIterator
 from bson import ObjectId
 from ..database import get_database
+from ..config import get_settings
 from ..models.detection_log import (
     DetectionLog, 
     DetectionLogCreate, 
@@ -9,13 +10,21 @@ from ..models.detection_log import (
     DetectionFilter
 )
 from datetime import datetime, timedelta
-from ..utils.timezone_utils import vietnam_now
+from ..utils.timezone_utils import vietnam_now, DB_BUCKET_TIMEZONE
+from .detection_counter_service import detection_counter_service
+from ..utils.pagination import apply_cursor, keyset_sort, split_page
 import asyncio
 import base64
+import logging
 import os
 import uuid
 
+logger = logging.getLogger(__name__)
+
 class DetectionService:
+    def __init__(self):
+        self._retention_task: Optional[asyncio.Task] = None
+
     @property
     def db(self):
         return get_database()
@@ -63,6 +72,7 @@ class DetectionService:
             
             # Insert to database
             result = await self.collection.insert_one(detection_dict)
+            await detection_counter_service.record_detection_log(detection_dict)
             
             # Send notification if stranger detected
             if detection_data.detection_type == "stranger":
@@ -129,6 +139,11 @@ class DetectionService:
 
     async def get_user_detections(self, user_id: str, filters: DetectionFilter) -> List[Dict[str, Any]]:
         """Lấy danh sách detections của user với các bộ lọc"""
+        page = await self.get_user_detections_page(user_id, filters)
+        return page["detections"]
+
+    async def get_user_detections_page(self, user_id: str, filters: DetectionFilter) -> Dict[str, Any]:
+        """Lấy một trang detections kèm cursor cho trang tiếp theo"""
         try:
             print(f"🔵 DetectionService: Getting detections for user {user_id} with filters: {filters}")
             
@@ -159,8 +174,13 @@ class DetectionService:
                 
             print(f"🔵 Final MongoDB query: {query}")
                 
-            # Execute query with pagination
-            cursor = self.collection.find(query).sort("timestamp", -1).skip(filters.offset).limit(filters.limit)
+            # Keyset pagination khi có cursor, offset giữ lại cho tương thích
+            if filters.cursor:
+                apply_cursor(query, filters.cursor)
+                cursor = self.collection.find(query).sort(keyset_sort()).limit(filters.limit + 1)
+            else:
+                cursor = self.collection.find(query).sort(keyset_sort()).skip(filters.offset).limit(filters.limit + 1)
+            documents, next_cursor = split_page(await cursor.to_list(length=filters.limit + 1), filters.limit)
             
             # Get camera name lookup dict for efficiency
             camera_dict = {}
@@ -170,7 +190,7 @@ class DetectionService:
                 
             # Process results
             results = []
-            async for detection in cursor:
+            for detection in documents:
                 try:
                     # Validate required fields
                     if not detection.get("_id"):
@@ -234,45 +254,39 @@ class DetectionService:
                     continue
             
             print(f"✅ DetectionService: Found {len(results)} detections")
-            return results
+            return {"detections": results, "next_cursor": next_cursor}
             
+        except ValueError:
+            # Cursor không hợp lệ - để router trả về 400
+            raise
         except Exception as e:
             import traceback
             print(f"❌ Error getting user detections: {e}")
             traceback.print_exc()
-            return []
+            return {"detections": [], "next_cursor": None}
 
     async def get_detection_stats(self, user_id: str) -> DetectionStats:
         """Lấy thống kê detection"""
         try:
-            query = {"user_id": ObjectId(user_id)}
-            
-            # Basic counts
-            total_detections = await self.collection.count_documents(query)
-            stranger_detections = await self.collection.count_documents({
-                **query, "detection_type": "stranger"
-            })
-            known_person_detections = await self.collection.count_documents({
-                **query, "detection_type": "known_person"
-            })
-            
-            # Time-based counts
+            # Time-based counts (đọc từ bộ đếm rollup)
             now = vietnam_now()
             today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
             week_start = now - timedelta(days=7)
             month_start = now - timedelta(days=30)
             
-            today_detections = await self.collection.count_documents({
-                **query, "timestamp": {"$gte": today_start}
-            })
+            totals, today, this_week, this_month = await asyncio.gather(
+                detection_counter_service.get_counts(user_id),
+                detection_counter_service.get_counts(user_id, since=today_start, now=now, until=now),
+                detection_counter_service.get_counts(user_id, since=week_start, now=now, until=now),
+                detection_counter_service.get_counts(user_id, since=month_start, now=now, until=now),
+            )
             
-            this_week_detections = await self.collection.count_documents({
-                **query, "timestamp": {"$gte": week_start}
-            })
-            
-            this_month_detections = await self.collection.count_documents({
-                **query, "timestamp": {"$gte": month_start}
-            })
+            total_detections = totals["total"]
+            stranger_detections = totals["stranger"]
+            known_person_detections = totals["known_person"]
+            today_detections = today["total"]
+            this_week_detections = this_week["total"]
+            this_month_detections = this_month["total"]
             
             # Active cameras count
             cameras_active = await self.db.cameras.count_documents({
@@ -392,76 +406,126 @@ class DetectionService:
                 "user_id": ObjectId(user_id)
             })
             
+            if result.deleted_count > 0:
+                await detection_counter_service.record_detection_log(detection, delta=-1)
+            
             return result.deleted_count > 0
             
         except Exception as e:
             print(f"Error deleting detection: {e}")
             return False
 
+    async def _delete_logs(self, detections: List[Dict[str, Any]]) -> int:
+        """
+        Xóa từng detection log kèm file ảnh và trừ bộ đếm
+
+        delete_one từng document để chỉ log do lần gọi này xóa mới bị trừ bộ
+        đếm / xóa file (nhiều worker có thể cùng chạy dọn dẹp).
+        """
+        results = await asyncio.gather(*[self.collection.delete_one({"_id": detection["_id"]}) for detection in detections])
+        deleted = [detection for detection, result in zip(detections, results) if result.deleted_count]
+        for detection in deleted:
+            if detection.get("image_path") and os.path.exists(detection["image_path"]):
+                try:
+                    os.remove(detection["image_path"])
+                except:
+                    pass
+        await detection_counter_service.record_deletions(deleted)
+        return len(deleted)
+
+    async def _purge(self, query: Dict[str, Any], batch_size: int = 500) -> int:
+        """Xóa theo batch mọi detection log khớp query"""
+        projection = {"user_id": 1, "camera_id": 1, "detection_type": 1, "timestamp": 1, "is_alert_sent": 1, "image_path": 1}
+        deleted = 0
+        while True:
+            batch = await self.collection.find(query, projection).sort("timestamp", 1).limit(batch_size).to_list(length=batch_size)
+            if not batch:
+                break
+            deleted += await self._delete_logs(batch)
+            if len(batch) < batch_size:
+                break
+        return deleted
+
     async def cleanup_old_detections(self, user_id: str, days_to_keep: int = 30) -> int:
         """Dọn dẹp detection logs cũ"""
         try:
             cutoff_date = vietnam_now() - timedelta(days=days_to_keep)
-            
-            # Get old detections to delete image files
-            old_detections = []
-            async for detection in self.collection.find({
-                "user_id": ObjectId(user_id),
-                "timestamp": {"$lt": cutoff_date}
-            }):
-                old_detections.append(detection)
-            
-            # Delete image files
-            for detection in old_detections:
-                if detection.get("image_path") and os.path.exists(detection["image_path"]):
-                    try:
-                        os.remove(detection["image_path"])
-                    except:
-                        pass
-            
-            # Delete from database
-            result = await self.collection.delete_many({
+            return await self._purge({
                 "user_id": ObjectId(user_id),
                 "timestamp": {"$lt": cutoff_date}
             })
-            
-            return result.deleted_count
-            
         except Exception as e:
             print(f"Error cleaning up old detections: {e}")
             return 0
+
+    async def purge_expired_detections(self) -> int:
+        """Xóa detection log (mọi user) cũ hơn detection_logs_retention_days"""
+        settings = get_settings()
+        if settings.detection_logs_retention_days <= 0:
+            return 0
+        # timestamp lưu giờ Việt Nam (naive) nên cutoff cũng tính theo vietnam_now()
+        cutoff_date = vietnam_now() - timedelta(days=settings.detection_logs_retention_days)
+        deleted = await self._purge({"timestamp": {"$lt": cutoff_date}})
+        if deleted:
+            print(f"🧹 Retention: deleted {deleted} detection logs older than {cutoff_date}")
+        return deleted
+
+    def start_retention_task(self):
+        """Bắt đầu job retention định kỳ (chỉ khi detection_logs_retention_enabled)"""
+        if self._retention_task is None and get_settings().detection_logs_retention_enabled:
+            self._retention_task = asyncio.create_task(self._retention_loop())
+
+    async def stop_retention_task(self):
+        """Dừng job retention"""
+        if self._retention_task:
+            self._retention_task.cancel()
+            try:
+                await self._retention_task
+            except asyncio.CancelledError:
+                pass
+            self._retention_task = None
+
+    async def _retention_loop(self):
+        """Chạy purge_expired_detections mỗi detection_logs_retention_interval_minutes"""
+        while True:
+            try:
+                await self.purge_expired_detections()
+                await asyncio.sleep(max(1, get_settings().detection_logs_retention_interval_minutes) * 60)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                print(f"Error in detection retention task: {e}")
+                await asyncio.sleep(60)
         
     async def get_stats_overview(self, user_id: str) -> Dict[str, Any]:
         """Lấy thống kê tổng quan chi tiết"""
         try:
-            query = {"user_id": ObjectId(user_id)}
-            
-            # Basic counts
-            total_detections = await self.collection.count_documents(query)
-            stranger_detections = await self.collection.count_documents({
-                **query, "detection_type": "stranger"
-            })
-            known_person_detections = await self.collection.count_documents({
-                **query, "detection_type": "known_person"
-            })
-            
             # Time-based statistics
-            now = datetime.utcnow()
+            now = vietnam_now()
             today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
             week_start = now - timedelta(days=7)
             month_start = now - timedelta(days=30)
+            yesterday = now - timedelta(hours=24)
             
-            today_detections = await self.collection.count_documents({
-                **query, "timestamp": {"$gte": today_start}
-            })
-            
-            this_week_detections = await self.collection.count_documents({
-                **query, "timestamp": {"$gte": week_start}
-            })
+            # Detection counts đọc từ bộ đếm rollup (vài truy vấn theo index)
+            totals, today, this_week, this_month, last_24h, hourly_series, camera_stats = await asyncio.gather(
+                detection_counter_service.get_counts(user_id),
+                detection_counter_service.get_counts(user_id, since=today_start, now=now, until=now),
+                detection_counter_service.get_counts(user_id, since=week_start, now=now, until=now),
+                detection_counter_service.get_counts(user_id, since=month_start, now=now, until=now),
+                detection_counter_service.get_counts(user_id, since=yesterday, now=now, until=now),
+                detection_counter_service.get_series(user_id, "hour", today_start, today_start + timedelta(days=1)),
+                detection_counter_service.get_camera_totals(user_id, limit=5),
+            )
             
-            this_month_detections = await self.collection.count_documents({
-                **query, "timestamp": {"$gte": month_start}
-            })
+            total_detections = totals["total"]
+            stranger_detections = totals["stranger"]
+            known_person_detections = totals["known_person"]
+            today_detections = today["total"]
+            this_week_detections = this_week["total"]
+            this_month_detections = this_month["total"]
+            recent_stranger_alerts = last_24h["stranger"]
+            alerts_sent = totals["alerts"]
             
             # Camera statistics
             total_cameras = await self.db.cameras.count_documents({
@@ -484,62 +548,33 @@ class DetectionService:
                 "is_active": True
             })
             
-            # Recent activity (last 24 hours)
-            yesterday = now - timedelta(hours=24)
-            recent_stranger_alerts = await self.collection.count_documents({
-                **query, 
-                "detection_type": "stranger",
-                "timestamp": {"$gte": yesterday}
-            })
-            
             # Detection accuracy (simple calculation)
             detection_accuracy = 0.0
             if total_detections > 0:
                 detection_accuracy = (known_person_detections / total_detections) * 100
             
-            # Alert statistics
-            alerts_sent = await self.collection.count_documents({
-                **query, 
-                "is_alert_sent": True
-            })
-            
             # Top cameras by detections
             top_cameras = []
-            camera_stats = await self.collection.aggregate([
-                {"$match": query},
-                {"$group": {
-                    "_id": "$camera_id",
-                    "detection_count": {"$sum": 1},
-                    "stranger_count": {
-                        "$sum": {"$cond": [{"$eq": ["$detection_type", "stranger"]}, 1, 0]}
-                    }
-                }},
-                {"$sort": {"detection_count": -1}},
-                {"$limit": 5}
-            ]).to_list(length=5)
+            camera_names = {}
+            camera_ids = [stat["_id"] for stat in camera_stats if stat["_id"] is not None]
+            if camera_ids:
+                async for camera_data in self.db.cameras.find({"_id": {"$in": camera_ids}}, {"name": 1}):
+                    camera_names[camera_data["_id"]] = camera_data.get("name", "Unknown Camera")
             
             for stat in camera_stats:
-                camera_data = await self.db.cameras.find_one({"_id": stat["_id"]})
-                if camera_data:
+                if stat["_id"] in camera_names:
                     top_cameras.append({
                         "camera_id": str(stat["_id"]),
-                        "camera_name": camera_data["name"],
+                        "camera_name": camera_names[stat["_id"]],
                         "detection_count": stat["detection_count"],
                         "stranger_count": stat["stranger_count"]
                     })
             
-            # Hourly detection pattern (last 24 hours)
+            # Hourly detection pattern (today)
             hourly_pattern = {}
             for hour in range(24):
                 hour_start = today_start + timedelta(hours=hour)
-                hour_end = hour_start + timedelta(hours=1)
-                
-                count = await self.collection.count_documents({
-                    **query,
-                    "timestamp": {"$gte": hour_start, "$lt": hour_end}
-                })
-                
-                hourly_pattern[f"{hour:02d}:00"] = count
+                hourly_pattern[f"{hour:02d}:00"] = hourly_series.get(hour_start, {}).get("total", 0)
             
             return {
                 "overview": {
@@ -661,62 +696,67 @@ class DetectionService:
                 }
             }
         
+    async def _aggregate_time_buckets(self, match: Dict[str, Any], unit: str) -> Dict[datetime, Dict[str, int]]:
+        """Đếm detection theo bucket thời gian ($dateTrunc) và loại trong một truy vấn aggregate"""
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": {
+                    "bucket": {"$dateTrunc": {"date": "$timestamp", "unit": unit, "timezone": DB_BUCKET_TIMEZONE}},
+                    "detection_type": "$detection_type"
+                },
+                "count": {"$sum": 1}
+            }}
+        ]
+        
+        buckets: Dict[datetime, Dict[str, int]] = {}
+        async for row in self.collection.aggregate(pipeline):
+            entry = buckets.setdefault(row["_id"]["bucket"], {"total": 0, "stranger": 0, "known_person": 0})
+            detection_type = row["_id"].get("detection_type")
+            if detection_type in entry:
+                entry[detection_type] += row["count"]
+            entry["total"] += row["count"]
+        return buckets
+
     async def get_chart_data(self, user_id: str, time_range: str = "7d", chart_type: str = "area") -> Dict[str, Any]:
         """Lấy dữ liệu cho charts"""
         try:
             days = {"24h": 1, "7d": 7, "30d": 30, "90d": 90}.get(time_range, 7)
-            start_date = datetime.utcnow() - timedelta(days=days)
+            now = vietnam_now()
             
-            query = {
-                "user_id": ObjectId(user_id),
-                "timestamp": {"$gte": start_date}
-            }
+            labels = []
+            stranger_data = []
+            known_data = []
             
             # Generate chart data based on time range
             if time_range == "24h":
                 # Hourly data
-                labels = []
-                stranger_data = []
-                known_data = []
+                start_date = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=23)
+                buckets = await self._aggregate_time_buckets({
+                    "user_id": ObjectId(user_id),
+                    "timestamp": {"$gte": start_date}
+                }, "hour")
                 
                 for hour in range(24):
                     hour_start = start_date + timedelta(hours=hour)
-                    hour_end = hour_start + timedelta(hours=1)
-                    
-                    hour_query = {**query, "timestamp": {"$gte": hour_start, "$lt": hour_end}}
-                    
-                    strangers = await self.collection.count_documents({
-                        **hour_query, "detection_type": "stranger"
-                    })
-                    known = await self.collection.count_documents({
-                        **hour_query, "detection_type": "known_person"
-                    })
-                    
-                    labels.append(f"{hour:02d}:00")
-                    stranger_data.append(strangers)
-                    known_data.append(known)
+                    counts = buckets.get(hour_start, {})
+                    labels.append(hour_start.strftime("%H:00"))
+                    stranger_data.append(counts.get("stranger", 0))
+                    known_data.append(counts.get("known_person", 0))
             else:
                 # Daily data
-                labels = []
-                stranger_data = []
-                known_data = []
+                start_date = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+                buckets = await self._aggregate_time_buckets({
+                    "user_id": ObjectId(user_id),
+                    "timestamp": {"$gte": start_date}
+                }, "day")
                 
                 for i in range(days):
                     day_start = start_date + timedelta(days=i)
-                    day_end = day_start + timedelta(days=1)
-                    
-                    day_query = {**query, "timestamp": {"$gte": day_start, "$lt": day_end}}
-                    
-                    strangers = await self.collection.count_documents({
-                        **day_query, "detection_type": "stranger"
-                    })
-                    known = await self.collection.count_documents({
-                        **day_query, "detection_type": "known_person"
-                    })
-                    
+                    counts = buckets.get(day_start, {})
                     labels.append(day_start.strftime("%m/%d"))
-                    stranger_data.append(strangers)
-                    known_data.append(known)
+                    stranger_data.append(counts.get("stranger", 0))
+                    known_data.append(counts.get("known_person", 0))
             
             return {
                 "chart_type": chart_type,
@@ -755,34 +795,25 @@ class DetectionService:
             if date:
                 target_date = datetime.strptime(date, "%Y-%m-%d")
             else:
-                target_date = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+                target_date = vietnam_now().replace(hour=0, minute=0, second=0, microsecond=0)
             
             day_start = target_date.replace(hour=0, minute=0, second=0, microsecond=0)
             day_end = day_start + timedelta(days=1)
             
+            # Một truy vấn aggregate cho cả 24 giờ
+            buckets = await self._aggregate_time_buckets({
+                "user_id": ObjectId(user_id),
+                "timestamp": {"$gte": day_start, "$lt": day_end}
+            }, "hour")
+            
             hourly_data = []
             for hour in range(24):
-                hour_start = day_start + timedelta(hours=hour)
-                hour_end = hour_start + timedelta(hours=1)
-                
-                query = {
-                    "user_id": ObjectId(user_id),
-                    "timestamp": {"$gte": hour_start, "$lt": hour_end}
-                }
-                
-                total = await self.collection.count_documents(query)
-                strangers = await self.collection.count_documents({
-                    **query, "detection_type": "stranger"
-                })
-                known = await self.collection.count_documents({
-                    **query, "detection_type": "known_person"
-                })
-                
+                counts = buckets.get(day_start + timedelta(hours=hour), {})
                 hourly_data.append({
                     "hour": f"{hour:02d}:00",
-                    "total_detections": total,
-                    "stranger_detections": strangers,
-                    "known_person_detections": known
+                    "total_detections": counts.get("total", 0),
+                    "stranger_detections": counts.get("stranger", 0),
+                    "known_person_detections": counts.get("known_person", 0)
                 })
             
             return {
@@ -798,7 +829,7 @@ class DetectionService:
         except Exception as e:
             print(f"Error getting hourly stats: {e}")
             return {
-                "date": date or datetime.utcnow().strftime("%Y-%m-%d"),
+                "date": date or vietnam_now().strftime("%Y-%m-%d"),
                 "hourly_stats": [],
                 "daily_summary": {
                     "total_detections": 0,
@@ -810,31 +841,23 @@ class DetectionService:
     async def get_realtime_stats(self, user_id: str) -> Dict[str, Any]:
         """Lấy thống kê real-time (last 30 minutes)"""
         try:
-            now = datetime.utcnow()
+            now = vietnam_now()
             last_30_min = now - timedelta(minutes=30)
             last_5_min = now - timedelta(minutes=5)
             
-            query_30min = {
-                "user_id": ObjectId(user_id),
-                "timestamp": {"$gte": last_30_min}
-            }
-            
-            query_5min = {
-                "user_id": ObjectId(user_id),
-                "timestamp": {"$gte": last_5_min}
-            }
+            # Đọc bucket theo phút từ bộ đếm rollup
+            counts_30min, counts_5min = await asyncio.gather(
+                detection_counter_service.get_counts(user_id, since=last_30_min, now=now, until=now),
+                detection_counter_service.get_counts(user_id, since=last_5_min, now=now, until=now),
+            )
             
             # Last 30 minutes
-            detections_30min = await self.collection.count_documents(query_30min)
-            strangers_30min = await self.collection.count_documents({
-                **query_30min, "detection_type": "stranger"
-            })
+            detections_30min = counts_30min["total"]
+            strangers_30min = counts_30min["stranger"]
             
             # Last 5 minutes
-            detections_5min = await self.collection.count_documents(query_5min)
-            strangers_5min = await self.collection.count_documents({
-                **query_5min, "detection_type": "stranger"
-            })
+            detections_5min = counts_5min["total"]
+            strangers_5min = counts_5min["stranger"]
             
             # Active cameras
             active_cameras = await self.db.cameras.count_documents({
@@ -887,52 +910,107 @@ class DetectionService:
                 }
             }
 
-    async def export_stats(self, user_id: str, time_range: str = "7d", format: str = "csv") -> str:
-        """Export thống kê detection"""
+    EXPORT_FIELDS = [
+        "timestamp", "camera_name", "detection_type",
+        "person_name", "confidence", "similarity_score"
+    ]
+
+    def build_export_query(self, user_id: str, time_range: str = "7d",
+                           camera_id: Optional[str] = None, detection_type: Optional[str] = None,
+                           start_date: Optional[datetime] = None,
+                           end_date: Optional[datetime] = None) -> Dict[str, Any]:
+        """Tạo query export (start_date/end_date ưu tiên hơn time_range)"""
+        days = {"24h": 1, "7d": 7, "30d": 30, "90d": 90}.get(time_range, 7)
+        query: Dict[str, Any] = {
+            "user_id": ObjectId(user_id),
+            "timestamp": {"$gte": start_date or vietnam_now() - timedelta(days=days)}
+        }
+        if end_date:
+            query["timestamp"]["$lte"] = end_date
+        if camera_id:
+            query["camera_id"] = ObjectId(camera_id)
+        if detection_type:
+            query["detection_type"] = detection_type
+        return query
+
+    async def stream_export(self, user_id: str, query: Dict[str, Any], format: str = "csv",
+                            batch_size: int = 1000) -> AsyncIterator[str]:
+        """
+        Export detection theo từng chunk (csv / json / ndjson)
+
+        Tên camera được lấy một lần trước khi duyệt cursor, mỗi chunk chứa
+        tối đa `batch_size` dòng nên bộ nhớ không phụ thuộc vào số bản ghi.
+        """
+        import csv
+        import io
+        import json
+
+        camera_names = {}
+        async for camera in self.db.cameras.find({"user_id": ObjectId(user_id)}, {"name": 1}):
+            camera_names[camera["_id"]] = camera.get("name", "Unknown")
+
+        projection = {
+            "timestamp": 1, "camera_id": 1, "detection_type": 1,
+            "person_name": 1, "confidence": 1, "similarity_score": 1
+        }
+        cursor = self.collection.find(query, projection).sort("timestamp", -1).batch_size(batch_size)
+
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=self.EXPORT_FIELDS) if format == "csv" else None
+        if writer:
+            writer.writeheader()
+        elif format == "json":
+            buffer.write("[")
+
+        rows = 0
         try:
-            days = {"24h": 1, "7d": 7, "30d": 30, "90d": 90}.get(time_range, 7)
-            start_date = datetime.utcnow() - timedelta(days=days)
-            
-            query = {
-                "user_id": ObjectId(user_id),
-                "timestamp": {"$gte": start_date}
-            }
-            
-            # Get detection data
-            detections = []
-            async for detection in self.collection.find(query).sort("timestamp", -1):
-                # Get camera name
-                camera = await self.db.cameras.find_one({"_id": detection["camera_id"]})
-                camera_name = camera["name"] if camera else "Unknown"
-                
-                detections.append({
-                    "timestamp": detection["timestamp"].isoformat(),
-                    "camera_name": camera_name,
-                    "detection_type": detection["detection_type"],
+            async for detection in cursor:
+                timestamp = detection.get("timestamp")
+                row = {
+                    "timestamp": timestamp.isoformat() if timestamp else "",
+                    "camera_name": camera_names.get(detection.get("camera_id"), "Unknown"),
+                    "detection_type": detection.get("detection_type", "unknown"),
                     "person_name": detection.get("person_name", "Unknown"),
                     "confidence": detection.get("confidence", 0.0),
                     "similarity_score": detection.get("similarity_score", 0)
-                })
-            
-            if format == "csv":
-                import csv
-                import io
-                
-                output = io.StringIO()
-                writer = csv.DictWriter(output, fieldnames=[
-                    "timestamp", "camera_name", "detection_type", 
-                    "person_name", "confidence", "similarity_score"
-                ])
-                writer.writeheader()
-                writer.writerows(detections)
-                return output.getvalue()
-            
-            elif format == "json":
-                import json
-                return json.dumps(detections, indent=2)
-            
-            else:
+                }
+
+                if writer:
+                    writer.writerow(row)
+                elif format == "json":
+                    buffer.write(("," if rows else "") + json.dumps(row))
+                else:
+                    buffer.write(json.dumps(row) + "\n")
+                rows += 1
+
+                if rows % batch_size == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate(0)
+        except Exception as e:
+            # Response đã bắt đầu gửi: raise để ngắt stream (client thấy transfer lỗi),
+            # không ghi phần kết thúc khiến file bị cắt trông như hoàn chỉnh
+            logger.error(f"Error streaming export after {rows} rows: {e}")
+            raise
+
+        if format == "json":
+            buffer.write("]")
+        if buffer.tell():
+            yield buffer.getvalue()
+        print(f"✅ Exported {rows} detections ({format})")
+
+    async def export_stats(self, user_id: str, time_range: str = "7d", format: str = "csv",
+                           camera_id: Optional[str] = None, detection_type: Optional[str] = None,
+                           start_date: Optional[datetime] = None,
+                           end_date: Optional[datetime] = None) -> str:
+        """Export thống kê detection (toàn bộ nội dung, dùng stream_export cho dữ liệu lớn)"""
+        try:
+            if format not in ("csv", "json", "ndjson"):
                 return "Unsupported format"
+
+            query = self.build_export_query(user_id, time_range, camera_id, detection_type, start_date, end_date)
+            chunks = [chunk async for chunk in self.stream_export(user_id, query, format)]
+            return "".join(chunks)
                 
         except Exception as e:
             print(f"Error exporting stats: {e}")
@@ -950,34 +1028,38 @@ class DetectionService:
             if filters.camera_id:
                 query["camera_id"] = ObjectId(filters.camera_id)
                 
-            if filters.date_from or filters.date_to:
+            if filters.start_date or filters.end_date:
                 query["timestamp"] = {}
-                if filters.date_from:
-                    query["timestamp"]["$gte"] = filters.date_from
-                if filters.date_to:
-                    query["timestamp"]["$lte"] = filters.date_to
-            
-            # Calculate pagination
-            skip = (filters.page - 1) * filters.limit
+                if filters.start_date:
+                    query["timestamp"]["$gte"] = filters.start_date
+                if filters.end_date:
+                    query["timestamp"]["$lte"] = filters.end_date
+            
+            # Keyset pagination khi có cursor, page giữ lại cho tương thích
+            page_query = dict(query)
+            if filters.cursor:
+                apply_cursor(page_query, filters.cursor)
+                cursor = self.collection.find(page_query).sort(keyset_sort()).limit(filters.limit + 1)
+            else:
+                skip = (filters.page - 1) * filters.limit
+                cursor = self.collection.find(page_query).sort(keyset_sort()).skip(skip).limit(filters.limit + 1)
+            documents, next_cursor = split_page(await cursor.to_list(length=filters.limit + 1), filters.limit)
             
-            # Execute query
-            cursor = self.collection.find(query).sort("timestamp", -1).skip(skip).limit(filters.limit)
+            # Lấy tên camera một lần cho cả trang
+            camera_ids = list({doc["camera_id"] for doc in documents if doc.get("camera_id")})
+            camera_names = {}
+            if camera_ids:
+                async for camera in self.db.cameras.find({"_id": {"$in": camera_ids}}, {"name": 1}):
+                    camera_names[camera["_id"]] = camera.get("name", "Unknown")
             
             # Convert to list
             detections = []
-            async for doc in cursor:
-                # Get camera name if available
-                camera_name = "Unknown"
-                if "camera_id" in doc:
-                    camera = await self.db.cameras.find_one({"_id": doc["camera_id"]})
-                    if camera:
-                        camera_name = camera.get("name", "Unknown")
-                
+            for doc in documents:
                 # Format detection
                 detection = {
                     "id": str(doc["_id"]),
-                    "camera_id": str(doc["camera_id"]),
-                    "camera_name": camera_name,
+                    "camera_id": str(doc.get("camera_id", "")),
+                    "camera_name": camera_names.get(doc.get("camera_id"), "Unknown"),
                     "detection_type": doc.get("detection_type", "unknown"),
                     "person_id": str(doc["person_id"]) if doc.get("person_id") else None,
                     "person_name": doc.get("person_name", "Unknown"),
@@ -989,14 +1071,11 @@ class DetectionService:
                 detections.append(detection)
             
             # Get counts
-            total_count = await self.collection.count_documents(query)
-            
-            # Count by type
-            query_known = {**query, "detection_type": "known_person"}
-            known_persons = await self.collection.count_documents(query_known)
-            
-            query_stranger = {**query, "detection_type": "stranger"}
-            strangers = await self.collection.count_documents(query_stranger)
+            total_count, known_persons, strangers = await asyncio.gather(
+                self.collection.count_documents(query),
+                self.collection.count_documents({**query, "detection_type": "known_person"}),
+                self.collection.count_documents({**query, "detection_type": "stranger"})
+            )
             
             return {
                 "detections": detections,
@@ -1004,9 +1083,12 @@ class DetectionService:
                 "known_persons": known_persons,
                 "strangers": strangers,
                 "page": filters.page,
-                "limit": filters.limit
+                "limit": filters.limit,
+                "next_cursor": next_cursor
             }
             
+        except ValueError:
+            raise
         except Exception as e:
             print(f"Error getting detections: {e}")
             return {
@@ -1015,7 +1097,8 @@ class DetectionService:
                 "known_persons": 0,
                 "strangers": 0,
                 "page": filters.page,
-                "limit": filters.limit
+                "limit": filters.limit,
+                "next_cursor": None
             }
         
     async def get_trends_data(self, user_id: str, time_range: str = "7d") -> Dict[str, Any]:
@@ -1023,31 +1106,23 @@ class DetectionService:
         try:
             # Parse time range
             days = {"7d": 7, "30d": 30, "90d": 90, "1y": 365}.get(time_range, 7)
-            start_date = datetime.utcnow() - timedelta(days=days)
+            today_start = vietnam_now().replace(hour=0, minute=0, second=0, microsecond=0)
+            start_date = today_start - timedelta(days=days - 1)
             
-            query = {
+            # Daily statistics - một truy vấn aggregate cho toàn bộ khoảng thời gian
+            daily_buckets = await self._aggregate_time_buckets({
                 "user_id": ObjectId(user_id),
                 "timestamp": {"$gte": start_date}
-            }
+            }, "day")
             
-            # Daily statistics
             daily_stats = []
             for i in range(days):
                 day_start = start_date + timedelta(days=i)
-                day_end = day_start + timedelta(days=1)
+                counts = daily_buckets.get(day_start, {})
                 
-                day_query = {
-                    **query,
-                    "timestamp": {"$gte": day_start, "$lt": day_end}
-                }
-                
-                total_detections = await self.collection.count_documents(day_query)
-                stranger_detections = await self.collection.count_documents({
-                    **day_query, "detection_type": "stranger"
-                })
-                known_detections = await self.collection.count_documents({
-                    **day_query, "detection_type": "known_person"
-                })
+                total_detections = counts.get("total", 0)
+                stranger_detections = counts.get("stranger", 0)
+                known_detections = counts.get("known_person", 0)
                 
                 # Calculate accuracy for the day
                 accuracy_rate = 0
@@ -1062,31 +1137,26 @@ class DetectionService:
                     "accuracy_rate": round(accuracy_rate, 1)
                 })
             
-            # Monthly comparison (last 6 months)
+            # Monthly comparison (last 6 months) - một truy vấn aggregate theo tháng
+            month_starts = []
+            month_start = today_start.replace(day=1)
+            for _ in range(6):
+                month_starts.append(month_start)
+                month_start = (month_start - timedelta(days=1)).replace(day=1)
+            month_starts.reverse()  # Show chronological order
+            
+            monthly_buckets = await self._aggregate_time_buckets({
+                "user_id": ObjectId(user_id),
+                "timestamp": {"$gte": month_starts[0].replace(year=month_starts[0].year - 1)}
+            }, "month")
+            
             monthly_stats = []
-            current_date = datetime.utcnow()
-            for i in range(6):
-                month_start = current_date.replace(day=1) - timedelta(days=i * 30)
-                month_end = month_start + timedelta(days=32)
-                month_end = month_end.replace(day=1) - timedelta(days=1)
-                
-                month_query = {
-                    **query,
-                    "timestamp": {"$gte": month_start, "$lt": month_end}
-                }
-                
-                current_month_detections = await self.collection.count_documents(month_query)
+            for month_start in month_starts:
+                current_month_detections = monthly_buckets.get(month_start, {}).get("total", 0)
                 
                 # Previous year same month
                 prev_year_start = month_start.replace(year=month_start.year - 1)
-                prev_year_end = month_end.replace(year=month_end.year - 1)
-                
-                prev_year_query = {
-                    "user_id": ObjectId(user_id),
-                    "timestamp": {"$gte": prev_year_start, "$lt": prev_year_end}
-                }
-                
-                prev_year_detections = await self.collection.count_documents(prev_year_query)
+                prev_year_detections = monthly_buckets.get(prev_year_start, {}).get("total", 0)
                 
                 # Calculate growth rate
                 growth_rate = 0
@@ -1100,8 +1170,6 @@ class DetectionService:
                     "growth_rate": round(growth_rate, 1)
                 })
             
-            monthly_stats.reverse()  # Show chronological order
-            
             # Get basic overview for patterns
             overview_stats = await self.get_stats_overview(user_id)
             
@@ -1216,28 +1284,72 @@ class DetectionService:
     async def generate_report_data(self, user_id: str, report_config: Dict[str, Any]) -> Dict[str, Any]:
         """Tạo dữ liệu báo cáo thực tế từ hệ thống"""
         try:
-            start_date = datetime.fromisoformat(report_config.get('start_date', (datetime.utcnow() - timedelta(days=7)).isoformat()))
-            end_date = datetime.fromisoformat(report_config.get('end_date', datetime.utcnow().isoformat()))
+            start_date = datetime.fromisoformat(report_config.get('start_date', (vietnam_now() - timedelta(days=7)).isoformat()))
+            end_date = datetime.fromisoformat(report_config.get('end_date', vietnam_now().isoformat()))
             detection_type = report_config.get('detection_type', 'all')
             
             # Base query
-            query = {
+            base_query = {
                 "user_id": ObjectId(user_id),
                 "timestamp": {"$gte": start_date, "$lte": end_date}
             }
             
             # Add detection type filter if specified
+            query = dict(base_query)
+            type_filter = []
             if detection_type in ['known_person', 'stranger']:
                 query["detection_type"] = detection_type
+                type_filter = [{"$match": {"detection_type": detection_type}}]
+            
+            # Một truy vấn aggregate ($facet) cho tổng, theo ngày, theo giờ và theo camera.
+            # Số stranger/known luôn tính trên toàn bộ loại, các số liệu còn lại theo bộ lọc.
+            pipeline = [
+                {"$match": base_query},
+                {"$facet": {
+                    "by_type": [
+                        {"$group": {"_id": "$detection_type", "count": {"$sum": 1}}}
+                    ],
+                    "daily": [
+                        {"$group": {
+                            "_id": {
+                                "day": {"$dateTrunc": {"date": "$timestamp", "unit": "day", "timezone": DB_BUCKET_TIMEZONE}},
+                                "detection_type": "$detection_type"
+                            },
+                            "count": {"$sum": 1}
+                        }}
+                    ],
+                    "hourly": type_filter + [
+                        {"$group": {
+                            "_id": {"$hour": {"date": "$timestamp", "timezone": DB_BUCKET_TIMEZONE}},
+                            "count": {"$sum": 1}
+                        }}
+                    ],
+                    "cameras": type_filter + [
+                        {"$group": {
+                            "_id": "$camera_id",
+                            "detection_count": {"$sum": 1},
+                            "stranger_count": {
+                                "$sum": {"$cond": [{"$eq": ["$detection_type", "stranger"]}, 1, 0]}
+                            },
+                            "known_count": {
+                                "$sum": {"$cond": [{"$eq": ["$detection_type", "known_person"]}, 1, 0]}
+                            }
+                        }},
+                        {"$sort": {"detection_count": -1}},
+                        {"$limit": 10}
+                    ]
+                }}
+            ]
+            facets = (await self.collection.aggregate(pipeline).to_list(length=1))[0]
             
             # Get basic statistics
-            total_detections = await self.collection.count_documents(query)
-            
-            stranger_query = {**query, "detection_type": "stranger"}
-            known_query = {**query, "detection_type": "known_person"}
-            
-            stranger_detections = await self.collection.count_documents(stranger_query)
-            known_detections = await self.collection.count_documents(known_query)
+            type_counts = {row["_id"]: row["count"] for row in facets["by_type"]}
+            if type_filter:
+                total_detections = type_counts.get(detection_type, 0)
+            else:
+                total_detections = sum(type_counts.values())
+            stranger_detections = type_counts.get("stranger", 0)
+            known_detections = type_counts.get("known_person", 0)
             
             # Calculate accuracy
             accuracy_rate = 0
@@ -1245,94 +1357,66 @@ class DetectionService:
                 accuracy_rate = (known_detections / total_detections) * 100
             
             # Get daily trend data
+            daily_counts: Dict[datetime, Dict[str, int]] = {}
+            for row in facets["daily"]:
+                entry = daily_counts.setdefault(row["_id"]["day"], {"total": 0, "stranger": 0, "known_person": 0})
+                row_type = row["_id"].get("detection_type")
+                if row_type in ("stranger", "known_person"):
+                    entry[row_type] += row["count"]
+                if not type_filter or row_type == detection_type:
+                    entry["total"] += row["count"]
+            
             daily_trends = []
-            current_date = start_date
+            current_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
             while current_date <= end_date:
-                day_start = current_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                day_end = day_start + timedelta(days=1)
-                
-                day_query = {
-                    **query,
-                    "timestamp": {"$gte": day_start, "$lt": day_end}
-                }
-                
-                day_total = await self.collection.count_documents(day_query)
-                day_strangers = await self.collection.count_documents({
-                    **day_query, "detection_type": "stranger"
-                })
-                day_known = await self.collection.count_documents({
-                    **day_query, "detection_type": "known_person"
-                })
-                
+                counts = daily_counts.get(current_date, {})
                 daily_trends.append({
                     "date": current_date.strftime("%Y-%m-%d"),
-                    "detections": day_total,
-                    "known": day_known,
-                    "strangers": day_strangers
+                    "detections": counts.get("total", 0),
+                    "known": counts.get("known_person", 0),
+                    "strangers": counts.get("stranger", 0)
                 })
-                
                 current_date += timedelta(days=1)
             
-            # Get hourly pattern
-            hourly_pattern = {}
-            for hour in range(24):
-                hour_start = start_date.replace(hour=hour, minute=0, second=0, microsecond=0)
-                hour_end = hour_start + timedelta(hours=1)
-                
-                hour_query = {
-                    **query,
-                    "timestamp": {"$gte": hour_start, "$lt": hour_end}
-                }
-                
-                hour_count = await self.collection.count_documents(hour_query)
-                hourly_pattern[f"{hour:02d}:00"] = hour_count
-            
-            # Get camera statistics
-            camera_stats = await self.collection.aggregate([
-                {"$match": query},
-                {"$group": {
-                    "_id": "$camera_id",
-                    "detection_count": {"$sum": 1},
-                    "stranger_count": {
-                        "$sum": {"$cond": [{"$eq": ["$detection_type", "stranger"]}, 1, 0]}
-                    },
-                    "known_count": {
-                        "$sum": {"$cond": [{"$eq": ["$detection_type", "known_person"]}, 1, 0]}
-                    }
-                }},
-                {"$sort": {"detection_count": -1}},
-                {"$limit": 10}
-            ]).to_list(length=10)
+            # Get hourly pattern (phân bố theo giờ trong ngày trên toàn bộ khoảng thời gian)
+            hour_counts = {row["_id"]: row["count"] for row in facets["hourly"]}
+            hourly_pattern = {f"{hour:02d}:00": hour_counts.get(hour, 0) for hour in range(24)}
+            
+            # Get recent detections for timeline
+            recent_detections = await self.collection.find(
+                query,
+                {"timestamp": 1, "detection_type": 1, "person_name": 1, "camera_id": 1}
+            ).sort("timestamp", -1).limit(50).to_list(length=50)
+            
+            # Camera names - một truy vấn cho cả camera stats và timeline
+            camera_ids = {stat["_id"] for stat in facets["cameras"] if stat["_id"] is not None}
+            camera_ids.update(d["camera_id"] for d in recent_detections if d.get("camera_id") is not None)
+            camera_names = {}
+            if camera_ids:
+                async for camera_data in self.db.cameras.find({"_id": {"$in": list(camera_ids)}}, {"name": 1}):
+                    camera_names[camera_data["_id"]] = camera_data.get("name", "Unknown Camera")
             
             # Enrich camera data
             camera_performance = []
-            for stat in camera_stats:
-                camera_data = await self.db.cameras.find_one({"_id": stat["_id"]})
-                if camera_data:
+            for stat in facets["cameras"]:
+                if stat["_id"] in camera_names:
                     camera_performance.append({
                         "camera_id": str(stat["_id"]),
-                        "camera_name": camera_data["name"],
+                        "camera_name": camera_names[stat["_id"]],
                         "detection_count": stat["detection_count"],
                         "stranger_count": stat["stranger_count"],
                         "known_count": stat["known_count"],
                         "accuracy": (stat["known_count"] / stat["detection_count"] * 100) if stat["detection_count"] > 0 else 0
                     })
             
-            # Get recent detections for timeline
-            recent_detections = await self.collection.find(
-                query,
-                {"timestamp": 1, "detection_type": 1, "person_name": 1, "camera_id": 1}
-            ).sort("timestamp", -1).limit(50).to_list(length=50)
-            
             # Enrich recent detections with camera names
             detection_timeline = []
             for detection in recent_detections:
-                camera_data = await self.db.cameras.find_one({"_id": detection["camera_id"]})
                 detection_timeline.append({
                     "timestamp": detection["timestamp"].isoformat(),
                     "detection_type": detection["detection_type"],
                     "person_name": detection.get("person_name", "Unknown"),
-                    "camera_name": camera_data["name"] if camera_data else "Unknown Camera"
+                    "camera_name": camera_names.get(detection.get("camera_id"), "Unknown Camera")
                 })
             
             return {
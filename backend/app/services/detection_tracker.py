@@ -1,8 +1,13 @@
-from typing import Dict, Optional
+from typing import Dict, Any, Optional
 from datetime import datetime, timedelta
 import asyncio
 import uuid
 from ..utils.timezone_utils import vietnam_now
+from .event_bus import event_bus
+from .state_store import state_store
+
+PRESENCE_PREFIX = "presence:"
+TRACKER_CHANNEL = "detection_tracker"
 
 class PersonPresence:
     """Lưu trạng thái hiện diện của một người trên camera"""
@@ -67,6 +72,10 @@ class DetectionTracker:
         # Task cleanup chạy định kỳ
         self._cleanup_task = None
         
+        # Camera đã ghi snapshot presence vào state store (cho worker khác đọc)
+        self._published_cameras = set()
+        event_bus.subscribe(TRACKER_CHANNEL, self._on_bus_message)
+        
     def start_cleanup_task(self):
         """Bắt đầu task cleanup định kỳ"""
         if self._cleanup_task is None:
@@ -88,6 +97,7 @@ class DetectionTracker:
             try:
                 await asyncio.sleep(5)  # Chạy mỗi 5 giây
                 await self._cleanup_absent_persons()
+                await self._publish_snapshots()
             except asyncio.CancelledError:
                 break
             except Exception as e:
@@ -171,5 +181,37 @@ class DetectionTracker:
                 }
         return camera_presences
 
+    async def _publish_snapshots(self):
+        """Ghi presence theo camera vào state store để worker khác đọc được"""
+        cameras = {presence.camera_id for presence in self.presences.values() if presence.is_present}
+        for camera_id in cameras:
+            snapshot = {
+                key: {**info, 'duration': info['duration'].total_seconds()}
+                for key, info in self.get_presence_info(camera_id).items()
+            }
+            await state_store.set(PRESENCE_PREFIX + camera_id, snapshot, ttl_seconds=15)
+        for camera_id in self._published_cameras - cameras:
+            await state_store.delete(PRESENCE_PREFIX + camera_id)
+        self._published_cameras = cameras
+        
+    async def get_shared_presence_info(self, camera_id: str) -> Dict[str, dict]:
+        """Presence của camera, kể cả khi camera đang được xử lý ở worker khác"""
+        presence_info = self.get_presence_info(camera_id)
+        if presence_info:
+            return presence_info
+        return await state_store.get(PRESENCE_PREFIX + camera_id, {})
+        
+    async def reset(self):
+        """Xóa toàn bộ presence trên mọi worker"""
+        self.presences.clear()
+        self._published_cameras = set()
+        await state_store.delete_prefix(PRESENCE_PREFIX)
+        await event_bus.publish(TRACKER_CHANNEL, {"action": "reset"})
+        
+    def _on_bus_message(self, payload: Dict[str, Any]):
+        if payload.get("action") == "reset":
+            self.presences.clear()
+            self._published_cameras = set()
+
 # Global instance
 detection_tracker = DetectionTracker()
@@ -0,0 +1,170 @@
+from typing import Dict, Any, List, Optional
+from datetime import datetime, timedelta
+from pathlib import Path
+from jinja2 import Environment, FileSystemLoader, Template, select_autoescape
+import os
+import time
+import uuid
+
+TEMPLATE_DIR = Path(__file__).resolve().parent.parent / "templates" / "email"
+
+
+def make_cid() -> str:
+    """Content-ID duy nhất cho ảnh inline"""
+    return f"{uuid.uuid4().hex}@safeface"
+
+
+class EmailTemplateService:
+    """
+    Template email (Jinja2) được compile một lần khi khởi động
+
+    Phần tĩnh (HTML/CSS) nằm trong app/templates/email, mỗi lần gửi chỉ render
+    các trường động. Ảnh được nhúng inline qua `cid:` (xem mail_queue_service).
+    """
+
+    TEMPLATES = ["stranger_alert.html", "stranger_digest.html", "alert.html", "test_email.html"]
+
+    def __init__(self):
+        self.env = Environment(
+            loader=FileSystemLoader(str(TEMPLATE_DIR)),
+            autoescape=select_autoescape(["html"]),
+            trim_blocks=True,
+            lstrip_blocks=True,
+            auto_reload=False
+        )
+        self.templates: Dict[str, Template] = {}
+
+    def compile_all(self):
+        """Compile toàn bộ template (gọi khi startup)"""
+        for name in self.TEMPLATES:
+            self.templates[name] = self.env.get_template(name)
+        print(f"✅ [EMAIL TEMPLATES] Compiled {len(self.templates)} templates")
+
+    def render(self, name: str, **context) -> str:
+        """Render template đã compile với các trường động"""
+        template = self.templates.get(name)
+        if template is None:
+            template = self.templates[name] = self.env.get_template(name)
+        return template.render(**context)
+
+    @staticmethod
+    def _to_vietnam_time(timestamp: Any) -> Optional[datetime]:
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        if not isinstance(timestamp, datetime):
+            return None
+        # Timestamp cảnh báo lưu theo UTC → GMT+7
+        return timestamp + timedelta(hours=7)
+
+    def render_stranger_alert(self, alert_data: Dict[str, Any], image_cid: Optional[str] = None) -> str:
+        """HTML email cảnh báo người lạ"""
+        camera_info = alert_data.get('camera_info', {})
+        detections = alert_data.get('detections') or []
+        confidences = [d.get('confidence', 0) * 100 for d in detections[:5]]
+        vietnam_time = self._to_vietnam_time(alert_data.get('timestamp'))
+
+        return self.render(
+            "stranger_alert.html",
+            formatted_time=vietnam_time.strftime("%d/%m/%Y lúc %H:%M:%S") if vietnam_time else "Không xác định",
+            stranger_count=alert_data.get('stranger_count', 0),
+            known_person_count=alert_data.get('known_person_count', 0),
+            camera_name=camera_info.get('name', 'Camera không xác định'),
+            camera_location=camera_info.get('location', ''),
+            camera_type=camera_info.get('camera_type', 'Không xác định'),
+            avg_confidence=sum(confidences) / len(detections) if detections else 0,
+            image_cid=image_cid
+        )
+
+    def render_stranger_digest(self, events: List[Dict[str, Any]], camera_names: List[str],
+                               stranger_count: int, image_cid: Optional[str] = None,
+                               more_events: int = 0, last_timestamp: Any = None) -> str:
+        """HTML email tổng hợp nhiều sự kiện người lạ (more_events: số sự kiện không liệt kê)"""
+        rows = []
+        for event in events:
+            event_time = self._to_vietnam_time(event.get("timestamp"))
+            rows.append({
+                "time": event_time.strftime('%H:%M:%S') if event_time else "",
+                "camera": event.get('camera_info', {}).get('name', 'Camera'),
+                "stranger_count": event.get('stranger_count', 0)
+            })
+        first_time = self._to_vietnam_time(events[0].get("timestamp")) if events else None
+        last_time = self._to_vietnam_time(last_timestamp or (events[-1].get("timestamp") if events else None))
+
+        return self.render(
+            "stranger_digest.html",
+            first_time=first_time.strftime("%d/%m/%Y %H:%M:%S") if first_time else "",
+            last_time=last_time.strftime("%H:%M:%S") if last_time else "",
+            events=rows,
+            more_events=more_events,
+            camera_names=camera_names,
+            stranger_count=stranger_count,
+            image_cid=image_cid
+        )
+
+    def render_alert(self, alert_data: Dict[str, Any]) -> str:
+        """HTML email cảnh báo chung"""
+        camera_name = "Unknown"
+        if alert_data.get('camera_info', {}).get('name'):
+            camera_name = alert_data['camera_info']['name']
+        elif alert_data.get('detection_data', {}).get('camera_name'):
+            camera_name = alert_data['detection_data']['camera_name']
+
+        return self.render(
+            "alert.html",
+            title=alert_data['title'],
+            timestamp=alert_data['timestamp'],
+            message=alert_data['message'],
+            header_color='#dc3545' if alert_data.get('severity') == 'high' else '#007bff',
+            camera_name=camera_name,
+            detection_type=alert_data.get('type', alert_data.get('detection_data', {}).get('detection_type', 'Unknown')),
+            severity=alert_data.get('severity', 'Unknown'),
+            stranger_count=alert_data.get('stranger_count'),
+            known_person_count=alert_data.get('known_person_count'),
+            action_required=alert_data.get('action_required', False)
+        )
+
+    def render_test_email(self) -> str:
+        """HTML email kiểm tra cấu hình"""
+        return self.render("test_email.html", test_time=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC"))
+
+    def benchmark(self, iterations: int = 200, image_bytes: int = 150_000) -> Dict[str, Any]:
+        """Đo thời gian render + dựng MIME cho một cảnh báo người lạ (ms/alert)"""
+        from .mail_queue_service import mail_queue_service
+
+        # Ảnh giả có kích thước tương đương một khung hình JPEG
+        image_data = os.urandom(max(0, image_bytes))
+
+        alert_data = {
+            "title": "Phát hiện người lạ",
+            "timestamp": datetime.utcnow().isoformat(),
+            "stranger_count": 2,
+            "known_person_count": 0,
+            "camera_info": {"name": "Benchmark Camera", "location": "Cổng chính", "camera_type": "ip"},
+            "detections": [{"confidence": 0.91, "bbox": [10, 20, 80, 80]}, {"confidence": 0.84, "bbox": [120, 40, 70, 70]}]
+        }
+
+        render_total = build_total = 0.0
+        for _ in range(max(1, iterations)):
+            cid = make_cid()
+            started = time.perf_counter()
+            html_content = self.render_stranger_alert(alert_data, image_cid=cid)
+            rendered = time.perf_counter()
+            mail_queue_service.build_message(
+                "benchmark@example.com", "Benchmark", html_content,
+                image_data or None, "benchmark.jpg", image_cid=cid
+            ).as_bytes()
+            build_total += time.perf_counter() - rendered
+            render_total += rendered - started
+
+        count = max(1, iterations)
+        return {
+            "iterations": count,
+            "image_bytes": len(image_data),
+            "render_ms": round(render_total / count * 1000, 3),
+            "mime_build_ms": round(build_total / count * 1000, 3),
+            "total_ms": round((render_total + build_total) / count * 1000, 3)
+        }
+
+
+# Global instance
+email_template_service = EmailTemplateService()
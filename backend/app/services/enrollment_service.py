@@ -0,0 +1,314 @@
+from typing import Dict, Any, List, Optional, Tuple
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ReturnDocument
+import asyncio
+import numpy as np
+from ..config import get_settings
+from ..database import get_database
+from ..utils.timezone_utils import vietnam_now
+from ..utils.embedding_codec import decode_embedding, encode_embedding
+from .face_processor import face_processor
+from .face_image_store import face_image_store
+from .recognition_index import recognition_index, normalize, select_informative
+from .websocket_manager import websocket_manager
+
+
+class EnrollmentError(Exception):
+    """Lỗi không retry được (không có khuôn mặt, không đạt chất lượng, ảnh trùng, ảnh đã bị xóa)"""
+
+
+class EnrollmentService:
+    """
+    Hàng đợi enrollment ảnh khuôn mặt (collection `enrollment_jobs`)
+
+    - `add_face_image` chỉ lưu ảnh rồi `enqueue()`, trả job id cho client poll
+    - Worker đọc ảnh từ GridFS, trích embedding + điểm chất lượng, ghi vào đúng
+      vị trí của ảnh trong `face_embeddings` rồi cập nhật recognition_index
+    - Ảnh không đạt quality gate hoặc gần trùng ảnh đã có bị từ chối; gallery mỗi
+      person giữ tối đa `enrollment_max_embeddings` embedding nhiều thông tin nhất
+    - Lỗi tạm thời được retry với exponential backoff, quá `enrollment_max_attempts` → failed
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.workers: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._running = False
+
+    @property
+    def db(self):
+        return get_database()
+
+    @property
+    def collection(self):
+        return self.db.enrollment_jobs
+
+    def _get_wakeup(self) -> asyncio.Event:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    async def enqueue(self, person_id: str, user_id: str, image_id: Any) -> Optional[str]:
+        """Tạo job trích embedding cho một ảnh, trả về job id"""
+        try:
+            now = datetime.utcnow()
+            result = await self.collection.insert_one({
+                "person_id": ObjectId(person_id),
+                "user_id": ObjectId(user_id),
+                "image_id": ObjectId(image_id),
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "created_at": now,
+                "result": None,
+                "error": None
+            })
+            self._get_wakeup().set()
+            return str(result.inserted_id)
+        except Exception as e:
+            print(f"❌ [ENROLLMENT] Error queueing job for person {person_id}: {e}")
+            return None
+
+    def _retry_delay(self, attempts: int) -> timedelta:
+        return timedelta(seconds=min(5 * (2 ** max(0, attempts - 1)), 300))
+
+    async def _claim_job(self) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"$set": {"status": "processing", "locked_at": now}, "$inc": {"attempts": 1}},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def set_image_fields(self, person_id: Any, image_id: Any, values: Dict[str, Any],
+                               index: Optional[int] = None) -> Optional[int]:
+        """
+        Ghi embedding / trạng thái của một ảnh theo image_id
+
+        `values`: khóa "embedding" → face_embeddings.{i}, khóa khác →
+        face_image_refs.{i}.<khóa>. Update được guard bằng id ảnh tại vị trí i;
+        ảnh dời chỗ (ảnh khác bị xóa) thì tìm lại vị trí. Trả về vị trí đã ghi,
+        None nếu ảnh không còn.
+        """
+        person_oid, image_oid = ObjectId(person_id), ObjectId(image_id)
+        for _ in range(3):
+            if index is None:
+                person_data = await self.db.known_persons.find_one({"_id": person_oid}, {"face_image_refs.id": 1})
+                refs = (person_data or {}).get("face_image_refs") or []
+                index = next((i for i, ref in enumerate(refs) if ref.get("id") == image_oid), None)
+                if index is None:
+                    return None
+            update: Dict[str, Any] = {"updated_at": vietnam_now()}
+            for key, value in values.items():
+                update[f"face_embeddings.{index}" if key == "embedding" else f"face_image_refs.{index}.{key}"] = value
+            operation: Dict[str, Any] = {"$set": update}
+            if "embedding" in values:
+                # gallery_rev tăng cùng update ghi embedding (gallery đã lưu trên đĩa hết hợp lệ)
+                operation["$inc"] = {"gallery_rev": 1}
+            result = await self.db.known_persons.update_one(
+                {"_id": person_oid, f"face_image_refs.{index}.id": image_oid},
+                operation
+            )
+            if result.matched_count:
+                return index
+            index = None
+        return None
+
+    async def _set_image_status(self, job: Dict[str, Any], index: int, values: Dict[str, Any]) -> bool:
+        return await self.set_image_fields(job["person_id"], job["image_id"], values, index) is not None
+
+    @staticmethod
+    def _gallery_entries(person_data: Dict[str, Any]) -> List[Tuple[int, np.ndarray, float]]:
+        """(vị trí ảnh, embedding đã chuẩn hóa, điểm chất lượng) của các ảnh đã có embedding"""
+        refs = person_data.get("face_image_refs") or []
+        entries = []
+        for i, raw in enumerate(person_data.get("face_embeddings") or []):
+            embedding = decode_embedding(raw) if i < len(refs) else None
+            if embedding is not None:
+                quality = refs[i].get("quality") or {}
+                entries.append((i, normalize(embedding), float(quality.get("score", 0.5))))
+        return entries
+
+    async def enforce_gallery_cap(self, person_id: Any, user_id: Any) -> int:
+        """
+        Giữ tối đa `enrollment_max_embeddings` embedding có nhiều thông tin nhất
+
+        Embedding bị loại được đặt về [] (ảnh vẫn giữ, embedding_status = "pruned").
+        Trả về số embedding bị loại.
+        """
+        person_data = await self.db.known_persons.find_one(
+            {"_id": ObjectId(person_id), "user_id": ObjectId(user_id)},
+            {"face_image_refs.id": 1, "face_image_refs.quality": 1, "face_embeddings": 1}
+        )
+        entries = self._gallery_entries(person_data or {})
+        if len(entries) <= self.settings.enrollment_max_embeddings:
+            return 0
+
+        keep = set(select_informative(
+            np.vstack([vector for _, vector, _ in entries]),
+            [score for _, _, score in entries],
+            self.settings.enrollment_max_embeddings
+        ))
+        dropped = [index for position, (index, _, _) in enumerate(entries) if position not in keep]
+        refs = person_data["face_image_refs"]
+        update: Dict[str, Any] = {"updated_at": vietnam_now()}
+        guard: Dict[str, Any] = {"_id": person_data["_id"]}
+        for index in dropped:
+            update[f"face_embeddings.{index}"] = []
+            update[f"face_image_refs.{index}.embedding_status"] = "pruned"
+            guard[f"face_image_refs.{index}.id"] = refs[index]["id"]
+        result = await self.db.known_persons.update_one(guard, {"$set": update, "$inc": {"gallery_rev": 1}})
+        return len(dropped) if result.modified_count else 0
+
+    async def _enroll(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        person_data = await self.db.known_persons.find_one(
+            {"_id": job["person_id"], "user_id": job["user_id"]},
+            {"face_image_refs.id": 1, "face_image_refs.quality": 1, "face_embeddings": 1}
+        )
+        refs = (person_data or {}).get("face_image_refs") or []
+        index = next((i for i, ref in enumerate(refs) if ref.get("id") == job["image_id"]), None)
+        if index is None:
+            raise EnrollmentError("Face image no longer exists")
+
+        image_data = await face_image_store.read(job["image_id"])
+        if not image_data:
+            raise EnrollmentError("Face image data not found")
+
+        embedding, quality = await face_processor.extract_face_embedding_with_quality(image_data)
+        if embedding is None:
+            if quality.get("retryable"):
+                raise RuntimeError(quality.get("error"))
+            await self._set_image_status(job, index, {"embedding_status": "failed", "quality": quality})
+            raise EnrollmentError(quality.get("error", "No face detected"))
+
+        # Quality gate: ảnh mờ / nhỏ / nghiêng không được đưa vào gallery
+        issues = face_processor.quality_issues(quality)
+        if issues:
+            await self._set_image_status(job, index, {"embedding_status": "rejected", "quality": {**quality, "issues": issues}})
+            raise EnrollmentError(f"Low quality face image: {', '.join(issues)}")
+
+        # Ảnh gần trùng với ảnh đã có không thêm thông tin cho nhận dạng
+        vector = normalize(embedding)
+        for other_index, other_vector, _ in self._gallery_entries(person_data):
+            similarity = float(vector @ other_vector)
+            if other_index != index and similarity >= self.settings.enrollment_duplicate_similarity:
+                await self._set_image_status(job, index, {
+                    "embedding_status": "duplicate",
+                    "quality": {**quality, "duplicate_of": other_index}
+                })
+                raise EnrollmentError(f"Near-duplicate of face image #{other_index} (similarity {similarity:.3f})")
+
+        # $set theo vị trí: mảng face_embeddings ngắn hơn được MongoDB pad null
+        if not await self._set_image_status(job, index, {
+            "embedding": encode_embedding(embedding, self.settings.embedding_storage_dtype),
+            "embedding_status": "done",
+            "quality": quality
+        }):
+            raise EnrollmentError("Face image was removed during enrollment")
+
+        pruned = await self.enforce_gallery_cap(job["person_id"], job["user_id"])
+        await recognition_index.refresh_persons(str(job["user_id"]), [str(job["person_id"])])
+        return {"image_index": index, "embedding_size": int(len(embedding)), "quality": quality, "pruned": pruned}
+
+    async def _process_job(self, job: Dict[str, Any]):
+        now = datetime.utcnow()
+        expires_at = now + timedelta(days=1)
+        try:
+            result = await self._enroll(job)
+            update = {"status": "done", "result": result, "error": None, "finished_at": now, "expires_at": expires_at}
+            print(f"✅ [ENROLLMENT] Person {job['person_id']} image {job['image_id']} enrolled (quality {result['quality']['score']})")
+        except EnrollmentError as e:
+            update = {"status": "failed", "error": str(e), "finished_at": now, "expires_at": expires_at}
+            print(f"⚠️ [ENROLLMENT] Job {job['_id']} failed: {e}")
+        except Exception as e:
+            attempts = job.get("attempts", 1)
+            if attempts >= self.settings.enrollment_max_attempts:
+                update = {"status": "failed", "error": str(e), "finished_at": now, "expires_at": expires_at}
+                print(f"❌ [ENROLLMENT] Giving up on job {job['_id']} after {attempts} attempts: {e}")
+            else:
+                update = {"status": "pending", "error": str(e), "next_attempt_at": now + self._retry_delay(attempts)}
+                print(f"⚠️ [ENROLLMENT] Job {job['_id']} failed (attempt {attempts}), retrying: {e}")
+
+        await self.collection.update_one({"_id": job["_id"]}, {"$set": update})
+        if update["status"] != "pending":
+            await websocket_manager.send_personal_message(
+                {"type": "enrollment_update", "job": self._serialize({**job, **update})},
+                str(job["user_id"])
+            )
+
+    async def _worker(self, worker_id: int):
+        wakeup = self._get_wakeup()
+        while self._running:
+            try:
+                job = await self._claim_job()
+                if job is None:
+                    wakeup.clear()
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), timeout=self.settings.enrollment_poll_seconds)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._process_job(job)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                print(f"❌ [ENROLLMENT] Worker {worker_id} error: {e}")
+                await asyncio.sleep(self.settings.enrollment_poll_seconds)
+
+    async def _recover_stale_jobs(self):
+        """Trả các job đang 'processing' quá lâu (app bị tắt giữa chừng) về pending"""
+        stale_before = datetime.utcnow() - timedelta(minutes=5)
+        result = await self.collection.update_many(
+            {"status": "processing", "locked_at": {"$lt": stale_before}},
+            {"$set": {"status": "pending", "next_attempt_at": datetime.utcnow()}}
+        )
+        if result.modified_count:
+            print(f"🔄 [ENROLLMENT] Recovered {result.modified_count} stale jobs")
+
+    async def start(self):
+        """Khởi động worker enrollment"""
+        if self._running:
+            return
+        self._running = True
+        await self._recover_stale_jobs()
+        self.workers = [
+            asyncio.create_task(self._worker(i))
+            for i in range(max(1, self.settings.enrollment_workers))
+        ]
+        print(f"✅ [ENROLLMENT] Started {len(self.workers)} workers")
+
+    async def stop(self):
+        """Dừng worker enrollment"""
+        self._running = False
+        for task in self.workers:
+            task.cancel()
+        if self.workers:
+            await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    # ===== Queries =====
+
+    @staticmethod
+    def _serialize(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "job_id": str(job["_id"]),
+            "person_id": str(job["person_id"]),
+            "image_id": str(job["image_id"]),
+            "status": job.get("status"),
+            "attempts": job.get("attempts", 0),
+            "result": job.get("result"),
+            "error": job.get("error"),
+            "created_at": job.get("created_at"),
+            "finished_at": job.get("finished_at")
+        }
+
+    async def get_job(self, job_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        """Trạng thái job enrollment của user"""
+        job = await self.collection.find_one({"_id": ObjectId(job_id), "user_id": ObjectId(user_id)})
+        return self._serialize(job) if job else None
+
+
+# Global instance
+enrollment_service = EnrollmentService()
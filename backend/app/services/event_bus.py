@@ -0,0 +1,186 @@
+from typing import Dict, Any, List, Callable, Optional
+from datetime import datetime
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+import asyncio
+import os
+import socket
+import uuid
+from ..config import get_settings
+from ..database import get_database
+
+
+class EventBus:
+    """
+    Event bus giữa các worker (mặc định: chỉ trong process)
+
+    Mỗi worker có `node_id` riêng. Message do worker tự publish không được gửi
+    lại cho chính nó - bên publish tự xử lý phần local, bus chỉ mang message tới
+    các worker khác. Với backend in-process (một worker) publish không làm gì.
+    """
+
+    distributed = False
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.node_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.handlers: Dict[str, List[Callable[[Dict[str, Any]], Any]]] = {}
+        self.tasks: set = set()
+
+    def subscribe(self, channel: str, handler: Callable[[Dict[str, Any]], Any]):
+        """Đăng ký handler (sync hoặc async) cho một channel"""
+        self.handlers.setdefault(channel, []).append(handler)
+
+    async def publish(self, channel: str, payload: Dict[str, Any]):
+        """Gửi message tới các worker khác"""
+        return None
+
+    def publish_nowait(self, channel: str, payload: Dict[str, Any]):
+        """Publish nền, không chờ (an toàn gọi từ code đồng bộ trong event loop)"""
+        if not self.distributed:
+            return
+        task = asyncio.create_task(self.publish(channel, payload))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _dispatch(self, channel: str, payload: Dict[str, Any], origin: Optional[str]):
+        if origin == self.node_id:
+            return
+        for handler in self.handlers.get(channel, []):
+            try:
+                result = handler(payload)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                print(f"❌ [EVENT BUS] Handler error on channel {channel}: {e}")
+
+    async def start(self):
+        return None
+
+    async def stop(self):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=5)
+
+    def get_info(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "node_id": self.node_id,
+            "channels": sorted(self.handlers.keys())
+        }
+
+
+class MongoEventBus(EventBus):
+    """
+    Event bus qua MongoDB: capped collection `event_bus` + tailable cursor
+
+    Không cần replica set như change stream; mỗi worker đọc tiếp từ message
+    mới nhất tại thời điểm khởi động, message cũ tự bị ghi đè khi collection đầy.
+    """
+
+    distributed = True
+
+    def __init__(self):
+        super().__init__()
+        self._reader_task: Optional[asyncio.Task] = None
+        self._running = False
+
+    @property
+    def collection(self):
+        return get_database().event_bus
+
+    async def _ensure_collection(self):
+        db = get_database()
+        try:
+            await db.create_collection(
+                "event_bus",
+                capped=True,
+                size=self.settings.event_bus_capped_size_mb * 1024 * 1024
+            )
+        except CollectionInvalid:
+            pass
+        # Cursor tailable cần ít nhất một document
+        if await self.collection.estimated_document_count() == 0:
+            await self.collection.insert_one({"channel": "__init__", "origin": self.node_id, "created_at": datetime.utcnow()})
+
+    async def publish(self, channel: str, payload: Dict[str, Any]):
+        try:
+            await self.collection.insert_one({
+                "channel": channel,
+                "origin": self.node_id,
+                "payload": payload,
+                "created_at": datetime.utcnow()
+            })
+        except Exception as e:
+            print(f"❌ [EVENT BUS] Error publishing to {channel}: {e}")
+
+    async def _reader(self):
+        """
+        Đọc message theo thứ tự ghi (natural order của capped collection)
+
+        `_id` do nhiều worker sinh ra không tăng theo thứ tự ghi, nên không lọc
+        `_id > last`: mỗi lần (mở lại) cursor đọc từ đầu collection, bỏ qua tới
+        message đã xử lý cuối cùng. Nếu message đó đã bị ghi đè (collection đầy)
+        thì bỏ qua những gì đang có và đọc tiếp message mới.
+        """
+        last = await self.collection.find_one(sort=[("$natural", -1)], projection={"_id": 1})
+        last_id = last["_id"] if last else None
+
+        while self._running:
+            try:
+                cursor = self.collection.find({}, cursor_type=CursorType.TAILABLE_AWAIT)
+                skipping = last_id is not None
+                newest_id = None
+                while self._running and cursor.alive:
+                    async for message in cursor:
+                        if skipping:
+                            skipping = message["_id"] != last_id
+                            newest_id = message["_id"]
+                            continue
+                        last_id = message["_id"]
+                        await self._dispatch(message.get("channel"), message.get("payload") or {}, message.get("origin"))
+                    if skipping:
+                        print("⚠️ [EVENT BUS] Last processed message was overwritten, resuming from newest messages")
+                        skipping = False
+                        last_id = newest_id or last_id
+                    await asyncio.sleep(0.05)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                print(f"⚠️ [EVENT BUS] Tailable cursor error, reconnecting: {e}")
+                await asyncio.sleep(1)
+
+    async def start(self):
+        if self._running:
+            return
+        await self._ensure_collection()
+        self._running = True
+        self._reader_task = asyncio.create_task(self._reader())
+        print(f"✅ [EVENT BUS] MongoDB event bus started (node {self.node_id})")
+
+    async def stop(self):
+        self._running = False
+        if self._reader_task:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        await super().stop()
+
+    def get_info(self) -> Dict[str, Any]:
+        return {**super().get_info(), "backend": "mongo", "running": self._running}
+
+
+def create_event_bus() -> EventBus:
+    """Tạo event bus theo cấu hình `event_bus_backend` (memory | mongo)"""
+    backend = get_settings().event_bus_backend.lower()
+    if backend == "mongo":
+        return MongoEventBus()
+    if backend != "memory":
+        print(f"⚠️ [EVENT BUS] Unknown backend '{backend}', using in-process bus")
+    return EventBus()
+
+
+# Global instance
+event_bus = create_event_bus()
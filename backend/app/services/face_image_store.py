@@ -0,0 +1,192 @@
+from typing import Dict, Any, List, Optional, Tuple
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+import asyncio
+import base64
+import cv2
+import numpy as np
+from ..config import get_settings
+from ..database import get_database
+from ..utils.timezone_utils import vietnam_now
+
+BUCKET_NAME = "face_images"
+
+
+class FaceImageStore:
+    """
+    Lưu ảnh khuôn mặt trên GridFS (bucket `face_images`), tách khỏi `known_persons`
+
+    Person chỉ giữ `face_image_refs`: [{id, thumbnail_id, size, width, height,
+    created_at}]. Thumbnail JPEG được tạo sẵn khi lưu để danh sách / chi tiết
+    person không phải tải ảnh gốc.
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._bucket: Optional[AsyncIOMotorGridFSBucket] = None
+        self._bucket_db = None
+
+    @property
+    def bucket(self) -> AsyncIOMotorGridFSBucket:
+        db = get_database()
+        if self._bucket is None or self._bucket_db is not db:
+            self._bucket = AsyncIOMotorGridFSBucket(db, bucket_name=BUCKET_NAME)
+            self._bucket_db = db
+        return self._bucket
+
+    @property
+    def files(self):
+        return get_database()[f"{BUCKET_NAME}.files"]
+
+    @staticmethod
+    def decode_base64(image_base64: str) -> bytes:
+        """Base64 (có hoặc không có prefix data URL) → bytes"""
+        if image_base64.startswith('data:image/'):
+            if ',' not in image_base64:
+                raise ValueError("Invalid data URL format - missing comma separator")
+            image_base64 = image_base64.split(',', 1)[1]
+        if not image_base64.strip():
+            raise ValueError("Empty base64 data")
+        image_data = base64.b64decode(image_base64)
+        if not image_data:
+            raise ValueError("Decoded image data is empty")
+        return image_data
+
+    @staticmethod
+    def _make_thumbnail(image_data: bytes, max_size: int) -> Tuple[bytes, int, int]:
+        """Tạo thumbnail JPEG (sync, chạy trong thread)"""
+        img = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("Invalid image data - cannot decode with OpenCV")
+        height, width = img.shape[:2]
+        scale = min(1.0, max_size / max(height, width))
+        if scale < 1.0:
+            img = cv2.resize(img, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        if not ok:
+            raise ValueError("Failed to encode thumbnail")
+        return encoded.tobytes(), width, height
+
+    async def save(self, image_data: bytes, user_id: str, person_id: str) -> Dict[str, Any]:
+        """Lưu ảnh gốc + thumbnail, trả về ref để push vào person"""
+        thumbnail, width, height = await asyncio.to_thread(
+            self._make_thumbnail, image_data, self.settings.face_thumbnail_size
+        )
+        metadata = {"user_id": ObjectId(user_id), "person_id": ObjectId(person_id)}
+        file_id = await self.bucket.upload_from_stream(
+            f"{person_id}.jpg", image_data, metadata={**metadata, "kind": "original"}
+        )
+        thumbnail_id = await self.bucket.upload_from_stream(
+            f"{person_id}_thumb.jpg", thumbnail, metadata={**metadata, "kind": "thumbnail", "original_id": file_id}
+        )
+        return {
+            "id": file_id,
+            "thumbnail_id": thumbnail_id,
+            "size": len(image_data),
+            "width": width,
+            "height": height,
+            "created_at": vietnam_now()
+        }
+
+    async def read(self, file_id: Any) -> Optional[bytes]:
+        """Đọc nội dung file, None nếu không tồn tại"""
+        try:
+            stream = await self.bucket.open_download_stream(ObjectId(file_id))
+            return await stream.read()
+        except Exception as e:
+            print(f"⚠️ [FACE IMAGES] Cannot read {file_id}: {e}")
+            return None
+
+    async def read_many(self, file_ids: List[Any]) -> List[Optional[bytes]]:
+        """Đọc nhiều file song song (giữ thứ tự)"""
+        return list(await asyncio.gather(*[self.read(file_id) for file_id in file_ids]))
+
+    async def thumbnail_data_urls(self, refs: List[Dict[str, Any]]) -> List[Optional[str]]:
+        """Thumbnail dạng data URL cho các ref"""
+        thumbnails = await self.read_many([ref.get("thumbnail_id") or ref["id"] for ref in refs])
+        return [
+            f"data:image/jpeg;base64,{base64.b64encode(data).decode('ascii')}" if data else None
+            for data in thumbnails
+        ]
+
+    async def delete_refs(self, refs: List[Dict[str, Any]]):
+        """Xóa ảnh gốc và thumbnail của các ref"""
+        for ref in refs:
+            for file_id in (ref.get("id"), ref.get("thumbnail_id")):
+                if file_id is None:
+                    continue
+                try:
+                    await self.bucket.delete(ObjectId(file_id))
+                except Exception as e:
+                    print(f"⚠️ [FACE IMAGES] Cannot delete {file_id}: {e}")
+
+    async def delete_person(self, person_id: Any) -> int:
+        """Xóa mọi ảnh thuộc person"""
+        deleted = 0
+        async for file_doc in self.files.find({"metadata.person_id": ObjectId(person_id)}, {"_id": 1}):
+            try:
+                await self.bucket.delete(file_doc["_id"])
+                deleted += 1
+            except Exception as e:
+                print(f"⚠️ [FACE IMAGES] Cannot delete {file_doc['_id']}: {e}")
+        return deleted
+
+    # ===== Migration =====
+
+    async def migrate_person(self, person_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Chuyển `face_images` base64 inline của một person sang GridFS
+
+        Trả về document sau khi chuyển (ảnh không decode được bị bỏ qua).
+        """
+        if "face_images" not in person_data:
+            return person_data
+        inline_images = person_data.get("face_images") or []
+        refs = list(person_data.get("face_image_refs") or [])
+
+        user_id = str(person_data["user_id"])
+        person_id = str(person_data["_id"])
+        new_refs = []
+        for i, image_base64 in enumerate(inline_images):
+            try:
+                new_refs.append(await self.save(self.decode_base64(str(image_base64)), user_id, person_id))
+            except Exception as e:
+                print(f"⚠️ [FACE IMAGES] Skipping invalid image {i} of person {person_id}: {e}")
+
+        result = await get_database().known_persons.update_one(
+            {"_id": person_data["_id"], "face_images": {"$exists": True}},
+            {"$push": {"face_image_refs": {"$each": new_refs}}, "$unset": {"face_images": ""}}
+        )
+        if result.modified_count == 0:
+            # Đã được chuyển ở nơi khác trong lúc này → bỏ bản vừa upload
+            await self.delete_refs(new_refs)
+            return await get_database().known_persons.find_one({"_id": person_data["_id"]}) or person_data
+
+        person_data = dict(person_data)
+        person_data.pop("face_images", None)
+        person_data["face_image_refs"] = refs + new_refs
+        return person_data
+
+    async def migrate_inline_images(self, batch_size: int = 20) -> Dict[str, Any]:
+        """Chuyển toàn bộ ảnh inline của `known_persons` sang GridFS"""
+        collection = get_database().known_persons
+        migrated_persons = migrated_images = 0
+        while True:
+            persons = await collection.find(
+                {"face_images": {"$exists": True}},
+                {"user_id": 1, "face_images": 1, "face_image_refs": 1}
+            ).limit(batch_size).to_list(length=batch_size)
+            if not persons:
+                break
+            for person_data in persons:
+                before = len(person_data.get("face_image_refs") or [])
+                person_data = await self.migrate_person(person_data)
+                migrated_persons += 1
+                migrated_images += len(person_data.get("face_image_refs") or []) - before
+            print(f"🔄 [FACE IMAGES] Migrated {migrated_persons} persons ({migrated_images} images)")
+
+        return {"migrated_persons": migrated_persons, "migrated_images": migrated_images}
+
+
+# Global instance
+face_image_store = FaceImageStore()
@@ -1,36 +1,356 @@
 import cv2
 import numpy as np
-import insightface
-from insightface.app import FaceAnalysis
-import faiss
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Dict, Any
 import asyncio
 import concurrent.futures
+import copy
 import gc
-import torch
+import os
+import threading
+import time
 import logging
+from ..config import get_settings
 
 logger = logging.getLogger(__name__)
 
+# Độ chính xác model: fp32 (model gốc của insightface) hoặc biến thể INT8 do
+# app.utils.model_quantization sinh ra, chỉ cho detector và recognizer
+PRECISIONS = ("fp32", "int8_dynamic", "int8_static")
+QUANTIZABLE_TASKS = ("detection", "recognition")
+
+
+def quantized_model_path(model_file: str, precision: str, model_dir: Optional[str] = None) -> str:
+    """Đường dẫn biến thể lượng tử hóa của một file model: {dir}/{tên}.{precision}.onnx"""
+    stem = os.path.splitext(os.path.basename(model_file))[0]
+    return os.path.join(model_dir or get_settings().quantized_model_dir, f"{stem}.{precision}.onnx")
+
+
 class FaceProcessorService:
-    def __init__(self):
-        # Detect available providers and choose the best one
-        available_providers = self._get_available_providers()
-        logger.info(f"Available providers: {available_providers}")
-        
-        # Initialize face analysis with GPU if available
-        self.face_app = FaceAnalysis(providers=available_providers)
-        
-        # Use GPU context if CUDA is available, otherwise CPU
-        ctx_id = 0 if 'CUDAExecutionProvider' in available_providers else -1
-        self.face_app.prepare(ctx_id=ctx_id, det_size=(640, 640))
-        
+    """
+    Detect / recognize khuôn mặt bằng InsightFace
+
+    Model không được nạp khi import module: `warm_up()` nạp nền lúc khởi động,
+    hoặc lần dùng `face_app` đầu tiên (trong thread của executor) tự nạp.
+    Trạng thái nạp được báo qua `get_status()` (endpoint /ready). Nạp lỗi thì
+    `ensure_loading()` thử lại sau backoff tăng dần (LOAD_RETRY_*).
+    """
+
+    LOAD_RETRY_BASE_SECONDS = 30
+    LOAD_RETRY_MAX_SECONDS = 600
+
+    def __init__(self, precision: Optional[str] = None):
+        settings = get_settings()
+        self.precision = precision or settings.model_precision
+        self.recognition_threshold = settings.face_similarity_threshold
+        # Đọc một lần: đường detect theo frame không dựng lại Settings mỗi lần
+        self.cascade_detection = settings.cascade_detection
+        self._cascade_settings = settings
+        self._face_app = None
+        self._providers: Optional[List[str]] = None
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._load_lock = threading.Lock()
+        self.state = "not_loaded"  # not_loaded | loading | ready | failed
+        self.load_error: Optional[str] = None
+        self.load_failures = 0
+        self._failed_at: Optional[float] = None  # time.monotonic() của lần nạp lỗi gần nhất
+        self.load_seconds: Optional[float] = None
+        self.session_profile: Optional[Dict[str, Any]] = None
+        self.model_latency: Dict[str, Dict[str, float]] = {}
+        self.model_variants: Dict[str, str] = {}
+        self._light_detector = None
+        # Đếm frame / thống kê cascade từ nhiều thread executor
+        self._cascade_lock = threading.Lock()
+        self._cascade_frames: Dict[str, int] = {}
+        self.cascade_stats = {"skipped": 0, "roi": 0, "full": 0}
+
+    @property
+    def providers(self) -> List[str]:
+        if self._providers is None:
+            self._providers = self._get_available_providers()
+            logger.info(f"Available providers: {self._providers}")
+        return self._providers
+
+    @property
+    def worker_count(self) -> int:
         # Adjust thread pool based on GPU availability
-        max_workers = 4 if 'CUDAExecutionProvider' in available_providers else 2
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
-        
-        logger.info(f"FaceProcessor initialized with providers: {available_providers}")
-        logger.info(f"Using context ID: {ctx_id} ({'GPU' if ctx_id >= 0 else 'CPU'})")
+        return 4 if 'CUDAExecutionProvider' in self.providers else 2
+
+    @property
+    def executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.worker_count)
+        return self._executor
+
+    @property
+    def face_app(self):
+        """FaceAnalysis đã prepare (nạp model nếu chưa có, gọi trong thread executor)"""
+        if self._face_app is None:
+            self.load()
+        return self._face_app
+
+    @property
+    def is_ready(self) -> bool:
+        return self.state == "ready"
+
+    def load(self):
+        """Nạp và prepare model InsightFace (sync, chỉ chạy một lần)"""
+        with self._load_lock:
+            if self._face_app is not None:
+                return
+            self.state = "loading"
+            started = time.perf_counter()
+            try:
+                from insightface.app import FaceAnalysis
+
+                available_providers = self.providers
+                face_app = FaceAnalysis(providers=available_providers)
+                # Use GPU context if CUDA is available, otherwise CPU
+                ctx_id = 0 if 'CUDAExecutionProvider' in available_providers else -1
+                face_app.prepare(ctx_id=ctx_id, det_size=(640, 640))
+                self._open_sessions(face_app)
+                if self.cascade_detection and get_settings().cascade_detector_model:
+                    self._light_detector = self._load_light_detector(ctx_id)
+                if self.cascade_detection and self._light_detector is None:
+                    self._light_detector = self._low_res_detector(face_app.det_model)
+                self._warm_up_models(face_app, get_settings().model_warmup_iterations)
+                self._face_app = face_app
+                self.state = "ready"
+                self.load_error = None
+                self.load_failures = 0
+                self._failed_at = None
+                self.load_seconds = round(time.perf_counter() - started, 3)
+                logger.info(f"FaceProcessor initialized with providers: {available_providers}")
+                logger.info(f"Using context ID: {ctx_id} ({'GPU' if ctx_id >= 0 else 'CPU'}), loaded in {self.load_seconds}s")
+                if self.model_latency:
+                    logger.info(f"⏱️ Model latency after warm-up: {self.model_latency}")
+            except Exception as e:
+                self.state = "failed"
+                self.load_error = str(e)
+                self.load_failures += 1
+                self._failed_at = time.monotonic()
+                logger.error(f"❌ FaceProcessor: Failed to load models: {e}")
+                raise
+
+    def _session_options(self):
+        """SessionOptions theo cấu hình onnx_* (intra-op mặc định chia core cho các worker executor)"""
+        import onnxruntime as ort
+
+        settings = get_settings()
+        levels = {
+            "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        }
+        intra_threads = settings.onnx_intra_op_threads or max(1, (os.cpu_count() or 1) // self.worker_count)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_threads
+        options.inter_op_num_threads = settings.onnx_inter_op_threads
+        options.graph_optimization_level = levels.get(settings.onnx_graph_optimization, ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+        options.execution_mode = (
+            ort.ExecutionMode.ORT_PARALLEL if settings.onnx_execution_mode == "parallel" else ort.ExecutionMode.ORT_SEQUENTIAL
+        )
+        options.enable_cpu_mem_arena = settings.onnx_enable_mem_arena
+        options.enable_mem_pattern = settings.onnx_enable_mem_pattern
+        self.session_profile = {
+            "intra_op_threads": intra_threads,
+            "inter_op_threads": settings.onnx_inter_op_threads,
+            "graph_optimization": settings.onnx_graph_optimization,
+            "execution_mode": settings.onnx_execution_mode,
+            "mem_arena": settings.onnx_enable_mem_arena,
+            "mem_pattern": settings.onnx_enable_mem_pattern,
+            "executor_workers": self.worker_count
+        }
+        return options
+
+    def _select_variants(self, face_app) -> Dict[str, str]:
+        """
+        File model lượng tử hóa theo taskname cho precision đã chọn
+
+        "auto" chỉ dùng INT8 khi không có GPU provider (ưu tiên static rồi
+        dynamic); biến thể chưa được sinh thì giữ model FP32.
+        """
+        if self.precision == "auto":
+            if self.providers[0] != 'CPUExecutionProvider':
+                return {}
+            candidates = ["int8_static", "int8_dynamic"]
+        elif self.precision in PRECISIONS and self.precision != "fp32":
+            candidates = [self.precision]
+        else:
+            return {}
+
+        variants = {}
+        for taskname in QUANTIZABLE_TASKS:
+            model = face_app.models.get(taskname)
+            if model is None:
+                continue
+            for candidate in candidates:
+                path = quantized_model_path(model.model_file, candidate)
+                if os.path.exists(path):
+                    variants[taskname] = path
+                    break
+            else:
+                if self.precision != "auto":
+                    logger.warning(f"⚠️ FaceProcessor: No {self.precision} variant for {taskname}, using FP32")
+        return variants
+
+    def _open_sessions(self, face_app):
+        """
+        Tạo lại session của các model với SessionOptions đã cấu hình / biến thể INT8
+
+        model_zoo của insightface không chuyển `sess_options` xuống InferenceSession
+        nên session được mở lại sau prepare(); biến thể lượng tử hóa giữ nguyên
+        input/output float32 nên pre/post-processing của model không đổi.
+        """
+        settings = get_settings()
+        variants = self._select_variants(face_app)
+        self.model_variants = {taskname: os.path.basename(path) for taskname, path in variants.items()}
+        if not settings.onnx_session_profile and not variants:
+            return
+
+        import onnxruntime as ort
+
+        options = self._session_options() if settings.onnx_session_profile else None
+        for taskname, model in face_app.models.items():
+            if options is None and taskname not in variants:
+                continue
+            try:
+                model.session = ort.InferenceSession(
+                    variants.get(taskname, model.model_file), sess_options=options, providers=self.providers
+                )
+            except Exception as e:
+                self.model_variants.pop(taskname, None)
+                logger.warning(f"⚠️ FaceProcessor: Keeping default session for {taskname}: {e}")
+        logger.info(f"FaceProcessor session profile: {self.session_profile}, variants: {self.model_variants or 'fp32'}")
+
+    @staticmethod
+    def _time_runs(run, iterations: int) -> Dict[str, float]:
+        """Lần chạy đầu (cold) + latency các lần sau (ms)"""
+        started = time.perf_counter()
+        run()
+        first_ms = (time.perf_counter() - started) * 1000
+        samples = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            run()
+            samples.append((time.perf_counter() - started) * 1000)
+        return {
+            "first_ms": round(first_ms, 2),
+            "mean_ms": round(float(np.mean(samples)), 2),
+            "p50_ms": round(float(np.median(samples)), 2),
+            "runs": len(samples)
+        }
+
+    def _warm_up_models(self, face_app, iterations: int):
+        """
+        Chạy input giả qua session từng model rồi cả pipeline trên frame giả
+
+        Lần chạy đầu khởi tạo kernel / memory arena; latency đo sau đó được giữ
+        trong `model_latency` (theo taskname, "frame" = face_app.get một frame).
+        """
+        self.model_latency = {}
+        if iterations <= 0:
+            return
+        rng = np.random.default_rng(0)
+        models = dict(face_app.models)
+        if self._light_detector is not None:
+            models["cascade_detection"] = self._light_detector
+        for taskname, model in models.items():
+            try:
+                session = model.session
+                model_input = session.get_inputs()[0]
+                dims = [dim if isinstance(dim, int) and dim > 0 else 1 for dim in model_input.shape]
+                input_size = getattr(model, "input_size", None)
+                if len(dims) == 4 and input_size:
+                    # input_size của insightface là (width, height)
+                    dims[2], dims[3] = int(input_size[1]), int(input_size[0])
+                feed = {model_input.name: rng.standard_normal(dims).astype(np.float32)}
+                self.model_latency[taskname] = self._time_runs(lambda: session.run(None, feed), iterations)
+            except Exception as e:
+                logger.warning(f"⚠️ FaceProcessor: Warm-up failed for {taskname}: {e}")
+        try:
+            frame = rng.integers(0, 255, (640, 640, 3), dtype=np.uint8)
+            self.model_latency["frame"] = self._time_runs(lambda: face_app.get(frame), iterations)
+        except Exception as e:
+            logger.warning(f"⚠️ FaceProcessor: Frame warm-up failed: {e}")
+
+    def _low_res_detector(self, det_model):
+        """
+        Detector chính ở cascade_det_size với ngưỡng cascade_threshold cho tầng đầu
+
+        Bản sao nông dùng chung session ONNX với det_model; det_thresh / input_size
+        riêng nên không phải đổi ngưỡng của det_model (đang được thread khác dùng).
+        """
+        size = self._cascade_settings.cascade_det_size
+        model = copy.copy(det_model)
+        model.input_size = (size, size)
+        model.det_thresh = self._cascade_settings.cascade_threshold
+        logger.info(f"FaceProcessor cascade detector: main detector at {size}x{size}")
+        return model
+
+    def _load_light_detector(self, ctx_id: int):
+        """Detector nhỏ cho tầng đầu của cascade (vd det_500m.onnx), None nếu lỗi"""
+        settings = get_settings()
+        try:
+            from insightface.model_zoo import get_model
+
+            model = get_model(settings.cascade_detector_model, providers=self.providers)
+            size = settings.cascade_det_size
+            model.prepare(ctx_id, input_size=(size, size), det_thresh=settings.cascade_threshold)
+            if settings.onnx_session_profile:
+                import onnxruntime as ort
+
+                model.session = ort.InferenceSession(
+                    model.model_file, sess_options=self._session_options(), providers=self.providers
+                )
+            logger.info(f"FaceProcessor cascade detector: {settings.cascade_detector_model} ({size}x{size})")
+            return model
+        except Exception as e:
+            logger.warning(f"⚠️ FaceProcessor: Cascade detector unavailable, using main detector at low resolution: {e}")
+            return None
+
+    async def warm_up(self):
+        """Nạp model nền (không block event loop)"""
+        if self._face_app is not None:
+            return
+        self.state = "loading"
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(self.executor, self.load)
+        except Exception:
+            pass
+
+    def _retry_in(self) -> float:
+        """Số giây còn lại trước khi được nạp lại sau lỗi (0 = được thử ngay)"""
+        if self.state != "failed" or self._failed_at is None:
+            return 0.0
+        backoff = min(self.LOAD_RETRY_MAX_SECONDS, self.LOAD_RETRY_BASE_SECONDS * 2 ** max(0, self.load_failures - 1))
+        return max(0.0, self._failed_at + backoff - time.monotonic())
+
+    def ensure_loading(self):
+        """Bắt đầu nạp model nền nếu chưa nạp hoặc lỗi đã hết backoff (không chờ)"""
+        if self.state == "not_loaded" or (self.state == "failed" and self._retry_in() <= 0):
+            if self.state == "failed":
+                logger.info(f"🔁 FaceProcessor: Retrying model load (attempt {self.load_failures + 1})")
+            self.state = "loading"
+            asyncio.ensure_future(self.warm_up())
+
+    def get_status(self) -> Dict[str, Any]:
+        """Trạng thái nạp model cho readiness check"""
+        return {
+            "state": self.state,
+            "ready": self.is_ready,
+            "providers": self._providers,
+            "load_seconds": self.load_seconds,
+            "precision": self.precision,
+            "model_variants": self.model_variants,
+            "session_profile": self.session_profile,
+            "model_latency": self.model_latency,
+            "cascade": dict(self.cascade_stats) if self.cascade_detection else None,
+            "error": self.load_error,
+            "load_failures": self.load_failures,
+            "retry_in_seconds": round(self._retry_in(), 1) if self.state == "failed" else None
+        }
     
     def _get_available_providers(self) -> List[str]:
         """Get list of available execution providers, prioritizing GPU"""
@@ -59,13 +379,20 @@ class FaceProcessorService:
     def cleanup(self):
         """Giải phóng tài nguyên"""
         try:
-            if hasattr(self, 'face_app'):
-                del self.face_app
-            if hasattr(self, 'executor'):
-                self.executor.shutdown(wait=True)
+            self._face_app = None
+            self._light_detector = None
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            self.state = "not_loaded"
             gc.collect()
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
+            # torch là tùy chọn, chỉ dùng để giải phóng cache CUDA nếu có
+            try:
+                import torch
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            except ImportError:
+                pass
         except:
             pass
 
@@ -112,6 +439,149 @@ class FaceProcessorService:
             traceback.print_exc()
             return None
 
+    async def extract_face_embedding_with_quality(self, image_data: bytes) -> Tuple[Optional[np.ndarray], Dict[str, Any]]:
+        """Trích xuất embedding kèm điểm chất lượng khuôn mặt (enrollment)"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            self._extract_face_embedding_with_quality_sync,
+            image_data
+        )
+
+    def _extract_face_embedding_with_quality_sync(self, image_data: bytes) -> Tuple[Optional[np.ndarray], Dict[str, Any]]:
+        """Embedding của khuôn mặt tốt nhất + quality (sync version)"""
+        try:
+            img = self._decode_image(image_data)
+            if img is None:
+                return None, {"error": "Invalid image data"}
+            faces = self.face_app.get(img)
+            if not faces:
+                return None, {"error": "No face detected", "faces": 0}
+            face = max(faces, key=lambda x: x.det_score)
+            quality = self.assess_face_quality(img, face)
+            quality["faces"] = len(faces)
+            return face.embedding, quality
+        except Exception as e:
+            print(f"❌ FaceProcessor: Error extracting face embedding: {e}")
+            # Lỗi model / runtime (không phải ảnh kém): caller không được coi là ảnh bị từ chối
+            return None, {"error": str(e), "retryable": True}
+
+    @staticmethod
+    def assess_face_quality(img: np.ndarray, face) -> Dict[str, Any]:
+        """
+        Điểm chất lượng 0..1 của khuôn mặt
+
+        Kết hợp độ tin cậy detect, kích thước, độ nét (phương sai Laplacian) và
+        góc mặt ước lượng từ 5 landmark (yaw: lệch mũi so với giữa hai mắt, roll:
+        độ nghiêng đường nối hai mắt).
+        """
+        x1, y1, x2, y2 = [int(v) for v in face.bbox]
+        x1, y1 = max(0, x1), max(0, y1)
+        face_size = max(0, min(x2 - x1, y2 - y1))
+        crop = img[y1:max(y1 + 1, y2), x1:max(x1 + 1, x2)]
+        sharpness = float(cv2.Laplacian(cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY), cv2.CV_64F).var()) if crop.size else 0.0
+        det_score = float(face.det_score)
+
+        yaw = roll = 0.0
+        kps = getattr(face, "kps", None)
+        if kps is not None and len(kps) >= 3:
+            left_eye, right_eye, nose = kps[0], kps[1], kps[2]
+            eye_distance = float(np.linalg.norm(right_eye - left_eye))
+            if eye_distance > 0:
+                yaw = float((nose[0] - (left_eye[0] + right_eye[0]) / 2) / eye_distance)
+                roll = float(np.degrees(np.arctan2(right_eye[1] - left_eye[1], right_eye[0] - left_eye[0])))
+
+        pose_factor = max(0.0, 1 - abs(yaw) / 0.6) * max(0.0, 1 - abs(roll) / 60)
+        score = det_score * min(1.0, face_size / 112) * min(1.0, sharpness / 100) * pose_factor
+        return {
+            "score": round(score, 4),
+            "det_score": round(det_score, 4),
+            "face_size": face_size,
+            "sharpness": round(sharpness, 2),
+            "yaw": round(yaw, 3),
+            "roll": round(roll, 1)
+        }
+
+    def quality_issues(self, quality: Dict[str, Any]) -> List[str]:
+        """Lý do ảnh không đạt ngưỡng chất lượng enrollment (rỗng nếu đạt)"""
+        settings = get_settings()
+        issues = []
+        if quality.get("det_score", 0) < settings.enrollment_min_det_score:
+            issues.append(f"low detection score ({quality.get('det_score', 0)})")
+        if quality.get("face_size", 0) < settings.enrollment_min_face_size:
+            issues.append(f"face too small ({quality.get('face_size', 0)}px)")
+        if quality.get("sharpness", 0) < settings.enrollment_min_sharpness:
+            issues.append(f"image too blurry ({quality.get('sharpness', 0)})")
+        if abs(quality.get("yaw", 0)) > settings.enrollment_max_yaw or abs(quality.get("roll", 0)) > settings.enrollment_max_roll:
+            issues.append("face not frontal")
+        return issues
+
+    @staticmethod
+    def _decode_image(image_data: bytes) -> Optional[np.ndarray]:
+        """Decode ảnh (cv2.imdecode nhả GIL nên chạy song song được giữa các thread)"""
+        try:
+            return cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+        except Exception:
+            return None
+
+    async def extract_face_embeddings_batch(self, images: List[bytes], batch_size: int = 32) -> List[Optional[np.ndarray]]:
+        """
+        Trích xuất embedding cho nhiều ảnh (bulk import)
+
+        Decode song song trên thread pool, detect từng ảnh rồi chạy model
+        recognition theo batch trên các khuôn mặt đã căn chỉnh. Kết quả theo
+        thứ tự đầu vào, None nếu ảnh lỗi hoặc không có khuôn mặt.
+        """
+        loop = asyncio.get_event_loop()
+        decoded = await asyncio.gather(*[
+            loop.run_in_executor(self.executor, self._decode_image, data) for data in images
+        ])
+        return await loop.run_in_executor(
+            self.executor,
+            self._extract_face_embeddings_batch_sync,
+            decoded,
+            batch_size
+        )
+
+    def _extract_face_embeddings_batch_sync(self, images: List[Optional[np.ndarray]], batch_size: int) -> List[Optional[np.ndarray]]:
+        """Detect khuôn mặt tốt nhất mỗi ảnh, embedding theo batch (sync version)"""
+        from insightface.utils import face_align
+
+        results: List[Optional[np.ndarray]] = [None] * len(images)
+        rec_model = self.face_app.models.get('recognition')
+        aligned, positions = [], []
+
+        for i, img in enumerate(images):
+            if img is None:
+                continue
+            try:
+                bboxes, kpss = self.face_app.det_model.detect(img, max_num=0, metric='default')
+                if bboxes is None or len(bboxes) == 0:
+                    continue
+                # Lấy face có độ tin cậy cao nhất
+                best = int(np.argmax(bboxes[:, 4]))
+                if kpss is None or rec_model is None:
+                    faces = self.face_app.get(img)
+                    if faces:
+                        results[i] = max(faces, key=lambda x: x.det_score).embedding
+                    continue
+                aligned.append(face_align.norm_crop(img, landmark=kpss[best], image_size=rec_model.input_size[0]))
+                positions.append(i)
+            except Exception as e:
+                print(f"❌ FaceProcessor: Error detecting face in batch image {i}: {e}")
+
+        for start in range(0, len(aligned), max(1, batch_size)):
+            chunk = aligned[start:start + batch_size]
+            try:
+                embeddings = rec_model.get_feat(chunk)
+                for offset, embedding in enumerate(embeddings):
+                    results[positions[start + offset]] = embedding
+            except Exception as e:
+                print(f"❌ FaceProcessor: Error extracting batch embeddings: {e}")
+
+        print(f"✅ FaceProcessor: Batch extracted {sum(r is not None for r in results)}/{len(images)} embeddings")
+        return results
+
     async def detect_faces_in_frame(self, frame: np.ndarray) -> List[dict]:
         """Phát hiện khuôn mặt trong frame"""
         loop = asyncio.get_event_loop()
@@ -137,9 +607,24 @@ class FaceProcessorService:
             print(f"Error detecting faces: {e}")
             return []
 
-    async def detect_and_recognize_faces(self, frame: np.ndarray, known_persons: List[dict] = None) -> List[dict]:
-        """Phát hiện và nhận dạng khuôn mặt trong frame cho streaming - dựa theo code mẫu"""
+    async def detect_and_recognize_faces(self, frame: np.ndarray, known_persons: List[dict] = None, gallery=None,
+                                         camera_id: Optional[str] = None) -> List[dict]:
+        """
+        Phát hiện và nhận dạng khuôn mặt trong frame cho streaming - dựa theo code mẫu
+
+        `gallery` là snapshot của recognition_index (index dựng sẵn); không có thì
+        dựng index tạm từ `known_persons` như trước. `camera_id` dùng để đếm frame
+        cho lượt detect đầy đủ định kỳ khi bật cascade_detection.
+        """
         loop = asyncio.get_event_loop()
+        if gallery is not None:
+            return await loop.run_in_executor(
+                self.executor,
+                self._detect_and_recognize_gallery_sync,
+                frame,
+                gallery,
+                camera_id
+            )
         return await loop.run_in_executor(
             self.executor,
             self._detect_and_recognize_sync,
@@ -147,6 +632,104 @@ class FaceProcessorService:
             known_persons or []
         )
 
+    @staticmethod
+    def _det_input_dim(side: int) -> int:
+        """Cạnh input detector cho một ROI: bội số của 32, trong khoảng 128..640"""
+        return min(640, max(128, int(np.ceil(side / 32)) * 32))
+
+    def _cascade_faces(self, frame: np.ndarray, camera_id: Optional[str]) -> list:
+        """
+        Detect hai tầng thay cho face_app.get(frame)
+
+        Tầng nhẹ (detector nhỏ, hoặc detector chính ở cascade_det_size) chạy trên
+        mọi frame AI; không thấy mặt thì bỏ qua frame. Có mặt thì detector đầy đủ
+        chỉ chạy trên vùng bao quanh các mặt được đánh dấu (nới theo
+        cascade_roi_margin), rồi các model còn lại chạy như face_app.get. Cứ
+        cascade_full_interval frame, hoặc khi vùng quá lớn, chạy detect cả frame
+        để bắt mặt nhỏ mà tầng nhẹ bỏ sót.
+        """
+        from insightface.app.common import Face
+
+        settings = self._cascade_settings
+        face_app = self.face_app
+        key = camera_id or ""
+        with self._cascade_lock:
+            self._cascade_frames[key] = frame_number = self._cascade_frames.get(key, 0) + 1
+        if settings.cascade_full_interval and frame_number % settings.cascade_full_interval == 0:
+            self._count_cascade("full")
+            return face_app.get(frame)
+
+        bboxes, _ = self._light_detector.detect(frame, max_num=0, metric='default')
+        if bboxes is None or len(bboxes) == 0:
+            self._count_cascade("skipped")
+            return []
+
+        height, width = frame.shape[:2]
+        pad = np.maximum(bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1]) * settings.cascade_roi_margin
+        x1 = int(max(0, np.min(bboxes[:, 0] - pad)))
+        y1 = int(max(0, np.min(bboxes[:, 1] - pad)))
+        x2 = int(min(width, np.max(bboxes[:, 2] + pad)))
+        y2 = int(min(height, np.max(bboxes[:, 3] + pad)))
+        if x2 <= x1 or y2 <= y1 or (x2 - x1) * (y2 - y1) > settings.cascade_max_roi_ratio * width * height:
+            self._count_cascade("full")
+            return face_app.get(frame)
+
+        self._count_cascade("roi")
+        input_size = (self._det_input_dim(x2 - x1), self._det_input_dim(y2 - y1))
+        bboxes, kpss = face_app.det_model.detect(frame[y1:y2, x1:x2], input_size=input_size, max_num=0, metric='default')
+        if bboxes is None or len(bboxes) == 0:
+            return []
+
+        offset = np.array([x1, y1], dtype=np.float32)
+        faces = []
+        for i in range(len(bboxes)):
+            face = Face(
+                bbox=bboxes[i, :4] + np.tile(offset, 2),
+                kps=kpss[i] + offset if kpss is not None else None,
+                det_score=bboxes[i, 4]
+            )
+            for taskname, model in face_app.models.items():
+                if taskname != 'detection':
+                    model.get(frame, face)
+            faces.append(face)
+        return faces
+
+    def _count_cascade(self, outcome: str):
+        with self._cascade_lock:
+            self.cascade_stats[outcome] += 1
+
+    def release_camera(self, camera_id: str):
+        """Bỏ bộ đếm frame cascade của camera đã dừng stream"""
+        with self._cascade_lock:
+            self._cascade_frames.pop(str(camera_id), None)
+
+    def _detect_and_recognize_gallery_sync(self, frame: np.ndarray, gallery, camera_id: Optional[str] = None) -> List[dict]:
+        """Phát hiện khuôn mặt rồi nhận dạng cả frame bằng một lần search trên gallery"""
+        try:
+            if self.cascade_detection:
+                faces = self._cascade_faces(frame, camera_id)
+            else:
+                faces = self.face_app.get(frame)
+            if not faces:
+                return []
+            matches = gallery.search(np.vstack([face.embedding for face in faces]), self.recognition_threshold)
+
+            result = []
+            for face, (person_id, name, similarity) in zip(faces, matches):
+                x1, y1, x2, y2 = map(int, face.bbox)
+                result.append({
+                    'bbox': [x1, y1, x2 - x1, y2 - y1],  # [x, y, width, height]
+                    'confidence': float(face.det_score),
+                    'person_id': person_id,
+                    'person_name': name,
+                    'recognition_confidence': similarity if person_id else 0.0,
+                    'is_new_detection': person_id is not None
+                })
+            return result
+        except Exception as e:
+            print(f"Error detecting and recognizing faces: {e}")
+            return []
+
     def _detect_and_recognize_sync(self, frame: np.ndarray, known_persons: List[dict]) -> List[dict]:
         """Phát hiện và nhận dạng khuôn mặt (sync version) - tương tự code mẫu"""
         try:
@@ -172,6 +755,7 @@ class FaceProcessorService:
                         names.append(person_name)
             
             # Chuyển sang numpy array để dùng với FAISS như code mẫu
+            import faiss
             if face_db:
                 face_db_array = np.array(face_db).astype('float32')
                 
@@ -223,6 +807,7 @@ class FaceProcessorService:
             return "Unknown"
         
         try:
+            import faiss
             # Chuẩn hóa embedding giống code mẫu
             embedding = face_embedding.astype('float32').reshape(1, -1)
             faiss.normalize_L2(embedding)
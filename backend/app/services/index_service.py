@@ -0,0 +1,233 @@
+from typing import Dict, Any, List, Optional
+from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from ..database import get_database
+from ..config import get_settings
+
+# TTL index cũ trên detection_logs.timestamp: không còn khai báo (retention là job
+# opt-in của detection_service, xóa cả file ảnh và trừ bộ đếm), bị drop nếu còn
+DETECTION_LOGS_TTL_INDEX = "detection_logs_ttl"
+
+
+class IndexService:
+    """
+    Quản lý index MongoDB cho các truy vấn chính của hệ thống
+
+    - Khai báo compound index cho detection_logs, known_persons, sessions...
+    - Báo cáo index thiếu / index không được sử dụng ($indexStats)
+    - Kiểm tra query plan (explain) của các truy vấn chính trong service
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+
+    @property
+    def db(self):
+        return get_database()
+
+    def declared_indexes(self) -> Dict[str, List[IndexModel]]:
+        """Danh sách index được khai báo cho từng collection"""
+        indexes = {
+            "detection_logs": [
+                IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)],
+                           name="user_timestamp"),
+                IndexModel([("user_id", ASCENDING), ("camera_id", ASCENDING), ("timestamp", DESCENDING)],
+                           name="user_camera_timestamp"),
+                IndexModel([("user_id", ASCENDING), ("detection_type", ASCENDING), ("timestamp", DESCENDING)],
+                           name="user_type_timestamp"),
+                IndexModel([("detection_type", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)],
+                           name="type_timestamp_id"),
+                IndexModel([("timestamp", ASCENDING)], name="timestamp"),
+            ],
+            "known_persons": [
+                IndexModel([("user_id", ASCENDING), ("is_active", ASCENDING)], name="user_active"),
+                IndexModel([("is_active", ASCENDING)], name="active"),
+            ],
+            "detection_sessions": [
+                IndexModel([("session_id", ASCENDING)], name="session_id"),
+                IndexModel([("user_id", ASCENDING), ("session_start", DESCENDING), ("_id", DESCENDING)],
+                           name="user_session_start_id"),
+            ],
+            "cameras": [
+                IndexModel([("user_id", ASCENDING), ("is_active", ASCENDING)], name="user_active"),
+            ],
+            "users": [
+                IndexModel([("username", ASCENDING)], name="username"),
+                IndexModel([("email", ASCENDING)], name="email"),
+            ],
+            "user_settings": [
+                IndexModel([("user_id", ASCENDING)], name="user_id"),
+            ],
+            "mail_queue": [
+                IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt"),
+                IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="mail_expires_at_ttl"),
+            ],
+            "shared_state": [
+                IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="shared_state_expires_at_ttl"),
+            ],
+            "face_images.files": [
+                IndexModel([("metadata.person_id", ASCENDING)], name="person_id"),
+            ],
+            "import_jobs": [
+                IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_created"),
+                IndexModel([("status", ASCENDING), ("heartbeat_at", ASCENDING)], name="status_heartbeat"),
+            ],
+            "import_job_items": [
+                IndexModel([("job_id", ASCENDING), ("status", ASCENDING), ("index", ASCENDING)], name="job_status_index"),
+            ],
+            "enrollment_jobs": [
+                IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt"),
+                IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="enrollment_expires_at_ttl"),
+            ],
+            "webhook_dead_letters": [
+                IndexModel([("created_at", ASCENDING)], name="created_at"),
+            ],
+            "detection_counters": [
+                IndexModel([("user_id", ASCENDING), ("granularity", ASCENDING), ("bucket", ASCENDING),
+                            ("camera_id", ASCENDING), ("detection_type", ASCENDING)],
+                           unique=True, name="counter_bucket_unique"),
+                IndexModel([("granularity", ASCENDING), ("bucket", DESCENDING)],
+                           name="counter_granularity_bucket"),
+                IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0,
+                           name="counter_expires_at_ttl"),
+            ],
+        }
+        return indexes
+
+    async def _sync_ttl_index(self) -> Optional[str]:
+        """Drop TTL index cũ của detection_logs (MongoDB tự xóa log mà không dọn file ảnh / bộ đếm)"""
+        collection = self.db.detection_logs
+        existing = await collection.index_information()
+        if DETECTION_LOGS_TTL_INDEX in existing:
+            await collection.drop_index(DETECTION_LOGS_TTL_INDEX)
+            return "dropped"
+        return None
+
+    async def ensure_indexes(self) -> Dict[str, List[str]]:
+        """Tạo các index đã khai báo (idempotent), chạy lúc startup"""
+        created: Dict[str, List[str]] = {}
+
+        try:
+            ttl_action = await self._sync_ttl_index()
+            if ttl_action:
+                print(f"✅ detection_logs TTL index {ttl_action}")
+        except Exception as e:
+            print(f"⚠️ Error syncing TTL index: {e}")
+
+        for collection_name, models in self.declared_indexes().items():
+            try:
+                created[collection_name] = await self.db[collection_name].create_indexes(models)
+            except OperationFailure as e:
+                # Index trùng tên nhưng khác định nghĩa - giữ nguyên, báo cáo qua report_indexes()
+                print(f"⚠️ Error creating indexes for {collection_name}: {e}")
+                created[collection_name] = []
+        return created
+
+    async def report_indexes(self) -> Dict[str, Any]:
+        """Báo cáo index thiếu, index ngoài khai báo và index không được sử dụng"""
+        existing_collections = set(await self.db.list_collection_names())
+        report: Dict[str, Any] = {}
+
+        for collection_name, models in self.declared_indexes().items():
+            declared = {model.document["name"] for model in models}
+            if collection_name not in existing_collections:
+                report[collection_name] = {
+                    "missing": sorted(declared),
+                    "undeclared": [],
+                    "unused": [],
+                    "usage": {}
+                }
+                continue
+
+            collection = self.db[collection_name]
+            existing = set((await collection.index_information()).keys())
+
+            usage: Dict[str, int] = {}
+            try:
+                async for stat in collection.aggregate([{"$indexStats": {}}]):
+                    usage[stat["name"]] = int(stat.get("accesses", {}).get("ops", 0))
+            except OperationFailure as e:
+                print(f"⚠️ $indexStats not available for {collection_name}: {e}")
+
+            report[collection_name] = {
+                "missing": sorted(declared - existing),
+                "undeclared": sorted(existing - declared - {"_id_"}),
+                "unused": sorted(name for name, ops in usage.items() if ops == 0 and name != "_id_"),
+                "usage": usage
+            }
+        return report
+
+    def _sample_queries(self, user_id: ObjectId) -> List[Dict[str, Any]]:
+        """Các truy vấn chính của service dùng để kiểm tra query plan"""
+        return [
+            {"name": "user_detections", "collection": "detection_logs",
+             "filter": {"user_id": user_id}, "sort": [("timestamp", -1), ("_id", -1)]},
+            {"name": "user_camera_detections", "collection": "detection_logs",
+             "filter": {"user_id": user_id, "camera_id": ObjectId()}, "sort": [("timestamp", -1)]},
+            {"name": "user_type_detections", "collection": "detection_logs",
+             "filter": {"user_id": user_id, "detection_type": "stranger"}, "sort": [("timestamp", -1)]},
+            {"name": "alerts", "collection": "detection_logs",
+             "filter": {"detection_type": {"$in": ["stranger", "unknown"]}}, "sort": [("timestamp", -1), ("_id", -1)]},
+            {"name": "user_active_persons", "collection": "known_persons",
+             "filter": {"user_id": user_id, "is_active": True}, "sort": None},
+            {"name": "active_persons", "collection": "known_persons",
+             "filter": {"is_active": True}, "sort": None},
+            {"name": "session_by_id", "collection": "detection_sessions",
+             "filter": {"session_id": "00000000-0000-0000-0000-000000000000"}, "sort": None},
+            {"name": "user_sessions", "collection": "detection_sessions",
+             "filter": {"user_id": user_id}, "sort": [("session_start", -1), ("_id", -1)]},
+            {"name": "user_counters", "collection": "detection_counters",
+             "filter": {"user_id": user_id, "granularity": "total"}, "sort": None},
+        ]
+
+    @staticmethod
+    def _collect_plan(plan: Dict[str, Any], stages: List[str], index_names: List[str]):
+        """Duyệt cây winningPlan để lấy danh sách stage và index được dùng"""
+        if not isinstance(plan, dict):
+            return
+        if plan.get("stage"):
+            stages.append(plan["stage"])
+        if plan.get("indexName"):
+            index_names.append(plan["indexName"])
+        for key in ("inputStage", "queryPlan"):
+            if key in plan:
+                IndexService._collect_plan(plan[key], stages, index_names)
+        for child in plan.get("inputStages", []):
+            IndexService._collect_plan(child, stages, index_names)
+
+    async def explain_queries(self, user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Chạy explain cho các truy vấn chính và đánh dấu truy vấn dùng COLLSCAN"""
+        user_oid = ObjectId(user_id) if user_id else ObjectId()
+        results = []
+
+        for sample in self._sample_queries(user_oid):
+            try:
+                cursor = self.db[sample["collection"]].find(sample["filter"])
+                if sample["sort"]:
+                    cursor = cursor.sort(sample["sort"])
+                explain = await cursor.limit(50).explain()
+
+                stages: List[str] = []
+                index_names: List[str] = []
+                self._collect_plan(explain.get("queryPlanner", {}).get("winningPlan", {}), stages, index_names)
+                execution = explain.get("executionStats", {})
+
+                results.append({
+                    "query": sample["name"],
+                    "collection": sample["collection"],
+                    "stages": stages,
+                    "indexes": index_names,
+                    "uses_collection_scan": "COLLSCAN" in stages,
+                    "in_memory_sort": "SORT" in stages,
+                    "docs_examined": execution.get("totalDocsExamined"),
+                    "keys_examined": execution.get("totalKeysExamined"),
+                    "returned": execution.get("nReturned")
+                })
+            except Exception as e:
+                results.append({"query": sample["name"], "collection": sample["collection"], "error": str(e)})
+        return results
+
+
+# Global instance
+index_service = IndexService()
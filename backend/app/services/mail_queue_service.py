@@ -0,0 +1,340 @@
+from typing import Dict, Any, List, Optional
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.image import MIMEImage
+from contextlib import asynccontextmanager
+from bson import ObjectId, Binary
+from pymongo import ReturnDocument
+import aiosmtplib
+import asyncio
+import time
+from ..config import get_settings
+from ..database import get_database
+
+
+class SMTPConnectionPool:
+    """
+    Pool nhỏ các kết nối SMTP đã STARTTLS + AUTH, giữ kết nối (keep-alive)
+
+    Kết nối idle quá `idle_timeout` giây được kiểm tra lại bằng NOOP trước khi
+    dùng; kết nối lỗi bị đóng và mở lại ở lần acquire tiếp theo.
+    """
+
+    def __init__(self, size: int = 2, timeout: float = 10, idle_timeout: float = 60):
+        self.settings = get_settings()
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._idle: List[tuple] = []  # (client, last_used)
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        return self._semaphore
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        """Mở kết nối mới (TCP + STARTTLS + AUTH)"""
+        client = aiosmtplib.SMTP(
+            hostname=self.settings.smtp_server,
+            port=self.settings.smtp_port,
+            start_tls=self.settings.smtp_use_tls,
+            username=self.settings.smtp_username,
+            password=self.settings.smtp_password,
+            timeout=self.timeout
+        )
+        await client.connect()
+        return client
+
+    async def _is_healthy(self, client: aiosmtplib.SMTP, last_used: float) -> bool:
+        if not client.is_connected:
+            return False
+        if time.monotonic() - last_used < self.idle_timeout:
+            return True
+        try:
+            await client.noop()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    async def _close(client: Optional[aiosmtplib.SMTP]):
+        if client is None:
+            return
+        try:
+            if client.is_connected:
+                await client.quit()
+        except Exception:
+            client.close()
+
+    async def _checkout(self) -> aiosmtplib.SMTP:
+        while self._idle:
+            client, last_used = self._idle.pop()
+            if await self._is_healthy(client, last_used):
+                return client
+            await self._close(client)
+        return await self._connect()
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Mượn một kết nối SMTP từ pool (tối đa `size` kết nối đồng thời)"""
+        async with self._get_semaphore():
+            client = await self._checkout()
+            healthy = True
+            try:
+                yield client
+            except Exception:
+                healthy = False
+                raise
+            finally:
+                if healthy and client.is_connected:
+                    self._idle.append((client, time.monotonic()))
+                else:
+                    await self._close(client)
+
+    async def close(self):
+        """Đóng toàn bộ kết nối idle"""
+        while self._idle:
+            client, _ = self._idle.pop()
+            await self._close(client)
+
+
+class MailQueueService:
+    """
+    Hàng đợi email bền vững (collection `mail_queue`) với worker gửi nền
+
+    - `enqueue()` chỉ ghi job vào MongoDB và trả về ngay, alert không chờ SMTP
+      (chưa cấu hình SMTP thì bỏ qua, không để job tồn đọng)
+    - Worker lấy job bằng find_one_and_update (an toàn khi chạy nhiều worker); job
+      'sending' quá `mail_send_lease_seconds` (worker chết giữa chừng) được nhận lại
+    - Lỗi gửi được retry với exponential backoff, quá `mail_max_attempts` → failed
+    - Gửi thành công thì cập nhật email_sent cho detection log liên quan
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.pool = SMTPConnectionPool(
+            size=self.settings.smtp_pool_size,
+            timeout=self.settings.smtp_timeout_seconds
+        )
+        self.workers: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._running = False
+
+    @property
+    def db(self):
+        return get_database()
+
+    @property
+    def collection(self):
+        return self.db.mail_queue
+
+    def _get_wakeup(self) -> asyncio.Event:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    def is_configured(self) -> bool:
+        return bool(self.settings.smtp_username and self.settings.smtp_password)
+
+    def build_message(self, to_email: str, subject: str, html_content: str,
+                      image_data: Optional[bytes] = None, image_filename: Optional[str] = None,
+                      image_cid: Optional[str] = None) -> MIMEMultipart:
+        """
+        Tạo MIME message (HTML + ảnh nếu có)
+
+        Có `image_cid` thì ảnh được nhúng inline (multipart/related, HTML tham chiếu
+        `cid:<image_cid>`), ngược lại ảnh là file đính kèm. Hàm đồng bộ, tốn CPU
+        (base64 ảnh) nên được gọi trong worker thread.
+        """
+        if image_data and image_cid:
+            message = MIMEMultipart("related")
+        else:
+            message = MIMEMultipart("mixed" if image_data else "alternative")
+        message["Subject"] = subject
+        message["From"] = self.settings.smtp_username
+        message["To"] = to_email
+        message.attach(MIMEText(html_content, "html", "utf-8"))
+
+        if image_data:
+            try:
+                img_attachment = MIMEImage(image_data, _subtype="jpeg")
+                img_attachment.add_header(
+                    'Content-Disposition',
+                    'inline' if image_cid else 'attachment',
+                    filename=image_filename or f'stranger_detection_{int(datetime.utcnow().timestamp())}.jpg'
+                )
+                if image_cid:
+                    img_attachment.add_header('Content-ID', f'<{image_cid}>')
+                message.attach(img_attachment)
+            except Exception as img_error:
+                print(f"⚠️ Warning: Could not attach image: {img_error}")
+        return message
+
+    async def send_now(self, to_email: str, subject: str, html_content: str,
+                       image_data: Optional[bytes] = None, image_filename: Optional[str] = None,
+                       image_cid: Optional[str] = None):
+        """Gửi trực tiếp qua pool (dùng cho test email cần biết kết quả ngay)"""
+        message = await asyncio.to_thread(
+            self.build_message, to_email, subject, html_content, image_data, image_filename, image_cid
+        )
+        async with self.pool.acquire() as client:
+            await client.send_message(message)
+
+    async def enqueue(self, to_email: str, subject: str, html_content: str,
+                      image_data: Optional[bytes] = None, image_filename: Optional[str] = None,
+                      metadata: Optional[Dict[str, Any]] = None, image_cid: Optional[str] = None) -> Optional[str]:
+        """Đưa email vào hàng đợi, trả về job id (None nếu chưa cấu hình SMTP)"""
+        if not self.is_configured():
+            print(f"⚠️ [MAIL QUEUE] SMTP credentials not configured, email to {to_email} not queued")
+            return None
+        try:
+            now = datetime.utcnow()
+            job = {
+                "to": to_email,
+                "subject": subject,
+                "html": html_content,
+                "image": Binary(image_data) if image_data else None,
+                "image_filename": image_filename,
+                "image_cid": image_cid,
+                "metadata": metadata or {},
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "created_at": now,
+                "last_error": None
+            }
+            result = await self.collection.insert_one(job)
+            self._get_wakeup().set()
+            print(f"📨 [MAIL QUEUE] Queued email to {to_email} ({result.inserted_id})")
+            return str(result.inserted_id)
+        except Exception as e:
+            print(f"❌ [MAIL QUEUE] Error queueing email: {e}")
+            return None
+
+    def _retry_delay(self, attempts: int) -> timedelta:
+        delay = self.settings.mail_retry_base_seconds * (2 ** max(0, attempts - 1))
+        return timedelta(seconds=min(delay, 3600))
+
+    async def _claim_job(self) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        lease_expired = now - timedelta(seconds=self.settings.mail_send_lease_seconds)
+        return await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {"status": "sending", "locked_at": {"$lt": lease_expired}}
+            ]},
+            {"$set": {"status": "sending", "locked_at": now}, "$inc": {"attempts": 1}},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _on_sent(self, job: Dict[str, Any]):
+        metadata = job.get("metadata", {})
+        log_ids = list(metadata.get("detection_log_ids", []))
+        if metadata.get("detection_log_id"):
+            log_ids.append(metadata["detection_log_id"])
+        object_ids = [ObjectId(log_id) for log_id in log_ids if log_id and ObjectId.is_valid(log_id)]
+        if object_ids:
+            await self.db.detection_logs.update_many(
+                {"_id": {"$in": object_ids}},
+                {"$set": {"email_sent": True, "email_sent_at": datetime.utcnow()}}
+            )
+
+    async def _process_job(self, job: Dict[str, Any]):
+        try:
+            image = job.get("image")
+            await self.send_now(
+                job["to"], job["subject"], job["html"],
+                bytes(image) if image else None, job.get("image_filename"), job.get("image_cid")
+            )
+            now = datetime.utcnow()
+            await self.collection.update_one(
+                {"_id": job["_id"]},
+                {"$set": {
+                    "status": "sent",
+                    "sent_at": now,
+                    "expires_at": now + timedelta(days=self.settings.mail_queue_retention_days)
+                }, "$unset": {"image": "", "html": ""}}
+            )
+            await self._on_sent(job)
+            print(f"✅ [MAIL QUEUE] Email sent to {job['to']} (attempt {job['attempts']})")
+        except Exception as e:
+            attempts = job.get("attempts", 1)
+            now = datetime.utcnow()
+            if attempts >= self.settings.mail_max_attempts:
+                await self._give_up(job, str(e))
+                return
+            await self.collection.update_one({"_id": job["_id"]}, {"$set": {
+                "status": "pending",
+                "last_error": str(e),
+                "next_attempt_at": now + self._retry_delay(attempts)
+            }})
+            print(f"⚠️ [MAIL QUEUE] Email to {job['to']} failed (attempt {attempts}), retrying: {e}")
+
+    async def _give_up(self, job: Dict[str, Any], error: str):
+        await self.collection.update_one({"_id": job["_id"]}, {"$set": {
+            "status": "failed",
+            "last_error": error,
+            "expires_at": datetime.utcnow() + timedelta(days=self.settings.mail_queue_retention_days)
+        }})
+        print(f"❌ [MAIL QUEUE] Giving up on email to {job['to']} after {job.get('attempts', 1)} attempts: {error}")
+
+    async def _worker(self, worker_id: int):
+        wakeup = self._get_wakeup()
+        while self._running:
+            try:
+                job = await self._claim_job()
+                if job is None:
+                    wakeup.clear()
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), timeout=self.settings.mail_queue_poll_seconds)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if job["attempts"] > self.settings.mail_max_attempts:
+                    # Nhận lại sau khi hết lease mà đã dùng hết số lần thử
+                    await self._give_up(job, "Send lease expired")
+                    continue
+                await self._process_job(job)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                print(f"❌ [MAIL QUEUE] Worker {worker_id} error: {e}")
+                await asyncio.sleep(self.settings.mail_queue_poll_seconds)
+
+    async def start(self):
+        """Khởi động worker gửi email"""
+        if self._running:
+            return
+        if not self.is_configured():
+            print("⚠️ [MAIL QUEUE] SMTP credentials not configured, workers not started")
+            return
+        self._running = True
+        self.workers = [
+            asyncio.create_task(self._worker(i))
+            for i in range(max(1, self.settings.mail_queue_workers))
+        ]
+        print(f"✅ [MAIL QUEUE] Started {len(self.workers)} workers")
+
+    async def stop(self):
+        """Dừng worker và đóng kết nối SMTP"""
+        self._running = False
+        for task in self.workers:
+            task.cancel()
+        if self.workers:
+            await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        await self.pool.close()
+
+    async def get_queue_stats(self) -> Dict[str, Any]:
+        """Thống kê hàng đợi theo trạng thái"""
+        counts = {"pending": 0, "sending": 0, "sent": 0, "failed": 0}
+        async for row in self.collection.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+            counts[row["_id"]] = row["count"]
+        return {"jobs": counts, "workers": len(self.workers), "running": self._running}
+
+
+# Global instance
+mail_queue_service = MailQueueService()
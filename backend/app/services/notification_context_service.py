@@ -0,0 +1,269 @@
+from typing import Dict, Any, Optional, Tuple
+from datetime import timedelta
+from bson import ObjectId
+import asyncio
+import time
+from ..config import get_settings
+from ..database import get_database
+from ..utils.timezone_utils import VIETNAM_TIMEZONE, vietnam_now
+from .detection_counter_service import detection_counter_service
+from .event_bus import event_bus
+
+NOTIFICATION_CONTEXT_CHANNEL = "notification_context"
+STATS_WINDOW_SECONDS = 24 * 3600
+STATS_BUCKET_SECONDS = 60
+
+
+class RollingDetectionStats:
+    """Bộ đếm detection 24h theo bucket 1 phút cho một cặp user/camera"""
+
+    def __init__(self):
+        # bucket_start -> [count, stranger_alerts, confidence_sum, confidence_n, confidence_max, confidence_min]
+        self.buckets: Dict[int, list] = {}
+
+    def add(self, epoch: float, count: int = 1, stranger_alerts: int = 0,
+            confidence_sum: float = 0.0, confidence_n: int = 0,
+            confidence_max: Optional[float] = None, confidence_min: Optional[float] = None):
+        key = int(epoch // STATS_BUCKET_SECONDS) * STATS_BUCKET_SECONDS
+        bucket = self.buckets.setdefault(key, [0, 0, 0.0, 0, None, None])
+        bucket[0] += count
+        bucket[1] += stranger_alerts
+        bucket[2] += confidence_sum
+        bucket[3] += confidence_n
+        if confidence_max is not None:
+            bucket[4] = confidence_max if bucket[4] is None else max(bucket[4], confidence_max)
+        if confidence_min is not None:
+            bucket[5] = confidence_min if bucket[5] is None else min(bucket[5], confidence_min)
+
+    def summary(self, now: float) -> Dict[str, Any]:
+        cutoff = now - STATS_WINDOW_SECONDS
+        for key in [key for key in self.buckets if key < cutoff - STATS_BUCKET_SECONDS]:
+            del self.buckets[key]
+
+        total = alerts = confidence_n = 0
+        confidence_sum = 0.0
+        confidence_max = confidence_min = None
+        for key, (count, stranger, c_sum, c_n, c_max, c_min) in self.buckets.items():
+            if key < cutoff:
+                continue
+            total += count
+            alerts += stranger
+            confidence_sum += c_sum
+            confidence_n += c_n
+            if c_max is not None:
+                confidence_max = c_max if confidence_max is None else max(confidence_max, c_max)
+            if c_min is not None:
+                confidence_min = c_min if confidence_min is None else min(confidence_min, c_min)
+
+        return {
+            "total_detections_24h": total,
+            "stranger_alerts_24h": alerts,
+            "avg_confidence": confidence_sum / confidence_n if confidence_n else 0,
+            "max_confidence": confidence_max or 0,
+            "min_confidence": confidence_min or 0
+        }
+
+
+class NotificationContextService:
+    """
+    Cache ngữ cảnh cần để dựng một cảnh báo (không đọc DB khi cache còn hạn)
+
+    - Notification settings, email của user, thông tin camera: cache theo TTL,
+      bị xóa khi settings/profile/camera thay đổi (invalidate_*, phát qua event bus
+      để các worker khác cũng xóa)
+    - Số camera / known persons của user: cache theo TTL + invalidate
+    - Thống kê 24h theo camera: bộ đếm rolling trong bộ nhớ, được nạp từ DB
+      một lần cho mỗi camera rồi cập nhật qua listener của detection_counter_service
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._cache: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+        self._stats: Dict[Tuple[str, str], RollingDetectionStats] = {}
+        self._stats_loading: Dict[Tuple[str, str], asyncio.Task] = {}
+        detection_counter_service.add_listener(self.record_detection_log)
+        event_bus.subscribe(NOTIFICATION_CONTEXT_CHANNEL, self._on_bus_message)
+
+    @property
+    def db(self):
+        return get_database()
+
+    # ===== Generic TTL cache =====
+
+    def _get_cached(self, kind: str, key: str) -> Tuple[bool, Any]:
+        entry = self._cache.get((kind, key))
+        if entry and entry[0] > time.monotonic():
+            return True, entry[1]
+        return False, None
+
+    def _set_cached(self, kind: str, key: str, value: Any):
+        self._cache[(kind, key)] = (time.monotonic() + self.settings.notification_cache_ttl_seconds, value)
+
+    def invalidate_user(self, user_id: str, broadcast: bool = True):
+        """Xóa cache settings / email / số liệu của user"""
+        for kind in ("settings", "email", "counts"):
+            self._cache.pop((kind, str(user_id)), None)
+        if broadcast:
+            event_bus.publish_nowait(NOTIFICATION_CONTEXT_CHANNEL, {"kind": "user", "user_id": str(user_id)})
+
+    def invalidate_counts(self, user_id: str, broadcast: bool = True):
+        """Xóa cache số camera / known persons của user"""
+        self._cache.pop(("counts", str(user_id)), None)
+        if broadcast:
+            event_bus.publish_nowait(NOTIFICATION_CONTEXT_CHANNEL, {"kind": "counts", "user_id": str(user_id)})
+
+    def invalidate_camera(self, camera_id: str, user_id: Optional[str] = None, broadcast: bool = True):
+        """Xóa cache thông tin camera (và số camera của user)"""
+        self._cache.pop(("camera", str(camera_id)), None)
+        if user_id:
+            self._cache.pop(("counts", str(user_id)), None)
+        if broadcast:
+            event_bus.publish_nowait(NOTIFICATION_CONTEXT_CHANNEL, {
+                "kind": "camera", "camera_id": str(camera_id), "user_id": str(user_id) if user_id else None
+            })
+
+    def _on_bus_message(self, payload: Dict[str, Any]):
+        kind = payload.get("kind")
+        if kind == "user":
+            self.invalidate_user(payload["user_id"], broadcast=False)
+        elif kind == "counts":
+            self.invalidate_counts(payload["user_id"], broadcast=False)
+        elif kind == "camera":
+            self.invalidate_camera(payload["camera_id"], payload.get("user_id"), broadcast=False)
+
+    # ===== User context =====
+
+    async def get_notification_settings(self, user_id: str) -> Dict[str, Any]:
+        """Notification preferences của user (cache)"""
+        hit, value = self._get_cached("settings", user_id)
+        if hit:
+            return dict(value)
+
+        settings = await self.db.user_settings.find_one({"user_id": ObjectId(user_id)})
+        value = {
+            "email_alerts": settings.get("email_alerts", True) if settings else True,
+            "stranger_only_alerts": settings.get("stranger_only_alerts", True) if settings else True,
+            "webhook_url": settings.get("webhook_url") if settings else None,
+            "webhook_secret": settings.get("webhook_secret") if settings else None,
+            "notify_known_persons": settings.get("notify_known_persons", False) if settings else False,
+            "alert_cooldown": settings.get("alert_cooldown", 300) if settings else 300
+        }
+        self._set_cached("settings", user_id, value)
+        return dict(value)
+
+    async def get_user_email(self, user_id: str) -> Optional[str]:
+        """Email của user (cache)"""
+        hit, value = self._get_cached("email", user_id)
+        if hit:
+            return value
+
+        user = await self.db.users.find_one({"_id": ObjectId(user_id)}, {"email": 1})
+        value = user.get("email") if user else None
+        self._set_cached("email", user_id, value)
+        return value
+
+    async def get_camera_document(self, camera_id: str) -> Optional[Dict[str, Any]]:
+        """Document camera (cache)"""
+        hit, value = self._get_cached("camera", camera_id)
+        if hit:
+            return value
+
+        value = await self.db.cameras.find_one({"_id": ObjectId(camera_id)})
+        self._set_cached("camera", camera_id, value)
+        return value
+
+    async def get_user_counts(self, user_id: str) -> Dict[str, int]:
+        """Số camera và known persons của user (cache)"""
+        hit, value = self._get_cached("counts", user_id)
+        if hit:
+            return value
+
+        total_cameras, known_persons_count = await asyncio.gather(
+            self.db.cameras.count_documents({"user_id": ObjectId(user_id)}),
+            self.db.known_persons.count_documents({"user_id": ObjectId(user_id)})
+        )
+        value = {"total_cameras": total_cameras, "known_persons_count": known_persons_count}
+        self._set_cached("counts", user_id, value)
+        return value
+
+    # ===== Rolling 24h stats =====
+
+    def record_detection_log(self, detection_doc: Dict[str, Any]):
+        """Listener: cập nhật bộ đếm rolling khi có detection log mới"""
+        user_id = detection_doc.get("user_id")
+        camera_id = detection_doc.get("camera_id")
+        if not user_id or not camera_id:
+            return
+
+        stats = self._stats.get((str(user_id), str(camera_id)))
+        if stats is None:
+            # Chưa nạp từ DB - lần đọc đầu tiên sẽ bao gồm log này
+            return
+
+        confidence = detection_doc.get("avg_confidence")
+        stats.add(
+            time.time(),
+            stranger_alerts=1 if detection_doc.get("alert_type") == "stranger_only_alert" else 0,
+            confidence_sum=confidence or 0.0,
+            confidence_n=1 if confidence is not None else 0,
+            confidence_max=confidence,
+            confidence_min=confidence
+        )
+
+    async def _load_stats(self, user_id: str, camera_id: str) -> RollingDetectionStats:
+        """Nạp thống kê 24h từ DB theo bucket phút (một aggregation)"""
+        # timestamp lưu naive theo giờ Việt Nam
+        last_24h = vietnam_now() - timedelta(hours=24)
+        pipeline = [
+            {"$match": {
+                "user_id": ObjectId(user_id),
+                "camera_id": ObjectId(camera_id),
+                "timestamp": {"$gte": last_24h}
+            }},
+            {"$group": {
+                "_id": {"$dateTrunc": {"date": "$timestamp", "unit": "minute"}},
+                "count": {"$sum": 1},
+                "stranger_alerts": {"$sum": {"$cond": [{"$eq": ["$alert_type", "stranger_only_alert"]}, 1, 0]}},
+                "confidence_sum": {"$sum": {"$ifNull": ["$avg_confidence", 0]}},
+                "confidence_n": {"$sum": {"$cond": [{"$ifNull": ["$avg_confidence", False]}, 1, 0]}},
+                "confidence_max": {"$max": "$avg_confidence"},
+                "confidence_min": {"$min": "$avg_confidence"}
+            }}
+        ]
+
+        stats = RollingDetectionStats()
+        now = time.time()
+        async for row in self.db.detection_logs.aggregate(pipeline):
+            epoch = row["_id"].replace(tzinfo=VIETNAM_TIMEZONE).timestamp()
+            stats.add(
+                min(epoch, now),
+                count=row["count"],
+                stranger_alerts=row["stranger_alerts"],
+                confidence_sum=row["confidence_sum"],
+                confidence_n=row["confidence_n"],
+                confidence_max=row.get("confidence_max"),
+                confidence_min=row.get("confidence_min")
+            )
+        return stats
+
+    async def get_detection_stats(self, user_id: str, camera_id: str) -> Dict[str, Any]:
+        """Thống kê 24h của camera từ bộ đếm rolling"""
+        key = (str(user_id), str(camera_id))
+        stats = self._stats.get(key)
+        if stats is None:
+            # Gộp các lần nạp đồng thời cho cùng camera
+            task = self._stats_loading.get(key)
+            if task is None:
+                task = asyncio.create_task(self._load_stats(user_id, camera_id))
+                self._stats_loading[key] = task
+            try:
+                stats = await task
+                self._stats.setdefault(key, stats)
+                stats = self._stats[key]
+            finally:
+                self._stats_loading.pop(key, None)
+        return stats.summary(time.time())
+
+
+# Global instance
+notification_context_service = NotificationContextService()
@@ -1,14 +1,16 @@
 from typing import Dict, Any, List, Optional
 from .websocket_manager import websocket_manager
-import aiosmtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.image import MIMEImage
-import json
-import httpx
-from datetime import datetime, timedelta
+from datetime import datetime
 from ..config import get_settings
 from ..database import get_database
+from .detection_counter_service import detection_counter_service
+from .mail_queue_service import mail_queue_service
+from .alert_digest_service import alert_digest_service, AlertDigest
+from .webhook_service import webhook_dispatcher
+from .notification_context_service import notification_context_service
+from .email_template_service import email_template_service, make_cid
+from .state_store import state_store
+from ..utils.timezone_utils import vietnam_now
 from bson import ObjectId
 import asyncio
 import os
@@ -28,17 +30,50 @@ def serialize_datetime_objects(obj):
 class NotificationService:
     def __init__(self):
         self.settings = get_settings()
-        self.alert_cooldown: Dict[str, datetime] = {}
-        
-        # Circuit breaker để tránh spam khi SMTP lỗi
-        self.smtp_failures: Dict[str, int] = {}  # Track failures per user
-        self.smtp_blocked_until: Dict[str, datetime] = {}  # Block until time
-        self.max_failures = 3  # Max failures before blocking
-        self.block_duration_minutes = 15  # Block for 15 minutes after max failures
-        
         # ANTI-SPAM: Lock mechanism để tránh race condition
         self.email_locks: Dict[str, asyncio.Lock] = {}  # Locks per user+camera  # Prevent spam alerts
         
+        # Email người lạ được gom theo digest (SMTP lỗi được mail queue retry)
+        alert_digest_service.set_flush_handler(self._send_stranger_digest)
+        
+    # ===== Cooldown (lưu trong state store dùng chung giữa các worker) =====
+    
+    ALERT_COOLDOWN_PREFIX = "alert_cooldown:"
+    
+    async def mark_alert_cooldown(self, cooldown_key: str, at: datetime):
+        """Ghi thời điểm sự kiện người lạ gần nhất của một camera"""
+        await state_store.set(self.ALERT_COOLDOWN_PREFIX + cooldown_key, at.isoformat(), ttl_seconds=24 * 3600)
+    
+    @staticmethod
+    def _event_cooldown_seconds(stranger_count: int) -> int:
+        """Khoảng cách tối thiểu giữa hai sự kiện người lạ của một camera (nhiều người lạ → ngắn hơn)"""
+        return 15 if stranger_count >= 3 else 30
+    
+    async def _event_cooldown_remaining(self, cooldown_key: str, stranger_count: int, now: datetime) -> float:
+        """Số giây còn lại trước khi camera được ghi / phát sự kiện người lạ tiếp theo"""
+        last = await state_store.get(self.ALERT_COOLDOWN_PREFIX + cooldown_key)
+        if not last:
+            return 0.0
+        elapsed = (now - datetime.fromisoformat(last)).total_seconds()
+        return max(0.0, self._event_cooldown_seconds(stranger_count) - elapsed)
+    
+    async def get_alert_cooldowns(self, user_id: str) -> Dict[str, datetime]:
+        """Các cooldown của user: {cooldown_key: thời điểm}"""
+        items = await state_store.items(f"{self.ALERT_COOLDOWN_PREFIX}{user_id}_")
+        return {
+            key[len(self.ALERT_COOLDOWN_PREFIX):]: datetime.fromisoformat(value)
+            for key, value in items.items()
+        }
+    
+    async def clear_alert_cooldowns(self, user_id: str, camera_id: Optional[str] = None) -> int:
+        """Xóa cooldown của user (hoặc của một camera)"""
+        if camera_id:
+            key = f"{self.ALERT_COOLDOWN_PREFIX}{user_id}_{camera_id}_stranger_email"
+            existed = await state_store.get(key) is not None
+            await state_store.delete(key)
+            return int(existed)
+        return await state_store.delete_prefix(f"{self.ALERT_COOLDOWN_PREFIX}{user_id}_")
+        
     async def send_stranger_alert_with_frame_analysis(self, user_id: str, camera_id: str, 
                                                      all_detections: List[Dict[str, Any]], 
                                                      image_data: bytes = None):
@@ -85,67 +120,25 @@ class NotificationService:
                 print(f"   - Camera ID: {camera_id}")
                 print(f"   - Current Time: {datetime.utcnow().strftime('%H:%M:%S')}")
                 
-                # ===== HỆ THỐNG EMAIL THÔNG MINH =====
-                # Kiểm tra cooldown thông minh dựa trên:
-                # - Thời gian: 1 phút cơ bản giữa các email
-                # - Mức độ nghiêm trọng: nhiều người lạ = cooldown ngắn hơn
-                
+                # ===== EVENT COOLDOWN + ALERT DIGEST =====
+                # Cooldown 15/30s theo camera giới hạn số sự kiện (detection log,
+                # WebSocket, webhook, digest) - hàm này được gọi mỗi khung hình AI.
+                # Email không gửi theo từng sự kiện: các sự kiện (kể cả ở nhiều camera)
+                # được gom vào digest theo cửa sổ thời gian và budget email/giờ của user
                 cooldown_key = f"{user_id}_{camera_id}_stranger_email"
                 current_time = datetime.utcnow()
                 
-                # Kiểm tra cooldown cơ bản (30 giây)
-                last_alert_time = self.alert_cooldown.get(cooldown_key)
-                basic_cooldown_seconds = 30  # 1 phút
-                
-                # Điều chỉnh cooldown dựa trên số lượng người lạ
-                if len(stranger_detections) >= 3:
-                    basic_cooldown_seconds = 15  # Nhiều người lạ → 15 giây
-                elif len(stranger_detections) == 1:
-                    basic_cooldown_seconds = 30  # 1 người lạ → 30 giây
-                
-                # Check if we should bypass cooldown in development
+                # Dev mode với bypass: không cooldown, gửi ngay, không tính budget
                 should_bypass_cooldown = (
                     self.settings.bypass_email_cooldown and self.settings.development_mode
                 )
                 
-                print(f"[EMAIL DEBUG] Settings - bypass: {self.settings.bypass_email_cooldown}, dev_mode: {self.settings.development_mode}")
-                print(f"[EMAIL DEBUG] Cooldown - key: {cooldown_key}, required: {basic_cooldown_seconds}s")
-                
-                # ===== CIRCUIT BREAKER: Kiểm tra SMTP failures =====
-                if not should_bypass_cooldown:
-                    # Check if SMTP is blocked due to repeated failures
-                    block_key = f"{user_id}_smtp_block"
-                    blocked_until = self.smtp_blocked_until.get(block_key)
-                    
-                    if blocked_until and current_time < blocked_until:
-                        remaining_block = (blocked_until - current_time).total_seconds()
-                        print(f"[SMTP BLOCKED] ❌ Email blocked due to repeated failures. Wait {remaining_block:.0f}s")
-                        return
-                    
-                    # Reset block if time passed
-                    if blocked_until and current_time >= blocked_until:
-                        if block_key in self.smtp_blocked_until:
-                            del self.smtp_blocked_until[block_key]
-                        if block_key in self.smtp_failures:
-                            self.smtp_failures[block_key] = 0
-                        print(f"[SMTP UNBLOCKED] ✅ SMTP block cleared for user {user_id}")
-                
                 if not should_bypass_cooldown:
-                    if last_alert_time and (current_time - last_alert_time < timedelta(seconds=basic_cooldown_seconds)):
-                        remaining_time = timedelta(seconds=basic_cooldown_seconds) - (current_time - last_alert_time)
-                        print(f"[EMAIL COOLDOWN] ❌ BLOCKED - Chờ {remaining_time.total_seconds():.0f}s nữa mới gửi email tiếp")
+                    remaining = await self._event_cooldown_remaining(cooldown_key, len(stranger_detections), current_time)
+                    if remaining > 0:
+                        print(f"[EVENT COOLDOWN] ❌ BLOCKED - Chờ {remaining:.0f}s nữa mới ghi sự kiện người lạ tiếp")
                         return
-                    else:
-                        if last_alert_time:
-                            elapsed = (current_time - last_alert_time).total_seconds()
-                            print(f"[EMAIL COOLDOWN] ✅ ALLOWED - {elapsed:.0f}s đã trôi qua (yêu cầu {basic_cooldown_seconds}s)")
-                        else:
-                            print(f"[EMAIL COOLDOWN] ✅ ALLOWED - Chưa có email nào được gửi")
-                else:
-                    print(f"[EMAIL COOLDOWN] ⚠️ BYPASSED - Development mode với bypass enabled")
-                
-                if should_bypass_cooldown:
-                    print(f"[DEV MODE] Bypassing email cooldown for testing")
+                await self.mark_alert_cooldown(cooldown_key, current_time)
                 
                 # Get camera info
                 camera_info = await self._get_camera_info(camera_id)
@@ -191,74 +184,23 @@ class NotificationService:
                 # Get user notification preferences
                 user_settings = await self._get_user_notification_settings(user_id)
                 
-                # ===== FORCE SEND EMAIL ALWAYS =====
-                print(f"🚀 FORCING EMAIL SEND - Settings check: {user_settings.get('email_alerts', True)}")
-                print(f"🚀 SMTP Config - Server: {self.settings.smtp_server}, User: {self.settings.smtp_username}")
-                
-                # Send email if enabled - ALWAYS FOR STRANGER ONLY
-                email_sent = False
-                email_attempted = False
-                try:
-                    email_attempted = True
-                    email_sent = await self._send_stranger_email_with_image(user_id, alert_data, image_data)
-                    print(f"🚀 EMAIL SEND RESULT: {email_sent}")
-                    
-                    # ===== CIRCUIT BREAKER: Track success/failure =====
-                    block_key = f"{user_id}_smtp_block"
-                    if email_sent:
-                        # Reset failure count on success
-                        if block_key in self.smtp_failures:
-                            self.smtp_failures[block_key] = 0
-                    else:
-                        # Increment failure count
-                        self.smtp_failures[block_key] = self.smtp_failures.get(block_key, 0) + 1
-                        
-                        # Block if too many failures
-                        if self.smtp_failures[block_key] >= self.max_failures:
-                            self.smtp_blocked_until[block_key] = current_time + timedelta(minutes=self.block_duration_minutes)
-                            print(f"[SMTP CIRCUIT BREAKER] ⚡ User {user_id} blocked for {self.block_duration_minutes} minutes after {self.max_failures} failures")
-                    
-                    # Update detection log to mark email sent
-                    if email_sent and detection_log_id:
-                        await self._update_detection_log_email_status(detection_log_id, True)
-                        print(f"✅ Detection log updated with email status")
-                except Exception as email_error:
-                    email_attempted = True
-                    print(f"❌ EMAIL SEND ERROR: {email_error}")
-                    
-                    # Track SMTP error in circuit breaker
-                    block_key = f"{user_id}_smtp_block"
-                    self.smtp_failures[block_key] = self.smtp_failures.get(block_key, 0) + 1
-                    
-                    if self.smtp_failures[block_key] >= self.max_failures:
-                        self.smtp_blocked_until[block_key] = current_time + timedelta(minutes=self.block_duration_minutes)
-                        print(f"[SMTP CIRCUIT BREAKER] ⚡ User {user_id} blocked for {self.block_duration_minutes} minutes after {self.max_failures} failures")
-                    
-                    import traceback
-                    traceback.print_exc()
+                # Email cho người lạ luôn được gửi (qua digest)
+                await alert_digest_service.add_event(
+                    user_id,
+                    alert_data,
+                    stranger_detections,
+                    image_data,
+                    immediate=should_bypass_cooldown
+                )
                 
                 # Send webhook if configured
                 if user_settings.get("webhook_url"):
-                    await self._send_webhook_alert(user_settings["webhook_url"], alert_data)
-                
-                # ===== QUAN TRỌNG: SET COOLDOWN KHI ĐÃ THỬ GỬI EMAIL =====
-                # Để tránh spam, set cooldown ngay cả khi email thất bại
-                if email_attempted:
-                    self.alert_cooldown[cooldown_key] = current_time
-                    
-                    if not should_bypass_cooldown:
-                        cooldown_info = f"{basic_cooldown_seconds}s"
-                        if len(stranger_detections) >= 3:
-                            cooldown_info += " (nhiều người lạ - ưu tiên cao)"
-                        elif len(stranger_detections) == 1:
-                            cooldown_info += " (1 người lạ - bình thường)"
-                        
-                        result_info = "thành công" if email_sent else "thất bại"
-                        print(f"✅ Email cooldown set: {cooldown_info} - Email {result_info}")
-                    else:
-                        print(f"✅ Email attempted (DEV MODE - không tính cooldown)")
+                    await self._send_webhook_alert(
+                        user_settings["webhook_url"], alert_data,
+                        secret=user_settings.get("webhook_secret"), user_id=user_id
+                    )
                 
-                print(f"[SUCCESS] Stranger-only email alert processing completed for user {user_id}")
+                print(f"[SUCCESS] Stranger-only alert added to digest for user {user_id}")
                 
             elif known_person_detections:
                 print(f"ℹ️ No email sent: Known persons present in frame ({len(known_person_detections)} known, {len(stranger_detections)} strangers)")
@@ -353,155 +295,28 @@ class NotificationService:
             # Create email content
             subject = f"🚨 Cảnh báo an ninh - {alert_data['title']}"
             
-            # Prepare detection details - Lấy số liệu thực từ hệ thống
-            stranger_count = alert_data.get('stranger_count', 0)
-            known_person_count = alert_data.get('known_person_count', 0)
-            camera_info = alert_data.get('camera_info', {})
-            camera_name = camera_info.get('name', 'Camera không xác định')
-            camera_location = camera_info.get('location', '')
             alert_id = alert_data.get('alert_id', 'N/A')
             
-            timestamp = datetime.fromisoformat(alert_data['timestamp'].replace('Z', '+00:00'))
-            # Convert to Vietnam timezone (UTC+7)
-            vietnam_timestamp = timestamp + timedelta(hours=7)
-            formatted_time = vietnam_timestamp.strftime("%d/%m/%Y lúc %H:%M:%S")
-            
-            # Chi tiết từng detection thực tế
-            stranger_details = ""
-            total_confidence = 0
-            if alert_data.get('detections'):
-                for i, detection in enumerate(alert_data['detections'][:5]):  # Limit to 5 detections
-                    confidence = detection.get('confidence', 0) * 100
-                    total_confidence += confidence
-                    bbox = detection.get('bbox', {})
-                    
-                    # Handle bbox format - could be dict or list [x, y, w, h]
-                    if isinstance(bbox, list) and len(bbox) >= 4:
-                        x, y, width, height = bbox[0], bbox[1], bbox[2], bbox[3]
-                    elif isinstance(bbox, dict):
-                        x = bbox.get('x', 0)
-                        y = bbox.get('y', 0)
-                        width = bbox.get('width', 0)
-                        height = bbox.get('height', 0)
-                    else:
-                        x = y = width = height = 0
-                    
-                    stranger_details += f"    • Người lạ #{i+1}:\n"
-                    stranger_details += f"      - Độ tin cậy: {confidence:.1f}%\n"
-                    stranger_details += f"      - Vị trí trong khung hình: ({x:.0f}, {y:.0f})\n"
-                    stranger_details += f"      - Kích thước khung: {width:.0f}x{height:.0f} pixels\n"
-                    
-                    # Convert timestamp to Vietnam timezone (UTC+7)
-                    timestamp_str = detection.get('timestamp', 'N/A')
-                    if timestamp_str != 'N/A':
-                        try:
-                            if isinstance(timestamp_str, str):
-                                # Parse ISO format timestamp
-                                dt = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                            elif isinstance(timestamp_str, datetime):
-                                dt = timestamp_str
-                            else:
-                                dt = None
-                            
-                            if dt:
-                                # Convert to Vietnam timezone (UTC+7)
-                                vietnam_time = dt + timedelta(hours=7)
-                                formatted_time = vietnam_time.strftime("%d/%m/%Y lúc %H:%M:%S")
-                                stranger_details += f"      - Thời gian phát hiện: {formatted_time} (GMT+7)\n\n"
-                            else:
-                                stranger_details += f"      - Thời gian phát hiện: {timestamp_str}\n\n"
-                        except Exception as e:
-                            print(f"[WARNING] Error parsing timestamp: {e}")
-                            stranger_details += f"      - Thời gian phát hiện: {timestamp_str}\n\n"
-                    else:
-                        stranger_details += f"      - Thời gian phát hiện: Không xác định\n\n"
-            
-            # Tính độ tin cậy trung bình
-            avg_confidence = total_confidence / len(alert_data.get('detections', [])) if alert_data.get('detections') else 0
-            
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <style>
-                    body {{ font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; margin: 0; padding: 20px; background-color: #f5f5f5; }}
-                    .container {{ max-width: 600px; margin: 0 auto; background-color: white; border-radius: 10px; box-shadow: 0 4px 15px rgba(0,0,0,0.1); overflow: hidden; }}
-                    .header {{ background: linear-gradient(135deg, #dc3545, #c82333); color: white; padding: 20px; text-align: center; }}
-                    .header h1 {{ margin: 0; font-size: 24px; font-weight: bold; }}
-                    .alert-icon {{ font-size: 48px; margin-bottom: 10px; }}
-                    .content {{ padding: 30px; }}
-                    .alert-box {{ background-color: #f8d7da; border: 1px solid #f5c6cb; border-radius: 8px; padding: 20px; margin: 20px 0; }}
-                    .detail-section {{ background-color: #f8f9fa; padding: 20px; border-radius: 8px; margin: 15px 0; }}
-                    .detail-title {{ font-weight: bold; color: #495057; margin-bottom: 10px; font-size: 16px; }}
-                    .detail-content {{ color: #6c757d; line-height: 1.6; }}
-                    .timestamp {{ color: #6c757d; font-size: 14px; font-style: italic; }}
-                    .footer {{ background-color: #f8f9fa; padding: 20px; text-align: center; color: #6c757d; font-size: 12px; border-top: 1px solid #dee2e6; }}
-                    .urgent {{ color: #dc3545; font-weight: bold; }}
-                    .image-note {{ background-color: #d1ecf1; border: 1px solid #bee5eb; border-radius: 5px; padding: 15px; margin: 15px 0; color: #0c5460; }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <div class="alert-icon">🚨</div>
-                        <h1>CẢNH BÁO AN NINH</h1>
-                        <p class="timestamp">Ngày {formatted_time} (GMT+7)</p>
-                    </div>
-                    
-                    <div class="content">
-                        <div class="alert-box">
-                            <h2 class="urgent">⚠️ PHÁT HIỆN NGƯỜI LẠ</h2>
-                            <p><strong>Tình huống:</strong> Hệ thống đã phát hiện <strong>{stranger_count} người lạ</strong> tại camera <strong>{camera_name}</strong> mà không có người quen nào trong khung hình.</p>
-                        </div>
-                        
-                        <div class="detail-section">
-                            <div class="detail-title">📍 Thông tin hệ thống:</div>
-                            <div class="detail-content">
-                                <p><strong>📹 Camera:</strong> {camera_name}</p>
-                                {f"<p><strong>� Vị trí:</strong> {camera_location}</p>" if camera_location else ""}
-                                <p><strong>🕒 Thời gian phát hiện:</strong> {formatted_time} (GMT+7)</p>
-                                <p><strong>👥 Tổng số người lạ:</strong> {stranger_count}</p>
-                                <p><strong>✅ Số người quen:</strong> {known_person_count}</p>
-                                <p><strong>🎯 Độ tin cậy trung bình:</strong> {avg_confidence:.1f}%</p>
-                                <p><strong>📊 Loại camera:</strong> {camera_info.get('camera_type', 'Không xác định')}</p>
-                            </div>
-                        </div>
-                        
-                        {'''
-                        <div class="image-note">
-                            <strong>📸 Hình ảnh:</strong> Hình ảnh hiện trường đã được đính kèm trong email này để bạn có thể xem chi tiết.
-                        </div>
-                        ''' if image_data else ''}
-                        
-                        <div class="alert-box">
-                            <p class="urgent"><strong>🎯 Hành động cần thiết:</strong></p>
-                            <p>Vui lòng kiểm tra camera ngay lập tức và thực hiện các biện pháp an ninh cần thiết.</p>
-                        </div>
-                    </div>
-                    
-                    <div class="footer">
-                        <p>📱 Đây là cảnh báo tự động từ Hệ thống Nhận diện Khuôn mặt SafeFace.</p>
-                        <p>🌐 Đăng nhập vào bảng điều khiển để xem thêm chi tiết và hình ảnh đã lưu.</p>
-                        <p>⚙️ Bạn có thể thay đổi cài đặt thông báo trong phần cài đặt tài khoản.</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
+            # Render template đã compile, ảnh hiện trường nhúng inline qua CID
+            image_cid = make_cid() if image_data else None
+            html_content = email_template_service.render_stranger_alert(alert_data, image_cid=image_cid)
             
             print(f"📧 Sending email to {user_email} with subject: {subject}")
             if image_data:
                 print(f"📎 Email includes image attachment ({len(image_data)} bytes)")
             
-            # Send email with attachment
-            success = await self._send_email_with_image(user_email, subject, html_content, image_data)
+            # Đưa email vào hàng đợi (worker gửi nền qua SMTP pool)
+            success = await self._send_email_with_image(
+                user_email, subject, html_content, image_data,
+                metadata={"detection_log_id": alert_data.get("detection_log_id"), "alert_id": alert_id},
+                image_cid=image_cid
+            )
             
             if success:
-                print(f"✅ Email sent successfully to {user_email}")
+                print(f"✅ Email queued for {user_email}")
                 return True
             else:
-                print(f"❌ Email sending failed to {user_email}")
+                print(f"❌ Email queueing failed for {user_email}")
                 return False
             
         except Exception as e:
@@ -510,71 +325,52 @@ class NotificationService:
             traceback.print_exc()
             return False
 
-    async def _send_email_with_image(self, to_email: str, subject: str, html_content: str, image_data: bytes = None):
-        """Send email with image attachment using aiosmtplib"""
+    async def _send_stranger_digest(self, digest: AlertDigest, contact_sheet: Optional[bytes] = None):
+        """Gửi email cho một digest người lạ (1 sự kiện → email chi tiết như cũ)"""
         try:
-            print(f"🚀 [EMAIL] Starting email send to {to_email}")
-            print(f"🚀 [EMAIL] SMTP Config: {self.settings.smtp_server}:{self.settings.smtp_port}")
-            print(f"🚀 [EMAIL] Username: {self.settings.smtp_username}")
+            if digest.total_events == 1:
+                await self._send_stranger_email_with_image(digest.user_id, digest.events[0], digest.latest_image or contact_sheet)
+                return
             
-            # Create message
-            message = MIMEMultipart("mixed")
-            message["Subject"] = subject
-            message["From"] = self.settings.smtp_username
-            message["To"] = to_email
+            user_email = await self._get_user_email(digest.user_id)
+            if not user_email:
+                print(f"[WARNING] No email found for user {digest.user_id}")
+                return
             
-            # Add HTML content
-            html_part = MIMEText(html_content, "html", "utf-8")
-            message.attach(html_part)
+            camera_names = digest.camera_names
+            subject = f"🚨 Cảnh báo an ninh - {digest.stranger_count} lượt người lạ tại {len(camera_names)} camera"
             
-            # Add image attachment if provided
-            if image_data:
-                try:
-                    img_attachment = MIMEImage(image_data)
-                    img_attachment.add_header(
-                        'Content-Disposition',
-                        'attachment',
-                        filename=f'stranger_detection_{int(datetime.utcnow().timestamp())}.jpg'
-                    )
-                    message.attach(img_attachment)
-                    print(f"📎 Image attachment added to email ({len(image_data)} bytes)")
-                except Exception as img_error:
-                    print(f"⚠️ Warning: Could not attach image: {img_error}")
-            
-            print(f"🚀 [EMAIL] Sending email via SMTP...")
-            
-            # Send email với timeout ngắn hơn để tránh hang
-            await aiosmtplib.send(
-                message,
-                hostname=self.settings.smtp_server,
-                port=self.settings.smtp_port,
-                start_tls=True,
-                username=self.settings.smtp_username,
-                password=self.settings.smtp_password,
-                timeout=10  # Giảm từ 30s xuống 10s
+            image_cid = make_cid() if contact_sheet else None
+            html_content = email_template_service.render_stranger_digest(
+                digest.events, camera_names, digest.stranger_count, image_cid=image_cid,
+                more_events=digest.overflow_events, last_timestamp=digest.last_timestamp
             )
             
-            print(f"✅ [SUCCESS] Email with image sent to {to_email}")
-            return True
+            await self._send_email_with_image(
+                user_email, subject, html_content, contact_sheet,
+                metadata={"detection_log_ids": [e.get("detection_log_id") for e in digest.events]},
+                image_cid=image_cid
+            )
             
-        except asyncio.TimeoutError:
-            print(f"❌ [TIMEOUT] SMTP timeout after 10s - Server may be busy")
-            return False
         except Exception as e:
-            print(f"❌ [ERROR] Error sending email with image: {e}")
-            return False
+            print(f"[ERROR] Error sending stranger digest: {e}")
             import traceback
             traceback.print_exc()
-            
-            # Fallback to sending email without image
-            try:
-                print(f"🔄 [FALLBACK] Attempting to send email without image...")
-                await self._send_email(to_email, subject, html_content)
-                print(f"✅ [FALLBACK] Email sent without image to {to_email}")
-                return True
-            except Exception as fallback_error:
-                print(f"❌ [ERROR] Fallback email also failed: {fallback_error}")
-                return False
+
+    async def _send_email_with_image(self, to_email: str, subject: str, html_content: str,
+                                     image_data: bytes = None, metadata: Dict[str, Any] = None,
+                                     image_cid: Optional[str] = None):
+        """Đưa email (kèm ảnh) vào mail queue, không chờ SMTP"""
+        job_id = await mail_queue_service.enqueue(
+            to_email,
+            subject,
+            html_content,
+            image_data,
+            image_filename=f'stranger_detection_{int(datetime.utcnow().timestamp())}.jpg' if image_data else None,
+            metadata=metadata,
+            image_cid=image_cid
+        )
+        return job_id is not None
 
     async def _send_email_alert(self, user_id: str, alert_data: Dict[str, Any]):
         """Gửi email alert với HTML template - Compatible với mọi loại alert_data"""
@@ -591,60 +387,7 @@ class NotificationService:
             # Create email content
             subject = f"Security Alert - {alert_data['title']}"
             
-            # Get camera name from different possible sources
-            camera_name = "Unknown"
-            if alert_data.get('camera_info', {}).get('name'):
-                camera_name = alert_data['camera_info']['name']
-            elif alert_data.get('detection_data', {}).get('camera_name'):
-                camera_name = alert_data['detection_data']['camera_name']
-            
-            # Get detection type
-            detection_type = alert_data.get('type', alert_data.get('detection_data', {}).get('detection_type', 'Unknown'))
-            
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <style>
-                    body {{ font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f5f5f5; }}
-                    .container {{ max-width: 600px; margin: 0 auto; background-color: white; padding: 20px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-                    .header {{ background-color: {'#dc3545' if alert_data.get('severity') == 'high' else '#007bff'}; color: white; padding: 15px; border-radius: 5px; margin-bottom: 20px; }}
-                    .content {{ padding: 20px 0; }}
-                    .detail-box {{ background-color: #f8f9fa; padding: 15px; border-radius: 5px; margin: 10px 0; }}
-                    .footer {{ text-align: center; color: #6c757d; font-size: 12px; margin-top: 30px; }}
-                    .timestamp {{ color: #6c757d; font-size: 14px; }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <h2>{alert_data['title']}</h2>
-                        <p class="timestamp">{alert_data['timestamp']}</p>
-                    </div>
-                    
-                    <div class="content">
-                        <p><strong>Alert:</strong> {alert_data['message']}</p>
-                        
-                        <div class="detail-box">
-                            <h4>Detection Details:</h4>
-                            <p><strong>Camera:</strong> {camera_name}</p>
-                            <p><strong>Detection Type:</strong> {detection_type}</p>
-                            <p><strong>Severity:</strong> {alert_data.get('severity', 'Unknown')}</p>
-                            {f"<p><strong>Stranger Count:</strong> {alert_data.get('stranger_count', 'N/A')}</p>" if alert_data.get('stranger_count') is not None else ""}
-                            {f"<p><strong>Known Persons:</strong> {alert_data.get('known_person_count', 'N/A')}</p>" if alert_data.get('known_person_count') is not None else ""}
-                        </div>
-                        
-                        {f'<p style="color: red;"><strong>Action Required:</strong> Please check your camera feed immediately.</p>' if alert_data.get('action_required') else ''}
-                    </div>
-                    
-                    <div class="footer">
-                        <p>This is an automated alert from your Face Recognition Security System.</p>
-                        <p>Log in to your dashboard to view more details and captured images.</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
+            html_content = email_template_service.render_alert(alert_data)
             
             # Send email
             await self._send_email(user_email, subject, html_content)
@@ -653,72 +396,25 @@ class NotificationService:
             print(f"[ERROR] Error sending email alert: {e}")
 
     async def _send_email(self, to_email: str, subject: str, html_content: str):
-        """Send email using aiosmtplib"""
-        try:
-            # Create message
-            message = MIMEMultipart("alternative")
-            message["Subject"] = subject
-            message["From"] = self.settings.smtp_username
-            message["To"] = to_email
-            
-            # Add HTML content
-            html_part = MIMEText(html_content, "html")
-            message.attach(html_part)
-            
-            # Send email
-            await aiosmtplib.send(
-                message,
-                hostname=self.settings.smtp_server,
-                port=self.settings.smtp_port,
-                start_tls=True,
-                username=self.settings.smtp_username,
-                password=self.settings.smtp_password,
-                timeout=30
-            )
-            
-            print(f"[SUCCESS] Email sent to {to_email}")
-            
-        except Exception as e:
-            print(f"[ERROR] Error sending email: {e}")
+        """Đưa email vào mail queue"""
+        job_id = await mail_queue_service.enqueue(to_email, subject, html_content)
+        if job_id:
+            print(f"[SUCCESS] Email queued for {to_email}")
+        else:
+            print(f"[ERROR] Error queueing email to {to_email}")
 
-    async def _send_webhook_alert(self, webhook_url: str, alert_data: Dict[str, Any]):
-        """Send webhook notification"""
+    async def _send_webhook_alert(self, webhook_url: str, alert_data: Dict[str, Any],
+                                  secret: Optional[str] = None, user_id: Optional[str] = None):
+        """Đưa webhook vào dispatcher (gửi nền, có retry và dead-letter)"""
         try:
-            webhook_payload = {
-                "event": "face_detection_alert",
-                "data": alert_data,
-                "timestamp": datetime.utcnow().isoformat()
-            }
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    webhook_url,
-                    json=webhook_payload,
-                    timeout=10.0,
-                    headers={"Content-Type": "application/json"}
-                )
-                
-                if response.status_code == 200:
-                    print(f"[SUCCESS] Webhook sent successfully to {webhook_url}")
-                else:
-                    print(f"[WARNING] Webhook failed with status {response.status_code}")
-                    
+            webhook_dispatcher.dispatch(webhook_url, alert_data, secret=secret, user_id=user_id)
         except Exception as e:
-            print(f"[ERROR] Error sending webhook: {e}")
+            print(f"[ERROR] Error dispatching webhook: {e}")
 
     async def _get_user_notification_settings(self, user_id: str) -> Dict[str, Any]:
         """Get user notification preferences"""
         try:
-            db = get_database()
-            settings = await db.user_settings.find_one({"user_id": ObjectId(user_id)})
-            
-            return {
-                "email_alerts": settings.get("email_alerts", True) if settings else True,
-                "stranger_only_alerts": settings.get("stranger_only_alerts", True) if settings else True,
-                "webhook_url": settings.get("webhook_url") if settings else None,
-                "notify_known_persons": settings.get("notify_known_persons", False) if settings else False,
-                "alert_cooldown": settings.get("alert_cooldown", 300) if settings else 300
-            }
+            return await notification_context_service.get_notification_settings(user_id)
             
         except Exception as e:
             print(f"[ERROR] Error getting user notification settings: {e}")
@@ -726,6 +422,7 @@ class NotificationService:
                 "email_alerts": True, 
                 "stranger_only_alerts": True,
                 "webhook_url": None, 
+                "webhook_secret": None,
                 "notify_known_persons": False, 
                 "alert_cooldown": 300
             }
@@ -733,9 +430,7 @@ class NotificationService:
     async def _get_user_email(self, user_id: str) -> Optional[str]:
         """Get user email address"""
         try:
-            db = get_database()
-            user = await db.users.find_one({"_id": ObjectId(user_id)})
-            return user.get("email") if user else None
+            return await notification_context_service.get_user_email(user_id)
             
         except Exception as e:
             print(f"[ERROR] Error getting user email: {e}")
@@ -744,8 +439,7 @@ class NotificationService:
     async def _get_camera_info(self, camera_id: str) -> Dict[str, Any]:
         """Get camera information"""
         try:
-            db = get_database()
-            camera = await db.cameras.find_one({"_id": ObjectId(camera_id)})
+            camera = await notification_context_service.get_camera_document(camera_id)
             
             if camera:
                 return {
@@ -791,7 +485,7 @@ class NotificationService:
                 "detection_count": len(detections),
                 "detections": detections,
                 "detection_type": "stranger",  # Sửa từ "stranger_only_alert" thành "stranger"
-                "timestamp": datetime.utcnow(),
+                "timestamp": vietnam_now(),
                 "alert_sent": True,
                 "confidence_scores": [d.get('confidence', 0) for d in detections],
                 "avg_confidence": sum(d.get('confidence', 0) for d in detections) / len(detections) if detections else 0,
@@ -799,6 +493,7 @@ class NotificationService:
             }
             
             result = await db.detection_logs.insert_one(detection_log)
+            await detection_counter_service.record_detection_log(detection_log)
             return str(result.inserted_id)
             
         except Exception as e:
@@ -806,60 +501,21 @@ class NotificationService:
             return "N/A"
 
     async def _get_system_detection_stats(self, user_id: str, camera_id: str) -> Dict[str, Any]:
-        """Lấy thống kê thực của hệ thống detection"""
+        """Lấy thống kê thực của hệ thống detection (bộ đếm rolling 24h trong bộ nhớ)"""
         try:
-            db = get_database()
-            
-            # Thống kê trong 24h qua
-            last_24h = datetime.utcnow() - timedelta(hours=24)
-            
-            # Đếm tổng số detection trong 24h
-            total_detections_24h = await db.detection_logs.count_documents({
-                "user_id": ObjectId(user_id),
-                "camera_id": ObjectId(camera_id),
-                "timestamp": {"$gte": last_24h}
-            })
-            
-            # Đếm số stranger alerts trong 24h
-            stranger_alerts_24h = await db.detection_logs.count_documents({
-                "user_id": ObjectId(user_id),
-                "camera_id": ObjectId(camera_id),
-                "alert_type": "stranger_only_alert",  # Sử dụng alert_type thay vì detection_type
-                "timestamp": {"$gte": last_24h}
-            })
-            
-            # Lấy confidence trung bình trong 24h
-            pipeline = [
-                {"$match": {
-                    "user_id": ObjectId(user_id),
-                    "camera_id": ObjectId(camera_id),
-                    "timestamp": {"$gte": last_24h}
-                }},
-                {"$group": {
-                    "_id": None,
-                    "avg_confidence": {"$avg": "$avg_confidence"},
-                    "max_confidence": {"$max": "$avg_confidence"},
-                    "min_confidence": {"$min": "$avg_confidence"}
-                }}
-            ]
-            
-            confidence_stats = await db.detection_logs.aggregate(pipeline).to_list(1)
-            confidence_data = confidence_stats[0] if confidence_stats else {}
-            
-            # Thống kê tổng số camera của user
-            total_cameras = await db.cameras.count_documents({"user_id": ObjectId(user_id)})
-            
-            # Thống kê số known persons
-            known_persons_count = await db.known_persons.count_documents({"user_id": ObjectId(user_id)})
+            stats, counts = await asyncio.gather(
+                notification_context_service.get_detection_stats(user_id, camera_id),
+                notification_context_service.get_user_counts(user_id)
+            )
             
             return {
-                "total_detections_24h": total_detections_24h,
-                "stranger_alerts_24h": stranger_alerts_24h,
-                "avg_confidence_24h": round(confidence_data.get("avg_confidence", 0) * 100, 1),
-                "max_confidence_24h": round(confidence_data.get("max_confidence", 0) * 100, 1),
-                "min_confidence_24h": round(confidence_data.get("min_confidence", 0) * 100, 1),
-                "total_cameras": total_cameras,
-                "known_persons_count": known_persons_count,
+                "total_detections_24h": stats["total_detections_24h"],
+                "stranger_alerts_24h": stats["stranger_alerts_24h"],
+                "avg_confidence_24h": round(stats["avg_confidence"] * 100, 1),
+                "max_confidence_24h": round(stats["max_confidence"] * 100, 1),
+                "min_confidence_24h": round(stats["min_confidence"] * 100, 1),
+                "total_cameras": counts["total_cameras"],
+                "known_persons_count": counts["known_persons_count"],
                 "stats_period": "24 hours",
                 "last_updated": datetime.utcnow().isoformat()
             }
@@ -889,10 +545,7 @@ class NotificationService:
                 "timestamp": datetime.utcnow().isoformat()
             }
             
-            await websocket_manager.send_personal_message(
-                json.dumps(notification_data), 
-                user_id
-            )
+            await websocket_manager.send_personal_message(notification_data, user_id)
         except Exception as e:
             print(f"[ERROR] Error sending system notification: {e}")
 
@@ -908,38 +561,10 @@ class NotificationService:
             
             # Send test email
             subject = "🧪 Test Email - SafeFace Security System"
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <style>
-                    body {{ font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f5f5f5; }}
-                    .container {{ max-width: 600px; margin: 0 auto; background-color: white; padding: 20px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-                    .header {{ background-color: #28a745; color: white; padding: 15px; border-radius: 5px; margin-bottom: 20px; text-align: center; }}
-                    .content {{ padding: 20px 0; }}
-                    .footer {{ text-align: center; color: #6c757d; font-size: 12px; margin-top: 30px; }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <h2>✅ Email Configuration Test</h2>
-                    </div>
-                    <div class="content">
-                        <p>Congratulations! Your email notification system is working correctly.</p>
-                        <p><strong>Test time:</strong> {datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")}</p>
-                        <p>You will now receive security alerts when strangers are detected by your cameras.</p>
-                    </div>
-                    <div class="footer">
-                        <p>SafeFace Security System - Email Test</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
+            html_content = email_template_service.render_test_email()
             
-            await self._send_email(user_email, subject, html_content)
+            # Gửi trực tiếp qua SMTP pool để trả về lỗi cấu hình ngay
+            await mail_queue_service.send_now(user_email, subject, html_content)
             
             return {"success": True, "message": f"Test email sent to {user_email}"}
             
@@ -957,7 +582,7 @@ class NotificationService:
                 "detection_count": len(detections),
                 "detections": detections,
                 "detection_type": "stranger",
-                "timestamp": datetime.utcnow(),
+                "timestamp": vietnam_now(),
                 "alert_sent": True,
                 "is_alert_sent": True,  # ✅ CRITICAL: Always set this to True for stranger detections
                 "confidence_scores": [d.get('confidence', 0) for d in detections],
@@ -965,7 +590,7 @@ class NotificationService:
                 "alert_type": "stranger_only_alert",
                 "has_known_person_in_frame": has_known_person,
                 "email_sent": not has_known_person,  # Chỉ gửi email nếu không có người quen
-                "email_sent_at": datetime.utcnow() if not has_known_person else None,
+                "email_sent_at": vietnam_now() if not has_known_person else None,
                 "alert_methods": ["websocket", "email", "system"],
                 "metadata": {
                     "created_by": "notification_service",
@@ -975,6 +600,7 @@ class NotificationService:
             }
             
             result = await db.detection_logs.insert_one(detection_log)
+            await detection_counter_service.record_detection_log(detection_log)
             return str(result.inserted_id)
             
         except Exception as e:
@@ -988,7 +614,7 @@ class NotificationService:
             
             update_data = {
                 "email_sent": email_sent,
-                "email_sent_at": datetime.utcnow() if email_sent else None
+                "email_sent_at": vietnam_now() if email_sent else None
             }
             
             await db.detection_logs.update_one(
@@ -1,6 +1,8 @@
 from typing import List, Optional, Dict, Any
 from bson import ObjectId
+from pymongo import UpdateOne
 from ..database import get_database
+from ..config import get_settings
 from ..models.known_person import (
     KnownPerson, 
     KnownPersonCreate, 
@@ -12,10 +14,25 @@ from ..models.known_person import (
 from ..services.face_processor import face_processor
 from datetime import datetime, timedelta
 from ..utils.timezone_utils import vietnam_now
-import base64
+from ..utils.embedding_codec import EMBEDDING_FORMAT, encode_embedding, canonicalize
+from .notification_context_service import notification_context_service
+from .bulk_import_service import bulk_import_service
+from .face_image_store import face_image_store
+from .recognition_index import recognition_index, normalize
+from .enrollment_service import enrollment_service
 import asyncio
 
 class PersonService:
+    # Projection cho danh sách / thống kê: không tải ảnh và embedding
+    SUMMARY_PROJECTION = {
+        "name": 1, "description": 1, "department": 1, "employee_id": 1, "position": 1,
+        "access_level": 1, "metadata": 1, "is_active": 1, "created_at": 1, "updated_at": 1,
+        "face_images_count": {"$add": [
+            {"$size": {"$ifNull": ["$face_image_refs", []]}},
+            {"$size": {"$ifNull": ["$face_images", []]}}
+        ]}
+    }
+
     @property
     def db(self):
         return get_database()
@@ -48,6 +65,71 @@ class PersonService:
             # Last resort - return empty dict
             return {}
 
+    @staticmethod
+    def _image_count(person_data: Dict[str, Any]) -> int:
+        """Số ảnh khuôn mặt (ảnh GridFS + ảnh inline chưa chuyển)"""
+        if "face_images_count" in person_data:
+            return person_data["face_images_count"]
+        return len(person_data.get("face_image_refs") or []) + len(person_data.get("face_images") or [])
+
+    async def _find_person_with_images(self, person_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        """Person kèm face_image_refs (ảnh inline cũ được chuyển sang GridFS khi đọc)"""
+        person_data = await self.collection.find_one({
+            "_id": ObjectId(person_id),
+            "user_id": ObjectId(user_id)
+        })
+        if person_data and "face_images" in person_data:
+            person_data = await face_image_store.migrate_person(person_data)
+        return person_data
+
+    async def _remove_face_refs(self, person_id: str, user_id: str, image_ids: List[Any]) -> bool:
+        """
+        Xóa các ảnh (theo id) cùng embedding ở đúng vị trí của chúng trong một update
+
+        Update pipeline giữ các vị trí có id không nằm trong `image_ids` cho cả
+        face_image_refs và face_embeddings, nên ảnh đang được enrollment worker ghi
+        (hoặc vừa thêm) không bị ghi đè như khi $set cả mảng.
+        """
+        if not image_ids:
+            return False
+        ids = [ObjectId(image_id) for image_id in image_ids]
+        keep = {"$filter": {
+            "input": {"$range": [0, {"$size": {"$ifNull": ["$face_image_refs", []]}}]},
+            "as": "i",
+            "cond": {"$not": [{"$in": [{"$arrayElemAt": ["$face_image_refs.id", "$$i"]}, ids]}]}
+        }}
+        result = await self.collection.update_one(
+            {"_id": ObjectId(person_id), "user_id": ObjectId(user_id), "face_image_refs.id": {"$in": ids}},
+            [
+                {"$set": {"_keep": keep}},
+                {"$set": {
+                    "face_image_refs": {"$map": {"input": "$_keep", "as": "i", "in": {"$arrayElemAt": ["$face_image_refs", "$$i"]}}},
+                    "face_embeddings": {"$map": {"input": "$_keep", "as": "i", "in": {
+                        "$ifNull": [{"$arrayElemAt": [{"$ifNull": ["$face_embeddings", []]}, "$$i"]}, []]
+                    }}},
+                    "updated_at": vietnam_now(),
+                    "gallery_rev": {"$add": [{"$ifNull": ["$gallery_rev", 0]}, 1]}
+                }},
+                {"$unset": "_keep"}
+            ]
+        )
+        return result.modified_count > 0
+
+    async def _face_image_entries(self, person_id: str, person_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Danh sách ảnh cho view chi tiết: thumbnail (data URL) + đường dẫn ảnh gốc"""
+        refs = person_data.get("face_image_refs") or []
+        thumbnails = await face_image_store.thumbnail_data_urls(refs)
+        return [
+            {
+                "image_id": str(ref["id"]),
+                "image_url": thumbnail or "",
+                "full_image_url": f"/api/persons/{person_id}/images/{ref['id']}",
+                "created_at": ref.get("created_at", person_data["created_at"]),
+                "is_primary": i == 0
+            }
+            for i, (ref, thumbnail) in enumerate(zip(refs, thumbnails))
+        ]
+
     async def create_person(self, person_data: KnownPersonCreate, user_id: str) -> KnownPersonResponse:
         """Tạo known person mới"""
         try:
@@ -73,8 +155,9 @@ class PersonService:
                 "access_level": person_dict.get("access_level"),
                 "metadata": person_dict.get("metadata", {}),
                 # ✅ Existing fields
-                "face_images": [],
+                "face_image_refs": [],
                 "face_embeddings": [],
+                "embedding_format": EMBEDDING_FORMAT,
                 "is_active": True,
                 "created_at": vietnam_now(),
                 "updated_at": vietnam_now()
@@ -84,6 +167,7 @@ class PersonService:
             
             result = await self.collection.insert_one(person_dict)
             person_dict["_id"] = result.inserted_id
+            notification_context_service.invalidate_counts(user_id)
             
             print(f"✅ PersonService: Person created with ID: {result.inserted_id}")
             
@@ -100,7 +184,7 @@ class PersonService:
                 metadata=person_dict.get("metadata", {}),
                 is_active=person_dict["is_active"],
                 created_at=person_dict["created_at"],
-                face_images_count=len(person_dict["face_images"])
+                face_images_count=len(person_dict["face_image_refs"])
             )
         except Exception as e:
             print(f"❌ PersonService: Error creating person: {e}")
@@ -116,7 +200,7 @@ class PersonService:
                 query["is_active"] = True
             
             persons = []
-            async for person_data in self.collection.find(query).sort("created_at", -1):
+            async for person_data in self.collection.find(query, self.SUMMARY_PROJECTION).sort("created_at", -1):
                 # ✅ FIX: Include all fields in list response
                 persons.append(KnownPersonResponse(
                     id=str(person_data["_id"]),
@@ -131,7 +215,7 @@ class PersonService:
                     is_active=person_data["is_active"],
                     created_at=person_data["created_at"],
                     updated_at=person_data.get("updated_at"),
-                    face_images_count=len(person_data.get("face_images", []))
+                    face_images_count=self._image_count(person_data)
                 ))
             return persons
         except Exception as e:
@@ -143,10 +227,7 @@ class PersonService:
     async def get_person_by_id(self, person_id: str, user_id: str) -> Optional[KnownPersonResponse]:
         """Lấy person theo ID"""
         try:
-            person_data = await self.collection.find_one({
-                "_id": ObjectId(person_id),
-                "user_id": ObjectId(user_id)
-            })
+            person_data = await self._find_person_with_images(person_id, user_id)
             
             if person_data:
                 # ✅ FIX: Include all fields in response
@@ -163,16 +244,9 @@ class PersonService:
                     is_active=person_data["is_active"],
                     created_at=person_data["created_at"],
                     updated_at=person_data.get("updated_at"),
-                    face_images_count=len(person_data.get("face_images", [])),
-                    # ✅ ADD: Include face images for detailed view
-                    face_images=[
-                        {
-                            "image_url": f"data:image/jpeg;base64,{img}" if not img.startswith('data:image/') else img,
-                            "created_at": person_data["created_at"].isoformat(),
-                            "is_primary": False
-                        }
-                        for img in person_data.get("face_images", [])
-                    ]
+                    face_images_count=self._image_count(person_data),
+                    # Thumbnail cho view chi tiết, ảnh gốc tải qua full_image_url
+                    face_images=await self._face_image_entries(person_id, person_data)
                 )
             return None
         except Exception as e:
@@ -195,7 +269,7 @@ class PersonService:
             existing_person = await self.collection.find_one({
                 "_id": ObjectId(person_id),
                 "user_id": ObjectId(user_id)
-            })
+            }, {"name": 1})
             
             if not existing_person:
                 print(f"❌ PersonService: Person {person_id} not found for user {user_id}")
@@ -239,14 +313,21 @@ class PersonService:
                 # But still return current data
                 return await self.get_person_by_id(person_id, user_id)
             
+            # gallery_rev tăng cùng update: gallery đã lưu trên đĩa không còn khớp
+            update = {"$set": update_dict}
+            if "name" in update_dict or "is_active" in update_dict:
+                update["$inc"] = {"gallery_rev": 1}
             result = await self.collection.find_one_and_update(
                 {"_id": ObjectId(person_id), "user_id": ObjectId(user_id)},
-                {"$set": update_dict},
+                update,
+                projection=self.SUMMARY_PROJECTION,
                 return_document=True
             )
             
             if result:
                 print(f"✅ PersonService: Person updated successfully")
+                if "name" in update_dict or "is_active" in update_dict:
+                    await recognition_index.refresh_persons(user_id, [person_id])
                 
                 # ✅ FIX: Return complete response with all fields
                 return KnownPersonResponse(
@@ -261,7 +342,7 @@ class PersonService:
                     is_active=result["is_active"],
                     created_at=result["created_at"],
                     updated_at=result.get("updated_at"),
-                    face_images_count=len(result.get("face_images", []))
+                    face_images_count=self._image_count(result)
                 )
             else:
                 print(f"❌ PersonService: Update operation failed")
@@ -283,6 +364,10 @@ class PersonService:
                     "_id": ObjectId(person_id),
                     "user_id": ObjectId(user_id)
                 })
+                notification_context_service.invalidate_counts(user_id)
+                if result.deleted_count > 0:
+                    await face_image_store.delete_person(person_id)
+                    await recognition_index.refresh_persons(user_id, [person_id])
                 return result.deleted_count > 0
             else:
                 result = await self.collection.update_one(
@@ -291,113 +376,62 @@ class PersonService:
                         "$set": {
                             "is_active": False,
                             "updated_at": vietnam_now()
-                        }
+                        },
+                        "$inc": {"gallery_rev": 1}
                     }
                 )
+                if result.modified_count > 0:
+                    await recognition_index.refresh_persons(user_id, [person_id])
                 return result.modified_count > 0
         except Exception as e:
             print(f"Error deleting person: {e}")
             return False       
 
     async def add_face_image(self, person_id: str, image_base64: str, user_id: str) -> Dict[str, Any]:
-        """Thêm ảnh khuôn mặt cho person với validation và extract embedding"""
+        """Thêm ảnh khuôn mặt cho person (ảnh lưu trên GridFS kèm thumbnail)"""
         try:
             # Handle both formats: with and without data URL prefix
-            if image_base64.startswith('data:image/'):
-                # Format: data:image/jpeg;base64,/9j/4AAQ...
-                if ',' in image_base64:
-                    base64_data = image_base64.split(',')[1]
-                else:
-                    raise ValueError("Invalid data URL format - missing comma separator")
-            else:
-                # Format: /9j/4AAQ... (pure base64)
-                base64_data = image_base64
+            try:
+                image_data = face_image_store.decode_base64(image_base64)
+            except Exception as decode_error:
+                raise ValueError(f"Failed to decode base64 image: {str(decode_error)}")
             
-            # Validate base64 data
-            if not base64_data.strip():
-                raise ValueError("Empty base64 data")
+            print(f"🔵 PersonService: Image decoded, size: {len(image_data)} bytes")
             
             # Get current person data
-            person = await self.get_person_by_id(person_id, user_id)
-            if not person:
+            person_data = await self._find_person_with_images(person_id, user_id)
+            if not person_data:
                 raise ValueError("Person not found")
             
-            # Get current face images count from database
-            person_data = await self.collection.find_one({
-                "_id": ObjectId(person_id),
-                "user_id": ObjectId(user_id)
-            })
+            current_count = self._image_count(person_data)
             
-            current_images = person_data.get("face_images", [])
-            current_embeddings = person_data.get("face_embeddings", [])
-            
-            # ✅ TEMP FIX: Skip face embedding extraction for now
-            try:
-                print(f"🔵 PersonService: Processing face image for person {person_id}")
-                
-                # Decode base64 image for validation
-                try:
-                    image_data = base64.b64decode(base64_data)
-                    if len(image_data) == 0:
-                        raise ValueError("Decoded image data is empty")
-                except Exception as decode_error:
-                    raise ValueError(f"Failed to decode base64 image: {str(decode_error)}")
-                    
-                print(f"🔵 PersonService: Image decoded, size: {len(image_data)} bytes")
-                
-                # Validate image with OpenCV
-                import cv2
-                import numpy as np
-                nparr = np.frombuffer(image_data, np.uint8)
-                img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                
-                if img is None:
-                    print("❌ PersonService: Failed to decode image with OpenCV")
-                    raise ValueError("Invalid image data - cannot decode with OpenCV")
-                
-                print(f"🔵 PersonService: Image successfully validated, shape: {img.shape}")
-                
-                # TODO: Re-enable face embedding extraction later
-                # For now, create a dummy embedding or skip it
-                embedding_list = None  # Skip embedding for now
-                
-                print(f"🔵 PersonService: Skipping face embedding extraction (temporary)")
-                
-            except Exception as e:
-                print(f"❌ PersonService: Error extracting face embedding: {e}")
-                raise ValueError(f"Failed to extract face embedding: {str(e)}")
-            
-            # Add to database with or without embedding
-            update_data = {
-                "$push": {
-                    "face_images": base64_data  # Store the clean base64 data
-                },
-                "$set": {"updated_at": vietnam_now()}
-            }
-            
-            # Only add embedding if it was extracted successfully
-            if embedding_list is not None:
-                update_data["$push"]["face_embeddings"] = embedding_list
-                print(f"🔵 PersonService: Adding image with embedding")
-            else:
-                print(f"🔵 PersonService: Adding image without embedding (embedding extraction skipped)")
+            # Validate image + tạo thumbnail, lưu GridFS
+            ref = await face_image_store.save(image_data, user_id, person_id)
             
+            # Embedding được trích nền bởi enrollment_service (client poll job id)
+            ref["embedding_status"] = "pending"
             result = await self.collection.update_one(
                 {"_id": ObjectId(person_id), "user_id": ObjectId(user_id)},
-                update_data
+                {
+                    "$push": {"face_image_refs": ref},
+                    "$set": {"updated_at": vietnam_now()}
+                }
             )
             
             if result.modified_count > 0:
-                print(f"✅ PersonService: Face image added successfully")
+                job_id = await enrollment_service.enqueue(person_id, user_id, ref["id"])
+                print(f"✅ PersonService: Face image added successfully ({ref['id']}), enrollment job {job_id}")
                 return {
                     "success": True,
                     "message": "Face image added successfully",
-                    "image_index": len(current_images),
-                    "total_images": len(current_images) + 1,
-                    "embedding_extracted": embedding_list is not None,
-                    "embedding_size": len(embedding_list) if embedding_list else 0
+                    "image_id": str(ref["id"]),
+                    "image_index": current_count,
+                    "total_images": current_count + 1,
+                    "enrollment_job_id": job_id,
+                    "embedding_status": "pending" if job_id else "failed"
                 }
             else:
+                await face_image_store.delete_refs([ref])
                 raise ValueError("Failed to add face image")
             
         except Exception as e:
@@ -413,104 +447,51 @@ class PersonService:
             print(f"🔵 PersonService: Regenerating embeddings for person {person_id}")
             
             # Get person data from database
-            person_data = await self.collection.find_one({
-                "_id": ObjectId(person_id),
-                "user_id": ObjectId(user_id)
-            })
+            person_data = await self._find_person_with_images(person_id, user_id)
             
             if not person_data:
                 return {"success": False, "message": "Person not found"}
             
-            face_images = person_data.get("face_images", [])
-            if not face_images:
+            refs = person_data.get("face_image_refs") or []
+            if not refs:
                 return {"success": False, "message": "No face images found"}
             
-            print(f"🔵 PersonService: Found {len(face_images)} face images to process")
-            
-            new_embeddings = []
-            successful_extractions = 0
-            failed_extractions = 0
-            
-            for i, image_base64 in enumerate(face_images):
-                try:
-                    print(f"🔵 PersonService: Processing image {i+1}/{len(face_images)}")
-                    
-                    # Skip empty or invalid base64 strings
-                    if not image_base64 or not isinstance(image_base64, str):
-                        print(f"❌ PersonService: Image {i+1} is empty or invalid type")
-                        new_embeddings.append([])
-                        failed_extractions += 1
-                        continue
-                    
-                    # Handle both formats: with and without data URL prefix
-                    if image_base64.startswith('data:image/'):
-                        # Format: data:image/jpeg;base64,/9j/4AAQ...
-                        if ',' in image_base64:
-                            base64_data = image_base64.split(',')[1]
-                        else:
-                            print(f"❌ PersonService: Image {i+1} has invalid data URL format")
-                            new_embeddings.append([])
-                            failed_extractions += 1
-                            continue
-                    else:
-                        # Format: /9j/4AAQ... (pure base64)
-                        base64_data = image_base64
-                    
-                    # Validate base64 data
-                    if not base64_data.strip():
-                        print(f"❌ PersonService: Image {i+1} has empty base64 data")
-                        new_embeddings.append([])
-                        failed_extractions += 1
-                        continue
-                    
-                    # Decode base64 image
-                    try:
-                        image_data = base64.b64decode(base64_data)
-                        if len(image_data) == 0:
-                            print(f"❌ PersonService: Image {i+1} decoded to empty data")
-                            new_embeddings.append([])
-                            failed_extractions += 1
-                            continue
-                    except Exception as decode_error:
-                        print(f"❌ PersonService: Failed to decode base64 for image {i+1}: {decode_error}")
-                        new_embeddings.append([])
-                        failed_extractions += 1
-                        continue
-                    
-                    # Extract face embedding
-                    embedding = await face_processor.extract_face_embedding(image_data)
-                    
-                    if embedding is not None:
-                        new_embeddings.append(embedding.tolist())
-                        successful_extractions += 1
-                        print(f"✅ PersonService: Embedding extracted for image {i+1}")
-                    else:
-                        new_embeddings.append([])  # Empty array for failed extraction
-                        failed_extractions += 1
-                        print(f"❌ PersonService: Failed to extract embedding for image {i+1}")
-                        
-                except Exception as e:
-                    print(f"❌ PersonService: Error processing image {i+1}: {e}")
-                    new_embeddings.append([])  # Empty array for failed extraction
+            print(f"🔵 PersonService: Found {len(refs)} face images to process")
+            
+            # Đọc ảnh gốc từ GridFS, trích embedding theo batch
+            images = await face_image_store.read_many([ref["id"] for ref in refs])
+            loaded = [image_data for image_data in images if image_data]
+            extracted = iter(await face_processor.extract_face_embeddings_batch(loaded))
+            
+            # Ghi từng ảnh theo id (không $set cả mảng): ảnh được thêm / xóa trong lúc
+            # trích embedding không bị ghi đè; ảnh đã bị xóa thì bỏ qua
+            storage_dtype = get_settings().embedding_storage_dtype
+            successful_extractions = failed_extractions = updated = 0
+            for index, (ref, image_data) in enumerate(zip(refs, images)):
+                embedding = next(extracted) if image_data else None
+                if embedding is not None:
+                    successful_extractions += 1
+                else:
                     failed_extractions += 1
-            
-            # Update database with new embeddings
-            result = await self.collection.update_one(
-                {"_id": ObjectId(person_id), "user_id": ObjectId(user_id)},
-                {
-                    "$set": {
-                        "face_embeddings": new_embeddings,
-                        "updated_at": vietnam_now()
-                    }
-                }
-            )
-            
-            if result.modified_count > 0:
+                written = await enrollment_service.set_image_fields(person_id, ref["id"], {
+                    # Empty array for failed extraction (giữ đúng thứ tự ảnh)
+                    "embedding": encode_embedding(embedding, storage_dtype) if embedding is not None else [],
+                    "embedding_status": "done" if embedding is not None else "failed"
+                }, index)
+                if written is not None:
+                    updated += 1
+            
+            if updated:
+                await self.collection.update_one(
+                    {"_id": ObjectId(person_id), "user_id": ObjectId(user_id)},
+                    {"$set": {"embedding_format": EMBEDDING_FORMAT}}
+                )
+                await recognition_index.refresh_persons(user_id, [person_id])
                 print(f"✅ PersonService: Face embeddings regenerated successfully")
                 return {
                     "success": True,
-                    "message": f"Regenerated embeddings for {successful_extractions}/{len(face_images)} images",
-                    "total_images": len(face_images),
+                    "message": f"Regenerated embeddings for {successful_extractions}/{len(refs)} images",
+                    "total_images": len(refs),
                     "successful_extractions": successful_extractions,
                     "failed_extractions": failed_extractions,
                     "embeddings_updated": True
@@ -529,55 +510,53 @@ class PersonService:
         """Xóa ảnh khuôn mặt theo index"""
         try:
             # Get current person data from database
-            person_data = await self.collection.find_one({
-                "_id": ObjectId(person_id),
-                "user_id": ObjectId(user_id)
-            })
+            person_data = await self._find_person_with_images(person_id, user_id)
             
             if not person_data:
                 return False
             
-            face_images = person_data.get("face_images", [])
-            face_embeddings = person_data.get("face_embeddings", [])
+            refs = person_data.get("face_image_refs") or []
             
-            if image_index >= len(face_images) or image_index < 0:
+            if image_index >= len(refs) or image_index < 0:
                 return False
             
-            # Remove by index
-            face_images.pop(image_index)
-            if image_index < len(face_embeddings):
-                face_embeddings.pop(image_index)
-            
-            # Update database
-            result = await self.collection.update_one(
-                {"_id": ObjectId(person_id), "user_id": ObjectId(user_id)},
-                {
-                    "$set": {
-                        "face_images": face_images,
-                        "face_embeddings": face_embeddings,
-                        "updated_at": vietnam_now()
-                    }
-                }
-            )
-            
-            return result.modified_count > 0
+            # Xóa theo id ảnh tại index (cùng embedding cùng vị trí), không $set cả mảng
+            removed = refs[image_index]
+            if not await self._remove_face_refs(person_id, user_id, [removed["id"]]):
+                return False
+            await face_image_store.delete_refs([removed])
+            await recognition_index.refresh_persons(user_id, [person_id])
+            return True
         except Exception as e:
             print(f"Error removing face image: {e}")
             return False
 
+    async def get_face_image(self, person_id: str, image_id: str, user_id: str, thumbnail: bool = False) -> Optional[bytes]:
+        """Nội dung ảnh gốc / thumbnail của person (kiểm tra quyền sở hữu)"""
+        try:
+            person_data = await self._find_person_with_images(person_id, user_id)
+            if not person_data:
+                return None
+            for ref in person_data.get("face_image_refs") or []:
+                if str(ref["id"]) == image_id:
+                    return await face_image_store.read(ref.get("thumbnail_id") if thumbnail else ref["id"])
+            return None
+        except Exception as e:
+            print(f"Error getting face image: {e}")
+            return None
+
     async def check_minimum_face_images(self, person_id: str, user_id: str) -> Dict[str, Any]:
         """Kiểm tra xem person có đủ tối thiểu 8 ảnh khuôn mặt không"""
         try:
             person_data = await self.collection.find_one({
                 "_id": ObjectId(person_id),
                 "user_id": ObjectId(user_id)
-            })
+            }, {"face_images_count": self.SUMMARY_PROJECTION["face_images_count"]})
             
             if not person_data:
                 return {"success": False, "message": "Person not found"}
             
-            face_images = person_data.get("face_images", [])
-            image_count = len(face_images)
+            image_count = self._image_count(person_data)
             
             if image_count < 8:
                 return {
@@ -596,132 +575,162 @@ class PersonService:
             return {"success": False, "message": str(e)}
 
     async def validate_face_images(self, person_id: str, user_id: str) -> Dict[str, Any]:
-        """Validate tất cả face images của person"""
+        """
+        Validate tất cả face images của person (quality gate, loại ảnh trùng, giới hạn gallery)
+
+        Chỉ ảnh đã decode và chấm điểm (không có khuôn mặt / dưới ngưỡng chất lượng)
+        hoặc trùng mới bị xóa; lỗi đọc ảnh / lỗi model thì dừng, không thay đổi gì.
+        Ảnh đang chờ enrollment được bỏ qua.
+        """
         try:
             # Get person data from database
-            person_data = await self.collection.find_one({
-                "_id": ObjectId(person_id),
-                "user_id": ObjectId(user_id)
-            })
+            person_data = await self._find_person_with_images(person_id, user_id)
             
             if not person_data:
                 return {"success": False, "message": "Person not found"}
             
-            face_images = person_data.get("face_images", [])
-            valid_images = []
-            valid_embeddings = []
-            invalid_indices = []
-            
-            for i, image_base64 in enumerate(face_images):
-                try:
-                    # Skip face validation for now to test basic functionality
-                    # Later add: image_data = base64.b64decode(image_base64.split(',')[1])
-                    # embedding = await face_processor.extract_face_embedding(image_data)
-                    
-                    # For now, assume all images are valid
-                    valid_images.append(image_base64)
-                    valid_embeddings.append([])  # Empty embedding for now
-                    
-                except Exception:
-                    invalid_indices.append(i)
-            
-            # Update database if needed
-            if invalid_indices:
-                await self.collection.update_one(
-                    {"_id": ObjectId(person_id), "user_id": ObjectId(user_id)},
-                    {
-                        "$set": {
-                            "face_images": valid_images,
-                            "face_embeddings": valid_embeddings,
-                            "updated_at": vietnam_now()
-                        }
-                    }
-                )
+            face_images = person_data.get("face_image_refs") or []
+            checked = [i for i, ref in enumerate(face_images) if ref.get("embedding_status") != "pending"]
+            images = await face_image_store.read_many([face_images[i]["id"] for i in checked])
+            missing = [i for i, image_data in zip(checked, images) if not image_data]
+            if missing:
+                return {"success": False, "message": f"Cannot read face images {missing}, validation aborted"}
+            extracted = dict(zip(checked, await asyncio.gather(*[
+                face_processor.extract_face_embedding_with_quality(image_data) for image_data in images
+            ])))
+            errors = {i: quality["error"] for i, (_, quality) in extracted.items() if quality.get("retryable")}
+            if errors:
+                return {"success": False, "message": f"Face processing failed, validation aborted: {next(iter(errors.values()))}"}
+            
+            # Quality gate: không có khuôn mặt / không đạt chất lượng → loại;
+            # ảnh không decode được thì giữ nguyên và chỉ báo lại
+            rejected_reasons = {}
+            unreadable_indices = []
+            candidates = []
+            for i, (embedding, quality) in extracted.items():
+                if embedding is None and quality.get("faces") != 0:
+                    unreadable_indices.append(i)
+                    continue
+                issues = [quality["error"]] if embedding is None else face_processor.quality_issues(quality)
+                if issues:
+                    rejected_reasons[i] = ", ".join(issues)
+                else:
+                    candidates.append((i, embedding, quality))
+            
+            # Near-duplicate: giữ ảnh chất lượng cao hơn
+            kept = {}
+            duplicate_indices = []
+            for i, embedding, quality in sorted(candidates, key=lambda item: -item[2]["score"]):
+                vector = normalize(embedding)
+                if any(float(vector @ other) >= get_settings().enrollment_duplicate_similarity for other in kept.values()):
+                    duplicate_indices.append(i)
+                else:
+                    kept[i] = vector
+            invalid_indices = sorted(rejected_reasons)
+            duplicate_indices.sort()
+            
+            # Ghi embedding từng ảnh giữ lại theo id (vị trí có thể đã dời)
+            dtype = get_settings().embedding_storage_dtype
+            for i in kept:
+                embedding, quality = extracted[i]
+                await enrollment_service.set_image_fields(person_id, face_images[i]["id"], {
+                    "embedding": encode_embedding(embedding, dtype),
+                    "embedding_status": "done",
+                    "quality": quality
+                })
+            await self.collection.update_one(
+                {"_id": ObjectId(person_id), "user_id": ObjectId(user_id)},
+                {"$set": {"embedding_format": EMBEDDING_FORMAT}}
+            )
+            
+            removed = [face_images[i] for i in invalid_indices + duplicate_indices]
+            if await self._remove_face_refs(person_id, user_id, [ref["id"] for ref in removed]):
+                await face_image_store.delete_refs(removed)
+            pruned = await enrollment_service.enforce_gallery_cap(person_id, user_id)
+            await recognition_index.refresh_persons(user_id, [person_id])
+            
+            result = {
+                "valid_images": len(kept),
+                "invalid_images": len(invalid_indices),
+                "invalid_indices": invalid_indices,
+                "duplicate_indices": duplicate_indices,
+                "unreadable_indices": sorted(unreadable_indices),
+                "rejected_reasons": {str(i): reason for i, reason in rejected_reasons.items()},
+                "pruned_embeddings": pruned
+            }
             
             # Check minimum requirement of 8 images
-            if len(valid_images) < 8:
+            if len(kept) < 8:
                 return {
                     "success": False,
-                    "valid_images": len(valid_images),
-                    "invalid_images": len(invalid_indices),
-                    "invalid_indices": invalid_indices,
-                    "message": f"Cần tối thiểu 8 ảnh khuôn mặt để hoàn thành. Hiện tại có {len(valid_images)} ảnh hợp lệ."
+                    **result,
+                    "message": f"Cần tối thiểu 8 ảnh khuôn mặt để hoàn thành. Hiện tại có {len(kept)} ảnh hợp lệ."
                 }
             
             return {
                 "success": True,
-                "valid_images": len(valid_images),
-                "invalid_images": len(invalid_indices),
-                "invalid_indices": invalid_indices,
-                "message": f"Validated {len(valid_images)} valid images, removed {len(invalid_indices)} invalid images"
+                **result,
+                "message": f"Validated {len(kept)} valid images, removed {len(invalid_indices)} invalid and {len(duplicate_indices)} duplicate images"
             }
             
         except Exception as e:
             return {"success": False, "message": str(e)}
 
+    async def migrate_embedding_storage(self, batch_size: int = 200) -> Dict[str, Any]:
+        """
+        Chuyển face_embeddings cũ (mảng double / base64) sang BinData `embedding_storage_dtype`
+
+        Mỗi document chỉ được ghi nếu face_embeddings chưa đổi kể từ lúc đọc
+        (tránh ghi đè embedding enrollment vừa cập nhật); document bị bỏ qua sẽ
+        được chuyển ở lần chạy sau.
+        """
+        dtype = get_settings().embedding_storage_dtype
+        migrated_persons = converted = skipped = 0
+        last_id = None
+        while True:
+            query: Dict[str, Any] = {"embedding_format": {"$ne": EMBEDDING_FORMAT}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            persons = await self.collection.find(query, {"face_embeddings": 1}).sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+            if not persons:
+                break
+            last_id = persons[-1]["_id"]
+            operations = []
+            for person_data in persons:
+                raw_embeddings = person_data.get("face_embeddings")
+                canonical = await asyncio.to_thread(canonicalize, raw_embeddings, dtype)
+                converted += sum(1 for raw, new in zip(raw_embeddings or [], canonical) if new and raw is not new)
+                operations.append(UpdateOne(
+                    {"_id": person_data["_id"], "face_embeddings": raw_embeddings},
+                    {"$set": {"face_embeddings": canonical, "embedding_format": EMBEDDING_FORMAT}, "$inc": {"gallery_rev": 1}}
+                ))
+            result = await self.collection.bulk_write(operations, ordered=False)
+            migrated_persons += result.modified_count
+            skipped += len(operations) - result.matched_count
+            print(f"🔄 [EMBEDDINGS] Migrated {migrated_persons} persons ({converted} embeddings → {dtype})")
+
+        return {"migrated_persons": migrated_persons, "converted_embeddings": converted, "skipped_persons": skipped, "dtype": dtype}
+
     async def bulk_import_persons(self, persons_data: List[Dict[str, Any]], user_id: str) -> Dict[str, Any]:
-        """Bulk import persons từ JSON data với face embedding extraction"""
+        """Bulk import persons từ JSON data (chạy job import theo batch và chờ kết quả)"""
         try:
             print(f"🔵 PersonService: Starting bulk import of {len(persons_data)} persons")
             
-            imported = 0
-            failed = 0
-            errors = []
-            
-            for i, person_data in enumerate(persons_data):
-                try:
-                    print(f"🔵 PersonService: Importing person {i+1}/{len(persons_data)}: {person_data.get('name', 'Unknown')}")
-                    
-                    # Create person first
-                    person_create_data = {
-                        "name": person_data["name"],
-                        "description": person_data.get("description", ""),
-                        "department": person_data.get("metadata", {}).get("department"),
-                        "employee_id": person_data.get("metadata", {}).get("employee_id"),
-                        "position": person_data.get("metadata", {}).get("position"),
-                        "access_level": person_data.get("metadata", {}).get("access_level"),
-                        "metadata": person_data.get("metadata", {})
-                    }
-                    
-                    person_create = KnownPersonCreate(**person_create_data)
-                    person = await self.create_person(person_create, user_id)
-                    print(f"✅ PersonService: Created person {person.id}")
-                    
-                    # ✅ Add face images with embedding extraction
-                    if person_data.get("face_images"):
-                        for j, image_base64 in enumerate(person_data["face_images"]):
-                            try:
-                                print(f"🔵 PersonService: Adding face image {j+1} for {person.name}")
-                                result = await self.add_face_image(person.id, image_base64, user_id)
-                                
-                                if result["success"]:
-                                    print(f"✅ PersonService: Face image {j+1} added with embedding")
-                                else:
-                                    print(f"⚠️ PersonService: Face image {j+1} failed: {result['message']}")
-                                    
-                            except Exception as img_error:
-                                print(f"⚠️ PersonService: Failed to add face image {j+1} for {person.name}: {img_error}")
-                                errors.append(f"Failed to add face image for {person_data['name']}: {str(img_error)}")
-                    
-                    imported += 1
-                    print(f"✅ PersonService: Successfully imported {person.name}")
-                    
-                except Exception as e:
-                    failed += 1
-                    error_msg = f"Failed to import {person_data.get('name', 'Unknown')}: {str(e)}"
-                    print(f"❌ PersonService: {error_msg}")
-                    errors.append(error_msg)
+            job = await bulk_import_service.start_job(persons_data, user_id)
+            job = await bulk_import_service.wait_for_job(job["id"])
             
             result = {
-                "success": failed == 0,
-                "imported_count": imported,
-                "failed_count": failed,
-                "errors": errors,
-                "message": f"Import completed: {imported} successful, {failed} failed",
-                "embedding_extraction": "enabled"
+                "success": job["status"] == "completed" and job["failed"] == 0,
+                "job_id": job["id"],
+                "imported_count": job["imported"],
+                "failed_count": job["failed"],
+                "errors": job["errors"] + ([job["last_error"]] if job["last_error"] else []),
+                "message": f"Import {job['status']}: {job['imported']} successful, {job['failed']} failed",
+                "embedding_extraction": "enabled",
+                "embeddings_extracted": job["embeddings_extracted"]
             }
             
-            print(f"✅ PersonService: Bulk import result: {result}")
+            print(f"✅ PersonService: Bulk import result: {result['message']}")
             return result
             
         except Exception as e:
@@ -739,21 +748,19 @@ class PersonService:
     async def get_person_detail(self, person_id: str, user_id: str) -> Optional[PersonDetailResponse]:
         """Get person with full details including face images"""
         try:
-            result = await self.collection.find_one({
-                "_id": ObjectId(person_id),
-                "user_id": ObjectId(user_id)
-            })
+            result = await self._find_person_with_images(person_id, user_id)
             
             if result:
-                # Convert face_images to FaceImageResponse
-                face_images = []
-                for img in result.get("face_images", []):
-                    # Ensure proper data URI format
-                    image_url = f"data:image/jpeg;base64,{img}" if not img.startswith('data:image/') else img
-                    face_images.append(FaceImageResponse(
-                        image_url=image_url,
-                        uploaded_at=result.get("created_at", vietnam_now())
-                    ))
+                # Convert face_image_refs to FaceImageResponse (thumbnail data URL)
+                face_images = [
+                    FaceImageResponse(
+                        image_id=entry["image_id"],
+                        image_url=entry["image_url"],
+                        full_image_url=entry["full_image_url"],
+                        uploaded_at=entry["created_at"]
+                    )
+                    for entry in await self._face_image_entries(person_id, result)
+                ]
                 
                 return PersonDetailResponse(
                     id=str(result["_id"]),
@@ -782,10 +789,13 @@ class PersonService:
                 "is_active": False
             })
             
-            # Count total face images
+            # Count total face images (đếm trên server, không tải ảnh)
             total_images = 0
-            async for person in self.collection.find({"user_id": ObjectId(user_id), "is_active": True}):
-                total_images += len(person.get("face_images", []))
+            async for row in self.collection.aggregate([
+                {"$match": {"user_id": ObjectId(user_id), "is_active": True}},
+                {"$group": {"_id": None, "total": {"$sum": self.SUMMARY_PROJECTION["face_images_count"]}}}
+            ]):
+                total_images = row["total"]
             
             # Recently added persons (last 7 days)
             week_ago = vietnam_now() - timedelta(days=7)
@@ -0,0 +1,728 @@
+from typing import Dict, Any, List, Optional, Tuple, Callable
+from bson import ObjectId
+from pymongo import ReturnDocument
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+import numpy as np
+import faiss
+from ..config import get_settings
+from ..database import get_database
+from ..utils.embedding_codec import decode_gallery
+from .event_bus import event_bus
+
+RECOGNITION_CHANNEL = "recognition_index"
+
+
+def _temp_path(path: str) -> str:
+    """File tạm riêng cho mỗi lần ghi (nhiều process ghi cùng thư mục), thay bằng os.replace"""
+    return f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+
+
+def decode_embeddings(raw_embeddings: List[Any]) -> np.ndarray:
+    """face_embeddings của một person → ma trận (n, d) đã chuẩn hóa L2"""
+    return decode_gallery([raw_embeddings])[0]
+
+
+def normalize(embedding: Any) -> np.ndarray:
+    """Một embedding → vector float32 đã chuẩn hóa L2"""
+    vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm > 0 else vector
+
+
+def select_informative(matrix: np.ndarray, scores: List[float], k: int) -> List[int]:
+    """
+    Chọn tối đa k embedding (vector đã chuẩn hóa) có nhiều thông tin nhất
+
+    Greedy: lấy embedding chất lượng cao nhất, sau đó lần lượt lấy embedding có
+    `chất lượng × (1 - similarity lớn nhất với các embedding đã chọn)` cao nhất,
+    nên ưu tiên ảnh tốt và khác biệt (góc mặt, ánh sáng) thay vì ảnh gần giống nhau.
+    """
+    if len(matrix) <= k:
+        return list(range(len(matrix)))
+    weights = np.maximum(np.asarray(scores, dtype=np.float32), 1e-3)
+    selected = [int(np.argmax(weights))]
+    max_similarity = matrix @ matrix[selected[0]]
+    while len(selected) < k:
+        gain = weights * (1 - max_similarity)
+        gain[selected] = -np.inf
+        best = int(np.argmax(gain))
+        selected.append(best)
+        max_similarity = np.maximum(max_similarity, matrix @ matrix[best])
+    return sorted(selected)
+
+
+def build_prototypes(matrix: np.ndarray, n_medoids: int) -> np.ndarray:
+    """
+    Prototype của một person: embedding trung bình + `n_medoids` medoid
+
+    Medoid được chọn bằng vài vòng k-medoids (khởi tạo farthest-point). Person có
+    ít embedding thì giữ nguyên toàn bộ.
+    """
+    if len(matrix) <= n_medoids + 1:
+        return matrix
+    similarity = matrix @ matrix.T
+    medoids = select_informative(matrix, [1.0] * len(matrix), n_medoids)
+    for _ in range(5):
+        assignment = np.argmax(similarity[:, medoids], axis=1)
+        updated = []
+        for cluster, medoid in enumerate(medoids):
+            members = np.flatnonzero(assignment == cluster)
+            if len(members) == 0:
+                updated.append(medoid)
+            else:
+                updated.append(int(members[np.argmax(similarity[np.ix_(members, members)].sum(axis=1))]))
+        if updated == medoids:
+            break
+        medoids = updated
+    mean = normalize(matrix.mean(axis=0))
+    return np.ascontiguousarray(np.vstack([mean[None, :], matrix[medoids]]), dtype=np.float32)
+
+
+class GalleryPerson:
+    """Embedding đã chuẩn hóa + prototype của một known person"""
+
+    __slots__ = ("name", "matrix", "prototypes", "rev")
+
+    def __init__(self, name: str, matrix: np.ndarray, n_medoids: int, prototypes: Optional[np.ndarray] = None,
+                 rev: int = 0):
+        self.name = name
+        self.matrix = matrix
+        self.rev = rev
+        if prototypes is None:
+            prototypes = build_prototypes(matrix, n_medoids) if matrix.size else matrix
+        self.prototypes = prototypes
+
+
+ANN_BACKENDS = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+
+def _ivf_nlist(count: int) -> int:
+    return int(min(4096, max(16, 4 * np.sqrt(count))))
+
+
+def _pq_subquantizers(dim: int) -> int:
+    return next((m for m in (64, 32, 16, 8) if dim % m == 0), 1)
+
+
+def create_index(backend: str, dim: int, count: int, hnsw_m: int = 32):
+    """Index FAISS rỗng (inner product trên vector đã chuẩn hóa = cosine)"""
+    if backend == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = max(40, 2 * hnsw_m)
+        return index
+    if backend in ("ivf_flat", "ivf_pq"):
+        quantizer = faiss.IndexFlatIP(dim)
+        if backend == "ivf_flat":
+            return faiss.IndexIVFFlat(quantizer, dim, _ivf_nlist(count), faiss.METRIC_INNER_PRODUCT)
+        return faiss.IndexIVFPQ(quantizer, dim, _ivf_nlist(count), _pq_subquantizers(dim), 8, faiss.METRIC_INNER_PRODUCT)
+    return faiss.IndexFlatIP(dim)
+
+
+def tune_index(index, backend: str, hnsw_ef_search: int = 64, ivf_nprobe: int = 16):
+    """Tham số search (không lưu trong file index)"""
+    if backend == "hnsw":
+        faiss.downcast_index(index).hnsw.efSearch = hnsw_ef_search
+    elif backend in ("ivf_flat", "ivf_pq"):
+        faiss.extract_index_ivf(index).nprobe = ivf_nprobe
+    return index
+
+
+def train_sample(vectors: np.ndarray, nlist: int) -> np.ndarray:
+    """Tập train cho IVF: tối đa 64 vector mỗi cell"""
+    limit = min(len(vectors), 64 * nlist)
+    if limit == len(vectors):
+        return vectors
+    rows = np.random.default_rng(0).choice(len(vectors), limit, replace=False)
+    return np.ascontiguousarray(vectors[rows])
+
+
+class GallerySnapshot:
+    """
+    Index nhận dạng (bất biến) của một user
+
+    Được thay bằng snapshot mới mỗi khi gallery đổi, nên thread nhận dạng có thể
+    search trên snapshot cũ trong lúc event loop dựng snapshot mới.
+
+    Gallery lớn (≥ `prototype_min_size` embedding) chỉ index prototype của từng
+    person; khi điểm tốt nhất nằm trong ±`rerank_margin` quanh ngưỡng thì re-rank
+    bằng toàn bộ embedding của các person ứng viên.
+    """
+
+    __slots__ = ("index", "backend", "person_ids", "names", "row_person", "matrices", "rows",
+                 "size", "indexed", "mode", "rerank_margin", "version")
+
+    PROTOTYPE_CANDIDATES = 4
+
+    def __init__(self, persons: Dict[str, GalleryPerson], version: int,
+                 prototype_min_size: int = 0, rerank_margin: float = 0.1,
+                 index_builder: Optional[Callable[[np.ndarray], Tuple[Any, str]]] = None):
+        self.version = version
+        self.rerank_margin = rerank_margin
+        self.person_ids: List[str] = []
+        self.names: List[str] = []
+        self.matrices: List[np.ndarray] = []
+        for person_id, person in persons.items():
+            if person.matrix.size == 0:
+                continue
+            self.person_ids.append(person_id)
+            self.names.append(person.name)
+            self.matrices.append(person.matrix)
+        self.size = sum(len(matrix) for matrix in self.matrices)
+        self.mode = "prototype" if prototype_min_size and self.size >= prototype_min_size else "flat"
+
+        self.rows = [persons[person_id].prototypes for person_id in self.person_ids] if self.mode == "prototype" else self.matrices
+        # Dòng thứ i của index thuộc person row_person[i]
+        self.row_person = np.repeat(np.arange(len(self.rows)), [len(matrix) for matrix in self.rows])
+        self.indexed = len(self.row_person)
+        self.index = None
+        self.backend = "flat"
+        if self.rows:
+            vectors = self.vectors()
+            if index_builder is not None:
+                self.index, self.backend = index_builder(vectors)
+            else:
+                self.index = faiss.IndexFlatIP(vectors.shape[1])
+                self.index.add(vectors)
+
+    def vectors(self) -> np.ndarray:
+        """Các vector được index (theo thứ tự dòng)"""
+        return np.ascontiguousarray(np.vstack(self.rows), dtype=np.float32)
+
+    def _exact_best(self, query: np.ndarray, candidates: List[int]) -> Tuple[int, float]:
+        """Person có similarity lớn nhất với query, tính trên toàn bộ embedding của ứng viên"""
+        best, best_score = -1, -1.0
+        for position in candidates:
+            score = float(np.max(self.matrices[position] @ query))
+            if score > best_score:
+                best, best_score = position, score
+        return best, best_score
+
+    def search(self, embeddings: np.ndarray, threshold: float) -> List[Tuple[Optional[str], str, float]]:
+        """Nhận dạng một batch embedding: [(person_id | None, tên | "Unknown", similarity)]"""
+        if self.index is None or len(embeddings) == 0:
+            return [(None, "Unknown", 0.0)] * len(embeddings)
+        queries = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        faiss.normalize_L2(queries)
+        k = min(self.PROTOTYPE_CANDIDATES, self.indexed) if self.mode == "prototype" else 1
+        scores, indices = self.index.search(queries, k)
+
+        results = []
+        for query, row_scores, row_indices in zip(queries, scores, indices):
+            if row_indices[0] < 0:
+                results.append((None, "Unknown", 0.0))
+                continue
+            position, score = int(self.row_person[row_indices[0]]), float(row_scores[0])
+            if self.mode == "prototype" and abs(score - threshold) <= self.rerank_margin:
+                candidates = list(dict.fromkeys(int(self.row_person[i]) for i in row_indices if i >= 0))
+                position, score = self._exact_best(query, candidates)
+            if score > threshold:
+                results.append((self.person_ids[position], self.names[position], score))
+            else:
+                results.append((None, "Unknown", score))
+        return results
+
+
+class RecognitionIndexService:
+    """
+    Index nhận dạng known persons theo user, giữ trong bộ nhớ
+
+    - Gallery của user được nạp từ Mongo ở lần nhận dạng đầu tiên
+    - Thay đổi person (enrollment, sửa, xóa) cập nhật gallery ngay qua
+      `refresh_persons`, không phải nạp lại mỗi frame
+    - Khi chạy nhiều worker, thay đổi được phát qua event bus
+    - Index được dựng lại nền (thread); gallery lớn dùng ANN (HNSW / IVF-Flat /
+      IVF-PQ) chọn theo số vector, index đã train được lưu xuống đĩa
+    - Gallery (vector + id map) được lưu thành file theo user, nạp bằng mmap khi
+      khởi động nếu version khớp counter `recognition_versions` trong Mongo
+      (mọi thay đổi gallery đi qua `refresh_persons` và tăng counter)
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        # user_id -> person_id -> embeddings đã chuẩn hóa + prototype
+        self.persons: Dict[str, Dict[str, GalleryPerson]] = {}
+        self.snapshots: Dict[str, GallerySnapshot] = {}
+        self._loading: Dict[str, asyncio.Task] = {}
+        # user_id -> thay đổi (person_ids, version) đến trong lúc gallery đang nạp
+        self._missed: Dict[str, List[Tuple[List[str], Optional[int]]]] = {}
+        self._building: Dict[str, asyncio.Task] = {}
+        self._dirty: set = set()
+        # user_id -> (backend, số vector lúc train, index IVF đã train nhưng rỗng)
+        self._trained: Dict[str, Tuple[str, int, Any]] = {}
+        # user_id -> version (counter Mongo) đã áp dụng liên tục vào gallery trong bộ nhớ
+        self.versions: Dict[str, int] = {}
+        self._pending_versions: Dict[str, set] = {}
+        self._saved_versions: Dict[str, int] = {}
+        self._version = 0
+        event_bus.subscribe(RECOGNITION_CHANNEL, self._on_bus_message)
+
+    @property
+    def collection(self):
+        return get_database().known_persons
+
+    @property
+    def version_collection(self):
+        return get_database().recognition_versions
+
+    def _make_persons(self, persons_data: List[Dict[str, Any]]) -> Dict[str, GalleryPerson]:
+        """Document person → GalleryPerson (decode cả batch một lần, chạy trong thread)"""
+        matrices = decode_gallery([person_data.get("face_embeddings") for person_data in persons_data])
+        return {
+            str(person_data["_id"]): GalleryPerson(
+                str(person_data["name"]), matrix, self.settings.recognition_prototype_medoids,
+                rev=person_data.get("gallery_rev", 0)
+            )
+            for person_data, matrix in zip(persons_data, matrices)
+        }
+
+    # ===== Gallery version / file =====
+
+    async def _bump_version(self, user_id: str) -> Optional[int]:
+        """Tăng counter gallery của user trong Mongo (sau mỗi thay đổi known persons)"""
+        try:
+            result = await self.version_collection.find_one_and_update(
+                {"_id": user_id},
+                {"$inc": {"version": 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return result["version"]
+        except Exception as e:
+            # Counter không tăng → file gallery đã lưu có thể bị coi là còn hợp lệ, bỏ nó đi
+            print(f"⚠️ [RECOGNITION] Cannot bump gallery version for user {user_id}: {e}")
+            meta_path = self._gallery_meta_path(user_id)
+            if meta_path and os.path.exists(meta_path):
+                os.remove(meta_path)
+            self._saved_versions.pop(user_id, None)
+            return None
+
+    def _mark_applied(self, user_id: str, version: Optional[int]):
+        """Ghi nhận đã áp dụng thay đổi `version`; chỉ tiến khi các version trước đã đủ"""
+        if version is None or user_id not in self.versions:
+            return
+        pending = self._pending_versions.setdefault(user_id, set())
+        pending.add(version)
+        while self.versions[user_id] + 1 in pending:
+            self.versions[user_id] += 1
+        self._pending_versions[user_id] = {v for v in pending if v > self.versions[user_id]}
+
+    def _gallery_meta_path(self, user_id: str) -> Optional[str]:
+        if not self.settings.recognition_index_dir or not self.settings.recognition_persist_galleries:
+            return None
+        return os.path.join(self.settings.recognition_index_dir, f"{user_id}.gallery.json")
+
+    def _save_gallery(self, user_id: str, persons: Dict[str, GalleryPerson], version: int):
+        """
+        Ghi gallery ra file (chạy trong thread)
+
+        Vector (embedding + prototype của mọi person) nằm trong một file .npy có
+        version trong tên; file meta JSON (id map + số dòng) được thay atomically
+        sau cùng nên không bao giờ trỏ tới file vector ghi dở.
+        """
+        meta_path = self._gallery_meta_path(user_id)
+        if not meta_path:
+            return
+        try:
+            entries = [(person_id, person) for person_id, person in persons.items() if person.matrix.size]
+            blocks = [block for _, person in entries for block in (person.matrix, person.prototypes)]
+            data_file = f"{user_id}.gallery.{version}.npy"
+            directory = os.path.dirname(meta_path)
+            os.makedirs(directory, exist_ok=True)
+            data_path = os.path.join(directory, data_file)
+            data_tmp = _temp_path(data_path)
+            with open(data_tmp, "wb") as f:
+                np.save(f, np.vstack(blocks).astype(np.float32) if blocks else np.zeros((0, 0), dtype=np.float32))
+            os.replace(data_tmp, data_path)
+            meta = {
+                "version": version,
+                "data_file": data_file,
+                "persons": [[person_id, person.name, len(person.matrix), len(person.prototypes)] for person_id, person in entries],
+                # gallery_rev của mọi person (kể cả chưa có embedding) lúc đọc từ Mongo
+                "revisions": {person_id: person.rev for person_id, person in persons.items()},
+                "saved_at": time.time()
+            }
+            meta_tmp = _temp_path(meta_path)
+            with open(meta_tmp, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(meta_tmp, meta_path)
+            for name in os.listdir(directory):
+                if name.startswith(f"{user_id}.gallery.") and name.endswith(".npy") and name != data_file:
+                    os.remove(os.path.join(directory, name))
+        except Exception as e:
+            print(f"⚠️ [RECOGNITION] Cannot save gallery for user {user_id}: {e}")
+
+    def _read_gallery(self, user_id: str) -> Optional[Tuple[int, Dict[str, int], Dict[str, GalleryPerson]]]:
+        """Đọc gallery đã lưu (vector được mmap, không copy vào RAM)"""
+        meta_path = self._gallery_meta_path(user_id)
+        if not meta_path or not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            data = np.load(os.path.join(os.path.dirname(meta_path), meta["data_file"]), mmap_mode="r")
+            persons = {}
+            offset = 0
+            for person_id, name, rows, prototype_rows in meta["persons"]:
+                matrix = data[offset:offset + rows]
+                prototypes = data[offset + rows:offset + rows + prototype_rows]
+                persons[person_id] = GalleryPerson(name, matrix, 0, prototypes=prototypes,
+                                                   rev=meta.get("revisions", {}).get(person_id, 0))
+                offset += rows + prototype_rows
+            return meta["version"], meta.get("revisions"), persons
+        except Exception as e:
+            print(f"⚠️ [RECOGNITION] Cannot read saved gallery for user {user_id}: {e}")
+            return None
+
+    async def _current_revisions(self, user_id: str) -> Dict[str, int]:
+        """gallery_rev hiện tại của các person active (không đọc embedding)"""
+        return {
+            str(row["_id"]): row.get("gallery_rev", 0)
+            async for row in self.collection.find({"user_id": ObjectId(user_id), "is_active": True}, {"gallery_rev": 1})
+        }
+
+    async def _load_saved(self, user_id: str, current_version: Optional[int]) -> bool:
+        """
+        Dùng gallery đã lưu nếu version khớp counter Mongo và gallery_rev của mọi person khớp
+
+        gallery_rev được tăng trong cùng update ghi person / embedding, nên ghi
+        thành công mà chưa kịp tăng counter (crash, lỗi giữa chừng) vẫn làm file hết hợp lệ.
+        """
+        saved = await asyncio.to_thread(self._read_gallery, user_id)
+        if saved is None or current_version is None or saved[0] != current_version or saved[1] is None:
+            return False
+        if saved[1] != await self._current_revisions(user_id):
+            return False
+        version, _, persons = saved
+        self.persons[user_id] = persons
+        self.versions[user_id] = version
+        self._saved_versions[user_id] = version
+        self._pending_versions.pop(user_id, None)
+        return True
+
+    async def warm_start(self) -> int:
+        """Nạp sẵn các gallery đã lưu còn hợp lệ (gọi khi khởi động)"""
+        directory = self.settings.recognition_index_dir
+        if not directory or not self.settings.recognition_persist_galleries or not os.path.isdir(directory):
+            return 0
+        user_ids = [name[:-len(".gallery.json")] for name in os.listdir(directory) if name.endswith(".gallery.json")]
+        if not user_ids:
+            return 0
+        started = time.perf_counter()
+        counters = {
+            row["_id"]: row["version"]
+            async for row in self.version_collection.find({"_id": {"$in": user_ids}})
+        }
+        loaded = 0
+        for user_id in user_ids:
+            if user_id not in self.persons and await self._load_saved(user_id, counters.get(user_id)):
+                self._rebuild(user_id)
+                loaded += 1
+        print(f"✅ [RECOGNITION] Warm start: {loaded}/{len(user_ids)} saved galleries valid ({time.perf_counter() - started:.3f}s)")
+        return loaded
+
+    # ===== Index build =====
+
+    def select_backend(self, count: int) -> str:
+        """Backend cho gallery `count` vector (`recognition_index_backend` = auto thì chọn theo kích thước)"""
+        backend = self.settings.recognition_index_backend
+        if backend == "auto":
+            if count >= self.settings.recognition_ivf_min_vectors:
+                backend = "ivf_pq"
+            elif count >= self.settings.recognition_hnsw_min_vectors:
+                backend = "hnsw"
+            else:
+                backend = "flat"
+        if backend not in ANN_BACKENDS:
+            backend = "flat"
+        # IVF cần đủ vector để train các cell
+        if backend in ("ivf_flat", "ivf_pq") and count < 39 * 16:
+            backend = "flat"
+        return backend
+
+    def _index_path(self, user_id: str, backend: str, fingerprint: str) -> Optional[str]:
+        """
+        File index của đúng gallery: backend + fingerprint vector nằm trong tên file
+
+        Không có file meta riêng nên index không thể bị ghép với fingerprint của
+        gallery khác khi nhiều worker cùng ghi.
+        """
+        if not self.settings.recognition_index_dir:
+            return None
+        return os.path.join(self.settings.recognition_index_dir, f"{user_id}.{backend}.{fingerprint}.faiss")
+
+    def _load_persisted(self, user_id: str, backend: str, fingerprint: str):
+        path = self._index_path(user_id, backend, fingerprint)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            return faiss.read_index(path)
+        except Exception as e:
+            print(f"⚠️ [RECOGNITION] Cannot load persisted index for user {user_id}: {e}")
+            return None
+
+    def _persist(self, user_id: str, index, backend: str, fingerprint: str):
+        path = self._index_path(user_id, backend, fingerprint)
+        if not path:
+            return
+        try:
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            temp_path = _temp_path(path)
+            faiss.write_index(index, temp_path)
+            os.replace(temp_path, path)
+            # Index cũ của user (gallery đã đổi)
+            for name in os.listdir(directory):
+                if name.startswith(f"{user_id}.") and name.endswith(".faiss") and name != os.path.basename(path):
+                    try:
+                        os.remove(os.path.join(directory, name))
+                    except OSError:
+                        pass
+        except Exception as e:
+            print(f"⚠️ [RECOGNITION] Cannot persist index for user {user_id}: {e}")
+
+    def _tune(self, index, backend: str):
+        return tune_index(index, backend, self.settings.recognition_hnsw_ef_search, self.settings.recognition_ivf_nprobe)
+
+    def _build_index(self, user_id: str, vectors: np.ndarray) -> Tuple[Any, str]:
+        """Dựng index cho ma trận vector (chạy trong thread)"""
+        count, dim = vectors.shape
+        backend = self.select_backend(count)
+        if backend == "flat":
+            index = faiss.IndexFlatIP(dim)
+            index.add(vectors)
+            return index, backend
+
+        fingerprint = hashlib.blake2b(vectors.tobytes(), digest_size=16).hexdigest()
+        index = self._load_persisted(user_id, backend, fingerprint)
+        if index is not None:
+            return self._tune(index, backend), backend
+
+        started = time.perf_counter()
+        if backend == "hnsw":
+            index = create_index(backend, dim, count, self.settings.recognition_hnsw_m)
+        else:
+            # Train lại khi gallery lớn gấp đôi lúc train (phân bố cell đã lệch)
+            trained = self._trained.get(user_id)
+            if trained and trained[0] == backend and trained[2].d == dim and count < 2 * trained[1]:
+                index = faiss.clone_index(trained[2])
+            else:
+                index = create_index(backend, dim, count)
+                index.train(train_sample(vectors, faiss.extract_index_ivf(index).nlist))
+                self._trained[user_id] = (backend, count, faiss.clone_index(index))
+        index.add(vectors)
+        print(f"✅ [RECOGNITION] Built {backend} index for user {user_id}: {count} vectors in {time.perf_counter() - started:.2f}s")
+        self._persist(user_id, index, backend, fingerprint)
+        return self._tune(index, backend), backend
+
+    def _build_snapshot(self, user_id: str, persons: Dict[str, GalleryPerson], version: int) -> GallerySnapshot:
+        return GallerySnapshot(
+            persons,
+            version,
+            prototype_min_size=self.settings.recognition_prototype_min_embeddings,
+            rerank_margin=self.settings.recognition_rerank_margin,
+            index_builder=lambda vectors: self._build_index(user_id, vectors)
+        )
+
+    async def _build_loop(self, user_id: str) -> Optional[GallerySnapshot]:
+        snapshot = self.snapshots.get(user_id)
+        while user_id in self._dirty:
+            self._dirty.discard(user_id)
+            persons = self.persons.get(user_id)
+            if persons is None:
+                break
+            persons = dict(persons)
+            gallery_version = self.versions.get(user_id)
+            self._version += 1
+            try:
+                snapshot = await asyncio.to_thread(self._build_snapshot, user_id, persons, self._version)
+            except Exception as e:
+                print(f"❌ [RECOGNITION] Error building index for user {user_id}: {e}")
+                continue
+            if user_id in self.persons:
+                self.snapshots[user_id] = snapshot
+            if gallery_version is not None and self._saved_versions.get(user_id) != gallery_version:
+                await asyncio.to_thread(self._save_gallery, user_id, persons, gallery_version)
+                self._saved_versions[user_id] = gallery_version
+        return snapshot
+
+    def _rebuild(self, user_id: str) -> asyncio.Task:
+        """
+        Dựng lại snapshot của user trong thread
+
+        Các thay đổi đến trong lúc đang dựng được gộp vào một lần dựng tiếp theo;
+        nhận dạng dùng snapshot cũ cho đến khi snapshot mới xong.
+        """
+        self._dirty.add(user_id)
+        task = self._building.get(user_id)
+        if task is None or task.done():
+            task = asyncio.create_task(self._build_loop(user_id))
+            self._building[user_id] = task
+        return task
+
+    # ===== Gallery =====
+
+    async def _load_user(self, user_id: str) -> GallerySnapshot:
+        started = time.perf_counter()
+        # Đọc counter trước khi đọc person: thay đổi xảy ra giữa chừng làm version
+        # lưu thấp hơn counter, lần khởi động sau sẽ nạp lại từ Mongo
+        counter = await self.version_collection.find_one({"_id": user_id})
+        current_version = counter["version"] if counter else 0
+        source = "file"
+        if not await self._load_saved(user_id, current_version):
+            source = "mongo"
+            persons_data = await self.collection.find(
+                {"user_id": ObjectId(user_id), "is_active": True},
+                {"name": 1, "face_embeddings": 1, "gallery_rev": 1}
+            ).to_list(length=None)
+            self.persons[user_id] = await asyncio.to_thread(self._make_persons, persons_data)
+            self.versions[user_id] = current_version
+            self._pending_versions.pop(user_id, None)
+        # Lần đọc ở trên có thể đã diễn ra trước các thay đổi này: đọc lại các person đó
+        while self._missed.get(user_id):
+            person_ids, version = self._missed[user_id].pop(0)
+            await self.refresh_persons(user_id, person_ids, broadcast=False, version=version)
+        self._missed.pop(user_id, None)
+        snapshot = await self._rebuild(user_id) or GallerySnapshot({}, self._version)
+        print(f"✅ [RECOGNITION] Loaded gallery for user {user_id} from {source} in {time.perf_counter() - started:.3f}s: "
+              f"{len(self.persons.get(user_id, {}))} persons, {snapshot.size} embeddings, "
+              f"{snapshot.mode}/{snapshot.backend} search over {snapshot.indexed} vectors")
+        return snapshot
+
+    async def get_gallery(self, user_id: str) -> GallerySnapshot:
+        """Snapshot index của user (nạp từ DB nếu chưa có)"""
+        snapshot = self.snapshots.get(user_id)
+        if snapshot is not None:
+            return snapshot
+        task = self._loading.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._load_user(user_id))
+            self._loading[user_id] = task
+        try:
+            return await task
+        finally:
+            self._loading.pop(user_id, None)
+
+    async def refresh_persons(self, user_id: str, person_ids: List[str], broadcast: bool = True,
+                              version: Optional[int] = None):
+        """Đọc lại các person từ DB và cập nhật gallery (person inactive / đã xóa bị gỡ khỏi index)"""
+        user_id = str(user_id)
+        person_ids = [str(person_id) for person_id in person_ids]
+        if not person_ids:
+            return
+        if broadcast:
+            version = await self._bump_version(user_id)
+            event_bus.publish_nowait(RECOGNITION_CHANNEL, {"user_id": user_id, "person_ids": person_ids, "version": version})
+        if user_id not in self.persons:
+            if user_id in self._loading:
+                self._missed.setdefault(user_id, []).append((person_ids, version))
+            return
+
+        found = self._make_persons(await self.collection.find(
+            {"_id": {"$in": [ObjectId(person_id) for person_id in person_ids]}, "is_active": True},
+            {"name": 1, "face_embeddings": 1, "gallery_rev": 1}
+        ).to_list(length=None))
+
+        persons = self.persons.get(user_id)
+        if persons is None:
+            return
+        for person_id in person_ids:
+            if person_id in found:
+                persons[person_id] = found[person_id]
+            else:
+                persons.pop(person_id, None)
+        self._mark_applied(user_id, version)
+        self._rebuild(user_id)
+
+    def invalidate_user(self, user_id: str, broadcast: bool = True):
+        """Bỏ gallery của user, lần nhận dạng sau sẽ nạp lại"""
+        user_id = str(user_id)
+        self.persons.pop(user_id, None)
+        self.snapshots.pop(user_id, None)
+        self.versions.pop(user_id, None)
+        self._pending_versions.pop(user_id, None)
+        self._missed.pop(user_id, None)
+        if broadcast:
+            event_bus.publish_nowait(RECOGNITION_CHANNEL, {"user_id": user_id, "invalidate": True})
+
+    async def _on_bus_message(self, payload: Dict[str, Any]):
+        if payload.get("invalidate"):
+            self.invalidate_user(payload["user_id"], broadcast=False)
+        else:
+            await self.refresh_persons(payload["user_id"], payload.get("person_ids", []), broadcast=False,
+                                       version=payload.get("version"))
+
+    # ===== Report =====
+
+    @staticmethod
+    def _benchmark_sync(snapshot: GallerySnapshot, queries: int, noise: float, threshold: float) -> Dict[str, Any]:
+        vectors = snapshot.vectors()
+        rng = np.random.default_rng(0)
+        rows = rng.choice(len(vectors), min(queries, len(vectors)), replace=False)
+        # Query = vector trong gallery + nhiễu (mô phỏng ảnh khác của cùng người)
+        probe = vectors[rows] + rng.normal(0, noise, (len(rows), vectors.shape[1])).astype(np.float32)
+        probe = np.ascontiguousarray(probe, dtype=np.float32)
+        faiss.normalize_L2(probe)
+
+        flat = faiss.IndexFlatIP(vectors.shape[1])
+        flat.add(vectors)
+        started = time.perf_counter()
+        _, flat_rows = flat.search(probe, 1)
+        flat_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        _, ann_rows = snapshot.index.search(probe, 1)
+        ann_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        snapshot.search(probe, threshold)
+        search_seconds = time.perf_counter() - started
+
+        valid = ann_rows[:, 0] >= 0
+        row_recall = float(np.mean(valid & (ann_rows[:, 0] == flat_rows[:, 0])))
+        person_recall = float(np.mean(valid & (
+            snapshot.row_person[np.where(valid, ann_rows[:, 0], 0)] == snapshot.row_person[flat_rows[:, 0]]
+        )))
+        return {
+            "backend": snapshot.backend,
+            "mode": snapshot.mode,
+            "vectors": len(vectors),
+            "queries": len(rows),
+            "recall_at_1": round(row_recall, 4),
+            "person_recall_at_1": round(person_recall, 4),
+            "flat_ms_per_query": round(flat_seconds * 1000 / len(rows), 4),
+            "index_ms_per_query": round(ann_seconds * 1000 / len(rows), 4),
+            "search_ms_per_query": round(search_seconds * 1000 / len(rows), 4),
+            "speedup": round(flat_seconds / ann_seconds, 2) if ann_seconds > 0 else None
+        }
+
+    async def benchmark(self, user_id: str, queries: int = 200, noise: float = 0.02) -> Dict[str, Any]:
+        """So sánh recall@1 và latency của index hiện tại với FlatIP (exact) trên gallery của user"""
+        snapshot = await self.get_gallery(str(user_id))
+        if snapshot.index is None:
+            return {"backend": snapshot.backend, "vectors": 0, "message": "Gallery is empty"}
+        return await asyncio.to_thread(
+            self._benchmark_sync, snapshot, queries, noise, self.settings.face_similarity_threshold
+        )
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Thống kê các gallery đang nạp"""
+        backends: Dict[str, int] = {}
+        for snapshot in self.snapshots.values():
+            backends[snapshot.backend] = backends.get(snapshot.backend, 0) + 1
+        return {
+            "users": len(self.snapshots),
+            "persons": sum(len(persons) for persons in self.persons.values()),
+            "embeddings": sum(snapshot.size for snapshot in self.snapshots.values()),
+            "indexed_vectors": sum(snapshot.indexed for snapshot in self.snapshots.values()),
+            "prototype_galleries": sum(1 for snapshot in self.snapshots.values() if snapshot.mode == "prototype"),
+            "backends": backends,
+            "building": sum(1 for task in self._building.values() if not task.done()),
+            "version": self._version
+        }
+
+
+# Global instance
+recognition_index = RecognitionIndexService()
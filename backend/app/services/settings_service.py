@@ -4,6 +4,7 @@ from ..database import get_database
 from datetime import datetime
 from ..utils.timezone_utils import vietnam_now
 from ..models.user import User
+from .notification_context_service import notification_context_service
 
 class SettingsService:
     @property
@@ -55,6 +56,7 @@ class SettingsService:
                 },
                 upsert=True
             )
+            notification_context_service.invalidate_user(user_id)
             
             return settings_data
         except Exception as e:
@@ -71,6 +73,7 @@ class SettingsService:
                 {"_id": ObjectId(user_id)},
                 {"$set": update_data}
             )
+            notification_context_service.invalidate_user(user_id)
             
             return result.modified_count > 0
         except Exception as e:
@@ -0,0 +1,158 @@
+from typing import Dict, Any, Optional, Tuple
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+import re
+import time
+from ..config import get_settings
+from ..database import get_database
+
+
+class StateStore:
+    """
+    Kho trạng thái dùng chung giữa các worker (mặc định: dict trong process)
+
+    Key-value có TTL tùy chọn, cộng thêm token bucket nguyên tử cho rate limit.
+    """
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[Any, Optional[float]]] = {}
+
+    def _alive(self, key: str) -> bool:
+        entry = self._data.get(key)
+        if entry is None:
+            return False
+        if entry[1] is not None and entry[1] <= time.time():
+            del self._data[key]
+            return False
+        return True
+
+    async def get(self, key: str, default: Any = None) -> Any:
+        return self._data[key][0] if self._alive(key) else default
+
+    async def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None):
+        self._data[key] = (value, time.time() + ttl_seconds if ttl_seconds else None)
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+    async def items(self, prefix: str) -> Dict[str, Any]:
+        """Mọi key còn hạn bắt đầu bằng prefix"""
+        return {key: self._data[key][0] for key in list(self._data) if key.startswith(prefix) and self._alive(key)}
+
+    async def delete_prefix(self, prefix: str) -> int:
+        keys = [key for key in self._data if key.startswith(prefix)]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+
+    async def take_token(self, key: str, capacity: int, refill_per_second: float) -> Tuple[bool, float]:
+        """Lấy một token từ bucket, trả về (được phép, số token còn lại)"""
+        now = time.time()
+        state = await self.get(key) or {"tokens": float(capacity), "updated": now}
+        tokens = min(capacity, state["tokens"] + (now - state["updated"]) * refill_per_second)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        await self.set(key, {"tokens": tokens, "updated": now}, ttl_seconds=capacity / refill_per_second)
+        return allowed, tokens
+
+    async def peek_tokens(self, key: str, capacity: int, refill_per_second: float) -> float:
+        """Số token hiện có (không tiêu thụ)"""
+        state = await self.get(key)
+        if not state:
+            return float(capacity)
+        return min(capacity, state["tokens"] + (time.time() - state["updated"]) * refill_per_second)
+
+    def get_info(self) -> Dict[str, Any]:
+        return {"backend": "memory", "keys": len(self._data)}
+
+
+class MongoStateStore(StateStore):
+    """Kho trạng thái trên collection `shared_state` (TTL index theo expires_at)"""
+
+    @property
+    def collection(self):
+        return get_database().shared_state
+
+    @staticmethod
+    def _not_expired(now: datetime) -> Dict[str, Any]:
+        return {"$or": [{"expires_at": None}, {"expires_at": {"$gt": now}}]}
+
+    async def get(self, key: str, default: Any = None) -> Any:
+        doc = await self.collection.find_one({"_id": key, **self._not_expired(datetime.utcnow())})
+        return doc["value"] if doc else default
+
+    async def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None):
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl_seconds) if ttl_seconds else None
+        await self.collection.update_one(
+            {"_id": key},
+            {"$set": {"value": value, "expires_at": expires_at}},
+            upsert=True
+        )
+
+    async def delete(self, key: str):
+        await self.collection.delete_one({"_id": key})
+
+    async def items(self, prefix: str) -> Dict[str, Any]:
+        query = {"_id": {"$regex": f"^{re.escape(prefix)}"}, **self._not_expired(datetime.utcnow())}
+        return {doc["_id"]: doc["value"] async for doc in self.collection.find(query)}
+
+    async def delete_prefix(self, prefix: str) -> int:
+        result = await self.collection.delete_many({"_id": {"$regex": f"^{re.escape(prefix)}"}})
+        return result.deleted_count
+
+    async def take_token(self, key: str, capacity: int, refill_per_second: float) -> Tuple[bool, float]:
+        """Token bucket nguyên tử bằng một update pipeline (an toàn giữa các worker)"""
+        now = datetime.utcnow()
+        refilled = {"$min": [
+            capacity,
+            {"$add": [
+                {"$ifNull": ["$value.tokens", capacity]},
+                {"$multiply": [
+                    {"$divide": [{"$subtract": [now, {"$ifNull": ["$value.updated", now]}]}, 1000]},
+                    refill_per_second
+                ]}
+            ]}
+        ]}
+        doc = await self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"_refilled": refilled}},
+                {"$set": {
+                    "value.allowed": {"$gte": ["$_refilled", 1]},
+                    "value.tokens": {"$cond": [{"$gte": ["$_refilled", 1]}, {"$subtract": ["$_refilled", 1]}, "$_refilled"]},
+                    "value.updated": now,
+                    "expires_at": {"$add": [now, int(capacity / refill_per_second * 1000)]}
+                }},
+                {"$unset": "_refilled"}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        value = doc.get("value", {})
+        return bool(value.get("allowed")), float(value.get("tokens", 0))
+
+    async def peek_tokens(self, key: str, capacity: int, refill_per_second: float) -> float:
+        doc = await self.collection.find_one({"_id": key})
+        if not doc:
+            return float(capacity)
+        value = doc.get("value", {})
+        elapsed = (datetime.utcnow() - value.get("updated", datetime.utcnow())).total_seconds()
+        return min(capacity, value.get("tokens", capacity) + elapsed * refill_per_second)
+
+    def get_info(self) -> Dict[str, Any]:
+        return {"backend": "mongo", "collection": "shared_state"}
+
+
+def create_state_store() -> StateStore:
+    """Tạo state store theo cấu hình `state_backend` (memory | mongo)"""
+    backend = get_settings().state_backend.lower()
+    if backend == "mongo":
+        return MongoStateStore()
+    if backend != "memory":
+        print(f"⚠️ [STATE] Unknown backend '{backend}', using in-process store")
+    return StateStore()
+
+
+# Global instance
+state_store = create_state_store()
@@ -1,19 +1,20 @@
 import cv2
 import asyncio
 import numpy as np
-import json
 from typing import Dict, Any, Optional, AsyncGenerator
 from ..models.camera import CameraResponse
 from ..services.face_processor import face_processor
-from ..services.websocket_manager import websocket_manager
+from ..services.websocket_manager import websocket_manager, camera_topic, user_topic
 from ..services.detection_tracker import detection_tracker
 from ..services.detection_optimizer_service import DetectionOptimizerService
 from ..services.notification_service import notification_service
+from ..services.detection_counter_service import detection_counter_service
 from ..utils.timezone_utils import vietnam_now
+from .event_bus import event_bus
+from .state_store import state_store
 from datetime import datetime
 import concurrent.futures
 import time
-import base64
 from io import BytesIO
 from PIL import Image, ImageDraw, ImageFont
 import os
@@ -25,14 +26,55 @@ from ..services.face_processor import face_processor
 from ..services.websocket_manager import websocket_manager
 import concurrent.futures
 import time
-import base64
 from io import BytesIO
 
+STREAM_PREFIX = "stream:"
+STREAM_CHANNEL = "stream_control"
+STREAM_REGISTRY_TTL = 60
+
 class StreamProcessor:
     def __init__(self):
+        # Stream (capture + reader thread) chỉ tồn tại trong worker đã mở nó;
+        # state store giữ registry stream:<camera_id> → worker để worker khác tra cứu / dừng
         self.active_streams: Dict[str, Dict[str, Any]] = {}
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
         self._frame_times: Dict[str, float] = {}  # Để tracking FPS
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        event_bus.subscribe(STREAM_CHANNEL, self._on_stream_control)
+
+    async def _register_stream(self, camera_id: str):
+        stream = self.active_streams.get(camera_id)
+        if stream:
+            await state_store.set(STREAM_PREFIX + camera_id, {
+                "node_id": event_bus.node_id,
+                "camera_name": stream["camera"].name,
+                "start_time": stream["start_time"]
+            }, ttl_seconds=STREAM_REGISTRY_TTL)
+
+    async def _heartbeat(self):
+        """Gia hạn registry cho các stream của worker này"""
+        while self.active_streams:
+            try:
+                await asyncio.sleep(STREAM_REGISTRY_TTL / 3)
+                for camera_id in list(self.active_streams):
+                    await self._register_stream(camera_id)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                print(f"Error refreshing stream registry: {e}")
+        self._heartbeat_task = None
+
+    async def _get_remote_stream(self, camera_id: str) -> Optional[Dict[str, Any]]:
+        """Stream đang chạy ở worker khác (theo registry)"""
+        entry = await state_store.get(STREAM_PREFIX + camera_id)
+        if entry and entry.get("node_id") != event_bus.node_id:
+            return entry
+        return None
+
+    async def _on_stream_control(self, payload: Dict[str, Any]):
+        """Lệnh điều khiển stream từ worker khác"""
+        if payload.get("action") == "stop" and payload.get("camera_id") in self.active_streams:
+            await self.stop_stream(payload["camera_id"])
 
     async def get_stream_info(self, camera_id: str) -> Dict[str, Any]:
         """Lấy thông tin stream"""
@@ -44,6 +86,15 @@ class StreamProcessor:
                 "viewers_count": stream.get("viewers_count", 0),
                 "uptime": time.time() - stream.get("start_time", time.time())
             }
+        remote = await self._get_remote_stream(camera_id)
+        if remote:
+            return {
+                "is_streaming": True,
+                "status": "online",
+                "viewers_count": 0,
+                "uptime": time.time() - remote.get("start_time", time.time()),
+                "node_id": remote.get("node_id")
+            }
         else:
             return {
                 "is_streaming": False,
@@ -169,6 +220,9 @@ class StreamProcessor:
                 "reader_thread": reader_thread
             }
             reader_thread.start()
+            await self._register_stream(camera_id)
+            if self._heartbeat_task is None:
+                self._heartbeat_task = asyncio.create_task(self._heartbeat())
             print(f"Stream started for camera: {camera.name}")
             return True
         except Exception as e:
@@ -190,10 +244,18 @@ class StreamProcessor:
                 if stream.get("cap"):
                     stream["cap"].release()
                 del self.active_streams[camera_id]
+                face_processor.release_camera(camera_id)
+                websocket_manager.clear_camera_state(camera_id)
+                await state_store.delete(STREAM_PREFIX + camera_id)
                 if not self.active_streams:
                     await detection_tracker.stop_cleanup_task()
                 print(f"Stream stopped for camera: {camera_id}")
                 return True
+            # Stream do worker khác giữ → gửi lệnh dừng qua event bus
+            if await self._get_remote_stream(camera_id):
+                await event_bus.publish(STREAM_CHANNEL, {"action": "stop", "camera_id": camera_id})
+                print(f"Stop requested for camera {camera_id} on another worker")
+                return True
             return False
         except Exception as e:
             print(f"Error stopping stream: {e}")
@@ -313,17 +375,23 @@ class StreamProcessor:
             cv2.putText(frame, timestamp, (10, frame.shape[0] - 10), 
                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
             
+            # Model chưa nạp xong: không chặn stream chờ model
+            if camera.detection_enabled and not face_processor.is_ready:
+                face_processor.ensure_loading()
+                cv2.putText(frame, "DETECTION: LOADING", (frame.shape[1] - 180, 30), 
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
+            
             # Face detection và recognition giống code mẫu
-            if camera.detection_enabled:
+            elif camera.detection_enabled:
                 cv2.putText(frame, "DETECTION: ON", (frame.shape[1] - 150, 30), 
                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
                 
                 try:
-                    # Load known persons for recognition
-                    known_persons = await self._get_known_persons_for_camera(camera_id)
+                    # Gallery (index dựng sẵn) của chủ camera
+                    gallery = await self._get_gallery_for_camera(camera_id)
                     
                     # Phát hiện và nhận dạng khuôn mặt với detection tracking
-                    detections = await face_processor.detect_and_recognize_faces(frame, known_persons)
+                    detections = await face_processor.detect_and_recognize_faces(frame, gallery=gallery, camera_id=camera_id)
                     
                     # Sử dụng detection_tracker để quyết định có lưu detection hay không
                     for detection in detections:
@@ -387,6 +455,17 @@ class StreamProcessor:
                             )
                             detection_task.add_done_callback(lambda t: None if not t.exception() else print(f"❌ Detection alert error: {t.exception()}"))
                     
+                    # Track overlay cho client đang xem camera (client delta chỉ nhận phần thay đổi)
+                    websocket_manager.publish_camera_state(camera_id, {
+                        str(detection.get('person_id') or f"s{i}"): {
+                            "bbox": [int(v) for v in detection.get('bbox', [0, 0, 0, 0])],
+                            "name": detection.get('person_name', 'Unknown'),
+                            "confidence": round(float(detection.get('confidence', 0)), 2),
+                            "detection_type": detection.get('detection_type')
+                        }
+                        for i, detection in enumerate(detections)
+                    })
+                    
                     # Add detection count overlay
                     detection_count = len(detections)
                     cv2.putText(frame, f"Faces: {detection_count}", (frame.shape[1] - 150, 60), 
@@ -505,6 +584,17 @@ class StreamProcessor:
                 "frame_rate": 30,  # TODO: Calculate actual FPS
                 "resolution": "640x480"  # TODO: Get actual resolution
             }
+        remote = await self._get_remote_stream(camera_id)
+        if remote:
+            return {
+                "is_streaming": True,
+                "is_recording": False,
+                "viewers_count": 0,
+                "uptime": time.time() - remote.get("start_time", time.time()),
+                "frame_rate": 0,
+                "resolution": "Unknown",
+                "node_id": remote.get("node_id")
+            }
         else:
             return {
                 "is_streaming": False,
@@ -551,79 +641,32 @@ class StreamProcessor:
                 }
             }
             
-            # Send to all connected clients (you might want to filter by user)
-            # Chạy background task để không block video stream
-            websocket_task = asyncio.create_task(
-                websocket_manager.broadcast(json.dumps(alert_message))
-            )
-            # Add error handling for websocket task
-            websocket_task.add_done_callback(lambda t: None if not t.exception() else print(f"❌ WebSocket error: {t.exception()}"))
-            print(f"✅ Detection alert sent via WebSocket: {detection.get('person_name', 'Unknown')}")
+            # Chỉ gửi cho chủ camera (topic user) và client đang xem camera (topic camera),
+            # publish chỉ đưa vào hàng đợi nên không block video stream
+            owner_id = str(camera_data.get("user_id", "")) if camera_data else ""
+            topics = [camera_topic(camera_id)]
+            if owner_id:
+                topics.append(user_topic(owner_id))
+            delivered = websocket_manager.publish_nowait(topics, alert_message)
+            print(f"✅ Detection alert sent via WebSocket to {delivered} clients: {detection.get('person_name', 'Unknown')}")
             
         except Exception as e:
             print(f"Error sending detection alert: {e}")
 
-    async def _get_known_persons_for_camera(self, camera_id: str) -> List[dict]:
-        """Get known persons data for face recognition"""
+    async def _get_gallery_for_camera(self, camera_id: str):
+        """Gallery nhận dạng của chủ camera (recognition_index), None nếu không xác định được chủ"""
         try:
-            # Import here to avoid circular imports
-            from ..database import get_database
-            from bson import ObjectId
-            
-            db = get_database()
-            known_persons = []
-            
-            print(f"🔵 Loading known persons for camera {camera_id}...")
-            
-            # Get all known persons (you might want to filter by camera or user)
-            async for person_data in db.known_persons.find({"is_active": True}):
-                # Convert embeddings - backend lưu trong field 'face_embeddings'
-                embeddings = []
-                if 'face_embeddings' in person_data and person_data['face_embeddings']:
-                    for emb_data in person_data['face_embeddings']:
-                        if isinstance(emb_data, str) and emb_data:
-                            # If stored as base64, decode it
-                            try:
-                                emb_bytes = base64.b64decode(emb_data)
-                                emb_array = np.frombuffer(emb_bytes, dtype=np.float32)
-                                embeddings.append(emb_array)
-                            except Exception as e:
-                                print(f"Error decoding base64 embedding: {e}")
-                        elif isinstance(emb_data, list) and emb_data:
-                            # If stored as list, convert to numpy array
-                            try:
-                                embeddings.append(np.array(emb_data, dtype=np.float32))
-                            except Exception as e:
-                                print(f"Error converting list to array: {e}")
-                
-                if embeddings:
-                    # Đảm bảo name được encode/decode đúng UTF-8
-                    person_name = person_data['name']
-                    if isinstance(person_name, bytes):
-                        person_name = person_name.decode('utf-8')
-                    elif not isinstance(person_name, str):
-                        person_name = str(person_name)
-                    
-                    known_persons.append({
-                        'id': str(person_data['_id']),
-                        'name': person_name,
-                        'embeddings': embeddings
-                    })
-                    print(f"✅ Loaded person: {person_name} with {len(embeddings)} embeddings")
-                else:
-                    person_name = person_data['name']
-                    if isinstance(person_name, bytes):
-                        person_name = person_name.decode('utf-8')
-                    print(f"⚠️ Person {person_name} has no valid embeddings")
-            
-            print(f"✅ Loaded {len(known_persons)} known persons for recognition")
-            return known_persons
-            
+            from .notification_context_service import notification_context_service
+            from .recognition_index import recognition_index
+
+            camera_data = await notification_context_service.get_camera_document(camera_id)
+            if not camera_data or not camera_data.get("user_id"):
+                return None
+            return await recognition_index.get_gallery(str(camera_data["user_id"]))
+
         except Exception as e:
-            print(f"❌ Error loading known persons: {e}")
-            import traceback
-            traceback.print_exc()
-            return []
+            print(f"❌ Error loading recognition gallery: {e}")
+            return None
 
     async def _save_detection_to_database(self, camera_id: str, camera_name: str, detection: Dict[str, Any], frame: np.ndarray):
         """Save detection to database"""
@@ -690,6 +733,7 @@ class StreamProcessor:
             # Insert to database
             result = await db.detection_logs.insert_one(detection_doc)
             detection_id = str(result.inserted_id)
+            await detection_counter_service.record_detection_log(detection_doc)
             
             print(f"✅ Saved detection to database: {detection_id}, type: {detection_type}")
             return detection_id
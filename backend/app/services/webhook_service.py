@@ -0,0 +1,290 @@
+from typing import Dict, Any, List, Optional
+from datetime import datetime
+from urllib.parse import urlsplit
+import asyncio
+import hashlib
+import hmac
+import json
+import random
+import time
+import httpx
+from bson import ObjectId
+from ..config import get_settings
+from ..database import get_database
+
+try:
+    import h2  # noqa: F401 - httpx cần gói h2 để bật HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+def sign_payload(secret: str, timestamp: str, body: bytes) -> str:
+    """Chữ ký HMAC-SHA256 của webhook: sha256=hex(HMAC(secret, "<timestamp>.<body>"))"""
+    digest = hmac.new(secret.encode(), timestamp.encode() + b"." + body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+def verify_signature(secret: str, timestamp: str, body: bytes, signature: str) -> bool:
+    """Kiểm tra chữ ký webhook phía nhận (dùng cho receiver / stub server)"""
+    return hmac.compare_digest(sign_payload(secret, timestamp, body), signature)
+
+
+class WebhookDispatcher:
+    """
+    Gửi webhook nền với client HTTP dùng chung theo từng destination
+
+    - Một `httpx.AsyncClient` (keep-alive, HTTP/2 nếu có gói h2) cho mỗi host
+    - Mỗi endpoint có hàng đợi giới hạn (`webhook_queue_size`) và tối đa
+      `webhook_max_concurrency` worker gửi; hàng đầy → sự kiện vào dead-letter
+    - Gom nhiều sự kiện thành một request khi `webhook_batch_size` > 1
+    - Ký HMAC-SHA256 (header X-SafeFace-Signature) khi có secret
+    - Retry với exponential backoff, thất bại cuối cùng ghi vào `webhook_dead_letters`
+      (khi shutdown, lần gửi đang chờ backoff được ghi dead-letter ngay thay vì chờ)
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.workers: Dict[str, List[asyncio.Task]] = {}
+        self.batches: Dict[tuple, List[Dict[str, Any]]] = {}
+        self.batch_secrets: Dict[tuple, Optional[str]] = {}
+        self.batch_tasks: Dict[tuple, asyncio.Task] = {}
+        self.tasks: set = set()
+        self._closing: Optional[asyncio.Event] = None
+
+    def _closing_event(self) -> asyncio.Event:
+        if self._closing is None:
+            self._closing = asyncio.Event()
+        return self._closing
+
+    @property
+    def db(self):
+        return get_database()
+
+    @staticmethod
+    def _destination(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _get_client(self, url: str) -> httpx.AsyncClient:
+        destination = self._destination(url)
+        client = self.clients.get(destination)
+        if client is None or client.is_closed:
+            concurrency = self.settings.webhook_max_concurrency
+            client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=self.settings.webhook_timeout_seconds,
+                limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+            )
+            self.clients[destination] = client
+        return client
+
+    def _get_queue(self, url: str) -> asyncio.Queue:
+        queue = self.queues.get(url)
+        if queue is None:
+            queue = asyncio.Queue(maxsize=max(1, self.settings.webhook_queue_size))
+            self.queues[url] = queue
+            self.workers[url] = [
+                asyncio.create_task(self._worker(url, queue))
+                for _ in range(max(1, self.settings.webhook_max_concurrency))
+            ]
+        return queue
+
+    def _enqueue(self, url: str, payload: Dict[str, Any], secret: Optional[str],
+                 user_id: Optional[str]) -> bool:
+        """Đưa payload vào hàng của endpoint, hàng đầy → ghi dead-letter thay vì chờ"""
+        try:
+            self._get_queue(url).put_nowait((payload, secret, user_id))
+            return True
+        except asyncio.QueueFull:
+            print(f"[WARNING] Webhook queue for {url} is full, moving event to dead letters")
+            self._spawn(self._dead_letter(url, payload, user_id, "queue full", None, 0))
+            return False
+
+    async def _worker(self, url: str, queue: asyncio.Queue):
+        while True:
+            payload, secret, user_id = await queue.get()
+            try:
+                await self._deliver(url, payload, secret, user_id)
+            except Exception as e:
+                print(f"[ERROR] Webhook worker error for {url}: {e}")
+            finally:
+                queue.task_done()
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def dispatch(self, url: str, event: Dict[str, Any], secret: Optional[str] = None,
+                 user_id: Optional[str] = None):
+        """Đưa một sự kiện vào hàng gửi webhook (không chờ kết quả)"""
+        secret = secret or self.settings.webhook_signing_secret
+        if self.settings.webhook_batch_size <= 1:
+            payload = {
+                "event": "face_detection_alert",
+                "data": event,
+                "timestamp": datetime.utcnow().isoformat()
+            }
+            self._enqueue(url, payload, secret, user_id)
+            return
+
+        # Batch theo (endpoint, user) để không trộn sự kiện / secret của các user khác nhau
+        key = (url, user_id)
+        self.batches.setdefault(key, []).append(event)
+        self.batch_secrets[key] = secret
+        if len(self.batches[key]) >= self.settings.webhook_batch_size:
+            self._flush_batch(key)
+        elif key not in self.batch_tasks or self.batch_tasks[key].done():
+            self.batch_tasks[key] = self._spawn(self._flush_batch_later(key))
+
+    async def _flush_batch_later(self, key: tuple):
+        await asyncio.sleep(self.settings.webhook_batch_window_seconds)
+        self._flush_batch(key)
+
+    def _flush_batch(self, key: tuple):
+        events = self.batches.pop(key, [])
+        if not events:
+            return
+        url, user_id = key
+        payload = {
+            "event": "face_detection_alert_batch",
+            "data": events,
+            "count": len(events),
+            "timestamp": datetime.utcnow().isoformat()
+        }
+        self._enqueue(url, payload, self.batch_secrets.pop(key, None), user_id)
+
+    def _build_request(self, payload: Dict[str, Any], secret: Optional[str]):
+        body = json.dumps(payload, default=str).encode("utf-8")
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            "User-Agent": "SafeFace-Webhook/1.0",
+            "X-SafeFace-Timestamp": timestamp
+        }
+        if secret:
+            headers["X-SafeFace-Signature"] = sign_payload(secret, timestamp, body)
+        return body, headers
+
+    async def _deliver(self, url: str, payload: Dict[str, Any], secret: Optional[str] = None,
+                       user_id: Optional[str] = None) -> bool:
+        """Gửi payload với retry + backoff, trả về True nếu endpoint nhận 2xx"""
+        max_attempts = max(1, self.settings.webhook_max_attempts)
+        last_error = None
+        status_code = None
+
+        for attempt in range(1, max_attempts + 1):
+            # Ký lại mỗi lần thử để timestamp luôn mới
+            body, headers = self._build_request(payload, secret)
+            try:
+                response = await self._get_client(url).post(url, content=body, headers=headers)
+                status_code = response.status_code
+
+                if 200 <= status_code < 300:
+                    print(f"[SUCCESS] Webhook sent successfully to {url} (attempt {attempt})")
+                    return True
+
+                last_error = f"HTTP {status_code}"
+                if status_code not in RETRYABLE_STATUS_CODES:
+                    print(f"[WARNING] Webhook rejected with status {status_code}, not retrying")
+                    break
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                last_error = f"{type(e).__name__}: {e}"
+            except Exception as e:
+                last_error = str(e)
+                break
+
+            if attempt < max_attempts:
+                if self._closing_event().is_set():
+                    break
+                delay = self.settings.webhook_retry_base_seconds * (2 ** (attempt - 1))
+                delay = min(delay, 300) * (0.5 + random.random() / 2)
+                print(f"[WARNING] Webhook to {url} failed ({last_error}), retry {attempt}/{max_attempts - 1} in {delay:.1f}s")
+                try:
+                    # close() cắt ngang backoff, payload vào dead-letter để gửi lại sau
+                    await asyncio.wait_for(self._closing_event().wait(), timeout=delay)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+
+        await self._dead_letter(url, payload, user_id, last_error, status_code, attempt)
+        return False
+
+    async def _dead_letter(self, url: str, payload: Dict[str, Any], user_id: Optional[str],
+                           error: Optional[str], status_code: Optional[int], attempts: int):
+        """Lưu webhook gửi thất bại để kiểm tra / gửi lại sau"""
+        print(f"[ERROR] Webhook to {url} failed after {attempts} attempts: {error}")
+        try:
+            await self.db.webhook_dead_letters.insert_one({
+                "url": url,
+                "user_id": user_id,  # Không lưu secret, lấy lại từ user_settings khi gửi lại
+                "payload": payload,
+                "last_error": error,
+                "status_code": status_code,
+                "attempts": attempts,
+                "created_at": datetime.utcnow()
+            })
+        except Exception as e:
+            print(f"[ERROR] Error saving webhook dead letter: {e}")
+
+    async def _get_user_secret(self, user_id: Optional[str]) -> Optional[str]:
+        if not user_id or not ObjectId.is_valid(user_id):
+            return None
+        settings = await self.db.user_settings.find_one({"user_id": ObjectId(user_id)}, {"webhook_secret": 1})
+        return settings.get("webhook_secret") if settings else None
+
+    async def redeliver_dead_letters(self, limit: int = 50) -> Dict[str, int]:
+        """Đưa các webhook trong dead-letter collection vào hàng gửi nền (không chờ kết quả)"""
+        queued = 0
+        async for letter in self.db.webhook_dead_letters.find().sort("created_at", 1).limit(limit):
+            # Xóa trước khi gửi: lần gửi lỗi sẽ tạo dead-letter mới
+            result = await self.db.webhook_dead_letters.delete_one({"_id": letter["_id"]})
+            if not result.deleted_count:
+                continue
+            secret = await self._get_user_secret(letter.get("user_id")) or self.settings.webhook_signing_secret
+            if self._enqueue(letter["url"], letter["payload"], secret, letter.get("user_id")):
+                queued += 1
+        return {"queued": queued}
+
+    async def close(self):
+        """Gửi nốt các batch đang chờ (một lần, lỗi → dead-letter) và đóng client"""
+        self._closing_event().set()
+        for task in list(self.batch_tasks.values()):
+            task.cancel()
+        for key in list(self.batches.keys()):
+            self._flush_batch(key)
+        if self.queues:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(queue.join() for queue in self.queues.values())),
+                    timeout=self.settings.webhook_timeout_seconds
+                )
+            except asyncio.TimeoutError:
+                pass
+        for workers in self.workers.values():
+            for task in workers:
+                task.cancel()
+        # Sự kiện chưa kịp gửi trong hàng → dead-letter để gửi lại sau
+        for url, queue in self.queues.items():
+            while not queue.empty():
+                payload, _, user_id = queue.get_nowait()
+                await self._dead_letter(url, payload, user_id, "shutdown before delivery", None, 0)
+        self.queues = {}
+        self.workers = {}
+        if self.tasks:
+            _, pending = await asyncio.wait(list(self.tasks), timeout=self.settings.webhook_timeout_seconds)
+            for task in pending:
+                task.cancel()
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients = {}
+
+
+# Global instance
+webhook_dispatcher = WebhookDispatcher()
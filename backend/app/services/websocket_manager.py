@@ -1,83 +1,380 @@
 from fastapi import WebSocket
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Iterable, Optional, Set, Union
+import asyncio
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
+from bson import ObjectId
+import numpy as np
+from ..config import get_settings
 from ..utils.timezone_utils import vietnam_now
+from .event_bus import event_bus
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+WEBSOCKET_CHANNEL = "websocket"
+ENCODINGS = ["json", "msgpack"] if MSGPACK_AVAILABLE else ["json"]
+
+
+def user_topic(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+def camera_topic(camera_id: str) -> str:
+    return f"camera:{camera_id}"
+
+
+def _to_plain(obj: Any) -> Any:
+    """Chuyển kiểu không serialize được (datetime, ObjectId, numpy) về kiểu cơ bản"""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, timedelta):
+        return obj.total_seconds()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+
+class OutboundMessage:
+    """
+    Message gửi đi, serialize tối đa một lần cho mỗi encoding
+
+    Dù topic có bao nhiêu subscriber, JSON / msgpack chỉ được tạo một lần
+    (ở lần gửi đầu tiên cho encoding đó) rồi dùng lại.
+    """
+
+    __slots__ = ("_payload", "_encoded")
+
+    def __init__(self, payload: Union[Dict[str, Any], str]):
+        self._payload = payload
+        self._encoded: Dict[str, Union[str, bytes]] = {}
+        if isinstance(payload, str):
+            self._encoded["json"] = payload
+
+    def as_dict(self) -> Dict[str, Any]:
+        if isinstance(self._payload, str):
+            self._payload = json.loads(self._payload)
+        return self._payload
+
+    def encode(self, encoding: str = "json") -> Union[str, bytes]:
+        data = self._encoded.get(encoding)
+        if data is None:
+            if encoding == "msgpack":
+                data = msgpack.packb(self.as_dict(), default=_to_plain, use_bin_type=True)
+            else:
+                data = json.dumps(self.as_dict(), default=_to_plain, ensure_ascii=False, separators=(",", ":"))
+            self._encoded[encoding] = data
+        return data
+
+
+class ClientConnection:
+    """
+    Một WebSocket client với hàng đợi gửi riêng (bounded) và task gửi nền
+
+    Producer chỉ `enqueue()` (không await), task gửi đẩy message ra socket.
+    Hàng đợi đầy nghĩa là client quá chậm → bị ngắt kết nối.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: str, queue_size: int, send_timeout: float,
+                 encoding: str = "json", delta: bool = False):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.encoding = encoding
+        self.delta = delta  # Nhận camera_delta thay vì camera_state đầy đủ
+        self.topics: Set[str] = set()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, queue_size))
+        self.send_timeout = send_timeout
+        self.sent = 0
+        self.closed = False
+        self.sender_task: Optional[asyncio.Task] = None
+
+    def enqueue(self, message: Union[OutboundMessage, Dict[str, Any], str]) -> bool:
+        """Đưa message vào hàng đợi, False nếu hàng đợi đầy"""
+        if self.closed:
+            return False
+        if not isinstance(message, OutboundMessage):
+            message = OutboundMessage(message)
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def send(self, message: OutboundMessage):
+        """Gửi message theo encoding của client (msgpack → binary frame)"""
+        data = message.encode(self.encoding)
+        if isinstance(data, bytes):
+            await self.websocket.send_bytes(data)
+        else:
+            await self.websocket.send_text(data)
+
 
 class WebSocketManager:
+    """
+    Hub pub/sub cho WebSocket theo topic
+
+    - Topic `user:<id>` (tự động subscribe khi kết nối) và `camera:<id>`
+      (client subscribe khi mở trang camera)
+    - Publish chỉ duyệt các connection của topic đó và không bao giờ chờ socket
+    - Mỗi connection có hàng đợi giới hạn `websocket_queue_size`, client chậm
+      (đầy hàng đợi hoặc gửi quá `websocket_send_timeout_seconds`) bị ngắt
+    - Khi chạy nhiều worker, message được chuyển qua event bus tới các worker
+      đang giữ socket của topic đó
+    - Mỗi client chọn encoding JSON hoặc msgpack; message chỉ serialize một lần
+      cho mỗi encoding. Track trên camera gửi dạng delta cho client bật `delta`
+    """
+
     def __init__(self):
+        self.settings = get_settings()
         # Lưu trữ connections theo user_id
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+        self.active_connections: Dict[str, List[ClientConnection]] = {}
+        self.subscribers: Dict[str, Set[ClientConnection]] = {}
+        self.evicted_count = 0
+        # Track hiện tại theo camera: {"seq": int, "tracks": {key: fields}}
+        self.camera_states: Dict[str, Dict[str, Any]] = {}
+        event_bus.subscribe(WEBSOCKET_CHANNEL, self._on_bus_message)
 
-    async def connect(self, websocket: WebSocket, user_id: str):
+    async def connect(self, websocket: WebSocket, user_id: str, encoding: str = "json",
+                      delta: bool = False) -> ClientConnection:
         """Kết nối WebSocket cho user"""
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = []
-        
-        self.active_connections[user_id].append(websocket)
-        print(f"✅ WebSocket connected for user: {user_id}")
+        connection = ClientConnection(
+            websocket,
+            user_id,
+            self.settings.websocket_queue_size,
+            self.settings.websocket_send_timeout_seconds,
+            encoding=encoding if encoding in ENCODINGS else "json",
+            delta=delta
+        )
+        self.active_connections.setdefault(user_id, []).append(connection)
+        self.subscribe(connection, user_topic(user_id))
+        connection.sender_task = asyncio.create_task(self._sender(connection))
+        print(f"✅ WebSocket connected for user: {user_id} ({connection.encoding}{', delta' if delta else ''})")
+        return connection
+
+    def _find_connection(self, websocket: WebSocket, user_id: str) -> Optional[ClientConnection]:
+        for connection in self.active_connections.get(user_id, []):
+            if connection.websocket is websocket:
+                return connection
+        return None
 
     def disconnect(self, websocket: WebSocket, user_id: str):
         """Ngắt kết nối WebSocket"""
-        if user_id in self.active_connections:
-            try:
-                self.active_connections[user_id].remove(websocket)
-                if not self.active_connections[user_id]:
-                    del self.active_connections[user_id]
-                print(f"❌ WebSocket disconnected for user: {user_id}")
-            except ValueError:
-                pass
-
-    async def send_personal_message(self, message: str, user_id: str):
-        """Gửi message riêng cho user"""
-        if user_id in self.active_connections:
-            dead_connections = []
-            for connection in self.active_connections[user_id]:
+        connection = self._find_connection(websocket, user_id)
+        if connection is not None:
+            self._remove(connection)
+            print(f"❌ WebSocket disconnected for user: {user_id}")
+
+    def _remove(self, connection: ClientConnection):
+        if connection.closed:
+            return
+        connection.closed = True
+        for topic in list(connection.topics):
+            self.unsubscribe(connection, topic)
+
+        connections = self.active_connections.get(connection.user_id, [])
+        if connection in connections:
+            connections.remove(connection)
+            if not connections:
+                del self.active_connections[connection.user_id]
+
+        task = connection.sender_task
+        if task is not None and task is not asyncio.current_task() and not task.done():
+            task.cancel()
+
+    def _evict(self, connection: ClientConnection, reason: str):
+        """Ngắt client chậm (không chờ, đóng socket trong nền)"""
+        if connection.closed:
+            return
+        self.evicted_count += 1
+        print(f"⚠️ Evicting slow WebSocket client for user {connection.user_id}: {reason}")
+        self._remove(connection)
+        asyncio.create_task(self._close_socket(connection.websocket))
+
+    @staticmethod
+    async def _close_socket(websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)  # Try again later
+        except Exception:
+            pass
+
+    async def _sender(self, connection: ClientConnection):
+        """Task gửi nền của một connection"""
+        try:
+            while not connection.closed:
+                message = await connection.queue.get()
                 try:
-                    await connection.send_text(message)
-                except:
-                    dead_connections.append(connection)
-            
-            # Cleanup dead connections
-            for dead_conn in dead_connections:
-                self.disconnect(dead_conn, user_id)
+                    await asyncio.wait_for(connection.send(message), timeout=connection.send_timeout)
+                    connection.sent += 1
+                except asyncio.TimeoutError:
+                    self._evict(connection, "send timeout")
+                    break
+                except (TypeError, ValueError) as e:
+                    # Lỗi serialize chỉ bỏ qua message đó
+                    print(f"[ERROR] WebSocket message serialization error: {e}")
+                except Exception:
+                    self._remove(connection)
+                    break
+        except asyncio.CancelledError:
+            pass
+
+    # ===== Topics =====
+
+    def subscribe(self, connection: ClientConnection, topic: str):
+        """Đăng ký connection vào topic"""
+        self.subscribers.setdefault(topic, set()).add(connection)
+        connection.topics.add(topic)
+
+        # Client mới mở camera nhận ngay snapshot track hiện tại (nền cho các delta sau)
+        if topic.startswith("camera:"):
+            camera_id = topic[len("camera:"):]
+            state = self.camera_states.get(camera_id)
+            if state:
+                connection.enqueue(self._camera_state_message(camera_id, state))
+
+    def unsubscribe(self, connection: ClientConnection, topic: str):
+        """Hủy đăng ký connection khỏi topic"""
+        subscribers = self.subscribers.get(topic)
+        if subscribers is not None:
+            subscribers.discard(connection)
+            if not subscribers:
+                del self.subscribers[topic]
+        connection.topics.discard(topic)
+
+    def publish_nowait(self, topics: Iterable[str], message: Union[Dict[str, Any], str]) -> int:
+        """
+        Gửi message tới các connection đã subscribe một trong các topic (mỗi connection một lần)
+
+        Không await nên không bao giờ chặn producer, trả về số connection local nhận message;
+        các worker khác nhận qua event bus.
+        """
+        topics = list(topics)
+        outbound = OutboundMessage(message)
+        if event_bus.distributed:
+            event_bus.publish_nowait(WEBSOCKET_CHANNEL, {"topics": topics, "message": outbound.encode("json")})
+        return self._deliver_local(topics, outbound)
+
+    def _on_bus_message(self, payload: Dict[str, Any]):
+        """Message từ worker khác"""
+        if payload.get("camera_state"):
+            self._apply_remote_camera_state(payload)
+        elif payload.get("broadcast"):
+            self._deliver_local([user_topic(user_id) for user_id in self.active_connections],
+                                OutboundMessage(payload["message"]))
+        else:
+            self._deliver_local(payload.get("topics", []), OutboundMessage(payload.get("message", "")))
+
+    def _deliver_local(self, topics: Iterable[str], message: OutboundMessage,
+                       delta_message: Optional[OutboundMessage] = None) -> int:
+        targets: Set[ClientConnection] = set()
+        for topic in topics:
+            targets.update(self.subscribers.get(topic, ()))
+
+        delivered = 0
+        for connection in targets:
+            outbound = delta_message if delta_message is not None and connection.delta else message
+            if connection.enqueue(outbound):
+                delivered += 1
+            else:
+                self._evict(connection, "outbound queue full")
+        return delivered
+
+    async def publish(self, topic: str, message: Union[Dict[str, Any], str]) -> int:
+        """Gửi message tới một topic"""
+        return self.publish_nowait([topic], message)
+
+    # ===== Camera tracks (delta) =====
+
+    @staticmethod
+    def _camera_state_message(camera_id: str, state: Dict[str, Any]) -> OutboundMessage:
+        return OutboundMessage({
+            "type": "camera_state",
+            "camera_id": camera_id,
+            "seq": state["seq"],
+            "tracks": state["tracks"]
+        })
+
+    def publish_camera_state(self, camera_id: str, tracks: Dict[str, Dict[str, Any]]) -> int:
+        """
+        Cập nhật các track đang hiển thị trên camera
+
+        Client thường nhận `camera_state` (toàn bộ track), client bật delta nhận
+        `camera_delta` chỉ gồm field thay đổi (`upsert`) và track biến mất (`remove`).
+        `seq` tăng mỗi lần để client phát hiện mất message và chờ snapshot mới.
+        Không có thay đổi thì không gửi gì.
+        """
+        previous = self.camera_states.get(camera_id, {"seq": 0, "tracks": {}})
+        previous_tracks = previous["tracks"]
+
+        upsert = {}
+        for key, fields in tracks.items():
+            old = previous_tracks.get(key, {})
+            changed = {name: value for name, value in fields.items() if old.get(name) != value}
+            if changed:
+                upsert[key] = changed
+        remove = [key for key in previous_tracks if key not in tracks]
+        if not upsert and not remove:
+            return 0
+
+        state = {"seq": previous["seq"] + 1, "tracks": tracks}
+        self.camera_states[camera_id] = state
+
+        full_message = self._camera_state_message(camera_id, state)
+        delta_message = OutboundMessage({
+            "type": "camera_delta",
+            "camera_id": camera_id,
+            "seq": state["seq"],
+            "upsert": upsert,
+            "remove": remove
+        })
+        if event_bus.distributed:
+            event_bus.publish_nowait(WEBSOCKET_CHANNEL, {
+                "camera_state": True,
+                "camera_id": camera_id,
+                "full": full_message.encode("json"),
+                "delta": delta_message.encode("json")
+            })
+        return self._deliver_local([camera_topic(camera_id)], full_message, delta_message)
+
+    def clear_camera_state(self, camera_id: str):
+        """Xóa track của camera (khi dừng stream) và báo client"""
+        if self.camera_states.get(camera_id, {}).get("tracks"):
+            self.publish_camera_state(camera_id, {})
+        self.camera_states.pop(camera_id, None)
+
+    def _apply_remote_camera_state(self, payload: Dict[str, Any]):
+        """Track từ worker đang xử lý camera: lưu snapshot và chuyển tới client local"""
+        camera_id = payload["camera_id"]
+        full_message = OutboundMessage(payload["full"])
+        state = full_message.as_dict()
+        self.camera_states[camera_id] = {"seq": state["seq"], "tracks": state["tracks"]}
+        self._deliver_local([camera_topic(camera_id)], full_message, OutboundMessage(payload["delta"]))
+
+    async def send_personal_message(self, message: Union[Dict[str, Any], str], user_id: str):
+        """Gửi message riêng cho user"""
+        self.publish_nowait([user_topic(user_id)], message)
 
     async def send_detection_alert(self, user_id: str, detection_data: Dict[str, Any]):
-        """Gửi thông báo phát hiện cho user"""
-        try:
-            message = {
-                "type": "detection_alert",
-                "data": detection_data,
-                "timestamp": vietnam_now().isoformat()
-            }
-            
-            # Try to serialize to catch any remaining datetime issues
-            json_message = json.dumps(message)
-            await self.send_personal_message(json_message, user_id)
-            
-        except (TypeError, ValueError) as e:
-            print(f"[ERROR] JSON serialization error in websocket alert: {e}")
-            print(f"[DEBUG] Detection data keys: {list(detection_data.keys()) if isinstance(detection_data, dict) else 'Not a dict'}")
-            
-            # Send simplified message as fallback
-            fallback_message = {
-                "type": "detection_alert",
-                "data": {
-                    "type": detection_data.get("type", "unknown"),
-                    "title": detection_data.get("title", "Detection Alert"),
-                    "message": detection_data.get("message", "Detection occurred"),
-                    "timestamp": vietnam_now().isoformat()
-                },
-                "timestamp": vietnam_now().isoformat()
-            }
-            
-            await self.send_personal_message(json.dumps(fallback_message), user_id)
-            raise e
-
-    async def broadcast(self, message: str):
-        """Broadcast message cho tất cả user"""
-        for user_id in self.active_connections:
-            await self.send_personal_message(message, user_id)
+        """Gửi thông báo phát hiện cho user (datetime / ObjectId / numpy được chuyển khi serialize)"""
+        message = {
+            "type": "detection_alert",
+            "data": detection_data,
+            "timestamp": vietnam_now().isoformat()
+        }
+        await self.send_personal_message(message, user_id)
+
+    async def broadcast(self, message: Union[Dict[str, Any], str]):
+        """Broadcast message cho tất cả user (thông báo hệ thống)"""
+        outbound = OutboundMessage(message)
+        if event_bus.distributed:
+            event_bus.publish_nowait(WEBSOCKET_CHANNEL, {"broadcast": True, "message": outbound.encode("json")})
+        self._deliver_local([user_topic(user_id) for user_id in self.active_connections], outbound)
 
     def get_connection_count(self) -> int:
         """Lấy số lượng connection hiện tại"""
@@ -87,5 +384,21 @@ class WebSocketManager:
         """Lấy số lượng connection của user"""
         return len(self.active_connections.get(user_id, []))
 
+    def get_stats(self) -> Dict[str, Any]:
+        """Thống kê hub: số connection, topic, hàng đợi"""
+        connections = [c for conns in self.active_connections.values() for c in conns]
+        return {
+            "connections": len(connections),
+            "topics": len(self.subscribers),
+            "encodings": {encoding: sum(1 for c in connections if c.encoding == encoding) for encoding in ENCODINGS},
+            "delta_clients": sum(1 for c in connections if c.delta),
+            "tracked_cameras": len(self.camera_states),
+            "queued_messages": sum(c.queue.qsize() for c in connections),
+            "max_queue_depth": max((c.queue.qsize() for c in connections), default=0),
+            "evicted_slow_consumers": self.evicted_count,
+            "event_bus": event_bus.get_info(),
+            "timestamp": datetime.utcnow().isoformat()
+        }
+
 # Global instance
-websocket_manager = WebSocketManager()
\ No newline at end of file
+websocket_manager = WebSocketManager()
@@ -0,0 +1,107 @@
+import base64
+from typing import Any, Dict, List, Optional, Tuple
+from bson import Binary
+import numpy as np
+
+# Định dạng lưu embedding trong `known_persons.face_embeddings` (phiên bản 1):
+# mỗi phần tử là BinData chứa vector little-endian, subtype user-defined cho biết
+# dtype (0x80 = float32, 0x81 = float16); ảnh chưa / không có embedding là [].
+# Dữ liệu cũ (mảng double BSON, chuỗi base64 float32) vẫn đọc được cho tới khi
+# được migrate; document đã chuyển có `embedding_format` = EMBEDDING_FORMAT.
+
+EMBEDDING_FORMAT = 1
+DTYPE_SUBTYPES = {"float32": 0x80, "float16": 0x81}
+SUBTYPE_DTYPES = {subtype: np.dtype(dtype).newbyteorder("<") for dtype, subtype in DTYPE_SUBTYPES.items()}
+
+
+def encode_embedding(vector: Any, dtype: str = "float16") -> Binary:
+    """Một embedding → BinData (dtype được ghi trong subtype)"""
+    array = np.asarray(vector, dtype=np.float32).reshape(-1)
+    return Binary(array.astype(SUBTYPE_DTYPES[DTYPE_SUBTYPES[dtype]]).tobytes(), DTYPE_SUBTYPES[dtype])
+
+
+def is_canonical(raw: Any) -> bool:
+    """Phần tử đã ở định dạng BinData (hoặc slot rỗng)"""
+    return (isinstance(raw, Binary) and raw.subtype in SUBTYPE_DTYPES) or (isinstance(raw, list) and not raw)
+
+
+def _decode_legacy(raw: Any) -> Optional[np.ndarray]:
+    """Mảng double BSON hoặc base64 float32 (định dạng cũ)"""
+    try:
+        if isinstance(raw, str) and raw:
+            return np.frombuffer(base64.b64decode(raw), dtype=np.float32)
+        if isinstance(raw, list) and raw:
+            return np.asarray(raw, dtype=np.float32)
+    except Exception as e:
+        print(f"Error decoding embedding: {e}")
+    return None
+
+
+def decode_embedding(raw: Any) -> Optional[np.ndarray]:
+    """Một phần tử face_embeddings → vector float32 (None nếu slot rỗng / lỗi)"""
+    if isinstance(raw, Binary) and raw.subtype in SUBTYPE_DTYPES:
+        if not raw:
+            return None
+        return np.frombuffer(raw, dtype=SUBTYPE_DTYPES[raw.subtype]).astype(np.float32)
+    return _decode_legacy(raw)
+
+
+def decode_gallery(raw_lists: List[List[Any]]) -> List[np.ndarray]:
+    """
+    face_embeddings của nhiều person → ma trận (n_i, d) float32 đã chuẩn hóa L2
+
+    BinData cùng dtype / kích thước của cả gallery được nối lại và decode bằng
+    một lần np.frombuffer; chỉ phần tử định dạng cũ mới decode từng vector.
+    Vector khác số chiều với vector đầu tiên của person bị bỏ qua.
+    """
+    # (subtype, số byte) -> (các BinData, person sở hữu)
+    groups: Dict[Tuple[int, int], Tuple[List[bytes], List[int]]] = {}
+    legacy: Dict[int, List[np.ndarray]] = {}
+    for owner, raw_list in enumerate(raw_lists):
+        for raw in raw_list or []:
+            if isinstance(raw, Binary) and raw.subtype in SUBTYPE_DTYPES:
+                if raw:
+                    parts, owners = groups.setdefault((raw.subtype, len(raw)), ([], []))
+                    parts.append(raw)
+                    owners.append(owner)
+            else:
+                vector = _decode_legacy(raw)
+                if vector is not None:
+                    legacy.setdefault(owner, []).append(vector)
+
+    blocks: List[List[np.ndarray]] = [[] for _ in raw_lists]
+    for (subtype, size), (parts, owners) in groups.items():
+        dtype = SUBTYPE_DTYPES[subtype]
+        matrix = np.frombuffer(b"".join(parts), dtype=dtype).reshape(len(parts), size // dtype.itemsize).astype(np.float32)
+        owners_array = np.asarray(owners)
+        order = np.argsort(owners_array, kind="stable")
+        counts = np.bincount(owners_array, minlength=len(raw_lists))
+        for owner, block in enumerate(np.split(matrix[order], np.cumsum(counts)[:-1])):
+            if len(block):
+                blocks[owner].append(block)
+    for owner, vectors in legacy.items():
+        blocks[owner].append(np.vstack([vector for vector in vectors if vector.shape == vectors[0].shape]))
+
+    result = []
+    for owner_blocks in blocks:
+        if owner_blocks:
+            owner_blocks = [block for block in owner_blocks if block.shape[1] == owner_blocks[0].shape[1]]
+        else:
+            result.append(np.zeros((0, 0), dtype=np.float32))
+            continue
+        matrix = np.ascontiguousarray(np.vstack(owner_blocks), dtype=np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        result.append(matrix)
+    return result
+
+
+def canonicalize(raw_list: List[Any], dtype: str = "float16") -> List[Any]:
+    """face_embeddings bất kỳ định dạng → định dạng hiện tại (giữ vị trí, slot lỗi → [])"""
+    canonical = []
+    for raw in raw_list or []:
+        if is_canonical(raw):
+            canonical.append(raw)
+        else:
+            vector = _decode_legacy(raw)
+            canonical.append(encode_embedding(vector, dtype) if vector is not None else [])
+    return canonical
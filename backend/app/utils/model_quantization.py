@@ -0,0 +1,275 @@
+import argparse
+import glob
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from ..config import get_settings
+from ..services.face_processor import FaceProcessorService, PRECISIONS, QUANTIZABLE_TASKS, quantized_model_path
+
+# Sinh và đánh giá biến thể INT8 của detector / recognizer (máy chỉ có CPU):
+#
+#   python -m app.utils.model_quantization quantize --mode static --calibration-dir data/calibration
+#   python -m app.utils.model_quantization compare --samples-dir data/samples
+#
+# Ảnh calibration là ảnh camera thật bất kỳ; bộ mẫu để so sánh có dạng
+# <samples-dir>/<tên người>/*.jpg. File sinh ra nằm trong quantized_model_dir
+# với tên {model}.int8_{mode}.onnx, được face_processor nạp theo model_precision.
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def _image_paths(directory: str, limit: Optional[int] = None) -> List[str]:
+    paths = sorted(
+        path for path in glob.glob(os.path.join(directory, "**", "*"), recursive=True)
+        if path.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    return paths[:limit] if limit else paths
+
+
+def _load_fp32() -> FaceProcessorService:
+    processor = FaceProcessorService(precision="fp32")
+    processor.load()
+    return processor
+
+
+def _best_face(face_app, img: np.ndarray) -> Tuple[Optional[np.ndarray], float]:
+    """Landmark của khuôn mặt có det_score cao nhất + thời gian detect (ms)"""
+    started = time.perf_counter()
+    bboxes, kpss = face_app.det_model.detect(img, max_num=0, metric='default')
+    elapsed = (time.perf_counter() - started) * 1000
+    if bboxes is None or len(bboxes) == 0 or kpss is None:
+        return None, elapsed
+    return kpss[int(np.argmax(bboxes[:, 4]))], elapsed
+
+
+def _detection_blobs(model, images: List[np.ndarray]) -> List[np.ndarray]:
+    """Input của detector như SCRFD.detect: letterbox về input_size, chuẩn hóa mean/std"""
+    width, height = model.input_size
+    blobs = []
+    for img in images:
+        ratio = min(width / img.shape[1], height / img.shape[0])
+        new_w, new_h = max(1, int(img.shape[1] * ratio)), max(1, int(img.shape[0] * ratio))
+        canvas = np.zeros((height, width, 3), dtype=np.uint8)
+        canvas[:new_h, :new_w] = cv2.resize(img, (new_w, new_h))
+        blobs.append(cv2.dnn.blobFromImage(
+            canvas, 1.0 / model.input_std, (width, height),
+            (model.input_mean, model.input_mean, model.input_mean), swapRB=True
+        ))
+    return blobs
+
+
+def _recognition_blobs(face_app, model, images: List[np.ndarray]) -> List[np.ndarray]:
+    """Input của recognizer như ArcFaceONNX.get_feat: khuôn mặt đã căn chỉnh bằng detector FP32"""
+    from insightface.utils import face_align
+
+    blobs = []
+    for img in images:
+        kps, _ = _best_face(face_app, img)
+        if kps is None:
+            continue
+        crop = face_align.norm_crop(img, landmark=kps, image_size=model.input_size[0])
+        blobs.append(cv2.dnn.blobFromImages(
+            [crop], 1.0 / model.input_std, model.input_size,
+            (model.input_mean, model.input_mean, model.input_mean), swapRB=True
+        ))
+    return blobs
+
+
+def quantize(mode: str, calibration_dir: Optional[str], output_dir: str, max_images: int, per_channel: bool) -> Dict[str, Any]:
+    """Lượng tử hóa detector + recognizer (dynamic: chỉ trọng số, static: cả activation theo calibration)"""
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    class _BlobReader(CalibrationDataReader):
+        def __init__(self, input_name: str, blobs: List[np.ndarray]):
+            self._feeds = iter([{input_name: blob} for blob in blobs])
+
+        def get_next(self):
+            return next(self._feeds, None)
+
+    if mode == "static" and not calibration_dir:
+        raise ValueError("Static quantization requires --calibration-dir")
+
+    face_app = _load_fp32().face_app
+    images = []
+    if mode == "static":
+        images = [img for img in (cv2.imread(path) for path in _image_paths(calibration_dir, max_images)) if img is not None]
+        if not images:
+            raise ValueError(f"No calibration images in {calibration_dir}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    report = {}
+    for taskname in QUANTIZABLE_TASKS:
+        model = face_app.models.get(taskname)
+        if model is None:
+            continue
+        output = quantized_model_path(model.model_file, f"int8_{mode}", output_dir)
+        source = _pre_process(model.model_file, output)
+        started = time.perf_counter()
+        try:
+            if mode == "dynamic":
+                quantize_dynamic(source, output, weight_type=QuantType.QInt8, per_channel=per_channel)
+                samples = 0
+            else:
+                blobs = _detection_blobs(model, images) if taskname == "detection" else _recognition_blobs(face_app, model, images)
+                if not blobs:
+                    report[taskname] = {"error": "No calibration samples (no faces detected)"}
+                    continue
+                quantize_static(
+                    source, output, _BlobReader(model.session.get_inputs()[0].name, blobs),
+                    quant_format=QuantFormat.QDQ, activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8, per_channel=per_channel
+                )
+                samples = len(blobs)
+        finally:
+            if source != model.model_file and os.path.exists(source):
+                os.remove(source)
+        report[taskname] = {
+            "source": model.model_file,
+            "output": output,
+            "calibration_samples": samples,
+            "fp32_mb": round(os.path.getsize(model.model_file) / 2**20, 2),
+            "int8_mb": round(os.path.getsize(output) / 2**20, 2),
+            "seconds": round(time.perf_counter() - started, 1)
+        }
+        print(f"✅ {taskname}: {output}")
+    return report
+
+
+def _pre_process(model_file: str, output: str) -> str:
+    """Shape inference + tối ưu graph trước khi lượng tử hóa (bỏ qua nếu lỗi)"""
+    prepared = output.replace(".onnx", ".prep.onnx")
+    try:
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+
+        quant_pre_process(model_file, prepared)
+        return prepared
+    except Exception as e:
+        print(f"⚠️ Pre-processing skipped for {os.path.basename(model_file)}: {e}")
+        return model_file
+
+
+def _latency(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    return {"mean_ms": round(float(np.mean(samples)), 2), "p50_ms": round(float(np.median(samples)), 2),
+            "p95_ms": round(float(np.percentile(samples, 95)), 2)}
+
+
+def _evaluate(processor: FaceProcessorService, samples: List[Tuple[str, str]]) -> Tuple[Dict[str, Any], List[Optional[np.ndarray]]]:
+    """Embedding từng ảnh mẫu + latency detect / recognize"""
+    from insightface.utils import face_align
+
+    face_app = processor.face_app
+    rec_model = face_app.models["recognition"]
+    embeddings: List[Optional[np.ndarray]] = []
+    det_ms, rec_ms = [], []
+    for path, _ in samples:
+        img = cv2.imread(path)
+        if img is None:
+            embeddings.append(None)
+            continue
+        kps, elapsed = _best_face(face_app, img)
+        det_ms.append(elapsed)
+        if kps is None:
+            embeddings.append(None)
+            continue
+        crop = face_align.norm_crop(img, landmark=kps, image_size=rec_model.input_size[0])
+        started = time.perf_counter()
+        embedding = rec_model.get_feat([crop])[0].astype(np.float32)
+        rec_ms.append((time.perf_counter() - started) * 1000)
+        embeddings.append(embedding / max(float(np.linalg.norm(embedding)), 1e-12))
+    return {"detection": _latency(det_ms), "recognition": _latency(rec_ms)}, embeddings
+
+
+def _accuracy(labels: List[str], embeddings: List[Optional[np.ndarray]], threshold: float) -> Dict[str, Any]:
+    """Tỉ lệ detect, rank-1 (leave-one-out) và TAR / FAR tại ngưỡng nhận dạng"""
+    kept = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+    result: Dict[str, Any] = {"detection_rate": round(len(kept) / max(1, len(labels)), 4)}
+    if len(kept) < 2:
+        return result
+    matrix = np.vstack([embeddings[i] for i in kept])
+    kept_labels = np.asarray([labels[i] for i in kept])
+    similarity = matrix @ matrix.T
+    np.fill_diagonal(similarity, -np.inf)
+
+    same = kept_labels[:, None] == kept_labels[None, :]
+    has_pair = same.sum(axis=1) > 1
+    nearest = np.argmax(similarity, axis=1)
+    if has_pair.any():
+        result["rank1_accuracy"] = round(float((kept_labels[nearest] == kept_labels)[has_pair].mean()), 4)
+
+    upper = np.triu(np.ones_like(same, dtype=bool), k=1)
+    genuine = similarity[same & upper]
+    impostor = similarity[~same & upper]
+    if len(genuine):
+        result["tar"] = round(float((genuine >= threshold).mean()), 4)
+    if len(impostor):
+        result["far"] = round(float((impostor >= threshold).mean()), 6)
+    return result
+
+
+def compare(samples_dir: str, precisions: List[str]) -> Dict[str, Any]:
+    """So sánh accuracy / latency các precision với FP32 trên bộ mẫu có nhãn"""
+    samples = [(path, os.path.basename(os.path.dirname(path))) for path in _image_paths(samples_dir)]
+    if not samples:
+        raise ValueError(f"No labeled samples in {samples_dir}")
+    labels = [label for _, label in samples]
+    threshold = get_settings().face_similarity_threshold
+
+    report: Dict[str, Any] = {"samples": len(samples), "identities": len(set(labels)), "threshold": threshold, "results": {}}
+    reference: Optional[List[Optional[np.ndarray]]] = None
+    for precision in ["fp32"] + [p for p in precisions if p != "fp32"]:
+        processor = FaceProcessorService(precision=precision)
+        processor.load()
+        if precision != "fp32" and not processor.model_variants:
+            report["results"][precision] = {"error": "No quantized variants found"}
+            processor.cleanup()
+            continue
+        latency, embeddings = _evaluate(processor, samples)
+        entry = {"variants": processor.model_variants, "latency": latency, **_accuracy(labels, embeddings, threshold)}
+        if reference is None:
+            reference = embeddings
+        else:
+            pairs = [(a, b) for a, b in zip(reference, embeddings) if a is not None and b is not None]
+            if pairs:
+                entry["cosine_vs_fp32"] = round(float(np.mean([float(a @ b) for a, b in pairs])), 4)
+        report["results"][precision] = entry
+        processor.cleanup()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lượng tử hóa INT8 model khuôn mặt và so sánh với FP32")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    quantize_parser = commands.add_parser("quantize")
+    quantize_parser.add_argument("--mode", choices=["dynamic", "static"], default="static")
+    quantize_parser.add_argument("--calibration-dir")
+    quantize_parser.add_argument("--output-dir", default=get_settings().quantized_model_dir)
+    quantize_parser.add_argument("--max-images", type=int, default=200)
+    quantize_parser.add_argument("--per-tensor", action="store_true", help="Lượng tử hóa per-tensor thay vì per-channel")
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("--samples-dir", required=True)
+    compare_parser.add_argument("--precisions", default="int8_dynamic,int8_static")
+    compare_parser.add_argument("--output", help="Ghi báo cáo JSON ra file")
+
+    args = parser.parse_args()
+    if args.command == "quantize":
+        report = quantize(args.mode, args.calibration_dir, args.output_dir, args.max_images, not args.per_tensor)
+    else:
+        precisions = [p.strip() for p in args.precisions.split(",") if p.strip() in PRECISIONS]
+        report = compare(args.samples_dir, precisions)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import base64
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from bson import ObjectId
+
+# Keyset (cursor) pagination trên cặp (sort_field, _id) giảm dần.
+# Cursor là token mờ (opaque) base64 chứa giá trị của bản ghi cuối trang trước,
+# truy vấn trang tiếp theo chỉ cần điều kiện "nhỏ hơn" trên index thay vì skip().
+
+
+def encode_cursor(value: datetime, doc_id: Any) -> str:
+    """Tạo continuation token từ (timestamp, _id) của bản ghi cuối trang"""
+    payload = json.dumps({"t": value.isoformat(), "id": str(doc_id)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> Tuple[datetime, ObjectId]:
+    """Giải mã continuation token, ValueError nếu token không hợp lệ"""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        return datetime.fromisoformat(payload["t"]), ObjectId(payload["id"])
+    except Exception:
+        raise ValueError("Invalid pagination cursor")
+
+
+def apply_cursor(query: Dict[str, Any], token: Optional[str], field: str = "timestamp") -> Dict[str, Any]:
+    """Thêm điều kiện keyset (field, _id) < cursor vào query"""
+    if not token:
+        return query
+    value, doc_id = decode_cursor(token)
+    keyset = {"$or": [
+        {field: {"$lt": value}},
+        {field: value, "_id": {"$lt": doc_id}},
+    ]}
+    query.setdefault("$and", []).append(keyset)
+    return query
+
+
+def keyset_sort(field: str = "timestamp") -> List[Tuple[str, int]]:
+    """Thứ tự sort ổn định dùng chung cho cả offset và cursor"""
+    return [(field, -1), ("_id", -1)]
+
+
+def split_page(docs: List[Dict[str, Any]], limit: int,
+               field: str = "timestamp") -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Tách trang từ kết quả truy vấn với limit + 1 bản ghi
+
+    Trả về (docs của trang, token trang tiếp theo hoặc None nếu đã hết dữ liệu).
+    """
+    if len(docs) <= limit:
+        return docs, None
+    page = docs[:limit]
+    last = page[-1]
+    if not isinstance(last.get(field), datetime):
+        return page, None
+    return page, encode_cursor(last[field], last["_id"])
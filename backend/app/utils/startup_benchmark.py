@@ -0,0 +1,90 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+# Đo thời gian khởi động: mỗi lần import chạy trong một process mới (không có
+# cache module), nạp model đo riêng vì đã được tách khỏi import.
+#
+#   python -m app.utils.startup_benchmark [--repeat 3] [--models] [--breakdown 15]
+
+MODULES = [
+    "app.config",
+    "app.services.face_processor",
+    "app.services.recognition_index",
+    "app.services.person_service",
+    "app.routers.person",
+    "app.main",
+]
+
+
+def _run(code: str, extra_args: List[str] = None) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *(extra_args or []), "-c", code],
+        capture_output=True, text=True, timeout=600
+    )
+
+
+def _last_line(text: str) -> str:
+    lines = [line for line in text.strip().splitlines() if line.strip()]
+    return lines[-1] if lines else ""
+
+
+def measure_import(module: str, repeat: int) -> Dict[str, Any]:
+    """Thời gian `import module` trong process mới (median của `repeat` lần)"""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    samples = []
+    for _ in range(repeat):
+        result = _run(code)
+        if result.returncode != 0:
+            return {"module": module, "error": _last_line(result.stderr)}
+        samples.append(float(_last_line(result.stdout)))
+    return {"module": module, "median_seconds": round(statistics.median(samples), 3), "max_seconds": round(max(samples), 3)}
+
+
+def measure_model_load() -> Dict[str, Any]:
+    """Thời gian nạp + prepare model InsightFace"""
+    code = (
+        "import time; from app.services.face_processor import face_processor; "
+        "t = time.perf_counter(); face_processor.load(); print(time.perf_counter() - t)"
+    )
+    result = _run(code)
+    if result.returncode != 0:
+        return {"error": _last_line(result.stderr)}
+    return {"load_seconds": round(float(_last_line(result.stdout)), 3)}
+
+
+def import_breakdown(module: str, top: int) -> List[Dict[str, Any]]:
+    """Các module import chậm nhất (python -X importtime, thời gian cộng dồn)"""
+    result = _run(f"import {module}", ["-X", "importtime"])
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = [part.strip() for part in line.split(":", 1)[1].split("|")]
+            rows.append({"module": name, "cumulative_ms": round(int(cumulative_us) / 1000, 1), "self_ms": round(int(self_us) / 1000, 1)})
+        except ValueError:
+            continue
+    return sorted(rows, key=lambda row: -row["cumulative_ms"])[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thời gian import và nạp model")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--models", action="store_true", help="Đo cả thời gian nạp model InsightFace")
+    parser.add_argument("--breakdown", type=int, default=0, help="Liệt kê N module import chậm nhất của app.main")
+    args = parser.parse_args()
+
+    report: Dict[str, Any] = {"imports": [measure_import(module, max(1, args.repeat)) for module in MODULES]}
+    if args.models:
+        report["models"] = measure_model_load()
+    if args.breakdown:
+        report["breakdown"] = import_breakdown("app.main", args.breakdown)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
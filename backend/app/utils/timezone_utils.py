@@ -8,6 +8,11 @@ from datetime import datetime, timezone, timedelta
 # Múi giờ Việt Nam (UTC+7)
 VIETNAM_TIMEZONE = timezone(timedelta(hours=7))
 
+# Múi giờ dùng khi nhóm timestamp trong MongoDB ($dateTrunc, $hour...).
+# Timestamp được lưu dạng naive theo giờ Việt Nam (xem get_vietnam_now), MongoDB
+# coi chúng là UTC, nên nhóm theo "+00:00" chính là nhóm theo ngày/giờ Việt Nam.
+DB_BUCKET_TIMEZONE = "+00:00"
+
 def get_vietnam_now() -> datetime:
     """
     Lấy thời gian hiện tại theo múi giờ Việt Nam
@@ -0,0 +1,66 @@
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from app.services.webhook_service import verify_signature
+
+# Receiver webhook cục bộ để thử dispatcher: kiểm tra chữ ký, in payload và có thể
+# giả lập endpoint chậm / lỗi để xem retry, hàng đợi đầy và dead-letter.
+#
+#   python -m app.utils.webhook_stub [--port 9000] [--secret S] [--status 503] [--delay 2]
+#
+# Rồi đặt webhook_url của user (PUT /settings/webhook) thành http://localhost:9000/hook
+
+
+def make_handler(secret: str, status: int, delay: float):
+    class WebhookStubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            timestamp = self.headers.get("X-SafeFace-Timestamp", "")
+            signature = self.headers.get("X-SafeFace-Signature")
+
+            if secret and not (signature and verify_signature(secret, timestamp, body, signature)):
+                print(f"❌ Invalid signature from {self.client_address[0]}")
+                self.send_response(401)
+                self.end_headers()
+                return
+
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                payload = None
+            count = payload.get("count", 1) if isinstance(payload, dict) else 0
+            print(f"📨 {payload.get('event') if isinstance(payload, dict) else 'invalid'} ({count} event) → {status}")
+
+            if delay:
+                time.sleep(delay)
+            self.send_response(status)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return WebhookStubHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook receiver cục bộ để thử dispatcher")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--secret", default="", help="Secret để kiểm tra X-SafeFace-Signature (bỏ trống: không kiểm tra)")
+    parser.add_argument("--status", type=int, default=200, help="Status trả về, vd 503 để thử retry / dead-letter")
+    parser.add_argument("--delay", type=float, default=0, help="Số giây chờ trước khi trả lời (endpoint chậm)")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(args.secret, args.status, args.delay))
+    print(f"🔗 Webhook stub listening on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -140,12 +140,20 @@ const VideoStream: React.FC<CameraStreamProps> = ({
     const userId = localStorage.getItem('user_id') || 
                    localStorage.getItem('userId') ||
                    sessionStorage.getItem('user_id');
-    return userId;
+    if (userId) return userId;
+
+    const storedUser = localStorage.getItem('user');
+    if (!storedUser) return null;
+    try {
+      return JSON.parse(storedUser)?.id ?? null;
+    } catch {
+      return null;
+    }
   };
 
   const { isConnected, lastMessage, sendMessage } = useWebSocket(
-    camera.is_streaming ? 
-      `${process.env.REACT_APP_WS_URL || 'ws://localhost:8000'}/ws/${getCurrentUserId()}` 
+    camera.is_streaming && getCurrentUserId() ? 
+      `${process.env.REACT_APP_WS_URL || 'ws://localhost:8000'}/api/ws/${getCurrentUserId()}` 
       : null,
     {
       shouldReconnect: true,
@@ -48,13 +48,19 @@ export const WebSocketProvider: React.FC<WebSocketProviderProps> = ({ children }
       return;
     }
 
+    const token = localStorage.getItem('access_token');
+    if (!token) {
+      console.log('❌ WebSocket: Missing access token');
+      return;
+    }
+
     try {
       const wsUrl = `ws://localhost:8000/api/ws/${user.id}`;
       console.log('🔗 WebSocket: Connecting to:', wsUrl);
       
       setConnectionState('connecting'); // ✅ ADD this
       
-      const newSocket = new WebSocket(wsUrl);
+      const newSocket = new WebSocket(`${wsUrl}?token=${encodeURIComponent(token)}`);
 
       newSocket.onopen = () => {
         console.log('✅ WebSocket: Connected successfully');
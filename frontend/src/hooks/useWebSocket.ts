@@ -54,8 +54,8 @@ export const useWebSocket = (
       setConnectionState('connecting');
       
       // Add authentication token to WebSocket URL if available
-      const token = localStorage.getItem('token');
-      const wsUrl = token ? `${url}?token=${token}` : url;
+      const token = localStorage.getItem('access_token');
+      const wsUrl = token ? `${url}?token=${encodeURIComponent(token)}` : url;
       
       const ws = new WebSocket(wsUrl);
       websocketRef.current = ws;